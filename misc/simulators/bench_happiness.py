@@ -0,0 +1,85 @@
+#! /usr/bin/python
+
+"""
+Measure how long it takes to compute servers-of-happiness for the share
+layouts that an immutable upload sees while it places shares.
+
+python bench_happiness.py [NUMSERVERS..]
+
+For each grid size and each number of shares N (10 to 255), the layout puts
+every share on one to three random servers, except that a few servers hold
+many shares each (as when an earlier upload of the same file only found a
+few servers). This prints the time for:
+
+ scratch:     servers_of_happiness() of the whole layout, as the encoder and
+              server selector used to do after every change
+ incremental: moving one share placement to another server in a
+              HappinessMatcher and reading the new value, as
+              Tahoe2ServerSelector now does
+"""
+
+import sys, random
+from pyutil import benchutil
+
+from allmydata.util.happinessutil import servers_of_happiness, \
+                                         HappinessMatcher
+
+class B(object):
+    def __init__(self, numservers, numshares):
+        self.numservers = numservers
+        self.numshares = numshares
+        self.random = random.Random(778)
+
+    def _make_layout(self):
+        servers = ["server%d" % i for i in range(self.numservers)]
+        busy = servers[:3]
+        layout = {}
+        for shnum in range(self.numshares):
+            holders = set(self.random.sample(servers,
+                                             self.random.randint(1, 3)))
+            if self.random.random() < 0.25:
+                holders.add(self.random.choice(busy))
+            layout[shnum] = holders
+        return layout
+
+    def init(self, N):
+        self.layouts = [self._make_layout() for i in range(N)]
+        self.matcher = HappinessMatcher(self.layouts[0])
+        self.placements = [(shnum, serverid)
+                           for (shnum, serverids) in self.layouts[0].items()
+                           for serverid in serverids]
+        self.moves = [(self.random.randrange(len(self.placements)),
+                       "server%d" % self.random.randrange(self.numservers))
+                      for i in range(N)]
+
+    def scratch(self, N):
+        for layout in self.layouts:
+            servers_of_happiness(layout)
+
+    def incremental(self, N):
+        m = self.matcher
+        placements = self.placements
+        for (i, serverid) in self.moves:
+            (shnum, old_serverid) = placements[i]
+            m.remove(shnum, old_serverid)
+            m.add(shnum, serverid)
+            placements[i] = (shnum, serverid)
+            m.get_happiness()
+
+if len(sys.argv) > 1:
+    sizes = [int(arg) for arg in sys.argv[1:]]
+else:
+    sizes = [100, 300, 1000]
+
+benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+print "(microseconds)"
+
+N = 100
+for numservers in sizes:
+    for numshares in [10, 50, 100, 255]:
+        b = B(numservers, numshares)
+        for name in ["scratch", "incremental"]:
+            print "%5d servers %3d shares %-11s" % (numservers, numshares,
+                                                    name),
+            benchutil.rep_bench(getattr(b, name), N, initfunc=b.init,
+                                UNITS_PER_SECOND=1000000)
@@ -0,0 +1,82 @@
+#! /usr/bin/python
+
+"""
+Measure how long StorageFarmBroker takes to permute the list of connected
+servers, as every upload, download, servermap update and check does.
+
+python bench_permute.py [NUMSERVERS..]
+
+For each grid size, this prints the time per storage index for:
+
+ uncached: sorting every server by its permutation hash, as the broker did
+           before it remembered permutations
+ first:    get_servers_for_psi() for a storage index it has not seen yet
+ repeat:   get_servers_for_psi() for the storage index it saw last (a
+           servermap update followed by a publish, for example)
+ lazy10:   the first 10 servers from iter_servers_for_psi(), for a storage
+           index it has not seen yet (a download that finds its shares on
+           the first few servers)
+"""
+
+import sys
+from itertools import count
+from pyutil import benchutil
+
+from allmydata.storage_client import StorageFarmBroker
+from allmydata.util import base32
+from allmydata.util.hashutil import tagged_hash, sha1
+
+class B(object):
+    def __init__(self, numservers):
+        self.numservers = numservers
+        self.sb = StorageFarmBroker(None, True)
+        for i in range(numservers):
+            serverid = tagged_hash("bench_permute", "%d" % i)[:20]
+            ann = {"anonymous-storage-FURL": "pb://%s@nowhere/fake"
+                   % base32.b2a(serverid),
+                   "permutation-seed-base32": base32.b2a(serverid)}
+            self.sb.test_add_rref(serverid, "rref", ann)
+        self.counter = count()
+
+    def init(self, N):
+        self.sis = [tagged_hash("si", "%d" % self.counter.next())[:16]
+                    for i in range(N)]
+
+    def uncached(self, N):
+        servers = self.sb.get_connected_servers()
+        for si in self.sis:
+            def _permuted(server):
+                seed = server.get_permutation_seed()
+                return sha1(si + seed).digest()
+            sorted(servers, key=_permuted)
+
+    def first(self, N):
+        for si in self.sis:
+            self.sb.get_servers_for_psi(si)
+
+    def repeat(self, N):
+        si = self.sis[0]
+        for i in xrange(N):
+            self.sb.get_servers_for_psi(si)
+
+    def lazy10(self, N):
+        for si in self.sis:
+            it = self.sb.iter_servers_for_psi(si)
+            for i in range(min(10, self.numservers)):
+                it.next()
+
+if len(sys.argv) > 1:
+    sizes = [int(arg) for arg in sys.argv[1:]]
+else:
+    sizes = [10, 100, 300, 1000]
+
+benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+print "(microseconds)"
+
+N = 1000
+for numservers in sizes:
+    b = B(numservers)
+    for name in ["uncached", "first", "repeat", "lazy10"]:
+        print "%5d servers %-8s" % (numservers, name),
+        benchutil.rep_bench(getattr(b, name), N, initfunc=b.init,
+                            UNITS_PER_SECOND=1000000)
@@ -9,6 +9,11 @@ from pycryptopp.publickey import rsa
 
 import allmydata
 from allmydata.storage.server import StorageServer
+from allmydata.storage.filecache import DEFAULT_MAX_OPEN_FILES
+from allmydata.storage.backend import get_backend
+from allmydata.storage.scheduler import DEFAULT_MAX_QUEUED_PER_CLIENT, \
+     parse_weights
+from allmydata.storage.advisories import DEFAULT_MAX_REPORTS_PER_CLIENT
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
 from allmydata.immutable.offloaded import Helper
@@ -292,6 +297,46 @@ class Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        share_index = self.get_config("storage", "share_index.enabled", False,
+                                      boolean=True)
+        open_file_cache_size = int(self.get_config("storage",
+                                                   "open_file_cache.size",
+                                                   DEFAULT_MAX_OPEN_FILES))
+        leasedb = self.get_config("storage", "leasedb.enabled", False,
+                                  boolean=True)
+        incremental = self.get_config("storage", "expire.incremental", False,
+                                      boolean=True)
+        prefetch_threads = int(self.get_config("storage",
+                                               "crawler.prefetch_threads", 0))
+        io_percentage = int(self.get_config("storage",
+                                            "crawler.io_percentage", 50))
+        if not 1 <= io_percentage <= 100:
+            raise ValueError("[storage]crawler.io_percentage= must be from 1"
+                             " to 100, not %d" % io_percentage)
+        disk_io_threads = int(self.get_config("storage", "disk_io_threads",
+                                              0))
+        write_buffer_size = parse_abbreviated_size(
+            self.get_config("storage", "write_buffer.size", "1MiB"))
+        write_buffer_total = parse_abbreviated_size(
+            self.get_config("storage", "write_buffer.total", "64MiB"))
+        fsync_shares = self.get_config("storage", "fsync_shares", False,
+                                       boolean=True)
+        packed_share_max_size = parse_abbreviated_size(
+            self.get_config("storage", "packed_shares.max_size", "0"))
+        backend = get_backend(self.get_config("storage", "backend", "disk"))
+        mutable_container_version = int(self.get_config(
+            "storage", "mutable_container.version", 1))
+        max_outstanding_requests = int(self.get_config(
+            "storage", "scheduler.max_outstanding", 0))
+        max_queued_requests_per_client = int(self.get_config(
+            "storage", "scheduler.max_queued_per_client",
+            DEFAULT_MAX_QUEUED_PER_CLIENT))
+        request_weights = parse_weights(self.get_config(
+            "storage", "scheduler.weights", ""))
+        max_advisories_per_client = int(self.get_config(
+            "storage", "corruption_advisories.max_per_client",
+            DEFAULT_MAX_REPORTS_PER_CLIENT))
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -301,7 +346,24 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           expiration_incremental=incremental,
+                           share_index_enabled=share_index,
+                           open_file_cache_size=open_file_cache_size,
+                           leasedb_enabled=leasedb,
+                           crawler_prefetch_threads=prefetch_threads,
+                           crawler_io_percentage=io_percentage,
+                           disk_io_threads=disk_io_threads,
+                           write_buffer_size=write_buffer_size,
+                           write_buffer_total=write_buffer_total,
+                           fsync_shares=fsync_shares,
+                           packed_share_max_size=packed_share_max_size,
+                           backend=backend,
+                           mutable_container_version=mutable_container_version,
+                           max_outstanding_requests=max_outstanding_requests,
+                           max_queued_requests_per_client=max_queued_requests_per_client,
+                           request_weights=request_weights,
+                           max_advisories_per_client=max_advisories_per_client)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -331,8 +393,11 @@ class Client(node.Node, pollmixin.PollMixin):
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
+        parallel = int(self.get_config("client", "upload.parallel_queries", 0))
+        encoding_processes = int(self.get_config("client",
+                                                 "encoding.processes", 0))
         self.add_service(Uploader(helper_furl, self.stats_provider,
-                                  self.history))
+                                  self.history, parallel, encoding_processes))
         self.init_blacklist()
         self.init_nodemaker()
 
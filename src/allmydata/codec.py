@@ -1,8 +1,10 @@
 # -*- test-case-name: allmydata.test.test_encode_share -*-
 
+import time
 from zope.interface import implements
-from twisted.internet import defer
-from allmydata.util import mathutil
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+from allmydata.util import mathutil, hashutil
 from allmydata.util.assertutil import precondition
 from allmydata.interfaces import ICodecEncoder, ICodecDecoder
 import zfec
@@ -34,16 +36,124 @@ class CRSEncoder(object):
         return self.share_size
 
     def encode(self, inshares, desired_share_ids=None):
-        precondition(desired_share_ids is None or len(desired_share_ids) <= self.max_shares, desired_share_ids, self.max_shares)
+        return defer.succeed(self._encode(inshares, desired_share_ids))
 
-        if desired_share_ids is None:
-            desired_share_ids = range(self.max_shares)
+    def encode_and_hash(self, inshares):
+        """Encode all shares, like encode(), and also hash each block that
+        it produces. The Deferred fires with (shares, shareids,
+        block_hashes, elapsed), where 'elapsed' is the time spent encoding
+        and hashing."""
+        return defer.succeed(self._encode_and_hash(inshares))
 
+    def _check_inshares(self, inshares, desired_share_ids):
+        precondition(desired_share_ids is None or len(desired_share_ids) <= self.max_shares, desired_share_ids, self.max_shares)
         for inshare in inshares:
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
+
+    def _encode(self, inshares, desired_share_ids):
+        self._check_inshares(inshares, desired_share_ids)
+        if desired_share_ids is None:
+            desired_share_ids = range(self.max_shares)
         shares = self.encoder.encode(inshares, desired_share_ids)
 
-        return defer.succeed((shares, desired_share_ids))
+        return (shares, desired_share_ids)
+
+    def _encode_and_hash(self, inshares):
+        start = time.time()
+        (shares, shareids) = self._encode(inshares, None)
+        block_hashes = [hashutil.block_hash(block) for block in shares]
+        return (shares, shareids, block_hashes, time.time() - start)
+
+# zfec encoders, by (required_shares, max_shares), for encode(). Each
+# EncodingPool worker process has its own.
+_encoders = {}
+
+def encode(required_shares, max_shares, inshares, desired_share_ids=None):
+    """Erasure-code one segment's worth of input shares. Returns (shares,
+    shareids). This only takes and returns plain data, so an EncodingPool
+    worker process can run it."""
+    if desired_share_ids is None:
+        desired_share_ids = range(max_shares)
+    encoder = _encoders.get((required_shares, max_shares))
+    if encoder is None:
+        encoder = zfec.Encoder(required_shares, max_shares)
+        _encoders[(required_shares, max_shares)] = encoder
+    shares = encoder.encode(inshares, desired_share_ids)
+    return (shares, desired_share_ids)
+
+def encode_and_hash(required_shares, max_shares, inshares):
+    """Like encode(), but also hash each block. Returns (shares, shareids,
+    block_hashes, elapsed). The time is measured here, so that it does not
+    include any time spent waiting for a worker."""
+    start = time.time()
+    (shares, shareids) = encode(required_shares, max_shares, inshares)
+    block_hashes = [hashutil.block_hash(block) for block in shares]
+    return (shares, shareids, block_hashes, time.time() - start)
+
+class PooledCRSEncoder(CRSEncoder):
+    """I am a CRSEncoder that does the encoding (and hashing) in the worker
+    processes of an EncodingPool, so that the reactor can keep sending
+    earlier segments while I work, and several segments (of one upload or
+    of several) can be encoded on several cores at once."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def encode(self, inshares, desired_share_ids=None):
+        self._check_inshares(inshares, desired_share_ids)
+        return self._pool.run(encode, self.required_shares, self.max_shares,
+                              inshares, desired_share_ids)
+
+    def encode_and_hash(self, inshares):
+        self._check_inshares(inshares, None)
+        return self._pool.run(encode_and_hash, self.required_shares,
+                              self.max_shares, inshares)
+
+class EncodingPool:
+    """I am a bounded pool of worker processes for PooledCRSEncoders, shared
+    by all of the uploads that one node runs. zfec holds the GIL while it
+    encodes, so encoding in threads would neither use more than one core
+    nor let the reactor run. Instead, each job is handed to a
+    multiprocessing worker by one of my dispatch threads, which waits for
+    the answer without holding the GIL. The functions that I run must be
+    module-level, and their arguments and results are copied to and from
+    the worker, so they must only be plain data.
+
+    An immutable upload that uses me keeps up to 'segments_in_flight'
+    segments read, being encoded, or encoded and waiting to be sent. By
+    default that is one more than the number of workers, which lets one
+    upload keep every worker busy while it sends the oldest segment.
+    """
+
+    def __init__(self, num_workers, segments_in_flight=None,
+                 name="encoding"):
+        assert num_workers > 0, num_workers
+        if segments_in_flight is None:
+            segments_in_flight = num_workers + 1
+        assert segments_in_flight > 0, segments_in_flight
+        self.num_workers = num_workers
+        self.segments_in_flight = segments_in_flight
+        self.pool = threadpool.ThreadPool(0, num_workers, name)
+        self.workers = None
+        self.started = False
+
+    def run(self, f, *args):
+        if not self.started:
+            # the workers are forked when they are first needed
+            import multiprocessing
+            self.workers = multiprocessing.Pool(self.num_workers)
+            self.pool.start()
+            self.started = True
+        return threads.deferToThreadPool(reactor, self.pool,
+                                         self.workers.apply, f, args)
+
+    def stop(self):
+        if self.started:
+            self.pool.stop()
+            self.workers.close()
+            self.workers.join()
+            self.workers = None
+            self.started = False
 
 class CRSDecoder(object):
     implements(ICodecDecoder)
@@ -83,6 +83,15 @@ class ControlServer(Referenceable, service.Service):
         st = SpeedTest(self.parent, count, size, mutable)
         return st.run()
 
+    def remote_speed_test_rates(self, count, size, mutable):
+        assert size > 8
+        log.msg("speed_test_rates: count=%d, size=%d, mutable=%s" %
+                (count, size, mutable))
+        st = SpeedTest(self.parent, count, size, mutable)
+        d = st.run()
+        d.addCallback(lambda res: st.get_rates())
+        return d
+
     def remote_get_memory_usage(self):
         return get_memory_usage()
 
@@ -129,6 +138,7 @@ class SpeedTest:
         self.size = size
         self.mutable_mode = mutable
         self.uris = {}
+        self.encoding_time = 0.0
         self.basedir = os.path.join(self.parent.basedir, "_speed_test_data")
 
     def run(self):
@@ -139,6 +149,25 @@ class SpeedTest:
         d.addCallback(lambda res: (self.upload_time, self.download_time))
         return d
 
+    def get_rates(self):
+        """Return the times (in seconds) and throughputs (in bytes per
+        second) of the last run. The encoding numbers only cover immutable
+        uploads: they add up the time each upload spent erasure-coding and
+        hashing, which may overlap with sending when the node has an
+        encoding pool."""
+        total_size = self.count * self.size
+        times = {"upload": self.upload_time,
+                 "download": self.download_time}
+        if not self.mutable_mode:
+            times["encoding"] = self.encoding_time
+        rates = {}
+        for (name, elapsed) in times.items():
+            rates["%s_time" % name] = elapsed
+            if elapsed > 0:
+                rates["%s_rate" % name] = total_size / elapsed
+        log.msg("speed_test rates: %s" % (rates,))
+        return rates
+
     def create_data(self):
         fileutil.make_dirs(self.basedir)
         for i in range(self.count):
@@ -171,6 +200,10 @@ class SpeedTest:
 
         def _record_uri(uri, i):
             self.uris[i] = uri
+        def _record_results(results):
+            timings = results.get_timings()
+            self.encoding_time += timings.get("cumulative_encoding", 0.0)
+            return results.get_uri()
         def _upload_one_file(ignored, i):
             if i >= self.count:
                 return
@@ -186,7 +219,7 @@ class SpeedTest:
             else:
                 up = upload.FileName(fn, convergence=None)
                 d1 = self.parent.upload(up)
-                d1.addCallback(lambda results: results.get_uri())
+                d1.addCallback(_record_results)
             d1.addCallback(_record_uri, i)
             d1.addCallback(_upload_one_file, i+1)
             return d1
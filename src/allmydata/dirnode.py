@@ -3,6 +3,7 @@ import time, math, unicodedata
 
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python import failure
 from foolscap.api import fireEventually
 import simplejson
 from allmydata.mutable.common import NotWriteableError
@@ -926,6 +927,14 @@ class ManifestWalker(DeepStats):
 
 
 class DeepChecker:
+    # When we are only checking (not repairing), we don't wait for one check
+    # to finish before starting the next: up to this many run at once. The
+    # get_buckets queries that concurrent checks send to the same server are
+    # coalesced into batched queries (see storage_client.get_buckets), so a
+    # deep-check of many files costs a few round trips per server instead of
+    # one per file. Repairs are still done one at a time.
+    MAX_CONCURRENT_CHECKS = 10
+
     def __init__(self, root, verify, repair, add_lease):
         root_si = root.get_storage_index()
         if root_si:
@@ -943,12 +952,25 @@ class DeepChecker:
         else:
             self._results = DeepCheckResults(root_si)
         self._stats = DeepStats(root)
+        self._limiter = defer.DeferredSemaphore(self.MAX_CONCURRENT_CHECKS)
+        self._checks_running = 0
+        self._check_failure = None
+        self._idle_waiters = []
 
     def set_monitor(self, monitor):
         self.monitor = monitor
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        if self._repair:
+            return self._check_node(node, childpath)
+        # the Deferred we return fires when the check has been started,
+        # which lets the traversal move on to the next node
+        d = self._limiter.acquire()
+        d.addCallback(lambda ignored: self._start_check(node, childpath))
+        return d
+
+    def _check_node(self, node, childpath):
         if self._repair:
             d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
             d.addCallback(self._results.add_check_and_repair, childpath)
@@ -958,10 +980,43 @@ class DeepChecker:
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
         return d
 
+    def _start_check(self, node, childpath):
+        if self._check_failure:
+            # an earlier check failed: stop the traversal
+            self._limiter.release()
+            return self._check_failure
+        self._checks_running += 1
+        d = self._check_node(node, childpath)
+        d.addBoth(self._check_finished)
+
+    def _check_finished(self, res):
+        self._checks_running -= 1
+        self._limiter.release()
+        if isinstance(res, failure.Failure) and not self._check_failure:
+            self._check_failure = res
+        if not self._checks_running:
+            waiters, self._idle_waiters = self._idle_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def _when_idle(self):
+        if not self._checks_running:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idle_waiters.append(d)
+        return d
+
     def enter_directory(self, parent, children):
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
+        d = self._when_idle()
+        d.addCallback(lambda ignored: self._finish())
+        return d
+
+    def _finish(self):
+        if self._check_failure:
+            return self._check_failure
         log.msg("deep-check done", parent=self._lp)
         self._results.update_stats(self._stats.get_results())
         return self._results
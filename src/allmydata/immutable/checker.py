@@ -5,6 +5,7 @@ from allmydata import hashtree, codec, uri
 from allmydata.interfaces import IValidatedThingProxy, IVerifierURI
 from allmydata.hashtree import IncompleteHashTree
 from allmydata.check_results import CheckResults
+from allmydata.storage_client import get_buckets
 from allmydata.uri import CHKFileVerifierURI
 from allmydata.util.assertutil import precondition
 from allmydata.util import base32, deferredutil, dictutil, log, mathutil
@@ -504,7 +505,7 @@ class Checker(log.PrefixingLogMixin):
                                  renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+        d = get_buckets(s, storageindex)
         def _wrap_results(res):
             return (res, True)
 
@@ -27,10 +27,11 @@ class SegmentFetcher:
         self.segnum = segnum
         self._k = k
         self._shares = [] # unused Share instances, sorted by "goodness"
-                          # (RTT), then shnum. This is populated when DYHB
-                          # responses arrive, or (for later segments) at
-                          # startup. We remove shares from it when we call
-                          # sh.get_block() on them.
+                          # (expected delay), then shnum, before each use.
+                          # This is populated when DYHB responses arrive,
+                          # or (for later segments) at startup. We remove
+                          # shares from it when we call sh.get_block() on
+                          # them.
         self._shares_from_server = DictOfSets() # maps server to set of
                                                 # Shares on that server for
                                                 # which we have outstanding
@@ -67,7 +68,6 @@ class SegmentFetcher:
         # segment fetch is started and we already know about shares from the
         # previous segment
         self._shares.extend(shares)
-        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
         eventually(self.loop)
 
     def no_more_shares(self):
@@ -188,6 +188,9 @@ class SegmentFetcher:
     def _find_and_use_share(self):
         sent_something = False
         want_more_diversity = False
+        # prefer the servers that have been fastest, and are least busy,
+        # across all downloads. This changes as our requests go out.
+        self._shares.sort(key=lambda s: (s.get_expected_delay(), s._shnum))
         for sh in self._shares: # find one good share to fetch
             shnum = sh._shnum ; server = sh._server # XXX
             if shnum in self._blocks:
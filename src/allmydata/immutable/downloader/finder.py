@@ -3,6 +3,7 @@ import time
 now = time.time
 from foolscap.api import eventually
 from allmydata.util import base32, log
+from allmydata.storage_client import get_buckets
 from twisted.internet import reactor
 
 from share import Share, CommonShare
@@ -62,8 +63,9 @@ class ShareFinder:
         # test_dirnode, which creates us with storage_broker=None
         if not self._started:
             si = self.verifycap.storage_index
-            servers = self._storage_broker.get_servers_for_psi(si)
-            self._servers = iter(servers)
+            # we usually find enough shares on the first few servers, so
+            # don't permute the rest until we need them
+            self._servers = self._storage_broker.iter_servers_for_psi(si)
             self._started = True
 
     def log(self, *args, **kwargs):
@@ -139,7 +141,9 @@ class ShareFinder:
         # TODO: get the timer from a Server object, it knows best
         self.overdue_timers[req] = reactor.callLater(self.OVERDUE_TIMEOUT,
                                                      self.overdue, req)
-        d = server.get_rref().callRemote("get_buckets", self._storage_index)
+        d = get_buckets(server, self._storage_index)
+        perf = self._storage_broker.get_server_performance(server)
+        perf.track(d, time_sent)
         d.addBoth(incidentally, self._request_retired, req)
         d.addCallbacks(self._got_response, self._got_error,
                        callbackArgs=(server, req, d_ev, time_sent, lp),
@@ -203,8 +207,9 @@ class ShareFinder:
             #  2: break _get_satisfaction into Deferred-attached pieces.
             #     Yuck.
             self._commonshares[shnum] = cs
+        perf = self._storage_broker.get_server_performance(server)
         s = Share(bucket, server, self.verifycap, cs, self.node,
-                  self._download_status, shnum, dyhb_rtt,
+                  self._download_status, shnum, dyhb_rtt, perf,
                   self._node_logparent)
         return s
 
@@ -238,6 +238,19 @@ class DownloadNode:
             fetcher.add_shares(active_shares) # this triggers the loop
 
 
+    def prefetch(self, segnums):
+        """Tell the servers of the shares we have been reading from that we
+        will want these segments soon. This is only a hint, and does nothing
+        until we know the real segment size."""
+        if self.num_segments is None:
+            return
+        segnums = [segnum for segnum in segnums
+                   if 0 <= segnum < self.num_segments]
+        if not segnums:
+            return
+        for share in self._shares:
+            share.prefetch(segnums)
+
     # called by our child ShareFinder
     def got_shares(self, shares):
         self._shares.update(shares)
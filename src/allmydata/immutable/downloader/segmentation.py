@@ -17,8 +17,14 @@ class Segmentation:
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
     request one segment at a time.
+
+    Once the segment size is known, each time I ask for a segment I also
+    tell the node which segments I will want after it (up to
+    PREFETCH_SEGMENTS of them), so the storage servers can read their blocks
+    from disk while the earlier ones are on the network.
     """
     implements(IPushProducer)
+    PREFETCH_SEGMENTS = 2
     def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
         self._node = node
         self._hungry = True
@@ -33,6 +39,8 @@ class Segmentation:
         self._read_ev = read_ev
         self._start_pause = None
         self._lp = logparent
+        # we have told the servers about the segments up to this one
+        self._prefetched_through = None
 
     def start(self):
         self._alive = True
@@ -78,6 +86,8 @@ class Segmentation:
         self._active_segnum = wanted_segnum
         d,c = n.get_segment(wanted_segnum, self._lp)
         self._cancel_segment_request = c
+        if have_actual_segment_size:
+            self._prefetch(wanted_segnum, segment_size)
         d.addBoth(self._request_retired)
         d.addCallback(self._got_segment, wanted_segnum)
         if not have_actual_segment_size:
@@ -85,6 +95,17 @@ class Segmentation:
             d.addErrback(self._retry_bad_segment)
         d.addErrback(self._error)
 
+    def _prefetch(self, wanted_segnum, segment_size):
+        last_segnum = (self._offset + self._size - 1) // segment_size
+        first = wanted_segnum + 1
+        if self._prefetched_through is not None:
+            first = max(first, self._prefetched_through + 1)
+        last = min(wanted_segnum + self.PREFETCH_SEGMENTS, last_segnum)
+        if first > last:
+            return
+        self._prefetched_through = last
+        self._node.prefetch(range(first, last+1))
+
     def _request_retired(self, res):
         self._active_segnum = None
         self._cancel_segment_request = None
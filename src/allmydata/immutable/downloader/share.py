@@ -12,6 +12,8 @@ from allmydata.hashtree import IncompleteHashTree, BadHashError, \
      NotEnoughHashesError
 
 from allmydata.immutable.layout import make_write_bucket_proxy
+from allmydata.storage_client import get_storage_v1_version, \
+     get_max_immutable_readv_size
 from allmydata.util.observer import EventStreamObserver
 from common import COMPLETE, CORRUPT, DEAD, BADSEGNUM
 
@@ -33,7 +35,7 @@ class Share:
     # servers. A different backend would use a different class.
 
     def __init__(self, rref, server, verifycap, commonshare, node,
-                 download_status, shnum, dyhb_rtt, logparent):
+                 download_status, shnum, dyhb_rtt, performance, logparent):
         self._rref = rref
         self._server = server
         self._node = node # holds share_hash_tree and UEB
@@ -50,6 +52,7 @@ class Share:
         self._si_prefix = base32.b2a(verifycap.storage_index)[:8]
         self._shnum = shnum
         self._dyhb_rtt = dyhb_rtt
+        self._performance = performance # the ServerPerformance of _server
         # self._alive becomes False upon fatal corruption or server error
         self._alive = True
         self._loop_scheduled = False
@@ -81,9 +84,8 @@ class Share:
         # download can re-fetch it.
 
         self._requested_blocks = [] # (segnum, set(observer2..))
-        v = server.get_version()
-        ver = v["http://allmydata.org/tahoe/protocols/storage/v1"]
-        self._overrun_ok = ver["tolerates-immutable-read-overrun"]
+        ver = get_storage_v1_version(server.get_version())
+        self._overrun_ok = ver.get("tolerates-immutable-read-overrun", False)
         # If _overrun_ok and we guess the offsets correctly, we can get
         # everything in one RTT. If _overrun_ok and we guess wrong, we might
         # need two RTT (but we could get lucky and do it in one). If overrun
@@ -96,6 +98,12 @@ class Share:
     def __repr__(self):
         return "Share(sh%d-on-%s)" % (self._shnum, self._server.get_name())
 
+    def get_expected_delay(self):
+        """Guess how long my server would take to send me a block now,
+        given how it has been doing for all of our downloads."""
+        return self._performance.expected_delay(self._node.block_size or 0,
+                                                self._dyhb_rtt)
+
     def is_alive(self):
         # XXX: reconsider. If the share sees a single error, should it remain
         # dead for all time? Or should the next segment try again? This DEAD
@@ -731,6 +739,7 @@ class Share:
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
+        requests = []
         for (start, length) in ask:
             # TODO: quantize to reasonably-large blocks
             self._pending.add(start, length)
@@ -741,7 +750,18 @@ class Share:
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
+            requests.append( (start, length, block_ev, lp) )
+
+        # servers that offer readv() get all the spans of this pass in a
+        # single message, rather than one message per span
+        max_readv = get_max_immutable_readv_size(self._server)
+        if max_readv > 1 and len(requests) > 1:
+            for i in range(0, len(requests), max_readv):
+                self._send_readv(requests[i:i+max_readv])
+            return
+        for (start, length, block_ev, lp) in requests:
             d = self._send_request(start, length)
+            self._performance.track(d)
             d.addCallback(self._got_data, start, length, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
             d.addCallback(self._trigger_loop)
@@ -750,9 +770,57 @@ class Share:
                                  failure=f, parent=self._lp,
                                  level=log.WEIRD, umid="qZu0wg"))
 
+    # called by the DownloadNode, to read ahead
+    def prefetch(self, segnums):
+        """Advise the server that the blocks of these segments will be
+        wanted soon, so it can read them from its disk while we are busy
+        with earlier ones. I can only do this once I have learned the layout
+        of my share, which means that the download has been using me."""
+        node = self._node
+        if (not self._alive or self.actual_offsets is None
+            or node.block_size is None or not self._server_can_prefetch()):
+            return
+        datastart = self.actual_offsets["data"]
+        ranges = []
+        for segnum in segnums:
+            blocklen = node.block_size
+            if segnum == node.num_segments-1:
+                blocklen = node.tail_block_size
+            ranges.append( (datastart + segnum*node.block_size, blocklen) )
+        log.msg(format="%(share)s.prefetch(segnums=%(segnums)s)",
+                share=repr(self), segnums=segnums,
+                level=log.NOISY, parent=self._lp, umid="t4sQWA")
+        self._rref.callRemoteOnly("prefetch", ranges)
+
+    def _server_can_prefetch(self):
+        v1 = get_storage_v1_version(self._server.get_version())
+        return v1.get("immutable-prefetch", False)
+
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
+    def _send_readv(self, requests):
+        readv = [(start, length) for (start, length, block_ev, lp) in requests]
+        d = self._rref.callRemote("readv", readv)
+        self._performance.track(d)
+        d.addCallback(self._got_datav, requests)
+        d.addErrback(self._got_errorv, requests)
+        d.addCallback(self._trigger_loop)
+        d.addErrback(lambda f:
+                     log.err(format="unhandled error during send_readv",
+                             failure=f, parent=self._lp,
+                             level=log.WEIRD, umid="mq5nCw"))
+
+    def _got_datav(self, datav, requests):
+        for (data, (start, length, block_ev, lp)) in zip(datav, requests):
+            self._got_data(data, start, length, block_ev, lp)
+
+    def _got_errorv(self, f, requests):
+        for (start, length, block_ev, lp) in requests[1:]:
+            block_ev.error(now())
+        (start, length, block_ev, lp) = requests[0]
+        self._got_error(f, start, length, block_ev, lp)
+
     def _got_data(self, data, start, length, block_ev, lp):
         block_ev.finished(len(data), now())
         if not self._alive:
@@ -9,7 +9,7 @@ from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
 from allmydata.util.assertutil import _assert, precondition
-from allmydata.codec import CRSEncoder
+from allmydata.codec import CRSEncoder, PooledCRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
      IEncryptedUploadable, IUploadStatus, UploadUnhappinessError
 
@@ -74,10 +74,12 @@ PiB=1024*TiB
 class Encoder(object):
     implements(IEncoder)
 
-    def __init__(self, log_parent=None, upload_status=None):
+    def __init__(self, log_parent=None, upload_status=None,
+                 encoding_pool=None):
         object.__init__(self)
         self.uri_extension_data = {}
         self._codec = None
+        self._encoding_pool = encoding_pool
         self._status = None
         if upload_status:
             self._status = IUploadStatus(upload_status)
@@ -130,7 +132,7 @@ class Encoder(object):
         self.num_segments = mathutil.div_ceil(self.file_size,
                                               self.segment_size)
 
-        self._codec = CRSEncoder()
+        self._codec = self._make_codec()
         self._codec.set_params(self.segment_size,
                                self.required_shares, self.num_shares)
 
@@ -158,11 +160,16 @@ class Encoder(object):
         # the tail codec is responsible for encoding tail_size bytes
         padded_tail_size = mathutil.next_multiple(tail_size,
                                                   self.required_shares)
-        self._tail_codec = CRSEncoder()
+        self._tail_codec = self._make_codec()
         self._tail_codec.set_params(padded_tail_size,
                                     self.required_shares, self.num_shares)
         data['tail_codec_params'] = self._tail_codec.get_serialized_params()
 
+    def _make_codec(self):
+        if self._encoding_pool:
+            return PooledCRSEncoder(self._encoding_pool)
+        return CRSEncoder()
+
     def _get_share_size(self):
         share_size = mathutil.div_ceil(self.file_size, self.required_shares)
         overhead = self._compute_overhead()
@@ -201,6 +208,7 @@ class Encoder(object):
         for v in servermap.itervalues():
             assert isinstance(v, set)
         self.servermap = servermap.copy()
+        self._happiness = happinessutil.HappinessMatcher(servermap)
 
     def start(self):
         """ Returns a Deferred that will fire with the verify cap (an instance of
@@ -225,22 +233,29 @@ class Encoder(object):
             }
         self._start_total_timestamp = time.time()
 
+        # Without an encoding pool, each segment is read and encoded only
+        # once the previous one has been sent. With one, the next few
+        # segments are read and encoded (one after another, so the reads
+        # stay in order) while the current one is sent.
+        self._segments_in_flight = 1
+        if self._encoding_pool:
+            self._segments_in_flight = self._encoding_pool.segments_in_flight
+        self._encoding = {} # segnum -> Deferred that fires when encoded
+        self._next_segment_to_encode = 0
+        self._read_lock = defer.DeferredLock()
+
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
 
-        for i in range(self.num_segments-1):
+        for i in range(self.num_segments):
             # note to self: this form doesn't work, because lambda only
             # captures the slot, not the value
             #d.addCallback(lambda res: self.do_segment(i))
             # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
+            d.addCallback(lambda res, i=i: self._get_encoded_segment(i))
             d.addCallback(self._send_segment, i)
             d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
 
         d.addCallback(lambda res: self.finish_hashing())
 
@@ -296,9 +311,19 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    def _get_encoded_segment(self, segnum):
+        last = min(segnum + self._segments_in_flight, self.num_segments)
+        while self._next_segment_to_encode < last:
+            n = self._next_segment_to_encode
+            if n == self.num_segments - 1:
+                self._encoding[n] = self._encode_tail_segment(n)
+            else:
+                self._encoding[n] = self._encode_segment(n)
+            self._next_segment_to_encode += 1
+        return self._encoding.pop(segnum)
+
     def _encode_segment(self, segnum):
         codec = self._codec
-        start = time.time()
 
         # the ICodecEncoder API wants to receive a total of self.segment_size
         # bytes on each encode() call, broken up into a number of
@@ -319,53 +344,53 @@ class Encoder(object):
         # we read data from the source one segment at a time, and then chop
         # it into 'input_piece_size' pieces before handing it to the codec
 
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
-
         # memory footprint: we only hold a tiny piece of the plaintext at any
         # given time. We build up a segment's worth of cryptttext, then hand
         # it to the encoder. Assuming 3-of-10 encoding (3.3x expansion) and
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
         # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
-        # footprint to 430KiB at the expense of more hash-tree overhead.
+        # footprint to 430KiB at the expense of more hash-tree overhead. With
+        # an encoding pool, multiply that by the number of segments in
+        # flight.
 
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher)
-        def _done_gathering(chunks):
-            for c in chunks:
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
+        d = self._read_lock.run(self._read_segment, input_piece_size)
+        # during this call, we hit 5*segsize memory
+        d.addCallback(lambda chunks: self._timed_encode(codec, chunks))
         return d
 
     def _encode_tail_segment(self, segnum):
 
-        start = time.time()
         codec = self._tail_codec
         input_piece_size = codec.get_block_size()
 
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+        # a short trailing chunk will be padded by _gather_data
+        d = self._read_lock.run(self._read_segment, input_piece_size,
+                                allow_short=True)
+        d.addCallback(lambda chunks: self._timed_encode(codec, chunks))
+        return d
 
+    def _read_segment(self, input_piece_size, allow_short=False):
+        # this runs under self._read_lock, so segments are read, and their
+        # crypttext hashes recorded, in order
+        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
         d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher, allow_short=True)
+                              crypttext_segment_hasher,
+                              allow_short=allow_short)
         def _done_gathering(chunks):
             for c in chunks:
-                # a short trailing chunk will have been padded by
-                # _gather_data
                 assert len(c) == input_piece_size
             self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            return codec.encode(chunks)
+            return chunks
         d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
+        return d
+
+    def _timed_encode(self, codec, chunks):
+        d = codec.encode_and_hash(chunks)
+        def _done((shares, shareids, block_hashes, elapsed)):
+            # the codec measures the encoding itself: with an encoding pool,
+            # the time spent waiting for a worker is not included
             self._times["cumulative_encoding"] += elapsed
-            return res
+            return (shares, shareids, block_hashes)
         d.addCallback(_done)
         return d
 
@@ -417,7 +442,7 @@ class Encoder(object):
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, (shares, shareids), segnum):
+    def _send_segment(self, (shares, shareids, block_hashes), segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
@@ -436,7 +461,7 @@ class Encoder(object):
             shareid = shareids[i]
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -486,11 +511,12 @@ class Encoder(object):
             self.servermap[shareid].remove(peerid)
             if not self.servermap[shareid]:
                 del self.servermap[shareid]
+            self._happiness.remove(shareid, peerid)
         else:
             # even more UNUSUAL
             self.log("they weren't in our list of landlords", parent=ln,
                      level=log.WEIRD, umid="TQGFRw")
-        happiness = happinessutil.servers_of_happiness(self.servermap)
+        happiness = self._happiness.get_happiness()
         if happiness < self.servers_of_happiness:
             peerids = set(happinessutil.shares_by_server(self.servermap).keys())
             msg = happinessutil.failure_message(len(peerids),
@@ -664,6 +690,10 @@ class Encoder(object):
         self.log("aborting shareholders", level=log.UNUSUAL)
         for shareid in list(self.landlords):
             self.landlords[shareid].abort()
+        # segments that were being encoded ahead will never be sent
+        for d in self._encoding.values():
+            d.addErrback(lambda f: None)
+        self._encoding.clear()
         if f.check(defer.FirstError):
             return f.value.subFailure
         return f
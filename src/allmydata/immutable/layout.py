@@ -1,11 +1,13 @@
 import struct
 from zope.interface import implements
 from twisted.internet import defer
+from foolscap.api import eventually
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
      FileTooLargeError, HASH_SIZE
 from allmydata.util import mathutil, observer, pipeline
 from allmydata.util.assertutil import precondition
 from allmydata.storage.server import si_b2a
+from allmydata.storage_client import get_max_immutable_readv_size
 
 class LayoutInvalid(Exception):
     """ There is something wrong with these bytes so they can't be
@@ -300,6 +302,7 @@ class ReadBucketProxy:
         self._storage_index = storage_index
         self._started = False # sent request to server
         self._ready = observer.OneShotObserverList() # got response from server
+        self._pending_reads = [] # (offset, length, Deferred) for next readv
 
     def get_peerid(self):
         return self._server.get_serverid()
@@ -500,4 +503,33 @@ class ReadBucketProxy:
         return d
 
     def _read(self, offset, length):
-        return self._rref.callRemote("read", offset, length)
+        if get_max_immutable_readv_size(self._server) < 2:
+            return self._rref.callRemote("read", offset, length)
+        # reads requested during the same turn (e.g. the hashes and the
+        # block data for one segment) are sent as a single readv
+        d = defer.Deferred()
+        self._pending_reads.append( (offset, length, d) )
+        if len(self._pending_reads) == 1:
+            eventually(self._send_reads)
+        return d
+
+    def _send_reads(self):
+        step = max(1, get_max_immutable_readv_size(self._server))
+        reads, self._pending_reads = self._pending_reads, []
+        for i in range(0, len(reads), step):
+            self._send_readv(reads[i:i+step])
+
+    def _send_readv(self, reads):
+        if len(reads) == 1:
+            (offset, length, waiter) = reads[0]
+            self._rref.callRemote("read", offset, length).chainDeferred(waiter)
+            return
+        readv = [(r[0], r[1]) for r in reads]
+        d = self._rref.callRemote("readv", readv)
+        def _got(datav):
+            for (data, (offset, length, waiter)) in zip(datav, reads):
+                waiter.callback(data)
+        def _failed(f):
+            for (offset, length, waiter) in reads:
+                waiter.errback(f)
+        d.addCallbacks(_got, _failed)
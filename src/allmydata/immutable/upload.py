@@ -10,10 +10,12 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
      bucket_cancel_secret_hash, plaintext_hasher, \
      storage_index_hash, plaintext_segment_hasher, convergence_hasher
 from allmydata import hashtree, uri
+from allmydata.codec import EncodingPool
 from allmydata.storage.server import si_b2a
+from allmydata.storage_client import get_storage_v1_version
 from allmydata.immutable import encode
 from allmydata.util import base32, dictutil, idlib, log, mathutil
-from allmydata.util.happinessutil import servers_of_happiness, \
+from allmydata.util.happinessutil import HappinessMatcher, \
                                          shares_by_server, merge_servers, \
                                          failure_message
 from allmydata.util.assertutil import precondition, _assert
@@ -203,9 +205,18 @@ def str_shareloc(shnum, bucketwriter):
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None,
+                 max_parallel_queries=0):
         self.upload_id = upload_id
+        # if this is more than 1, the first pass asks up to this many
+        # servers at once, instead of one after another
+        self._max_parallel_queries = max_parallel_queries
         self.query_count, self.good_query_count, self.bad_query_count = 0,0,0
+        # seconds spent waiting for allocate_buckets answers, summed over
+        # all queries (so this exceeds the elapsed time when they overlap)
+        self.query_time = 0.0
+        # shares that the last parallel round failed to place
+        self._rejected_in_last_round = 0
         # Servers that are working normally, but full.
         self.full_count = 0
         self.error_count = 0
@@ -242,6 +253,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         self.use_trackers = set() # ServerTrackers that have shares assigned
                                   # to them
         self.preexisting_shares = {} # shareid => set(serverids) holding shareid
+        # every share placement we know of, both preexisting shares and
+        # those allocated in use_trackers, kept up to date as they change
+        self._happiness = HappinessMatcher()
 
         # These servers have shares -- any shares -- for our SI. We keep
         # track of these to write an error message with them later.
@@ -268,8 +282,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # field) from getting large shares (for files larger than about
         # 12GiB). See #439 for details.
         def _get_maxsize(server):
-            v0 = server.get_rref().version
-            v1 = v0["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1 = get_storage_v1_version(server.get_rref().version)
             return v1["maximum-immutable-share-size"]
         writeable_servers = [server for server in all_servers
                             if _get_maxsize(server) >= allocated_size]
@@ -361,12 +374,18 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     % (tracker.get_name(), tuple(sorted(buckets))),
                     level=log.NOISY)
             for bucket in buckets:
-                self.preexisting_shares.setdefault(bucket, set()).add(serverid)
+                self._add_preexisting_share(bucket, serverid)
                 self.homeless_shares.discard(bucket)
             self.full_count += 1
             self.bad_query_count += 1
 
 
+    def _add_preexisting_share(self, shnum, serverid):
+        serverids = self.preexisting_shares.setdefault(shnum, set())
+        if serverid not in serverids:
+            serverids.add(serverid)
+            self._happiness.add(shnum, serverid)
+
     def _get_progress_message(self):
         if not self.homeless_shares:
             msg = "placed all %d shares, " % (self.total_shares)
@@ -389,9 +408,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
     def _loop(self):
         if not self.homeless_shares:
-            merged = merge_servers(self.preexisting_shares, self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._happiness.get_happiness()
             if self.servers_of_happiness <= effective_happiness:
+                merged = merge_servers(self.preexisting_shares,
+                                       self.use_trackers)
                 msg = ("server selection successful for %s: %s: pretty_print_merged: %s, "
                        "self.use_trackers: %s, self.preexisting_shares: %s") \
                        % (self, self._get_progress_message(),
@@ -431,14 +451,21 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                             share = sharelist.pop()
                             self.homeless_shares.add(share)
                             self.preexisting_shares[share].remove(server)
+                            self._happiness.remove(share, server)
                             if not self.preexisting_shares[share]:
                                 del self.preexisting_shares[share]
                             items.append((server, sharelist))
                         for writer in self.use_trackers:
+                            for shnum in self.homeless_shares:
+                                if shnum in writer.buckets:
+                                    self._happiness.remove(shnum,
+                                                           writer.get_serverid())
                             writer.abort_some_buckets(self.homeless_shares)
                     return self._loop()
                 else:
                     # Redistribution won't help us; fail.
+                    merged = merge_servers(self.preexisting_shares,
+                                           self.use_trackers)
                     server_count = len(self.serverids_with_shares)
                     failmsg = failure_message(server_count,
                                               self.needed_shares,
@@ -454,7 +481,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     self.log(servmsg, level=log.INFREQUENT)
                     return self._failed("%s (%s)" % (failmsg, self._get_progress_message()))
 
-        if self.first_pass_trackers:
+        if self.first_pass_trackers and self._max_parallel_queries > 1:
+            return self._query_first_pass_in_parallel()
+        elif self.first_pass_trackers:
             tracker = self.first_pass_trackers.pop(0)
             # TODO: don't pre-convert all serverids to ServerTrackers
             assert isinstance(tracker, ServerTracker)
@@ -468,7 +497,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                         " %d shares left.."
                                         % (tracker.get_name(),
                                            len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
+            d = self._query(tracker, shares_to_ask)
             d.addBoth(self._got_response, tracker, shares_to_ask,
                       self.second_pass_trackers)
             return d
@@ -489,7 +518,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                         " %d shares left.."
                                         % (tracker.get_name(),
                                            len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
+            d = self._query(tracker, shares_to_ask)
             d.addBoth(self._got_response, tracker, shares_to_ask,
                       self.next_pass_trackers)
             return d
@@ -502,7 +531,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         else:
             # no more servers. If we haven't placed enough shares, we fail.
             merged = merge_servers(self.preexisting_shares, self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._happiness.get_happiness()
             if effective_happiness < self.servers_of_happiness:
                 msg = failure_message(len(self.serverids_with_shares),
                                       self.needed_shares,
@@ -523,7 +552,72 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.log(msg, level=log.OPERATIONAL)
                 return (self.use_trackers, self.preexisting_shares)
 
+    def _query(self, tracker, shares_to_ask):
+        started = time.time()
+        d = tracker.query(shares_to_ask)
+        def _answered(res):
+            self.query_time += time.time() - started
+            return res
+        d.addBoth(_answered)
+        return d
+
+    def _query_first_pass_in_parallel(self):
+        # Ask enough servers for one homeless share each, all at once. If
+        # the last round left some shares homeless (because servers were
+        # full or broken), expect the same again: ask that many extra
+        # servers for shares that are already being asked for. When more
+        # than one server accepts the same share, the first one (in
+        # permuted order) keeps it and the others' buckets are aborted.
+        homeless = sorted(self.homeless_shares)
+        num_queries = min(self._max_parallel_queries,
+                          len(self.first_pass_trackers),
+                          len(homeless) + self._rejected_in_last_round)
+        trackers = self.first_pass_trackers[:num_queries]
+        del self.first_pass_trackers[:num_queries]
+        queries = []
+        for i, tracker in enumerate(trackers):
+            assert isinstance(tracker, ServerTracker)
+            queries.append((tracker, set([homeless[i % len(homeless)]])))
+        asked = set(homeless[:num_queries])
+        self.homeless_shares -= asked
+        self.query_count += num_queries
+        self.num_servers_contacted += num_queries
+        if self._status:
+            self._status.set_status("Contacting Servers [%s] (first query,"
+                                    " %d at once), %d shares left.."
+                                    % (trackers[0].get_name(), num_queries,
+                                       len(self.homeless_shares)))
+        dl = defer.DeferredList([self._query(tracker, shares_to_ask)
+                                 for (tracker, shares_to_ask) in queries],
+                                consumeErrors=True)
+        dl.addCallback(self._got_parallel_responses, queries, asked)
+        return dl
+
+    def _got_parallel_responses(self, results, queries, asked):
+        placed = set() # shares that an earlier server in this round took
+        for ((success, res), (tracker, shares_to_ask)) in zip(results, queries):
+            self._handle_response(res, tracker, shares_to_ask,
+                                  self.second_pass_trackers, placed)
+        # a share that one server turned away may have been accepted by
+        # another one
+        self.homeless_shares -= placed
+        self._rejected_in_last_round = len(asked - placed)
+        return self._loop()
+
     def _got_response(self, res, tracker, shares_to_ask, put_tracker_here):
+        self._handle_response(res, tracker, shares_to_ask, put_tracker_here)
+        # now loop
+        return self._loop()
+
+    def _handle_response(self, res, tracker, shares_to_ask, put_tracker_here,
+                         placed=None):
+        """
+        I record the answer to an allocate_buckets query. 'placed' is None
+        for a query that was sent by itself. For queries sent in parallel
+        it is the set of shares that the servers whose answers I have
+        already handled accepted or already had: I abort this server's
+        buckets for those, and add the shares that this server takes.
+        """
         if isinstance(res, failure.Failure):
             # This is unusual, and probably indicates a bug or a network
             # problem.
@@ -551,26 +645,38 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     % (tracker.get_name(),
                        tuple(sorted(alreadygot)), tuple(sorted(allocated))),
                     level=log.NOISY)
+            duplicates = set()
+            if placed is not None:
+                duplicates = set(allocated) & placed
+            if duplicates:
+                # another server in the same round was answered first
+                tracker.abort_some_buckets(duplicates)
             progress = False
             for s in alreadygot:
-                self.preexisting_shares.setdefault(s, set()).add(tracker.get_serverid())
+                self._add_preexisting_share(s, tracker.get_serverid())
                 if s in self.homeless_shares:
                     self.homeless_shares.remove(s)
                     progress = True
                 elif s in shares_to_ask:
                     progress = True
 
+            not_yet_present = set(shares_to_ask) - set(alreadygot)
+            still_homeless = not_yet_present - set(allocated)
+            allocated = set(allocated) - duplicates
+
             # the ServerTracker will remember which shares were allocated on
             # that peer. We just have to remember to use them.
             if allocated:
                 self.use_trackers.add(tracker)
                 progress = True
+            for s in allocated:
+                self._happiness.add(s, tracker.get_serverid())
 
             if allocated or alreadygot:
                 self.serverids_with_shares.add(tracker.get_serverid())
-
-            not_yet_present = set(shares_to_ask) - set(alreadygot)
-            still_homeless = not_yet_present - set(allocated)
+            if placed is not None:
+                placed.update(alreadygot)
+                placed.update(allocated)
 
             if progress:
                 # They accepted at least one of the shares that we asked
@@ -580,7 +686,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.good_query_count += 1
             else:
                 self.bad_query_count += 1
-                self.full_count += 1
+                if not duplicates:
+                    self.full_count += 1
 
             if still_homeless:
                 # In networks with lots of space, this is very unusual and
@@ -600,9 +707,6 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 # willing to accept even more.
                 put_tracker_here.append(tracker)
 
-        # now loop
-        return self._loop()
-
 
     def _failed(self, msg):
         """
@@ -894,10 +998,13 @@ class UploadStatus:
 class CHKUploader:
     server_selector_class = Tahoe2ServerSelector
 
-    def __init__(self, storage_broker, secret_holder):
+    def __init__(self, storage_broker, secret_holder, max_parallel_queries=0,
+                 encoding_pool=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._max_parallel_queries = max_parallel_queries
+        self._encoding_pool = encoding_pool
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -948,7 +1055,8 @@ class CHKUploader:
 
         started = time.time()
         self._encoder = e = encode.Encoder(self._log_number,
-                                           self._upload_status)
+                                           self._upload_status,
+                                           self._encoding_pool)
         d = e.set_encrypted_uploadable(eu)
         d.addCallback(self.locate_all_shareholders, started)
         d.addCallback(self.set_shareholders, e)
@@ -967,7 +1075,8 @@ class CHKUploader:
         self.log("using storage index %s" % upload_id)
         server_selector = self.server_selector_class(upload_id,
                                                      self._log_number,
-                                                     self._upload_status)
+                                                     self._upload_status,
+                                                     self._max_parallel_queries)
 
         share_size = encoder.get_param("share_size")
         block_size = encoder.get_param("block_size")
@@ -981,6 +1090,7 @@ class CHKUploader:
                                              num_segments, n, k, desired)
         def _done(res):
             self._server_selection_elapsed = time.time() - server_selection_started
+            self._server_selection_query_time = server_selector.query_time
             return res
         d.addCallback(_done)
         return d
@@ -1037,6 +1147,7 @@ class CHKUploader:
         timings["total"] = now - self._started
         timings["storage_index"] = self._storage_index_elapsed
         timings["peer_selection"] = self._server_selection_elapsed
+        timings["cumulative_peer_selection"] = self._server_selection_query_time
         timings.update(e.get_times())
         ur = UploadResults(file_size=e.file_size,
                            ciphertext_fetched=0,
@@ -1503,10 +1614,17 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None,
+                 max_parallel_queries=0, encoding_processes=0):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
         self._history = history
+        self._max_parallel_queries = max_parallel_queries
+        # with encoding processes, uploads erasure-code their segments in
+        # this pool instead of in the reactor
+        self._encoding_pool = None
+        if encoding_processes:
+            self._encoding_pool = EncodingPool(encoding_processes)
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
@@ -1518,6 +1636,11 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
             self.parent.tub.connectTo(self._helper_furl,
                                       self._got_helper)
 
+    def stopService(self):
+        if self._encoding_pool:
+            self._encoding_pool.stop()
+        return service.MultiService.stopService(self)
+
     def _got_helper(self, helper):
         self.log("got helper connection, getting versions")
         default = { "http://allmydata.org/tahoe/protocols/helper/v1" :
@@ -1575,7 +1698,9 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           self._max_parallel_queries,
+                                           self._encoding_pool)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
@@ -18,6 +18,8 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_BATCH_SIZE = 100 # storage indexes per batched query
+MAX_READV_SIZE = 100 # ranges per vectored read
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -54,6 +56,24 @@ class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(readv=ListOf(TupleOf(Offset, ReadSize),
+                           maxLength=MAX_READV_SIZE)):
+        """Read several ranges of the share at once. I return a list with
+        one string for each (offset, length) tuple, each truncated in the
+        same way as read() would truncate it. Servers that offer this
+        method set 'immutable-readv' in their version dictionary."""
+        return ListOf(ShareData, maxLength=MAX_READV_SIZE)
+
+    def prefetch(readv=ListOf(TupleOf(Offset, ReadSize),
+                              maxLength=MAX_READV_SIZE)):
+        """Advise me that the given ranges of the share will be read soon,
+        so that I can start to fetch them from the disk while the client is
+        busy with earlier ones. This is only a hint: I return None, perhaps
+        before the data has been read, and later reads are not affected.
+        Servers that offer this method set 'immutable-prefetch' in their
+        version dictionary."""
+        return None
+
     def advise_corrupt_share(reason=str):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -93,6 +113,20 @@ class RIStorageServer(RemoteInterface):
         """
         return DictOf(str, Any())
 
+    def get_client_facet(canary=Referenceable):
+        """
+        Return an object that offers all of my methods, and which a client
+        should use instead of me to get its fair share of my time: the
+        requests that it receives are charged to the client that owns
+        'canary' (any Referenceable of the client's will do), and those of
+        different clients take turns when I am busy. Requests that come to
+        me directly are all charged to a single anonymous client.
+
+        Servers which implement this method advertise it with a true
+        'client-facets' key in their version dictionary.
+        """
+        return Any()
+
     def allocate_buckets(storage_index=StorageIndex,
                          renew_secret=LeaseRenewSecret,
                          cancel_secret=LeaseCancelSecret,
@@ -149,6 +183,22 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_batch(storage_indexes=ListOf(StorageIndex,
+                                                 maxLength=MAX_BATCH_SIZE)):
+        """
+        Equivalent to calling get_buckets() once for each of the given
+        storage indexes, but in a single round trip. Returns a dictionary
+        that maps each storage index to the dictionary that get_buckets()
+        would have returned for it. Storage indexes for which I hold no
+        shares are omitted.
+
+        Servers which implement this method advertise it with a true
+        'get-buckets-batch' key in their version dictionary, along with
+        'maximum-get-buckets-batch-size'.
+        """
+        return DictOf(StorageIndex,
+                      DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_BATCH_SIZE)
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -273,6 +323,36 @@ class RIStorageServer(RemoteInterface):
         """
         return TupleOf(bool, DictOf(int, ReadData))
 
+    def slot_testv_and_readv_and_writev_batch(
+        requests=ListOf(TupleOf(StorageIndex,
+                                TupleOf(WriteEnablerSecret,
+                                        LeaseRenewSecret,
+                                        LeaseCancelSecret),
+                                TestAndWriteVectorsForShares,
+                                ReadVector),
+                        maxLength=MAX_BATCH_SIZE)):
+        """
+        Equivalent to calling slot_testv_and_readv_and_writev() once for
+        each (storage_index, secrets, tw_vectors, r_vector) tuple in
+        'requests', in order, but in a single round trip. Each slot is
+        tested and written atomically, exactly as the single call would,
+        and independently of the others: a failed test vector or a bad
+        write enabler for one slot does not stop the writes to the rest.
+
+        Returns a list with one (bool, dict, error) tuple per request. The
+        bool and the dict are the ones that slot_testv_and_readv_and_writev()
+        would have returned, and 'error' is None. If that call would have
+        raised an exception, the bool is False, the dict is empty, and
+        'error' is a string that describes the exception (for a wrong write
+        enabler, it starts with 'BadWriteEnablerError').
+
+        Servers which implement this method advertise it with a true
+        'slot-writev-batch' key in their version dictionary, along with
+        'maximum-slot-writev-batch-size'.
+        """
+        return ListOf(TupleOf(bool, DictOf(int, ReadData), ChoiceOf(None, str)),
+                      maxLength=MAX_BATCH_SIZE)
+
     def advise_corrupt_share(share_type=str, storage_index=StorageIndex,
                              shnum=int, reason=str):
         """Clients who discover hash failures in shares that they have
@@ -386,6 +466,16 @@ class IStorageBroker(Interface):
         """
         @return: list of IServer instances
         """
+    def iter_servers_for_psi(peer_selection_index):
+        """
+        @return: iterator of the same IServer instances, in the same order,
+                 as get_servers_for_psi()
+        """
+    def get_server_performance(server):
+        """
+        @return: the ServerPerformance that records how quickly and reliably
+                 the given IServer has been answering requests
+        """
     def get_connected_servers():
         """
         @return: frozenset of connected IServer instances
@@ -1987,11 +2077,16 @@ class IUploadResults(Interface):
           total : total upload time, start to finish
           storage_index : time to compute the storage index
           peer_selection : time to decide which peers will be used
+          cumulative_peer_selection : time spent waiting for servers to
+                                      answer allocate_buckets queries, summed
+                                      over queries that may overlap
           contacting_helper : initial helper query to upload/no-upload decision
           helper_total : initial helper query to helper finished pushing
           cumulative_fetch : helper waiting for ciphertext requests
           total_fetch : helper start to last ciphertext response
-          cumulative_encoding : just time spent in zfec
+          cumulative_encoding : just time spent in zfec and block hashing,
+                                summed over segments that may be encoded
+                                concurrently (see [client]encoding.processes)
           cumulative_sending : just time spent waiting for storage servers
           hashes_and_close : last segment push to shareholder close
           total_encode_and_push : first encode to shareholder close
@@ -2670,6 +2765,17 @@ class RIControlClient(RemoteInterface):
         """
         return (float, float)
 
+    def speed_test_rates(count=int, size=int, mutable=Any()):
+        """Run the same test as speed_test(), and also report throughput.
+
+        Returns a dict with 'upload_time' and 'download_time' (in seconds)
+        and 'upload_rate' and 'download_rate' (in bytes per second). For
+        immutable files ('mutable' is False) it also has 'encoding_time', the
+        time the uploads spent erasure-coding and hashing their segments,
+        and 'encoding_rate'. A rate is left out if its time was zero.
+        """
+        return DictOf(str, float)
+
     def measure_peer_response_time():
         """Send a short message to each connected peer, and measure the time
         it takes for them to respond to it. This is a rough measure of the
@@ -2756,6 +2862,22 @@ class RIStatsProvider(RemoteInterface):
         """
         return DictOf(str, DictOf(str, ChoiceOf(float, int, long, None)))
 
+    def get_latency_histograms():
+        """
+        returns a dictionary that maps latency names (like
+        'storage_server.readv') to the recent distribution of that latency,
+        as a tuple of (layout, count, total, min, max, buckets), where
+        buckets maps bucket number to count: see
+        allmydata.util.histogram.LatencyHistogram.to_wire . Histograms with
+        the same layout can be added together, to get the distribution
+        across many nodes.
+        """
+        return DictOf(str, TupleOf(int, ChoiceOf(int, long),
+                                   ChoiceOf(float, int, long),
+                                   ChoiceOf(float, int, long),
+                                   ChoiceOf(float, int, long),
+                                   DictOf(int, ChoiceOf(int, long))))
+
 
 class RIStatsGatherer(RemoteInterface):
     __remote_name__ = "RIStatsGatherer.tahoe.allmydata.com"
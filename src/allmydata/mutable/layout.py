@@ -5,6 +5,7 @@ from allmydata.mutable.common import NeedMoreDataError, UnknownVersionError, \
 from allmydata.interfaces import HASH_SIZE, SALT_SIZE, SDMF_VERSION, \
                                  MDMF_VERSION, IMutableSlotWriter
 from allmydata.util import mathutil
+from allmydata.storage_client import slot_testv_and_readv_and_writev
 from twisted.python import failure
 from twisted.internet import defer
 from zope.interface import implements
@@ -541,12 +542,13 @@ class SDMFSlotWriteProxy:
 
         tw_vectors = {}
         tw_vectors[self.shnum] = (self._testvs, datavs, None)
-        return self._rref.callRemote("slot_testv_and_readv_and_writev",
-                                     self._storage_index,
-                                     self._secrets,
-                                     tw_vectors,
-                                     # TODO is it useful to read something?
-                                     self._readvs)
+        return slot_testv_and_readv_and_writev(self._rref,
+                                               self._storage_index,
+                                               self._secrets,
+                                               tw_vectors,
+                                               # TODO is it useful to read
+                                               # something?
+                                               self._readvs)
 
 
 MDMFHEADER = ">BQ32sBBQQ QQQQQQQQ"
@@ -1159,11 +1161,11 @@ class MDMFSlotWriteProxy:
                 self._testvs = [(0, len(new_checkstring), "eq", new_checkstring)]
             on_success = _first_write
         tw_vectors[self.shnum] = (self._testvs, datavs, None)
-        d = self._rref.callRemote("slot_testv_and_readv_and_writev",
-                                  self._storage_index,
-                                  self._secrets,
-                                  tw_vectors,
-                                  self._readv)
+        d = slot_testv_and_readv_and_writev(self._rref,
+                                            self._storage_index,
+                                            self._secrets,
+                                            tw_vectors,
+                                            self._readv)
         def _result(results):
             if isinstance(results, failure.Failure) or not results[0]:
                 # Do nothing; the write was unsuccessful.
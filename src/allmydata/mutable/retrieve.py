@@ -19,6 +19,7 @@ from pycryptopp.publickey import rsa
 from allmydata.mutable.common import CorruptShareError, BadShareError, \
      UncoordinatedWriteError
 from allmydata.mutable.layout import MDMFSlotReadProxy
+from allmydata.storage_client import delay_class
 
 class RetrieveStatus:
     implements(IRetrieveStatus)
@@ -477,11 +478,13 @@ class Retrieve:
         elif len(self._active_readers) < self._required_shares:
             # need more shares
             more = self._required_shares - len(self._active_readers)
-            # We favor lower numbered shares, since FEC is faster with
-            # primary shares than with other shares, and lower-numbered
-            # shares are more likely to be primary than higher numbered
-            # shares.
-            new_shnums = sorted(unused_shnums)[:more]
+            # We favor servers that have been answering quickly, across
+            # all of our downloads. Among those that are about as fast, we
+            # favor lower numbered shares, since FEC is faster with primary
+            # shares than with other shares, and lower-numbered shares are
+            # more likely to be primary than higher numbered shares.
+            new_shnums = sorted(unused_shnums,
+                                key=self._reader_preference)[:more]
             if len(new_shnums) < more:
                 # We don't have enough readers to retrieve the file; fail.
                 self._raise_notenoughshareserror()
@@ -528,6 +531,12 @@ class Retrieve:
         # Otherwise, we're okay -- no issues.
 
 
+    def _reader_preference(self, shnum):
+        server = self.readers[shnum].server
+        perf = self._storage_broker.get_server_performance(server)
+        return (delay_class(perf.expected_delay()), shnum)
+
+
     def _remove_reader(self, reader):
         """
         At various points, we will wish to remove a server from
@@ -631,6 +640,8 @@ class Retrieve:
         for reader in self._active_readers:
             started = time.time()
             d1 = reader.get_block_and_salt(segnum)
+            perf = self._storage_broker.get_server_performance(reader.server)
+            perf.track(d1, started)
             d2,d3 = self._get_needed_hashes(reader, segnum)
             d = deferredutil.gatherResults([d1,d2,d3])
             d.addCallback(self._validate_block, segnum, reader, reader.server, started)
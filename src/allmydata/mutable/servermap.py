@@ -580,6 +580,7 @@ class ServermapUpdater:
         started = time.time()
         self._queries_outstanding.add(server)
         d = self._do_read(server, storage_index, [], [(0, readsize)])
+        self._storage_broker.get_server_performance(server).track(d, started)
         d.addCallback(self._got_results, server, readsize, storage_index,
                       started)
         d.addErrback(self._query_failed, server)
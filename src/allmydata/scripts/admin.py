@@ -1,6 +1,8 @@
 
+import os
 from twisted.python import usage
 from allmydata.scripts.common import BaseOptions
+from allmydata.util.encodingutil import quote_output
 
 class GenerateKeypairOptions(BaseOptions):
     def getSynopsis(self):
@@ -46,12 +48,58 @@ def derive_pubkey(options):
     print >>out, "public:", pubkey_vs
     return 0
 
+class ImportLeasesOptions(BaseOptions):
+    def parseArgs(self, nodedir):
+        from allmydata.util.encodingutil import argv_to_abspath
+        self.nodedir = argv_to_abspath(nodedir)
+
+    def getSynopsis(self):
+        return "Usage: tahoe [global-opts] admin import-leases NODEDIR"
+
+    def getUsage(self, width=None):
+        t = BaseOptions.getUsage(self, width)
+        t += """
+Copy the leases from every share held by the (stopped) storage node in
+NODEDIR into its lease database (NODEDIR/storage/leasedb.sqlite), creating
+the database if necessary. Run this before setting [storage]leasedb.enabled
+on a large server, so the node does not have to do it when it starts.
+Leases already in the database are kept, so it is safe to run this more
+than once.
+
+"""
+        return t
+
+def import_leases(options):
+    from allmydata.storage.leasedb import get_leasedb, import_share_leases
+    out = options.stdout
+    err = options.stderr
+    storedir = os.path.join(options.nodedir, "storage")
+    sharedir = os.path.join(storedir, "shares")
+    if os.path.exists(os.path.join(options.nodedir, "twistd.pid")):
+        print >>err, "%s is running: stop it before importing leases" \
+              % quote_output(options.nodedir)
+        return 1
+    if not os.path.isdir(sharedir):
+        print >>err, "%s does not look like a storage node (no %s)" \
+              % (quote_output(options.nodedir), quote_output(sharedir))
+        return 1
+    leasedb = get_leasedb(os.path.join(storedir, "leasedb.sqlite"))
+    (shares, leases, skipped) = import_share_leases(sharedir, leasedb)
+    print >>out, "imported %d leases from %d shares" % (leases, shares)
+    if skipped:
+        print >>out, "skipped %d unreadable shares" % skipped
+    print >>out, "%d leases in the database" % leasedb.count_leases()
+    leasedb.close()
+    return 0
+
 class AdminCommand(BaseOptions):
     subCommands = [
         ("generate-keypair", None, GenerateKeypairOptions,
          "Generate a public/private keypair, write to stdout."),
         ("derive-pubkey", None, DerivePubkeyOptions,
          "Derive a public key from a private key."),
+        ("import-leases", None, ImportLeasesOptions,
+         "Copy a storage node's in-share leases into its lease database."),
         ]
     def postOptions(self):
         if not hasattr(self, 'subOptions'):
@@ -69,6 +117,7 @@ each subcommand.
 subDispatch = {
     "generate-keypair": print_keypair,
     "derive-pubkey": derive_pubkey,
+    "import-leases": import_leases,
     }
 
 def do_admin(options):
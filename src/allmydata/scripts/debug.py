@@ -36,7 +36,7 @@ verify-cap for the file that uses the share.
         self['filename'] = argv_to_abspath(filename)
 
 def dump_share(options):
-    from allmydata.storage.mutable import MutableShareFile
+    from allmydata.storage.mutable import is_mutable_magic
     from allmydata.util.encodingutil import quote_output
 
     out = options.stdout
@@ -47,7 +47,7 @@ def dump_share(options):
     f = open(options['filename'], "rb")
     prefix = f.read(32)
     f.close()
-    if prefix == MutableShareFile.MAGIC:
+    if is_mutable_magic(prefix):
         return dump_mutable_share(options)
     # otherwise assume it's immutable
     return dump_immutable_share(options)
@@ -169,20 +169,18 @@ def format_expiration_time(expiration_time):
 
 
 def dump_mutable_share(options):
-    from allmydata.storage.mutable import MutableShareFile
+    from allmydata.storage.mutable import get_mutable_share_file
     from allmydata.util import base32, idlib
     out = options.stdout
-    m = MutableShareFile(options['filename'])
+    m = get_mutable_share_file(options['filename'])
     f = open(options['filename'], "rb")
     WE, nodeid = m._read_write_enabler_and_nodeid(f)
-    num_extra_leases = m._read_num_extra_leases(f)
     data_length = m._read_data_length(f)
-    extra_lease_offset = m._read_extra_lease_offset(f)
-    container_size = extra_lease_offset - m.DATA_OFFSET
+    data_offset = m._get_data_offset(f)
     leases = list(m._enumerate_leases(f))
 
     share_type = "unknown"
-    f.seek(m.DATA_OFFSET)
+    f.seek(data_offset)
     version = f.read(1)
     if version == "\x00":
         # this slot contains an SMDF share
@@ -196,8 +194,17 @@ def dump_mutable_share(options):
     print >>out, " share_type: %s" % share_type
     print >>out, " write_enabler: %s" % base32.b2a(WE)
     print >>out, " WE for nodeid: %s" % idlib.nodeid_b2a(nodeid)
-    print >>out, " num_extra_leases: %d" % num_extra_leases
-    print >>out, " container_size: %d" % container_size
+    if m.CONTAINER_VERSION == 1:
+        f = open(options['filename'], "rb")
+        num_extra_leases = m._read_num_extra_leases(f)
+        container_size = m._read_extra_lease_offset(f) - data_offset
+        f.close()
+        print >>out, " num_extra_leases: %d" % num_extra_leases
+        print >>out, " container_size: %d" % container_size
+    else:
+        print >>out, " container_version: %d" % m.CONTAINER_VERSION
+        print >>out, " lease_slots: %d" % \
+              ((data_offset - m.HEADER_SIZE) // m.LEASE_SIZE)
     print >>out, " data_length: %d" % data_length
     if leases:
         for (leasenum, lease) in leases:
@@ -227,7 +234,8 @@ def dump_SDMF_share(m, length, options):
     from allmydata.uri import SSKVerifierURI
     from allmydata.util.encodingutil import quote_output, to_str
 
-    offset = m.DATA_OFFSET
+    data_offset = m.get_data_offset()
+    offset = data_offset
 
     out = options.stdout
 
@@ -289,21 +297,22 @@ def dump_SDMF_share(m, length, options):
         def printoffset(name, value, shift=0):
             print >>out, "%s%20s: %s   (0x%x)" % (" "*shift, name, value, value)
         printoffset("first lease", m.HEADER_SIZE)
-        printoffset("share data", m.DATA_OFFSET)
-        o_seqnum = m.DATA_OFFSET + struct.calcsize(">B")
+        printoffset("share data", data_offset)
+        o_seqnum = data_offset + struct.calcsize(">B")
         printoffset("seqnum", o_seqnum, 2)
-        o_root_hash = m.DATA_OFFSET + struct.calcsize(">BQ")
+        o_root_hash = data_offset + struct.calcsize(">BQ")
         printoffset("root_hash", o_root_hash, 2)
         for k in ["signature", "share_hash_chain", "block_hash_tree",
                   "share_data",
                   "enc_privkey", "EOF"]:
             name = {"share_data": "block data",
                     "EOF": "end of share data"}.get(k,k)
-            offset = m.DATA_OFFSET + offsets[k]
+            offset = data_offset + offsets[k]
             printoffset(name, offset, 2)
-        f = open(options['filename'], "rb")
-        printoffset("extra leases", m._read_extra_lease_offset(f) + 4)
-        f.close()
+        if m.CONTAINER_VERSION == 1:
+            f = open(options['filename'], "rb")
+            printoffset("extra leases", m._read_extra_lease_offset(f) + 4)
+            f.close()
 
     print >>out
 
@@ -313,7 +322,8 @@ def dump_MDMF_share(m, length, options):
     from allmydata.uri import MDMFVerifierURI
     from allmydata.util.encodingutil import quote_output, to_str
 
-    offset = m.DATA_OFFSET
+    data_offset = m.get_data_offset()
+    offset = data_offset
     out = options.stdout
 
     f = open(options['filename'], "rb")
@@ -384,10 +394,10 @@ def dump_MDMF_share(m, length, options):
         def printoffset(name, value, shift=0):
             print >>out, "%s%.20s: %s   (0x%x)" % (" "*shift, name, value, value)
         printoffset("first lease", m.HEADER_SIZE, 2)
-        printoffset("share data", m.DATA_OFFSET, 2)
-        o_seqnum = m.DATA_OFFSET + struct.calcsize(">B")
+        printoffset("share data", data_offset, 2)
+        o_seqnum = data_offset + struct.calcsize(">B")
         printoffset("seqnum", o_seqnum, 4)
-        o_root_hash = m.DATA_OFFSET + struct.calcsize(">BQ")
+        o_root_hash = data_offset + struct.calcsize(">BQ")
         printoffset("root_hash", o_root_hash, 4)
         for k in ["enc_privkey", "share_hash_chain", "signature",
                   "verification_key", "verification_key_end",
@@ -396,11 +406,12 @@ def dump_MDMF_share(m, length, options):
                     "verification_key": "pubkey",
                     "verification_key_end": "end of pubkey",
                     "EOF": "end of share data"}.get(k,k)
-            offset = m.DATA_OFFSET + offsets[k]
+            offset = data_offset + offsets[k]
             printoffset(name, offset, 4)
-        f = open(options['filename'], "rb")
-        printoffset("extra leases", m._read_extra_lease_offset(f) + 4, 2)
-        f.close()
+        if m.CONTAINER_VERSION == 1:
+            f = open(options['filename'], "rb")
+            printoffset("extra leases", m._read_extra_lease_offset(f) + 4, 2)
+            f.close()
 
     print >>out
 
@@ -629,9 +640,25 @@ one per line, for each share file found.
 It may be useful during testing, when running a test grid in which all the
 nodes are on a local disk. The share files thus located can be counted,
 examined (with dump-share), or corrupted/deleted to test checker/repairer.
+
+Shares that live in pack files (small shares, or every immutable share on a
+node that uses the log backend) have no file of their own. They are listed
+as PACKFILE@OFFSET, where OFFSET is the start of the share data.
 """
         return t
 
+def open_pack_store(nodedir):
+    """Return the PackStore of a node's storage directory, or None if it
+    does not keep any shares in pack files."""
+    from allmydata.storage.packed import PackStore
+    packdir = os.path.join(nodedir, "storage", "packs")
+    if not os.path.exists(os.path.join(packdir, "index.sqlite")):
+        return None
+    return PackStore(packdir)
+
+def describe_packed_share(sf):
+    return "%s@%d" % (sf.home, sf.get_offset())
+
 def find_shares(options):
     """Given a storage index and a list of node directories, emit a list of
     all matching shares to stdout, one per line. For example:
@@ -648,12 +675,19 @@ def find_shares(options):
     from allmydata.util.encodingutil import listdir_unicode
 
     out = options.stdout
-    sharedir = storage_index_to_dir(si_a2b(options.si_s))
-    for d in options.nodedirs:
-        d = os.path.join(d, "storage/shares", sharedir)
+    storage_index = si_a2b(options.si_s)
+    sharedir = storage_index_to_dir(storage_index)
+    for nodedir in options.nodedirs:
+        d = os.path.join(nodedir, "storage/shares", sharedir)
         if os.path.exists(d):
             for shnum in listdir_unicode(d):
                 print >>out, os.path.join(d, shnum)
+        packs = open_pack_store(nodedir)
+        if packs:
+            packed = packs.get_shares(storage_index)
+            for shnum in sorted(packed):
+                print >>out, describe_packed_share(packed[shnum])
+            packs.close()
 
     return 0
 
@@ -685,6 +719,9 @@ The lines it emits will look like the following:
  SDMF $SI $k/$N $filesize $seqnum/$roothash $expiration $abspath_sharefile
  UNKNOWN $abspath_sharefile
 
+Shares that live in pack files are shown as $abspath_packfile@$offset, like
+'tahoe debug find-shares' does.
+
 This command can be used to build up a catalog of shares from many storage
 servers and then sort the results to compare all shares for the same file. If
 you see shares with the same SI but different parameters/filesize/UEB_hash,
@@ -705,12 +742,11 @@ def call(c, *args, **kwargs):
     return results[0]
 
 def describe_share(abs_sharefile, si_s, shnum_s, now, out):
-    from allmydata import uri
-    from allmydata.storage.mutable import MutableShareFile
+    from allmydata.storage.mutable import is_mutable_magic, \
+         get_mutable_share_file
     from allmydata.storage.immutable import ShareFile
     from allmydata.mutable.layout import unpack_share
     from allmydata.mutable.common import NeedMoreDataError
-    from allmydata.immutable.layout import ReadBucketProxy
     from allmydata.util import base32
     from allmydata.util.encodingutil import quote_output
     import struct
@@ -718,9 +754,10 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
     f = open(abs_sharefile, "rb")
     prefix = f.read(32)
 
-    if prefix == MutableShareFile.MAGIC:
+    if is_mutable_magic(prefix):
         # mutable share
-        m = MutableShareFile(abs_sharefile)
+        m = get_mutable_share_file(abs_sharefile)
+        data_offset = m._get_data_offset(f)
         WE, nodeid = m._read_write_enabler_and_nodeid(f)
         data_length = m._read_data_length(f)
         expiration_time = min( [lease.expiration_time
@@ -728,7 +765,7 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
         expiration = max(0, expiration_time - now)
 
         share_type = "unknown"
-        f.seek(m.DATA_OFFSET)
+        f.seek(data_offset)
         version = f.read(1)
         if version == "\x00":
             # this slot contains an SMDF share
@@ -737,7 +774,7 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
             share_type = "MDMF"
 
         if share_type == "SDMF":
-            f.seek(m.DATA_OFFSET)
+            f.seek(data_offset)
             data = f.read(min(data_length, 2000))
 
             try:
@@ -745,7 +782,7 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
             except NeedMoreDataError, e:
                 # retry once with the larger size
                 size = e.needed_bytes
-                f.seek(m.DATA_OFFSET)
+                f.seek(data_offset)
                 data = f.read(min(data_length, size))
                 pieces = unpack_share(data)
             (seqnum, root_hash, IV, k, N, segsize, datalen,
@@ -764,7 +801,7 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
                 def _read(self, readvs, force_remote=False, queue=False):
                     data = []
                     for (where,length) in readvs:
-                        f.seek(m.DATA_OFFSET+where)
+                        f.seek(data_offset+where)
                         data.append(f.read(length))
                     return defer.succeed({fake_shnum: data})
 
@@ -790,40 +827,64 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
 
     elif struct.unpack(">L", prefix[:4]) == (1,):
         # immutable
+        describe_immutable_share(ShareFile(abs_sharefile), abs_sharefile,
+                                 si_s, now, out)
 
-        class ImmediateReadBucketProxy(ReadBucketProxy):
-            def __init__(self, sf):
-                self.sf = sf
-                ReadBucketProxy.__init__(self, None, None, "")
-            def __repr__(self):
-                return "<ImmediateReadBucketProxy>"
-            def _read(self, offset, size):
-                return defer.succeed(sf.read_share_data(offset, size))
+    else:
+        print >>out, "UNKNOWN really-unknown %s" % quote_output(abs_sharefile)
 
-        # use a ReadBucketProxy to parse the bucket and find the uri extension
-        sf = ShareFile(abs_sharefile)
-        bp = ImmediateReadBucketProxy(sf)
+    f.close()
 
-        expiration_time = min( [lease.expiration_time
-                                for lease in sf.get_leases()] )
-        expiration = max(0, expiration_time - now)
+def describe_immutable_share(sf, where, si_s, now, out):
+    # 'sf' is a ShareFile or a PackedShare
+    from allmydata import uri
+    from allmydata.immutable.layout import ReadBucketProxy
+    from allmydata.util.encodingutil import quote_output
 
-        UEB_data = call(bp.get_uri_extension)
-        unpacked = uri.unpack_extension_readable(UEB_data)
+    class ImmediateReadBucketProxy(ReadBucketProxy):
+        def __init__(self, sf):
+            self.sf = sf
+            ReadBucketProxy.__init__(self, None, None, "")
+        def __repr__(self):
+            return "<ImmediateReadBucketProxy>"
+        def _read(self, offset, size):
+            return defer.succeed(sf.read_share_data(offset, size))
 
-        k = unpacked["needed_shares"]
-        N = unpacked["total_shares"]
-        filesize = unpacked["size"]
-        ueb_hash = unpacked["UEB_hash"]
+    # use a ReadBucketProxy to parse the bucket and find the uri extension
+    bp = ImmediateReadBucketProxy(sf)
 
-        print >>out, "CHK %s %d/%d %d %s %d %s" % (si_s, k, N, filesize,
-                                                   ueb_hash, expiration,
-                                                   quote_output(abs_sharefile))
+    expiration_time = min( [lease.expiration_time
+                            for lease in sf.get_leases()] )
+    expiration = max(0, expiration_time - now)
 
-    else:
-        print >>out, "UNKNOWN really-unknown %s" % quote_output(abs_sharefile)
+    UEB_data = call(bp.get_uri_extension)
+    unpacked = uri.unpack_extension_readable(UEB_data)
 
-    f.close()
+    k = unpacked["needed_shares"]
+    N = unpacked["total_shares"]
+    filesize = unpacked["size"]
+    ueb_hash = unpacked["UEB_hash"]
+
+    print >>out, "CHK %s %d/%d %d %s %d %s" % (si_s, k, N, filesize,
+                                               ueb_hash, expiration,
+                                               quote_output(where))
+
+def catalog_packed_shares(nodedir, now, out, err):
+    from allmydata.storage.common import si_b2a
+    from allmydata.util.encodingutil import quote_output
+
+    packs = open_pack_store(nodedir)
+    if not packs:
+        return
+    for (storage_index, shnum, sf) in packs.iter_shares():
+        where = describe_packed_share(sf)
+        try:
+            describe_immutable_share(sf, where, si_b2a(storage_index), now,
+                                     out)
+        except:
+            print >>err, "Error processing %s" % quote_output(where)
+            failure.Failure().printTraceback(err)
+    packs.close()
 
 def catalog_shares(options):
     from allmydata.util.encodingutil import listdir_unicode, quote_output
@@ -831,8 +892,8 @@ def catalog_shares(options):
     out = options.stdout
     err = options.stderr
     now = time.time()
-    for d in options.nodedirs:
-        d = os.path.join(d, "storage/shares")
+    for nodedir in options.nodedirs:
+        d = os.path.join(nodedir, "storage/shares")
         try:
             abbrevs = listdir_unicode(d)
         except EnvironmentError:
@@ -854,6 +915,7 @@ def catalog_shares(options):
                 except:
                     print >>err, "Error processing %s" % quote_output(abbrevdir)
                     failure.Failure().printTraceback(err)
+        catalog_packed_shares(nodedir, now, out, err)
 
     return 0
 
@@ -908,7 +970,8 @@ Obviously, this command should not be used in normal operation.
 
 def corrupt_share(options):
     import random
-    from allmydata.storage.mutable import MutableShareFile
+    from allmydata.storage.mutable import is_mutable_magic, \
+         get_mutable_share_file
     from allmydata.storage.immutable import ShareFile
     from allmydata.mutable.layout import unpack_header
     from allmydata.immutable.layout import ReadBucketProxy
@@ -932,11 +995,12 @@ def corrupt_share(options):
     f = open(fn, "rb")
     prefix = f.read(32)
     f.close()
-    if prefix == MutableShareFile.MAGIC:
+    if is_mutable_magic(prefix):
         # mutable
-        m = MutableShareFile(fn)
+        m = get_mutable_share_file(fn)
+        data_offset = m.get_data_offset()
         f = open(fn, "rb")
-        f.seek(m.DATA_OFFSET)
+        f.seek(data_offset)
         data = f.read(2000)
         # make sure this slot contains an SMDF share
         assert data[0] == "\x00", "non-SDMF mutable shares not supported"
@@ -946,8 +1010,8 @@ def corrupt_share(options):
          ig_datalen, offsets) = unpack_header(data)
 
         assert version == 0, "we only handle v0 SDMF files"
-        start = m.DATA_OFFSET + offsets["share_data"]
-        end = m.DATA_OFFSET + offsets["enc_privkey"]
+        start = data_offset + offsets["share_data"]
+        end = data_offset + offsets["enc_privkey"]
         flip_bit(start, end)
     else:
         # otherwise assume it's immutable
@@ -959,6 +1023,211 @@ def corrupt_share(options):
         flip_bit(start, end)
 
 
+class ConvertMutableSharesOptions(BaseOptions):
+    def getSynopsis(self):
+        return "Usage: tahoe [global-opts] debug convert-mutable-shares [--to-version=N] NODEDIRS.."
+
+    optParameters = [
+        ["to-version", None, "2", "The container version to convert to (1 or 2)."],
+        ]
+
+    def parseArgs(self, *nodedirs):
+        from allmydata.util.encodingutil import argv_to_abspath
+        self.nodedirs = map(argv_to_abspath, nodedirs)
+        if not nodedirs:
+            raise usage.UsageError("must specify at least one node directory")
+
+    def postOptions(self):
+        from allmydata.storage.mutable import MUTABLE_CONTAINER_VERSIONS
+        try:
+            self['to-version'] = int(self['to-version'])
+        except ValueError:
+            self['to-version'] = None
+        if self['to-version'] not in MUTABLE_CONTAINER_VERSIONS:
+            raise usage.UsageError("--to-version must be 1 or 2")
+
+    def getUsage(self, width=None):
+        t = BaseOptions.getUsage(self, width)
+        t += """
+Rewrite every mutable share held by the (stopped) storage nodes in NODEDIRS
+in the given mutable container version, keeping their write enablers, leases
+and data. Version 2 containers let the server extend and shrink mutable
+shares in place (see [storage]mutable_container.version in
+docs/configuration.rst); converting back to version 1 makes the shares
+readable by older versions of Tahoe-LAFS.
+
+ tahoe debug convert-mutable-shares ~/.tahoe
+"""
+        return t
+
+def convert_mutable_shares(options):
+    from allmydata.storage.mutable import is_mutable_magic, \
+         convert_mutable_sharefile
+    from allmydata.util.encodingutil import listdir_unicode, quote_output
+
+    out = options.stdout
+    err = options.stderr
+    rc = 0
+    for nodedir in options.nodedirs:
+        if os.path.exists(os.path.join(nodedir, "twistd.pid")):
+            print >>err, "%s is running: stop it before converting its shares" \
+                  % quote_output(nodedir)
+            rc = 1
+            continue
+        sharedir = os.path.join(nodedir, "storage", "shares")
+        if not os.path.isdir(sharedir):
+            continue
+        converted = unchanged = failed = 0
+        for prefix in sorted(listdir_unicode(sharedir)):
+            prefixdir = os.path.join(sharedir, prefix)
+            if prefix == "incoming" or not os.path.isdir(prefixdir):
+                continue
+            for si_s in sorted(listdir_unicode(prefixdir)):
+                bucketdir = os.path.join(prefixdir, si_s)
+                if not os.path.isdir(bucketdir):
+                    continue
+                for shnum_s in sorted(listdir_unicode(bucketdir)):
+                    if not shnum_s.isdigit():
+                        continue
+                    fn = os.path.join(bucketdir, shnum_s)
+                    try:
+                        f = open(fn, "rb")
+                        prefix_data = f.read(32)
+                        f.close()
+                        if not is_mutable_magic(prefix_data):
+                            continue
+                        if convert_mutable_sharefile(fn, options['to-version']):
+                            converted += 1
+                        else:
+                            unchanged += 1
+                    except EnvironmentError:
+                        print >>err, "Error processing %s" % quote_output(fn)
+                        failure.Failure().printTraceback(err)
+                        failed += 1
+        print >>out, "%s: converted %d mutable shares to version %d, %d " \
+              "already were" % (quote_output(nodedir), converted,
+                                options['to-version'], unchanged)
+        if failed:
+            print >>out, "%d shares could not be converted" % failed
+            rc = 1
+    return rc
+
+
+class CorruptionAdvisoriesOptions(BaseOptions):
+    def getSynopsis(self):
+        return "Usage: tahoe [global-opts] debug corruption-advisories [options] NODEDIRS.."
+
+    optFlags = [
+        ["catalog", "c", "Also describe each reported share that is still present, like catalog-shares does."],
+        ["verbose", "v", "Show the reason given in the latest report."],
+        ]
+
+    def __init__(self):
+        BaseOptions.__init__(self)
+        self['remove'] = []
+
+    def opt_remove(self, share):
+        """Forget the reports about STORAGE_INDEX[:SHNUM] (every share of the
+        storage index if SHNUM is left out). May be given more than once."""
+        from allmydata.storage.advisories import parse_share_spec
+        try:
+            self['remove'].append(parse_share_spec(share))
+        except ValueError, e:
+            raise usage.UsageError(str(e))
+
+    def parseArgs(self, *nodedirs):
+        from allmydata.util.encodingutil import argv_to_abspath
+        self.nodedirs = map(argv_to_abspath, nodedirs)
+        if not nodedirs:
+            raise usage.UsageError("must specify at least one node directory")
+
+    def getUsage(self, width=None):
+        t = BaseOptions.getUsage(self, width)
+        t += """
+List the shares that clients have reported as corrupt to the storage nodes in
+NODEDIRS, most recently reported first, one line per share:
+
+ $TYPE $SI $SHNUM $REPORTS $FIRST_REPORT $LATEST_REPORT $abspath_sharefile
+
+where the path is 'missing' if the node no longer has the share. With
+--catalog, each share that is still present is also described in the format
+of 'tahoe debug catalog-shares', so that the shares of each file can be
+compared with the ones on other servers (or re-verified with 'tahoe check
+--verify' by someone who holds the filecap).
+
+Once a share has been dealt with (repaired, or deleted), its reports can be
+removed:
+
+ tahoe debug corruption-advisories --remove=4vozh77tsrw7mdhnj7qvp5ky74:3 ~/.tahoe
+"""
+        return t
+
+def find_share(nodedir, storage_index, shnum, packs):
+    """Return the filename of a share held by a node (PACKFILE@OFFSET for a
+    packed share, with its PackedShare), or None."""
+    from allmydata.storage.common import storage_index_to_dir
+    fn = os.path.join(nodedir, "storage", "shares",
+                      storage_index_to_dir(storage_index), str(shnum))
+    if os.path.exists(fn):
+        return (fn, None)
+    if packs:
+        sf = packs.get_shares(storage_index).get(shnum)
+        if sf:
+            return (describe_packed_share(sf), sf)
+    return (None, None)
+
+def corruption_advisories(options):
+    from allmydata.storage.advisories import CorruptionAdvisories
+    from allmydata.storage.common import si_b2a
+    from allmydata.util import time_format
+    from allmydata.util.encodingutil import quote_output
+
+    out = options.stdout
+    err = options.stderr
+    now = time.time()
+    for nodedir in options.nodedirs:
+        dbfile = os.path.join(nodedir, "storage",
+                              "corruption-advisories.sqlite")
+        if not os.path.exists(dbfile):
+            continue
+        advisories = CorruptionAdvisories(dbfile)
+        try:
+            for (storage_index, shnum) in options['remove']:
+                removed = advisories.remove(storage_index, shnum)
+                print >>out, "%s: removed the reports about %d shares of %s" \
+                      % (quote_output(nodedir), removed, si_b2a(storage_index))
+            if options['remove']:
+                continue
+            packs = open_pack_store(nodedir)
+            for a in advisories.get_advisories():
+                si_s = si_b2a(a["storage_index"])
+                (where, packed) = find_share(nodedir, a["storage_index"],
+                                             a["shnum"], packs)
+                print >>out, "%s %s %d %d %s %s %s" % (
+                    a["share_type"], si_s, a["shnum"], a["count"],
+                    time_format.iso_utc(a["first_seen"], sep="T"),
+                    time_format.iso_utc(a["last_seen"], sep="T"),
+                    where and quote_output(where) or "missing")
+                if options['verbose']:
+                    for line in a["reason"].splitlines():
+                        print >>out, "  " + line
+                if options['catalog'] and where:
+                    try:
+                        if packed:
+                            describe_immutable_share(packed, where, si_s,
+                                                     now, out)
+                        else:
+                            describe_share(where, si_s, str(a["shnum"]),
+                                           now, out)
+                    except:
+                        print >>err, "Error processing %s" % quote_output(where)
+                        failure.Failure().printTraceback(err)
+            if packs:
+                packs.close()
+        finally:
+            advisories.close()
+    return 0
+
 
 class ReplOptions(BaseOptions):
     def getSynopsis(self):
@@ -1051,6 +1320,8 @@ class DebugCommand(BaseOptions):
         ["find-shares", None, FindSharesOptions, "Locate sharefiles in node dirs."],
         ["catalog-shares", None, CatalogSharesOptions, "Describe all shares in node dirs."],
         ["corrupt-share", None, CorruptShareOptions, "Corrupt a share by flipping a bit."],
+        ["convert-mutable-shares", None, ConvertMutableSharesOptions, "Convert mutable shares to another container version."],
+        ["corruption-advisories", None, CorruptionAdvisoriesOptions, "List the shares that clients reported as corrupt."],
         ["repl", None, ReplOptions, "Open a Python interpreter."],
         ["trial", None, TrialOptions, "Run tests using Twisted Trial with the right imports."],
         ["flogtool", None, FlogtoolOptions, "Utilities to access log files."],
@@ -1069,6 +1340,12 @@ Subcommands:
     tahoe debug find-shares     Locate sharefiles in node directories.
     tahoe debug catalog-shares  Describe all shares in node dirs.
     tahoe debug corrupt-share   Corrupt a share by flipping a bit.
+    tahoe debug convert-mutable-shares
+                                Convert mutable shares to another container
+                                version.
+    tahoe debug corruption-advisories
+                                List the shares that clients reported as
+                                corrupt.
     tahoe debug repl            Open a Python interpreter.
     tahoe debug trial           Run tests using Twisted Trial with the right imports.
     tahoe debug flogtool        Utilities to access log files.
@@ -1110,6 +1387,8 @@ subDispatch = {
     "find-shares": find_shares,
     "catalog-shares": catalog_shares,
     "corrupt-share": corrupt_share,
+    "convert-mutable-shares": convert_mutable_shares,
+    "corruption-advisories": corruption_advisories,
     "repl": repl,
     "trial": trial,
     "flogtool": flogtool,
@@ -13,6 +13,7 @@ from foolscap.api import eventually, DeadReferenceError, Referenceable, Tub
 
 from allmydata.util import log
 from allmydata.util.encodingutil import quote_output
+from allmydata.util.histogram import LatencyHistogram
 from allmydata.interfaces import RIStatsProvider, RIStatsGatherer, IStatsProducer
 
 class LoadMonitor(service.MultiService):
@@ -174,6 +175,16 @@ class StatsProvider(Referenceable, service.MultiService):
     def remote_get_stats(self):
         return self.get_stats()
 
+    def get_latency_histograms(self):
+        histograms = {}
+        for sp in self.stats_producers:
+            if hasattr(sp, "get_latency_histograms"):
+                histograms.update(sp.get_latency_histograms())
+        return histograms
+
+    def remote_get_latency_histograms(self):
+        return self.get_latency_histograms()
+
     def _connected(self, gatherer, nickname):
         gatherer.callRemoteOnly('provide', self, nickname or '')
 
@@ -189,6 +200,7 @@ class StatsGatherer(Referenceable, service.MultiService):
 
         self.clients = {}
         self.nicknames = {}
+        self.latency_histograms = {} # tubid -> latency name -> wire form
 
         self.timer = TimerService(self.poll_interval, self.poll)
         self.timer.setServiceParent(self)
@@ -213,11 +225,18 @@ class StatsGatherer(Referenceable, service.MultiService):
                            callbackArgs=(tubid, nickname),
                            errbackArgs=(tubid,))
             d.addErrback(self.log_client_error, tubid)
+            d = client.callRemote('get_latency_histograms')
+            # older nodes do not offer latency histograms, and lost clients
+            # are noticed by the get_stats call above
+            d.addCallbacks(self.got_latency_histograms, lambda f: None,
+                           callbackArgs=(tubid, nickname))
+            d.addErrback(self.log_client_error, tubid)
 
     def lost_client(self, f, tubid):
         # this is called lazily, when a get_stats request fails
         del self.clients[tubid]
         del self.nicknames[tubid]
+        self.latency_histograms.pop(tubid, None)
         f.trap(DeadReferenceError)
 
     def log_client_error(self, f, tubid):
@@ -227,6 +246,20 @@ class StatsGatherer(Referenceable, service.MultiService):
     def got_stats(self, stats, tubid, nickname):
         raise NotImplementedError()
 
+    def got_latency_histograms(self, histograms, tubid, nickname):
+        self.latency_histograms[tubid] = histograms
+
+    def get_merged_latencies(self):
+        """Return a dict that maps each latency name to a LatencyHistogram
+        of its values on all of the nodes that I poll."""
+        merged = {}
+        for histograms in self.latency_histograms.values():
+            for (name, wire) in histograms.items():
+                if name not in merged:
+                    merged[name] = LatencyHistogram()
+                merged[name].add_wire(wire)
+        return merged
+
 class StdOutStatsGatherer(StatsGatherer):
     verbose = True
     def remote_provide(self, provider, nickname):
@@ -250,6 +283,7 @@ class PickleStatsGatherer(StdOutStatsGatherer):
         self.verbose = verbose
         StatsGatherer.__init__(self, basedir)
         self.picklefile = os.path.join(basedir, "stats.pickle")
+        self.latencies_picklefile = os.path.join(basedir, "latencies.pickle")
 
         if os.path.exists(self.picklefile):
             f = open(self.picklefile, 'rb')
@@ -271,14 +305,26 @@ class PickleStatsGatherer(StdOutStatsGatherer):
         s['stats'] = stats
         self.dump_pickle()
 
-    def dump_pickle(self):
-        tmp = "%s.tmp" % (self.picklefile,)
+    def got_latency_histograms(self, histograms, tubid, nickname):
+        StdOutStatsGatherer.got_latency_histograms(self, histograms, tubid,
+                                                   nickname)
+        latencies = {}
+        for (name, h) in self.get_merged_latencies().items():
+            latencies[name] = h.get_stats()
+        self.dump_pickle(latencies, self.latencies_picklefile)
+
+    def dump_pickle(self, data=None, picklefile=None):
+        if data is None:
+            data = self.gathered_stats
+        if picklefile is None:
+            picklefile = self.picklefile
+        tmp = "%s.tmp" % (picklefile,)
         f = open(tmp, 'wb')
-        pickle.dump(self.gathered_stats, f)
+        pickle.dump(data, f)
         f.close()
-        if os.path.exists(self.picklefile):
-            os.unlink(self.picklefile)
-        os.rename(tmp, self.picklefile)
+        if os.path.exists(picklefile):
+            os.unlink(picklefile)
+        os.rename(tmp, picklefile)
 
 class StatsGathererService(service.MultiService):
     furl_file = "stats_gatherer.furl"
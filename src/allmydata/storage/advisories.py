@@ -0,0 +1,265 @@
+import os, re, time
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownAdvisoryDBVersionError
+from allmydata.util import log
+
+# Corruption advisories live in storage/corruption-advisories.sqlite, one row
+# per share that clients have complained about. Servers before this one
+# wrote a text file per report into storage/corruption-advisories/ : those
+# are imported when the database is created, and left where they are.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE advisories
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ share_type VARCHAR(9) NOT NULL,      -- 'mutable' or 'immutable'
+ first_seen INTEGER NOT NULL,         -- seconds since epoch
+ last_seen INTEGER NOT NULL,          -- seconds since epoch
+ count INTEGER NOT NULL,              -- number of reports
+ reason TEXT NOT NULL,                -- of the latest report
+ client VARCHAR(52) NOT NULL,         -- who sent the latest report
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX advisories_by_last_seen ON advisories (last_seen);
+"""
+
+# reports from a single client beyond this many per hour are dropped
+DEFAULT_MAX_REPORTS_PER_CLIENT = 100
+RATE_PERIOD = 60*60
+# longer reasons are truncated
+MAX_REASON_LENGTH = 2000
+
+def get_advisory_db(dbfile):
+    """Open the advisory database in 'dbfile', creating it if necessary.
+    Returns (connection, created)."""
+    import sqlite3
+    must_create = not os.path.exists(dbfile)
+    db = sqlite3.connect(dbfile)
+    c = db.cursor()
+    if must_create:
+        c.executescript(SCHEMA_v1)
+        c.execute("INSERT INTO version (version) VALUES (?)", (1,))
+        db.commit()
+    try:
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+    except sqlite3.DatabaseError, e:
+        raise UnknownAdvisoryDBVersionError("corruption advisory database %s"
+                                            " is unusable: %s" % (dbfile, e))
+    if version != 1:
+        raise UnknownAdvisoryDBVersionError("unable to handle corruption"
+                                            " advisory database version %s"
+                                            " in %s" % (version, dbfile))
+    return (db, must_create)
+
+def parse_advisory_file(filename):
+    """Read one of the per-report text files that older servers wrote.
+    Returns (share_type, storage_index, shnum, reason), or None if the file
+    is not a corruption report."""
+    f = open(filename, "r")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    (header, sep, reason) = data.partition("\n\n")
+    fields = {}
+    for line in header.splitlines():
+        (name, sep, value) = line.partition(": ")
+        fields[name] = value
+    try:
+        return (fields["type"], si_a2b(fields["storage_index"]),
+                int(fields["share_number"]), reason.rstrip("\n"))
+    except (KeyError, ValueError, AssertionError):
+        return None
+
+
+class CorruptionAdvisories:
+    """I remember the shares that clients have told the storage server are
+    corrupt, so that its operator can re-verify or remove them. Each share
+    has a single record, whatever the number of reports about it: the
+    number of reports, the time of the first and the latest, and the reason
+    given in the latest.
+
+    A client (as charged by the RequestScheduler) may make at most
+    'max_reports_per_client' reports per hour: any more are counted and
+    dropped, so that a broken or hostile client cannot fill the disk or the
+    log. The allowance refills steadily, so a client that stops for a while
+    may report again.
+    """
+
+    def __init__(self, dbfile,
+                 max_reports_per_client=DEFAULT_MAX_REPORTS_PER_CLIENT,
+                 clock=time.time):
+        self.dbfile = dbfile
+        self.max_reports_per_client = max_reports_per_client
+        self._clock = clock
+        (self._db, self.created) = get_advisory_db(dbfile)
+        self._cursor = self._db.cursor()
+        self._allowances = {} # client -> (reports allowed, when)
+        self.reports = 0
+        self.dropped = 0
+
+    def close(self):
+        self._db.close()
+
+    def _allow(self, client):
+        now = self._clock()
+        limit = self.max_reports_per_client
+        (allowed, when) = self._allowances.get(client, (limit, now))
+        allowed = min(limit, allowed + (now - when) * limit / RATE_PERIOD)
+        if allowed < 1:
+            self._allowances[client] = (allowed, now)
+            return False
+        self._allowances[client] = (allowed - 1, now)
+        if len(self._allowances) > 1000:
+            # forget the clients that have their whole allowance back
+            for (c, (a, w)) in self._allowances.items():
+                if a + (now - w) * limit / RATE_PERIOD >= limit:
+                    del self._allowances[c]
+        return True
+
+    def add(self, client, share_type, storage_index, shnum, reason):
+        """Record a report. Returns 'new' if this is the first report about
+        the share, 'repeat' if it is not, and None if the report was dropped
+        because the client has sent too many."""
+        if not self._allow(client):
+            self.dropped += 1
+            return None
+        self.reports += 1
+        return self._record(client, share_type, storage_index, shnum, reason,
+                            int(self._clock()))
+
+    def _record(self, client, share_type, storage_index, shnum, reason, now,
+                commit=True):
+        si_s = si_b2a(storage_index)
+        # reasons come from clients, and might not be UTF-8
+        reason = reason[:MAX_REASON_LENGTH].decode("utf-8", "replace")
+        self._cursor.execute("UPDATE advisories"
+                             " SET count=count+1, last_seen=?, reason=?,"
+                             "     client=?, share_type=?"
+                             " WHERE storage_index=? AND shnum=?",
+                             (now, reason, client, share_type, si_s, shnum))
+        if self._cursor.rowcount:
+            result = "repeat"
+        else:
+            self._cursor.execute("INSERT INTO advisories VALUES"
+                                 " (?,?,?,?,?,?,?,?)",
+                                 (si_s, shnum, share_type, now, now, 1,
+                                  reason, client))
+            result = "new"
+        if commit:
+            self._db.commit()
+        return result
+
+    def import_advisory_files(self, dirname):
+        """Add the reports in the text files that older servers wrote into
+        'dirname'. Returns the number of reports imported."""
+        try:
+            names = sorted(os.listdir(dirname))
+        except EnvironmentError:
+            return 0
+        imported = 0
+        for name in names:
+            fn = os.path.join(dirname, name)
+            try:
+                report = parse_advisory_file(fn)
+                when = int(os.stat(fn).st_mtime)
+            except EnvironmentError:
+                report = None
+            if report is None:
+                log.msg("unable to import corruption advisory %s" % fn,
+                        level=log.UNUSUAL, facility="tahoe.storage")
+                continue
+            (share_type, storage_index, shnum, reason) = report
+            self._record("", share_type, storage_index, shnum, reason, when,
+                         commit=False)
+            imported += 1
+        self._db.commit()
+        return imported
+
+    def _advisory_from_row(self, row):
+        (si_s, shnum, share_type, first_seen, last_seen, count, reason,
+         client) = row
+        return {"storage_index": si_a2b(str(si_s)),
+                "shnum": shnum,
+                "share_type": str(share_type),
+                "first_seen": first_seen,
+                "last_seen": last_seen,
+                "count": count,
+                "reason": reason.encode("utf-8"),
+                "client": str(client),
+                }
+
+    def get_advisories(self, limit=None):
+        """Return a list of dicts, one per share, most recently reported
+        first. Each has 'storage_index', 'shnum', 'share_type',
+        'first_seen', 'last_seen', 'count', 'reason' and 'client' keys."""
+        query = ("SELECT storage_index, shnum, share_type, first_seen,"
+                 " last_seen, count, reason, client FROM advisories"
+                 " ORDER BY last_seen DESC, storage_index, shnum")
+        if limit is None:
+            self._cursor.execute(query)
+        else:
+            self._cursor.execute(query + " LIMIT ?", (limit,))
+        return [self._advisory_from_row(row)
+                for row in self._cursor.fetchall()]
+
+    def get_advisory(self, storage_index, shnum):
+        self._cursor.execute("SELECT storage_index, shnum, share_type,"
+                             " first_seen, last_seen, count, reason, client"
+                             " FROM advisories"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_b2a(storage_index), shnum))
+        row = self._cursor.fetchone()
+        if row is None:
+            return None
+        return self._advisory_from_row(row)
+
+    def remove(self, storage_index, shnum=None):
+        """Forget the reports about a share (or, if shnum is None, about
+        every share of a storage index), once they have been dealt with.
+        Returns the number of shares forgotten."""
+        si_s = si_b2a(storage_index)
+        if shnum is None:
+            self._cursor.execute("DELETE FROM advisories"
+                                 " WHERE storage_index=?", (si_s,))
+        else:
+            self._cursor.execute("DELETE FROM advisories"
+                                 " WHERE storage_index=? AND shnum=?",
+                                 (si_s, shnum))
+        removed = self._cursor.rowcount
+        self._db.commit()
+        return removed
+
+    def count_shares(self):
+        self._cursor.execute("SELECT COUNT(*) FROM advisories")
+        return self._cursor.fetchone()[0]
+
+    def get_stats(self):
+        return {"shares": self.count_shares(),
+                "reports": self.reports,
+                "dropped": self.dropped,
+                }
+
+def parse_share_spec(s):
+    """Parse the STORAGEINDEX[:SHNUM] argument of 'tahoe debug
+    corruption-advisories --remove'. Returns (storage_index, shnum), with
+    shnum=None for every share."""
+    mo = re.search(r'^([a-z2-7]+)(:(\d+))?$', s)
+    if not mo:
+        raise ValueError("'%s' is not STORAGEINDEX[:SHNUM]" % s)
+    try:
+        storage_index = si_a2b(mo.group(1))
+    except AssertionError:
+        raise ValueError("'%s' is not a storage index" % mo.group(1))
+    shnum = None
+    if mo.group(3) is not None:
+        shnum = int(mo.group(3))
+    return (storage_index, shnum)
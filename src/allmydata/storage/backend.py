@@ -0,0 +1,359 @@
+import os, errno, stat, time
+from allmydata.util import fileutil
+
+# A storage backend holds everything that a StorageServer keeps under
+# storage/shares/: the share containers (whose formats, leases included, are
+# the same on every backend), the bucket directories they live in, and the
+# incoming/ directory. The server, its crawlers, the share containers
+# (ShareFile and MutableShareFile) and 'tahoe debug' do all of their share
+# I/O through the methods below, which follow the os and fileutil functions
+# of the same names, and raise the same EnvironmentErrors. The server's own
+# state (crawler state, share counts, lease database) stays in files in the
+# storage directory on every backend.
+#
+# Backends that do not keep real files (.local_files=False) cannot be used
+# with the features that work on share files directly: the open-file cache
+# and the disk I/O threads are turned off, and the share index, the lease
+# database and packed shares are refused.
+
+class DiskBackend:
+    """I keep shares as files in a directory tree on the local disk. I am
+    the default backend."""
+
+    name = "disk"
+    local_files = True
+    # every immutable share goes into the pack files (see packed.py)
+    pack_all_immutable_shares = False
+
+    def open(self, filename, mode="rb"):
+        return open(filename, mode)
+
+    def exists(self, filename):
+        return os.path.exists(filename)
+
+    def isdir(self, dirname):
+        return os.path.isdir(dirname)
+
+    def listdir(self, dirname):
+        return os.listdir(dirname)
+
+    def stat(self, filename):
+        return os.stat(filename)
+
+    def getsize(self, filename):
+        return os.path.getsize(filename)
+
+    def make_dirs(self, dirname):
+        fileutil.make_dirs(dirname)
+
+    def rename(self, src, dst):
+        fileutil.rename(src, dst)
+
+    def remove(self, filename):
+        os.remove(filename)
+
+    def rmdir(self, dirname):
+        os.rmdir(dirname)
+
+    def rm_dir(self, dirname):
+        fileutil.rm_dir(dirname)
+
+    def fsync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def advise_willneed(self, f, offset, length):
+        return fileutil.advise_willneed(f, offset, length)
+
+    def get_disk_stats(self, whichdir, reserved_space=0):
+        return fileutil.get_disk_stats(whichdir, reserved_space)
+
+    def get_available_space(self, whichdir, reserved_space):
+        return fileutil.get_available_space(whichdir, reserved_space)
+
+# share containers that are opened without a backend (by 'tahoe debug', for
+# example) are files on the local disk
+LOCAL_DISK = DiskBackend()
+
+
+class LogBackend(DiskBackend):
+    """I am a DiskBackend that is tuned for write throughput: every
+    immutable share is appended to the pack files (see packed.py) when it
+    is closed, so that an upload costs one sequential write per share,
+    instead of a new file, a bucket directory and a rename. The space of
+    expired shares is reclaimed by compaction at the end of each lease
+    checker cycle. Mutable shares, which are rewritten in place, still get
+    files of their own."""
+
+    name = "log"
+    pack_all_immutable_shares = True
+
+
+def _enoent(filename):
+    return OSError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+
+class _MemoryFile:
+    """I am an open file of a MemoryBackend. I offer the part of the file
+    object interface that the share containers use."""
+
+    def __init__(self, backend, filename, data, writable):
+        self._backend = backend
+        self.name = filename
+        self._data = data # a bytearray, shared by every open file
+        self._writable = writable
+        self._pos = 0
+        self.closed = False
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._data)
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._data)
+        else:
+            end = self._pos + size
+        data = str(self._data[self._pos:end])
+        self._pos += len(data)
+        return data
+
+    def write(self, data):
+        if not self._writable:
+            raise IOError(errno.EBADF, "file not open for writing", self.name)
+        old_size = len(self._data)
+        if self._pos > old_size:
+            # like a file with a hole, the gap reads as zeros
+            self._data.extend("\x00" * (self._pos - old_size))
+        self._data[self._pos:self._pos+len(data)] = data
+        self._pos += len(data)
+        self._backend._resized(self.name, len(self._data) - old_size)
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self._pos
+        old_size = len(self._data)
+        if size < old_size:
+            del self._data[size:]
+        else:
+            self._data.extend("\x00" * (size - old_size))
+        self._backend._resized(self.name, len(self._data) - old_size)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class MemoryBackend:
+    """I keep shares in memory, so that nothing survives a restart. I am
+    for benchmarks and tests (like the no-network grids of
+    allmydata.test.no_network), which want a storage server without the
+    cost of a disk.
+
+    If 'capacity' is not None, I report that many bytes as the size of my
+    disk, and the bytes that my files use as its used space. Otherwise I
+    behave like a platform that cannot report disk statistics, and the
+    server accepts shares of any size."""
+
+    name = "memory"
+    local_files = False
+    pack_all_immutable_shares = False
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.used = 0
+        self._files = {} # filename -> bytearray
+        self._mtimes = {} # filename -> time of the last change
+        self._dirs = {} # dirname -> set of the names in it
+        self._next_ino = 1
+        self._inodes = {} # filename or dirname -> inode number
+
+    def _norm(self, path):
+        return os.path.normpath(path)
+
+    def _parent(self, path):
+        (parent, name) = os.path.split(path)
+        if parent not in self._dirs:
+            raise _enoent(parent)
+        return (parent, name)
+
+    def _resized(self, filename, delta):
+        self.used += delta
+        self._mtimes[filename] = time.time()
+
+    def _add(self, path, kind):
+        self._inodes[path] = self._next_ino
+        self._next_ino += 1
+        if kind == "file":
+            self._files[path] = bytearray()
+            self._mtimes[path] = time.time()
+        else:
+            self._dirs[path] = set()
+
+    def open(self, filename, mode="rb"):
+        filename = self._norm(filename)
+        if filename in self._dirs:
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), filename)
+        if mode[0] == "r":
+            if filename not in self._files:
+                raise IOError(errno.ENOENT, os.strerror(errno.ENOENT),
+                              filename)
+        else:
+            (parent, name) = self._parent(filename)
+            if filename not in self._files:
+                self._add(filename, "file")
+                self._dirs[parent].add(name)
+            if mode[0] == "w":
+                self._resized(filename, -len(self._files[filename]))
+                del self._files[filename][:]
+        f = _MemoryFile(self, filename, self._files[filename],
+                        mode[0] != "r" or "+" in mode)
+        if mode[0] == "a":
+            f.seek(0, 2)
+        return f
+
+    def exists(self, filename):
+        filename = self._norm(filename)
+        return filename in self._files or filename in self._dirs
+
+    def isdir(self, dirname):
+        return self._norm(dirname) in self._dirs
+
+    def listdir(self, dirname):
+        dirname = self._norm(dirname)
+        if dirname not in self._dirs:
+            raise _enoent(dirname)
+        return list(self._dirs[dirname])
+
+    def stat(self, filename):
+        filename = self._norm(filename)
+        if filename in self._files:
+            mode = stat.S_IFREG | 0600
+            size = len(self._files[filename])
+            mtime = self._mtimes[filename]
+        elif filename in self._dirs:
+            mode = stat.S_IFDIR | 0700
+            size = 0
+            mtime = 0
+        else:
+            raise _enoent(filename)
+        # (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime)
+        return os.stat_result((mode, self._inodes[filename], 0, 1, 0, 0,
+                               size, mtime, mtime, mtime),
+                              {"st_blocks": (size + 511) // 512})
+
+    def getsize(self, filename):
+        return self.stat(filename).st_size
+
+    def make_dirs(self, dirname):
+        dirname = self._norm(dirname)
+        missing = []
+        while dirname not in self._dirs:
+            if dirname in self._files:
+                raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
+                              dirname)
+            missing.append(dirname)
+            (parent, name) = os.path.split(dirname)
+            if parent == dirname:
+                break
+            dirname = parent
+        for dirname in reversed(missing):
+            (parent, name) = os.path.split(dirname)
+            self._add(dirname, "dir")
+            if parent != dirname:
+                self._dirs.setdefault(parent, set()).add(name)
+
+    def rename(self, src, dst):
+        src = self._norm(src)
+        dst = self._norm(dst)
+        if src not in self._files:
+            raise _enoent(src)
+        (src_parent, src_name) = os.path.split(src)
+        (dst_parent, dst_name) = self._parent(dst)
+        if dst in self._files:
+            self.remove(dst)
+        self._files[dst] = self._files.pop(src)
+        self._mtimes[dst] = self._mtimes.pop(src)
+        self._inodes[dst] = self._inodes.pop(src)
+        self._dirs[src_parent].discard(src_name)
+        self._dirs[dst_parent].add(dst_name)
+
+    def remove(self, filename):
+        filename = self._norm(filename)
+        if filename not in self._files:
+            raise _enoent(filename)
+        self.used -= len(self._files.pop(filename))
+        del self._mtimes[filename]
+        del self._inodes[filename]
+        (parent, name) = os.path.split(filename)
+        self._dirs[parent].discard(name)
+
+    def rmdir(self, dirname):
+        dirname = self._norm(dirname)
+        if dirname not in self._dirs:
+            raise _enoent(dirname)
+        if self._dirs[dirname]:
+            raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY),
+                          dirname)
+        del self._dirs[dirname]
+        del self._inodes[dirname]
+        (parent, name) = os.path.split(dirname)
+        if parent in self._dirs:
+            self._dirs[parent].discard(name)
+
+    def rm_dir(self, dirname):
+        dirname = self._norm(dirname)
+        if dirname not in self._dirs:
+            return
+        for name in list(self._dirs[dirname]):
+            path = os.path.join(dirname, name)
+            if path in self._dirs:
+                self.rm_dir(path)
+            else:
+                self.remove(path)
+        self.rmdir(dirname)
+
+    def fsync(self, f):
+        pass
+
+    def advise_willneed(self, f, offset, length):
+        # everything is in memory already
+        return True
+
+    def get_disk_stats(self, whichdir, reserved_space=0):
+        if self.capacity is None:
+            # what fileutil.get_disk_stats() does without statvfs()
+            raise AttributeError("this MemoryBackend has no capacity")
+        free = max(self.capacity - self.used, 0)
+        return {"total": self.capacity,
+                "free_for_root": free,
+                "free_for_nonroot": free,
+                "used": self.used,
+                "avail": max(free - reserved_space, 0),
+                }
+
+    def get_available_space(self, whichdir, reserved_space):
+        try:
+            return self.get_disk_stats(whichdir, reserved_space)["avail"]
+        except AttributeError:
+            return None
+
+
+BACKENDS = {"disk": DiskBackend,
+            "log": LogBackend,
+            "memory": MemoryBackend,
+            }
+
+def get_backend(name):
+    """Return a new backend of the kind that [storage]backend= names."""
+    if name not in BACKENDS:
+        raise ValueError("unknown storage backend '%s' (must be one of %s)"
+                         % (name, ", ".join(sorted(BACKENDS))))
+    return BACKENDS[name]()
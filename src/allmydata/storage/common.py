@@ -8,6 +8,14 @@ class UnknownMutableContainerVersionError(Exception):
     pass
 class UnknownImmutableContainerVersionError(Exception):
     pass
+class UnknownLeaseDBVersionError(Exception):
+    pass
+class UnknownPackIndexVersionError(Exception):
+    pass
+class UnknownAdvisoryDBVersionError(Exception):
+    pass
+class ServerBusyError(Exception):
+    pass
 
 
 def si_b2a(storageindex):
@@ -1,14 +1,159 @@
 
 import os, time, struct
 import cPickle as pickle
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
 from twisted.application import service
+from twisted.python import threadpool
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.util import fileutil, log
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.sharecount import count_prefixdir
 
 class TimeSliceExceeded(Exception):
     pass
 
+class PrefetchPending(Exception):
+    """The next prefixdir is still being read by a prefetch thread. The
+    crawler sleeps until the Deferred in .d fires."""
+    def __init__(self, d):
+        Exception.__init__(self)
+        self.d = d
+
+class _Device:
+    def __init__(self, device):
+        self.device = device
+        self.queue = [] # prefix indexes, in crawl order
+        self.total = 0
+        self.done = 0
+        self.ready = 0 # prefetched but not yet processed by the crawler
+        self.in_flight = False
+        self.timer = None
+        self.busy_time = 0.0
+        self.started = time.time()
+
+class PrefixPrefetcher:
+    """I read the prefixdirs of one ShareCrawler cycle ahead of the
+    crawler, in a thread pool. The prefixdirs are grouped by the device
+    they live on (storage/shares/ may have prefixdirs symlinked onto
+    several disks), and each device has a single worker, so every disk is
+    kept busy but none is asked to seek between two streams. A worker stays
+    at most 'depth' prefixdirs ahead of the crawler, and sleeps after each
+    one so that it is busy for no more than 'allowed_io_percentage' of the
+    time.
+
+    The threads only call the crawler's prefetch_prefix(), which reads
+    (listing the buckets and warming the kernel's caches) but changes
+    nothing. The crawler still processes prefixdirs in order, in the
+    reactor thread, and finds the data it needs already in memory.
+    """
+
+    def __init__(self, crawler, first_index, pool, depth,
+                 allowed_io_percentage):
+        self.crawler = crawler
+        self.pool = pool
+        self.depth = depth
+        self.allowed_io_percentage = allowed_io_percentage
+        self.results = {} # prefix index -> list of buckets, or None
+        self.waiting = {} # prefix index -> Deferred
+        self.device_of = {} # prefix index -> _Device
+        self.devices = {} # device number -> _Device
+        self.stopped = False
+        for i in range(first_index, len(crawler.prefixes)):
+            prefixdir = os.path.join(crawler.sharedir, crawler.prefixes[i])
+            device = crawler.get_device(prefixdir)
+            if device not in self.devices:
+                self.devices[device] = _Device(device)
+            dev = self.devices[device]
+            dev.queue.append(i)
+            dev.total += 1
+            self.device_of[i] = dev
+        for dev in self.devices.values():
+            self._pump(dev)
+
+    def _pump(self, dev):
+        if (self.stopped or dev.in_flight or dev.timer or not dev.queue
+            or dev.ready >= self.depth):
+            return
+        i = dev.queue.pop(0)
+        dev.in_flight = True
+        prefix = self.crawler.prefixes[i]
+        prefixdir = os.path.join(self.crawler.sharedir, prefix)
+        start = time.time()
+        d = threads.deferToThreadPool(reactor, self.pool,
+                                      self.crawler.prefetch_prefix,
+                                      prefix, prefixdir)
+        d.addErrback(self._failed, prefix)
+        d.addCallback(self._done, dev, i, start)
+
+    def _failed(self, f, prefix):
+        log.msg(format="crawler prefetch of %(prefix)s failed",
+                prefix=prefix, failure=f, level=log.UNUSUAL, umid="c5Rw8g")
+        return None # the crawler will read this prefixdir itself
+
+    def _done(self, buckets, dev, i, start):
+        dev.in_flight = False
+        if self.stopped:
+            return
+        elapsed = time.time() - start
+        dev.busy_time += elapsed
+        dev.done += 1
+        dev.ready += 1
+        self.results[i] = buckets
+        if i in self.waiting:
+            self.waiting.pop(i).callback(None)
+        # this_prefix/(this_prefix+sleep_time) = allowed_io_percentage
+        sleep_time = (elapsed / self.allowed_io_percentage) - elapsed
+        sleep_time = max(0.0, min(sleep_time, 299))
+        if sleep_time:
+            dev.timer = reactor.callLater(sleep_time, self._wake, dev)
+        else:
+            self._pump(dev)
+
+    def _wake(self, dev):
+        dev.timer = None
+        self._pump(dev)
+
+    def get(self, i):
+        """Return the prefetched bucket list for prefix index 'i' (None if
+        the prefetch failed), or raise PrefetchPending if it is not ready
+        yet."""
+        if i not in self.results:
+            if i not in self.waiting:
+                self.waiting[i] = defer.Deferred()
+            raise PrefetchPending(self.waiting[i])
+        buckets = self.results.pop(i)
+        dev = self.device_of[i]
+        dev.ready -= 1
+        self._pump(dev)
+        return buckets
+
+    def get_progress(self):
+        now = time.time()
+        progress = {}
+        for dev in self.devices.values():
+            elapsed = now - dev.started
+            busy = None
+            if elapsed > 0:
+                busy = 100.0 * min(dev.busy_time / elapsed, 1.0)
+            progress[str(dev.device)] = {
+                "prefixes": dev.total,
+                "prefetched-prefixes": dev.done,
+                "prefetch-complete-percentage": 100.0 * dev.done / dev.total,
+                "busy-percentage": busy,
+                }
+        return progress
+
+    def stop(self):
+        self.stopped = True
+        for dev in self.devices.values():
+            if dev.timer:
+                dev.timer.cancel()
+                dev.timer = None
+        # anyone still waiting will find the crawler stopped
+        waiting, self.waiting = self.waiting, {}
+        for d in waiting.values():
+            d.callback(None)
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -57,6 +202,16 @@ class ShareCrawler(service.MultiService):
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    On servers whose prefixdirs are spread over several disks, set
+    prefetch_threads= to have a PrefixPrefetcher read prefixdirs ahead of
+    the crawler, one thread per device, each using the disk for at most
+    allowed_io_percentage of the time. The reading is done by
+    prefetch_prefix() and prefetch_bucket(), which run in those threads:
+    subclasses can override prefetch_bucket() to read whatever their
+    process_bucket() is going to read (so it comes from the kernel's cache),
+    but it must not modify anything. Subclasses whose list_prefixdir() is
+    not safe to call from a thread must set prefetch_safe=False.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,12 +219,18 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # these take effect at the start of the next cycle
+    prefetch_threads = 0 # 0 means the crawler does all its own reading
+    allowed_io_percentage = .50 # keep each disk busy up to 50% of the time
+    prefetch_depth = 4 # read at most this many prefixdirs ahead, per disk
+    prefetch_safe = True
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
         if allowed_cpu_percentage is not None:
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
+        self.backend = server.backend
         self.sharedir = server.sharedir
         self.statefile = statefile
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
@@ -83,6 +244,8 @@ class ShareCrawler(service.MultiService):
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.prefetcher = None
+        self.prefetch_pool = None
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -114,6 +277,12 @@ class ShareCrawler(service.MultiService):
                 crawlers (which can process a whole prefix in a single tick)
          estimated-time-per-cycle: float, seconds required to do a complete
                                    cycle
+         devices: only present while prefetch threads are reading ahead: a
+                  dict that maps each device (as a string) to a dict with
+                  the number of 'prefixes' in this cycle that live on it,
+                  the number of 'prefetched-prefixes', the
+                  'prefetch-complete-percentage', and the 'busy-percentage'
+                  of the time that its prefetch thread has spent reading
 
         If cycle-in-progress is False, the following keys are available::
 
@@ -147,6 +316,8 @@ class ShareCrawler(service.MultiService):
             # finished_prefix() function
             d["remaining-sleep-time"] = self.minus_or_none(self.next_wake_time,
                                                            time.time())
+            if self.prefetcher:
+                d["devices"] = self.prefetcher.get_progress()
         per_cycle = None
         if self.last_cycle_elapsed_time is not None:
             per_cycle = self.last_cycle_elapsed_time
@@ -248,6 +419,10 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        self.stop_prefetching()
+        if self.prefetch_pool:
+            self.prefetch_pool.stop()
+            self.prefetch_pool = None
         self.save_state()
         return service.MultiService.stopService(self)
 
@@ -257,11 +432,15 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        waiting = None
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
+        except PrefetchPending, e:
+            finished_cycle = False
+            waiting = e.d
         self.save_state()
         if not self.running:
             # someone might have used stopService() to shut us down
@@ -289,6 +468,16 @@ class ShareCrawler(service.MultiService):
         self.current_sleep_time = sleep_time # for status page
         self.next_wake_time = now + sleep_time
         self.yielding(sleep_time)
+        if waiting:
+            # sleep until the prefetch threads have caught up, too
+            waiting.addCallback(self._prefetch_ready)
+            return
+        self.timer = reactor.callLater(sleep_time, self.start_slice)
+
+    def _prefetch_ready(self, ignored):
+        if not self.running or self.timer:
+            return
+        sleep_time = max(0.0, self.next_wake_time - time.time())
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
     def start_current_prefix(self, start_slice):
@@ -310,11 +499,7 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self.get_prefix_buckets(i, prefix, prefixdir)
                 self.bucket_cache = (i, buckets)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
@@ -339,9 +524,66 @@ class ShareCrawler(service.MultiService):
         state["last-complete-bucket"] = None
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
+        self.stop_prefetching()
         self.finished_cycle(cycle)
         self.save_state()
 
+    def get_prefix_buckets(self, i, prefix, prefixdir):
+        if self.prefetch_threads and self.prefetch_safe:
+            if self.prefetcher is None:
+                if self.prefetch_pool is None:
+                    self.prefetch_pool = threadpool.ThreadPool(
+                        0, self.prefetch_threads,
+                        "%s-prefetch" % self.__class__.__name__)
+                    self.prefetch_pool.start()
+                self.prefetcher = PrefixPrefetcher(self, i, self.prefetch_pool,
+                                                   self.prefetch_depth,
+                                                   self.allowed_io_percentage)
+            buckets = self.prefetcher.get(i)
+            if buckets is not None:
+                return buckets
+        return self.list_prefixdir(prefix, prefixdir)
+
+    def stop_prefetching(self):
+        if self.prefetcher:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def get_device(self, prefixdir):
+        """Return the device that holds a prefixdir, following symlinks."""
+        try:
+            return os.stat(prefixdir).st_dev
+        except EnvironmentError:
+            return os.stat(self.sharedir).st_dev
+
+    def prefetch_prefix(self, prefix, prefixdir):
+        """Read one prefixdir ahead of the crawler. This runs in a prefetch
+        thread, and returns the sorted list of buckets."""
+        buckets = self.list_prefixdir(prefix, prefixdir)
+        for bucket in buckets:
+            self.prefetch_bucket(prefixdir, bucket)
+        return buckets
+
+    def prefetch_bucket(self, prefixdir, storage_index_b32):
+        """Read whatever process_bucket() will need from one bucket, so that
+        it will be cached. This runs in a prefetch thread, so it must not
+        change anything, and must not use the server's objects.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        pass
+
+    def list_prefixdir(self, prefix, prefixdir):
+        """Return a sorted list of the bucket names (base32 storage index
+        strings) in one prefixdir. Subclasses which can learn this without
+        listing the directory may override it."""
+        try:
+            buckets = self.backend.listdir(prefixdir)
+            buckets.sort()
+        except EnvironmentError:
+            buckets = []
+        return buckets
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
         base32-encoded) in sorted order.
@@ -441,9 +683,14 @@ class BucketCountingCrawler(ShareCrawler):
     will have shares on other servers instead of me. Also note that the
     number of buckets will differ from the number of shares in small grids,
     when more than one share is placed on a single server.
+
+    The storage server's ShareCounter keeps live counts of buckets, shares
+    and share bytes, so I only need to verify them once in a while: I count
+    the shares in each prefixdir and hand the result to the ShareCounter,
+    which replaces its own counts for that prefix (and logs any difference).
     """
 
-    minimum_cycle_time = 60*60 # we don't need this more than once an hour
+    minimum_cycle_time = 24*60*60 # the live counts only need a daily check
 
     def __init__(self, server, statefile, num_sample_prefixes=1):
         ShareCrawler.__init__(self, server, statefile)
@@ -459,16 +706,40 @@ class BucketCountingCrawler(ShareCrawler):
         self.state.setdefault("last-complete-bucket-count", None)
         self.state.setdefault("storage-index-samples", {})
 
+    def started_cycle(self, cycle):
+        self.server.share_counter.started_reconciliation()
+
+    def prefetch_bucket(self, prefixdir, storage_index_b32):
+        # read the share headers that count_prefixdir() will look at
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            for fn in os.listdir(bucketdir):
+                if fn.isdigit():
+                    f = open(os.path.join(bucketdir, fn), "rb")
+                    f.read(MutableShareFile.HEADER_SIZE)
+                    f.close()
+        except EnvironmentError:
+            pass
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         # we override process_prefixdir() because we don't want to look at
         # the individual buckets. We'll save state after each one. On my
         # laptop, a mostly-empty storage server can process about 70
         # prefixdirs in a 1.0s slice.
+        packed = None
+        if self.server.packs:
+            # buckets whose shares all live in pack files have no directory
+            packed = self.server.packs.count_prefix(prefix)
+            buckets = sorted(set(buckets) | set(packed))
         if cycle not in self.state["bucket-counts"]:
             self.state["bucket-counts"][cycle] = {}
         self.state["bucket-counts"][cycle][prefix] = len(buckets)
         if prefix in self.prefixes[:self.num_sample_prefixes]:
             self.state["storage-index-samples"][prefix] = (cycle, buckets)
+        # the bucket list may have been read ahead of time, so count from
+        # the disk as it is now
+        counts = count_prefixdir(prefixdir, packed, self.backend)
+        self.server.share_counter.reconcile_prefix(prefix, counts)
 
     def finished_cycle(self, cycle):
         last_counts = self.state["bucket-counts"].get(cycle, [])
@@ -480,6 +751,7 @@ class BucketCountingCrawler(ShareCrawler):
             for old_cycle in list(self.state["bucket-counts"].keys()):
                 if old_cycle != cycle:
                     del self.state["bucket-counts"][old_cycle]
+        self.server.share_counter.finished_reconciliation(self.prefixes)
         # get rid of old samples too
         for prefix in list(self.state["storage-index-samples"].keys()):
             old_cycle,buckets = self.state["storage-index-samples"][prefix]
@@ -0,0 +1,77 @@
+import time
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool
+
+class DiskIOPool:
+    """I run share file I/O for one storage directory in a bounded pool of
+    threads, so that a slow disk stalls only the requests that are waiting
+    for it, instead of the whole reactor.
+
+    run() returns a Deferred that fires (in the reactor thread) with the
+    result of the function. The function runs in a pool thread, so it may
+    read and write share files, but must not touch any state that the
+    reactor thread also uses: the share index, the lease database, the
+    share counters and the server's latency lists all stay in the reactor.
+
+    For every job I record two extra latency categories on the server:
+    'disk-queue-depth' is the number of jobs that were already queued or
+    running when it was submitted, and 'disk-queue-wait' is how long it
+    waited for a free thread.
+    """
+
+    def __init__(self, server, num_threads, name="storage-disk-io"):
+        assert num_threads > 0, num_threads
+        self.server = server
+        self.pool = threadpool.ThreadPool(0, num_threads, name)
+        self.started = False
+        self.outstanding = 0
+
+    def run(self, f, *args, **kwargs):
+        if not self.started:
+            self.pool.start()
+            self.started = True
+        self.server.add_latency("disk-queue-depth", self.outstanding)
+        self.outstanding += 1
+        submitted = time.time()
+        def _in_thread():
+            waited = time.time() - submitted
+            return (waited, f(*args, **kwargs))
+        d = threads.deferToThreadPool(reactor, self.pool, _in_thread)
+        def _done(res):
+            self.outstanding -= 1
+            (waited, result) = res
+            self.server.add_latency("disk-queue-wait", waited)
+            return result
+        def _failed(failure):
+            self.outstanding -= 1
+            return failure
+        d.addCallbacks(_done, _failed)
+        return d
+
+    def stop(self):
+        if self.started:
+            self.pool.stop()
+            self.started = False
+
+
+class KeyedLock:
+    """I hold one DeferredLock per key (a storage index), and forget it
+    when nobody holds it or waits for it. The storage server uses me to
+    keep mutable share reads, which run in the disk I/O pool, apart from
+    writes to the same slot, which run in the reactor thread."""
+
+    def __init__(self):
+        self._locks = {}
+
+    def run(self, key, f, *args, **kwargs):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+        d = lock.run(f, *args, **kwargs)
+        def _cleanup(res):
+            if not lock.locked and not lock.waiting:
+                if self._locks.get(key) is lock:
+                    del self._locks[key]
+            return res
+        d.addBoth(_cleanup)
+        return d
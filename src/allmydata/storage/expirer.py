@@ -1,10 +1,16 @@
-import time, os, pickle, struct
+import time, os, pickle, struct, math
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.leasedb import LeasedShare
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b, si_b2a
 from twisted.python import log as twlog
 
+# leases last this long after they are granted or renewed
+LEASE_DURATION = 31*24*60*60
+# the lease-age histogram has one bucket per day
+AGE_HISTOGRAM_INTERVAL = 24*60*60
+
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
     and which have expired. I can remove the expired leases (if so
@@ -110,15 +116,32 @@ class LeaseCheckingCrawler(ShareCrawler):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
 
     def stat(self, fn):
-        return os.stat(fn)
+        return self.backend.stat(fn)
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        if self.server.packs:
+            # buckets whose shares all live in pack files have no directory
+            packed = self.server.packs.count_prefix(prefix)
+            buckets = sorted(set(buckets) | set(packed))
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
         would_keep_shares = []
         wks = None
-
-        for fn in os.listdir(bucketdir):
+        try:
+            s = self.stat(bucketdir)
+            sharefiles = self.backend.listdir(bucketdir)
+        except EnvironmentError:
+            if not self.process_packed_shares(storage_index_b32,
+                                              would_keep_shares):
+                raise
+            # a bucket that only exists in pack files
+            self.account_bucket(bucketdir, would_keep_shares, None)
+            return
+
+        for fn in sharefiles:
             try:
                 shnum = int(fn)
             except ValueError:
@@ -133,35 +156,102 @@ class LeaseCheckingCrawler(ShareCrawler):
                 twlog.err()
                 which = (storage_index_b32, shnum)
                 self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+                wks = (1, 1, 1, "unknown", None)
+            if wks[2] == 0:
+                # we cancelled the last lease, so the share is gone
+                self.server.share_removed(si_a2b(storage_index_b32), shnum,
+                                          wks[3], wks[4])
             would_keep_shares.append(wks)
+        self.process_packed_shares(storage_index_b32, would_keep_shares)
+
+        self.account_bucket(bucketdir, would_keep_shares, s)
+
+    def process_packed_shares(self, storage_index_b32, would_keep_shares):
+        """Examine the leases on the shares of one bucket that live in pack
+        files, and add them to would_keep_shares. Return True if there were
+        any."""
+        if not self.server.packs:
+            return False
+        storage_index = si_a2b(storage_index_b32)
+        packed = self.server.packs.get_shares(storage_index)
+        for shnum in sorted(packed):
+            sf = packed[shnum]
+            length = sf.get_data_length()
+            wks = self.process_leases(sf, sf.sharetype, (length, length))
+            if wks[2] == 0:
+                # we cancelled the last lease, so the share is gone
+                self.server.share_removed(storage_index, shnum,
+                                          wks[3], wks[4])
+            would_keep_shares.append(wks)
+        return bool(packed)
 
+    def account_bucket(self, bucketdir, would_keep_shares, s=None):
+        # 's' is the stat() of the bucket directory, which is only needed
+        # (and only fetched, if it is None) when the whole bucket would go
         sharetype = None
-        if wks:
+        if would_keep_shares:
             # use the last share's sharetype as the buckettype
-            sharetype = wks[3]
+            sharetype = would_keep_shares[-1][3]
         rec = self.state["cycle-to-date"]["space-recovered"]
         self.increment(rec, "examined-buckets", 1)
         if sharetype:
             self.increment(rec, "examined-buckets-"+sharetype, 1)
 
+        gone = [a for (i, a) in enumerate(("original", "configured", "actual"))
+                if sum([wks[i] for wks in would_keep_shares]) == 0]
+        if not gone:
+            return
+        bucket_diskbytes = self.get_bucket_diskbytes(bucketdir, s)
+        for a in gone:
+            self.increment_bucketspace(a, bucket_diskbytes, sharetype)
+
+    def get_bucket_diskbytes(self, bucketdir, s=None):
+        if s is None:
+            try:
+                s = self.stat(bucketdir)
+            except EnvironmentError:
+                pass
         try:
-            bucket_diskbytes = s.st_blocks * 512
+            return s.st_blocks * 512
         except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
-        if sum([wks[0] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("original", bucket_diskbytes, sharetype)
-        if sum([wks[1] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("configured", bucket_diskbytes, sharetype)
-        if sum([wks[2] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
+            return 0 # no stat().st_blocks on windows
+
+    def prefetch_bucket(self, prefixdir, storage_index_b32):
+        # read the same things that process_bucket() will, so they come from
+        # the kernel's cache. Any errors will be reported by process_bucket().
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            self.stat(bucketdir)
+            for fn in os.listdir(bucketdir):
+                if not fn.isdigit():
+                    continue
+                sharefile = os.path.join(bucketdir, fn)
+                self.stat(sharefile)
+                if not self.server.leasedb:
+                    list(get_share_file(sharefile).get_leases())
+        except (EnvironmentError, UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError, struct.error):
+            pass
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
-        sharetype = sf.sharetype
-        now = time.time()
+        sf = get_share_file(sharefilename, self.server.filecache,
+                            self.backend)
+        if self.server.leasedb:
+            bucketdir, shnum = os.path.split(sharefilename)
+            storage_index = si_a2b(os.path.basename(bucketdir))
+            sf = LeasedShare(self.server.leasedb, storage_index, int(shnum),
+                             sf.home, sf.sharetype)
         s = self.stat(sharefilename)
+        return self.process_leases(sf, sf.sharetype, self.get_space(s))
+
+    def process_leases(self, sf, sharetype, space):
+        """Examine (and maybe cancel) the leases on one share. 'space' is
+        a (sharebytes, diskbytes) tuple. I return a would_keep_share list of
+        [original, configured, actual, sharetype, data_length], where each of
+        the first three is 0 if the share would be (or was) deleted, and
+        data_length is the size of a deleted share's data (or None)."""
+        now = time.time()
 
         num_leases = 0
         num_valid_leases_original = 0
@@ -201,28 +291,31 @@ class LeaseCheckingCrawler(ShareCrawler):
 
         so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
-        self.increment_space("examined", s, sharetype)
+        self.increment_space("examined", space, sharetype)
 
-        would_keep_share = [1, 1, 1, sharetype]
+        would_keep_share = [1, 1, 1, sharetype, None]
 
         if self.expiration_enabled:
+            if expired_leases_configured and not num_valid_leases_configured:
+                # the share is about to go, so measure it first
+                would_keep_share[4] = sf.get_data_length()
             for li in expired_leases_configured:
                 sf.cancel_lease(li.cancel_secret)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
-            self.increment_space("original", s, sharetype)
+            self.increment_space("original", space, sharetype)
 
         if num_valid_leases_configured == 0:
             would_keep_share[1] = 0
-            self.increment_space("configured", s, sharetype)
+            self.increment_space("configured", space, sharetype)
             if self.expiration_enabled:
                 would_keep_share[2] = 0
-                self.increment_space("actual", s, sharetype)
+                self.increment_space("actual", space, sharetype)
 
         return would_keep_share
 
-    def increment_space(self, a, s, sharetype):
+    def get_space(self, s):
         sharebytes = s.st_size
         try:
             # note that stat(2) says that st_blocks is 512 bytes, and that
@@ -233,12 +326,20 @@ class LeaseCheckingCrawler(ShareCrawler):
             # the docs say that st_blocks is only on linux. I also see it on
             # MacOS. But it isn't available on windows.
             diskbytes = sharebytes
+        return (sharebytes, diskbytes)
+
+    def increment_space(self, a, space, sharetype):
+        self.add_space(a, 1, space, sharetype)
+
+    def add_space(self, a, shares, space, sharetype):
+        # 'space' is the total (sharebytes, diskbytes) of 'shares' shares
+        (sharebytes, diskbytes) = space
         so_far_sr = self.state["cycle-to-date"]["space-recovered"]
-        self.increment(so_far_sr, a+"-shares", 1)
+        self.increment(so_far_sr, a+"-shares", shares)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
         self.increment(so_far_sr, a+"-diskbytes", diskbytes)
         if sharetype:
-            self.increment(so_far_sr, a+"-shares-"+sharetype, 1)
+            self.increment(so_far_sr, a+"-shares-"+sharetype, shares)
             self.increment(so_far_sr, a+"-sharebytes-"+sharetype, sharebytes)
             self.increment(so_far_sr, a+"-diskbytes-"+sharetype, diskbytes)
 
@@ -256,7 +357,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         d[k] += delta
 
     def add_lease_age_to_histogram(self, age):
-        bucket_interval = 24*60*60
+        bucket_interval = AGE_HISTOGRAM_INTERVAL
         bucket_number = int(age/bucket_interval)
         bucket_start = bucket_number * bucket_interval
         bucket_end = bucket_start + bucket_interval
@@ -274,6 +375,9 @@ class LeaseCheckingCrawler(ShareCrawler):
         return json_safe_lah
 
     def finished_cycle(self, cycle):
+        if self.server.packs:
+            # reclaim the space of the packed shares that expired
+            self.server.packs.compact()
         # add to our history state, prune old history
         h = {}
 
@@ -422,3 +526,179 @@ class LeaseCheckingCrawler(ShareCrawler):
         state["estimated-remaining-cycle"] = remaining
         state["estimated-current-cycle"] = cycle
         return state
+
+
+class IndexedLeaseCheckingCrawler(LeaseCheckingCrawler):
+    """I am a LeaseCheckingCrawler for servers that keep their leases in a
+    LeaseDB. I visit the same prefixes in the same order, and produce the
+    same state and history, but I do not look at buckets or shares one at a
+    time. For each prefix, a few aggregate queries on the database give me
+    the sizes and lease histograms of all of its shares, and range queries
+    on the lease expiration index give me the shares that have expired
+    (which are the only shares I look at individually). The only files I
+    touch are the shares that I delete, and their bucket directories,
+    which I stat to account for the space they would free. Shares in pack
+    files keep their leases in the pack index, so I still examine those
+    one by one.
+
+    The database is maintained by the storage server as leases are added,
+    renewed, and cancelled, so shares which are added to the storage
+    directory by hand are not seen until they are imported with 'tahoe
+    admin import-leases'.
+    """
+
+    # there are no disk reads to do ahead of time, and the lease database
+    # may only be used from the reactor thread
+    prefetch_safe = False
+
+    def list_prefixdir(self, prefix, prefixdir):
+        # process_prefixdir() asks the database about the whole prefix
+        return []
+
+    def get_configured_cutoff(self, now):
+        """Return the expiration time at or before which process_leases()
+        would consider a lease to have expired, for the share types that
+        we expire."""
+        # leases are granted or renewed LEASE_DURATION before they expire
+        # (see LeaseInfo.get_grant_renew_time_time()), so each rule is a
+        # bound on the expiration time
+        if self.mode == "age":
+            if self.override_lease_duration is not None:
+                limit = now + LEASE_DURATION - self.override_lease_duration
+            else:
+                # process_leases() compares the age of the lease with its
+                # original expiration time
+                limit = (now + LEASE_DURATION) / 2.0
+        else:
+            limit = self.cutoff_date + LEASE_DURATION
+        # a lease has expired if its (integer) expiration time is < limit
+        return int(math.ceil(limit)) - 1
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        leasedb = self.server.leasedb
+        now = time.time()
+        so_far = self.state["cycle-to-date"]
+
+        for (sharetype, shares, sharebytes, diskbytes) \
+                in leasedb.get_prefix_space(prefix):
+            self.add_space("examined", shares, (sharebytes, diskbytes),
+                           sharetype)
+        for (num_leases, shares) \
+                in leasedb.get_prefix_leases_per_share(prefix).items():
+            self.increment(so_far["leases-per-share-histogram"], num_leases,
+                           shares)
+        ages = leasedb.get_prefix_lease_ages(prefix, now + LEASE_DURATION,
+                                             AGE_HISTOGRAM_INTERVAL)
+        for (n, leases) in ages.items():
+            k = (n * AGE_HISTOGRAM_INTERVAL, (n+1) * AGE_HISTOGRAM_INTERVAL)
+            self.increment(so_far["lease-age-histogram"], k, leases)
+
+        # the shares that would go (or will go) under each rule
+        configured_cutoff = self.get_configured_cutoff(now)
+        configured = [row for row
+                      in leasedb.get_prefix_expired_space(prefix,
+                                                          configured_cutoff)
+                      if row[2] in self.sharetypes_to_expire or row[5] == 0]
+        gone = {"original": leasedb.get_prefix_expired_space(prefix, now),
+                "configured": configured}
+        if self.expiration_enabled:
+            gone["actual"] = configured
+        for (a, rows) in gone.items():
+            for (storage_index, shnum, sharetype, sharebytes, diskbytes,
+                 num_leases) in rows:
+                self.increment_space(a, (sharebytes, diskbytes), sharetype)
+
+        # a bucket goes when all of its shares, in the database and in pack
+        # files, go. Its type is that of its last share, packed or not.
+        bucket_types = leasedb.get_prefix_bucket_types(prefix)
+        db_shares = {} # storage_index -> get_bucket_shares(), for a few
+        def _get_db_shares(storage_index):
+            if storage_index not in db_shares:
+                db_shares[storage_index] = \
+                    leasedb.get_bucket_shares(storage_index)
+            return db_shares[storage_index]
+        packed = {} # storage_index -> would_keep_shares of packed shares
+        if self.server.packs:
+            for storage_index_b32 \
+                    in sorted(self.server.packs.count_prefix(prefix)):
+                would_keep_shares = []
+                self.process_packed_shares(storage_index_b32,
+                                           would_keep_shares)
+                storage_index = si_a2b(storage_index_b32)
+                packed[storage_index] = would_keep_shares
+                shares = _get_db_shares(storage_index)
+                if shares:
+                    bucket_types[shares[-1][1]] -= 1
+                if would_keep_shares:
+                    self.increment(bucket_types, would_keep_shares[-1][3], 1)
+        for (sharetype, buckets) in bucket_types.items():
+            self.increment(so_far["space-recovered"], "examined-buckets",
+                           buckets)
+            self.increment(so_far["space-recovered"],
+                           "examined-buckets-"+sharetype, buckets)
+
+        bucket_space = {} # storage_index -> (diskbytes, sharetype)
+        for (i, a) in enumerate(("original", "configured", "actual")):
+            gone_shares = {}
+            for row in gone.get(a, []):
+                self.increment(gone_shares, row[0], 1)
+            for storage_index in packed:
+                gone_shares.setdefault(storage_index, 0)
+            for (storage_index, num_gone) in sorted(gone_shares.items()):
+                shares = _get_db_shares(storage_index)
+                would_keep_shares = packed.get(storage_index, [])
+                if not shares and not would_keep_shares:
+                    continue # its packed shares went away before we looked
+                if num_gone < len(shares):
+                    continue
+                if sum([wks[i] for wks in would_keep_shares]):
+                    continue
+                if storage_index not in bucket_space:
+                    # before any of its shares are deleted
+                    bucketdir = os.path.join(prefixdir,
+                                             si_b2a(storage_index))
+                    if would_keep_shares:
+                        sharetype = would_keep_shares[-1][3]
+                    else:
+                        sharetype = shares[-1][1]
+                    bucket_space[storage_index] = \
+                        (self.get_bucket_diskbytes(bucketdir), sharetype)
+                (bucket_diskbytes, sharetype) = bucket_space[storage_index]
+                self.increment_bucketspace(a, bucket_diskbytes, sharetype)
+
+        if self.expiration_enabled:
+            self.expire_leases(prefix, prefixdir, configured_cutoff)
+
+    def expire_leases(self, prefix, prefixdir, cutoff):
+        """Cancel the leases in one prefix that expire at or before
+        'cutoff', which deletes the shares that have no other leases."""
+        leasedb = self.server.leasedb
+        # the shares that are about to go, which must be measured first
+        doomed = set(leasedb.get_expired_shares(cutoff, prefix))
+        expired = {} # (storage_index, shnum) -> (sharetype, cancel_secrets)
+        for (storage_index, shnum, sharetype, cancel_secret) \
+                in leasedb.get_expired_leases(cutoff, prefix):
+            if sharetype not in self.sharetypes_to_expire:
+                continue
+            (ignored, cancel_secrets) = expired.setdefault(
+                (storage_index, shnum), (sharetype, set()))
+            cancel_secrets.add(cancel_secret)
+        for ((storage_index, shnum), (sharetype, cancel_secrets)) \
+                in sorted(expired.items()):
+            sharefile = os.path.join(prefixdir, si_b2a(storage_index),
+                                     "%d" % shnum)
+            sf = LeasedShare(leasedb, storage_index, shnum, sharefile,
+                             sharetype)
+            data_length = None
+            if (storage_index, shnum) in doomed:
+                try:
+                    data_length = sf.get_data_length()
+                except (UnknownMutableContainerVersionError,
+                        UnknownImmutableContainerVersionError,
+                        struct.error, EnvironmentError):
+                    pass # the next bucket count will correct for it
+            for cancel_secret in sorted(cancel_secrets):
+                sf.cancel_lease(cancel_secret)
+            if (storage_index, shnum) in doomed:
+                self.server.share_removed(storage_index, shnum, sharetype,
+                                          data_length)
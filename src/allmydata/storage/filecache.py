@@ -0,0 +1,254 @@
+import os, mmap, thread, threading
+
+DEFAULT_MAX_OPEN_FILES = 64
+
+def _signature(s):
+    return (s.st_ino, s.st_size, s.st_mtime)
+
+class _CachedFile:
+    def __init__(self, f, signature):
+        self.f = f
+        self.signature = signature
+        self.metadata = None
+        self.mmap = None
+        self.last_used = 0
+        self.users = 0
+        self.owner = None # the thread that is using the handle
+        self.forgotten = False
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        self.f.close()
+
+class FileHandleCache:
+    """I keep a bounded number of share files open for reading, so that the
+    storage server does not have to open, fstat and close a share file (and
+    re-parse its container header) for every block that a client reads.
+
+    open() returns a read-only file object. The caller must give it back
+    with release() when it is done, and must seek() before every read,
+    since other readers share it. Alongside each handle I can remember a
+    small piece of metadata (like the parsed container header), which is
+    forgotten with the handle. Only trust get_metadata() between open() and
+    release(), since open() checks that the file has not changed.
+
+    When more than 'max_open' files are open, the least recently used one
+    is closed. The storage server calls invalidate() whenever it modifies a
+    share file (lease changes, mutable writes, deletion, or a new share
+    landing at the same filename). Changes made behind its back are caught
+    too: each hit compares the file's inode, size and mtime against the
+    open handle, which costs a stat() but not an open() and close(). Pack
+    files only ever grow, so the PackStore calls appended() instead, which
+    keeps the handle open.
+
+    Large reads can use get_mmap() instead of the file object: slicing the
+    read-only mapping copies the bytes out of the page cache once, without
+    a read() syscall or stdio's intermediate buffer. The mapping lives as
+    long as the handle, so it costs nothing after the first large read.
+
+    I may be used from several threads (the storage server's disk I/O
+    pool). A handle belongs to one thread between open() and release(): a
+    second thread that opens the same file gets a private file object
+    (which release() closes), and get_metadata() and get_mmap() return
+    None to it. A handle that is evicted or invalidated while it is in use
+    is closed when its last user releases it.
+    """
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN_FILES):
+        assert max_open > 0, max_open
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._files = {} # filename -> _CachedFile
+        # file object -> _CachedFile, for every cached handle that is still
+        # open, including forgotten ones that wait for their last user
+        self._handles = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.mmap_reads = 0
+        self.private_opens = 0
+
+    def _touch(self, entry):
+        self._clock += 1
+        entry.last_used = self._clock
+
+    def _use(self, entry):
+        entry.users += 1
+        entry.owner = thread.get_ident()
+        return entry.f
+
+    def _owned(self, filename):
+        # the entry for filename, if the calling thread is using it
+        entry = self._files.get(filename)
+        if entry is None or not entry.users:
+            return None
+        if entry.owner != thread.get_ident():
+            return None
+        return entry
+
+    def open(self, filename):
+        self._lock.acquire()
+        try:
+            entry = self._files.get(filename)
+            if entry is not None:
+                try:
+                    current = _signature(os.stat(filename))
+                except EnvironmentError:
+                    current = None
+                if current == entry.signature:
+                    if entry.users and entry.owner != thread.get_ident():
+                        # another thread is reading from this handle
+                        self.private_opens += 1
+                        return open(filename, 'rb')
+                    self.hits += 1
+                    self._touch(entry)
+                    return self._use(entry)
+                # the file was replaced, modified, or deleted
+                self._invalidate(filename)
+            self.misses += 1
+            f = open(filename, 'rb')
+            entry = _CachedFile(f, _signature(os.fstat(f.fileno())))
+            self._files[filename] = entry
+            self._handles[f] = entry
+            self._touch(entry)
+            while len(self._files) > self.max_open:
+                self._evict_oldest()
+            return self._use(entry)
+        finally:
+            self._lock.release()
+
+    def release(self, f):
+        """Give back a file object that open() returned."""
+        self._lock.acquire()
+        try:
+            entry = self._handles.get(f)
+            if entry is None:
+                f.close() # a private handle
+                return
+            entry.users -= 1
+            if not entry.users:
+                entry.owner = None
+                if entry.forgotten:
+                    self._close(entry)
+        finally:
+            self._lock.release()
+
+    def _evict_oldest(self):
+        oldest = min(self._files, key=lambda fn: self._files[fn].last_used)
+        self.evictions += 1
+        self._forget(oldest)
+
+    def _forget(self, filename):
+        entry = self._files.pop(filename)
+        entry.forgotten = True
+        if not entry.users:
+            self._close(entry)
+
+    def _close(self, entry):
+        del self._handles[entry.f]
+        entry.close()
+
+    def get_metadata(self, filename):
+        self._lock.acquire()
+        try:
+            entry = self._owned(filename)
+            if entry is None:
+                return None
+            return entry.metadata
+        finally:
+            self._lock.release()
+
+    def set_metadata(self, filename, metadata):
+        self._lock.acquire()
+        try:
+            entry = self._owned(filename)
+            if entry is not None:
+                entry.metadata = metadata
+        finally:
+            self._lock.release()
+
+    def get_mmap(self, filename):
+        """Return a read-only mmap of the whole file, or None if it cannot
+        be mapped (it is empty, or the platform is out of address space).
+        Like get_metadata(), only call this between open() and release()."""
+        self._lock.acquire()
+        try:
+            entry = self._owned(filename)
+            if entry is None:
+                return None
+            if entry.mmap is None:
+                try:
+                    entry.mmap = mmap.mmap(entry.f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError):
+                    return None
+            self.mmap_reads += 1
+            return entry.mmap
+        finally:
+            self._lock.release()
+
+    def invalidate(self, filename):
+        self._lock.acquire()
+        try:
+            self._invalidate(filename)
+        finally:
+            self._lock.release()
+
+    def _invalidate(self, filename):
+        if filename in self._files:
+            self.invalidations += 1
+            self._forget(filename)
+
+    def appended(self, filename):
+        """Data was appended to this file, and nothing before it changed.
+        Its open handle (if any) can still read everything, so only its
+        signature is updated. A mapping only covers the old length: an idle
+        one is dropped, and a handle whose mapping is in use is forgotten
+        like invalidate() would."""
+        self._lock.acquire()
+        try:
+            entry = self._files.get(filename)
+            if entry is None:
+                return
+            if entry.mmap is not None:
+                if entry.users:
+                    self._invalidate(filename)
+                    return
+                entry.mmap.close()
+                entry.mmap = None
+            try:
+                entry.signature = _signature(os.stat(filename))
+            except EnvironmentError:
+                self._invalidate(filename)
+        finally:
+            self._lock.release()
+
+    def close_all(self):
+        """Close every handle, including ones that are in use. This is for
+        shutdown, once no more reads can happen."""
+        self._lock.acquire()
+        try:
+            self._files.clear()
+            for entry in self._handles.values():
+                entry.close()
+            self._handles.clear()
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "mmap_reads": self.mmap_reads,
+                "private_opens": self.private_opens,
+                "open_files": len(self._files),
+                }
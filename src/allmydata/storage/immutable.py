@@ -1,15 +1,18 @@
-import os, stat, struct, time
+import os, struct, time
 
 from foolscap.api import Referenceable
+from twisted.internet import defer
 
 from zope.interface import implements
 from allmydata.interfaces import RIBucketWriter, RIBucketReader
-from allmydata.util import base32, fileutil, log
+from allmydata.util import base32, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import constant_time_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.backend import LOCAL_DISK
+from allmydata.storage.scheduler import ANONYMOUS
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -39,18 +42,24 @@ from allmydata.storage.common import UnknownImmutableContainerVersionError, \
 class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
+    # reads at least this large are sliced out of an mmap of the share file
+    # (when a FileHandleCache is in use), rather than read()
+    MMAP_READ_THRESHOLD = 32*1024
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, filecache=None,
+                 backend=LOCAL_DISK):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If filecache is not None, reads of the share data go through that FileHandleCache. The file lives in 'backend' (see storage/backend.py). """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._filecache = filecache
+        self._backend = backend
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
-            assert not os.path.exists(self.home)
-            fileutil.make_dirs(os.path.dirname(self.home))
-            f = open(self.home, 'wb')
+            assert not backend.exists(self.home)
+            backend.make_dirs(os.path.dirname(self.home))
+            f = backend.open(self.home, 'wb')
             # The second field -- the four-byte share data length -- is no
             # longer used as of Tahoe v1.3.0, but we continue to write it in
             # there in case someone downgrades a storage server from >=
@@ -65,22 +74,54 @@ class ShareFile:
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            f = open(self.home, 'rb')
-            filesize = os.path.getsize(self.home)
-            (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
-            f.close()
-            if version != 1:
-                msg = "sharefile %s had version %d but we wanted 1" % \
-                      (filename, version)
-                raise UnknownImmutableContainerVersionError(msg)
-            self._num_leases = num_leases
-            self._lease_offset = filesize - (num_leases * self.LEASE_SIZE)
+            f = self._open_for_read()
+            try:
+                header = None
+                if filecache:
+                    header = filecache.get_metadata(self.home)
+                if header is None:
+                    header = self._read_header(f)
+                    if filecache:
+                        filecache.set_metadata(self.home, header)
+            finally:
+                self._done_reading(f)
+            (self._num_leases, self._lease_offset) = header
         self._data_offset = 0xc
 
+    def _read_header(self, f):
+        f.seek(0, 2)
+        filesize = f.tell()
+        f.seek(0)
+        (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
+        if version != 1:
+            msg = "sharefile %s had version %d but we wanted 1" % \
+                  (self.home, version)
+            raise UnknownImmutableContainerVersionError(msg)
+        return (num_leases, filesize - (num_leases * self.LEASE_SIZE))
+
+    def _open_for_read(self):
+        if self._filecache:
+            return self._filecache.open(self.home)
+        return self._backend.open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._filecache:
+            self._filecache.release(f)
+        else:
+            f.close()
+
+    def _invalidate(self):
+        if self._filecache:
+            self._filecache.invalidate(self.home)
+
     def unlink(self):
-        os.unlink(self.home)
+        self._invalidate()
+        self._backend.remove(self.home)
 
-    def read_share_data(self, offset, length):
+    def get_data_length(self):
+        return self._lease_offset - self._data_offset
+
+    def _read_share_data(self, f, offset, length):
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
         # beyond the end of the data return an empty string.
@@ -88,22 +129,78 @@ class ShareFile:
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return ""
-        f = open(self.home, 'rb')
+        if self._filecache and actuallength >= self.MMAP_READ_THRESHOLD:
+            m = self._filecache.get_mmap(self.home)
+            if m is not None:
+                return m[seekpos:seekpos+actuallength]
         f.seek(seekpos)
         return f.read(actuallength)
 
-    def write_share_data(self, offset, data):
-        length = len(data)
+    def read_share_data(self, offset, length):
+        f = self._open_for_read()
+        try:
+            return self._read_share_data(f, offset, length)
+        finally:
+            self._done_reading(f)
+
+    def readv(self, readv):
+        datav = []
+        f = self._open_for_read()
+        try:
+            for (offset, length) in readv:
+                datav.append(self._read_share_data(f, offset, length))
+        finally:
+            self._done_reading(f)
+        return datav
+
+    def prefetch(self, readv):
+        """Tell the OS that the (offset, length) ranges of share data will
+        be read soon. Return False if it cannot take the hint."""
+        f = self._open_for_read()
+        try:
+            for (offset, length) in readv:
+                seekpos = self._data_offset+offset
+                actuallength = max(0, min(length, self._lease_offset-seekpos))
+                if (actuallength and
+                    not self._backend.advise_willneed(f, seekpos,
+                                                      actuallength)):
+                    return False
+        finally:
+            self._done_reading(f)
+        return True
+
+    def check_write(self, offset, length):
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        f = open(self.home, 'rb+')
+
+    def _write_share_data(self, f, offset, data):
         real_offset = self._data_offset+offset
         f.seek(real_offset)
         assert f.tell() == real_offset
         f.write(data)
+
+    def write_share_data(self, offset, data):
+        self.check_write(offset, len(data))
+        f = self._backend.open(self.home, 'rb+')
+        self._write_share_data(f, offset, data)
         f.close()
 
+    def writev_share_data(self, datav, fsync=False):
+        """Write a list of (offset, data) pairs, in order, with a single
+        open() of the share file. If fsync=True, make sure they (and
+        everything written before them) are on the disk before returning."""
+        for (offset, data) in datav:
+            self.check_write(offset, len(data))
+        f = self._backend.open(self.home, 'rb+')
+        try:
+            for (offset, data) in datav:
+                self._write_share_data(f, offset, data)
+            if fsync:
+                self._backend.fsync(f)
+        finally:
+            f.close()
+
     def _write_lease_record(self, f, lease_number, lease_info):
         offset = self._lease_offset + lease_number * self.LEASE_SIZE
         f.seek(offset)
@@ -124,7 +221,7 @@ class ShareFile:
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        f = open(self.home, 'rb')
+        f = self._backend.open(self.home, 'rb')
         (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
         f.seek(self._lease_offset)
         for i in range(num_leases):
@@ -133,7 +230,8 @@ class ShareFile:
                 yield LeaseInfo().from_immutable_data(data)
 
     def add_lease(self, lease_info):
-        f = open(self.home, 'rb+')
+        self._invalidate()
+        f = self._backend.open(self.home, 'rb+')
         num_leases = self._read_num_leases(f)
         self._write_lease_record(f, num_leases, lease_info)
         self._write_num_leases(f, num_leases+1)
@@ -146,7 +244,8 @@ class ShareFile:
                 if new_expire_time > lease.expiration_time:
                     # yes
                     lease.expiration_time = new_expire_time
-                    f = open(self.home, 'rb+')
+                    self._invalidate()
+                    f = self._backend.open(self.home, 'rb+')
                     self._write_lease_record(f, i, lease)
                     f.close()
                 return
@@ -181,7 +280,8 @@ class ShareFile:
             # the same order as they were added, so that if we crash while
             # doing this, we won't lose any non-cancelled leases.
             leases = [l for l in leases if l] # remove the cancelled leases
-            f = open(self.home, 'rb+')
+            self._invalidate()
+            f = self._backend.open(self.home, 'rb+')
             for i,lease in enumerate(leases):
                 self._write_lease_record(f, i, lease)
             self._write_num_leases(f, len(leases))
@@ -189,15 +289,19 @@ class ShareFile:
             f.close()
         space_freed = self.LEASE_SIZE * num_leases_removed
         if not len(leases):
-            space_freed += os.stat(self.home)[stat.ST_SIZE]
+            space_freed += self._backend.getsize(self.home)
             self.unlink()
         return space_freed
 
 
 class BucketWriter(Referenceable):
     implements(RIBucketWriter)
+    # who our writes are charged to (see StorageServer.schedule_call)
+    client = ANONYMOUS
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary,
+                 write_buffer=None, fsync=False, packer=None,
+                 backend=LOCAL_DISK):
         self.ss = ss
         self.incominghome = incominghome
         self.finalhome = finalhome
@@ -205,30 +309,111 @@ class BucketWriter(Referenceable):
         self._canary = canary
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
+        self._closing = False
+        self._pending_writes = [] # Deferreds, when writes use the I/O pool
+        # writes are held here (a WriteBuffer) until there are enough of
+        # them, or until the share is closed
+        self._write_buffer = write_buffer
+        self._fsync = fsync
+        # a small share is handed to this function when it is closed, to be
+        # appended to a pack file (see storage/packed.py), instead of being
+        # moved into place. It returns the location of the share's data.
+        self._packer = packer
+        self.packed = packer is not None
+        self.pack_location = None
         self.throw_out_all_data = False
-        self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
+        self._backend = backend
+        self._sharefile = ShareFile(incominghome, create=True, max_size=max_size,
+                                    backend=backend)
         # also, add our lease to the file now, so that other ones can be
-        # added by simultaneous uploaders
+        # added by simultaneous uploaders. A server with a lease database
+        # records it there too, once the share is closed.
+        self.lease_info = lease_info
         self._sharefile.add_lease(lease_info)
 
     def allocated_size(self):
         return self._max_size
 
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self.ss.scheduler.call(self.client, self, methodname, args,
+                                      kwargs)
+
     def remote_write(self, offset, data):
         start = time.time()
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
+        if self._write_buffer is not None:
+            self._sharefile.check_write(offset, len(data))
+            if not self._write_buffer.add(offset, data):
+                self._written(start)
+                return
+            write = self._sharefile.writev_share_data
+            args = (self._write_buffer.take(),)
+        else:
+            write = self._sharefile.write_share_data
+            args = (offset, data)
+        if self.ss.diskio:
+            d = self.ss.diskio.run(write, *args)
+            self._pending_writes.append(d)
+            def _done(res):
+                self._pending_writes.remove(d)
+                self._written(start)
+                return res
+            d.addBoth(_done)
+            return d
+        write(*args)
+        self._written(start)
+
+    def _written(self, start):
         self.ss.add_latency("write", time.time() - start)
         self.ss.count("write")
 
+    def _when_written(self):
+        # fires when the writes that are still in the I/O pool are done
+        return defer.DeferredList(list(self._pending_writes))
+
     def remote_close(self):
-        precondition(not self.closed)
+        precondition(not self.closed and not self._closing)
         start = time.time()
-
-        fileutil.make_dirs(os.path.dirname(self.finalhome))
-        fileutil.rename(self.incominghome, self.finalhome)
+        datav = []
+        if self._write_buffer is not None:
+            datav = self._write_buffer.take()
+        if self.ss.diskio:
+            # the client does not wait for its writes to finish before it
+            # closes the share, so we must
+            self._closing = True
+            d = self._when_written()
+            d.addCallback(lambda ign: self.ss.diskio.run(self._finish, datav))
+            d.addCallback(self._closed, start)
+            return d
+        self._closed(self._finish(datav), start)
+
+    def _finish(self, datav):
+        if self.packed:
+            return self._pack(datav)
+        # the rest of the buffered data goes out in one last write, and the
+        # share is synced (if at all) just once, before it is moved
+        if datav or self._fsync:
+            self._sharefile.writev_share_data(datav, fsync=self._fsync)
+        return self._move_into_place()
+
+    def _pack(self, datav):
+        if datav:
+            self._sharefile.writev_share_data(datav)
+        data = self._sharefile.read_share_data(0, self._max_size)
+        self.pack_location = self._packer(data)
+        self._backend.remove(self.incominghome)
+        self._remove_incoming_dirs()
+        return len(data)
+
+    def _move_into_place(self):
+        self._backend.make_dirs(os.path.dirname(self.finalhome))
+        self._backend.rename(self.incominghome, self.finalhome)
+        self._remove_incoming_dirs()
+        return self._backend.getsize(self.finalhome)
+
+    def _remove_incoming_dirs(self):
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -241,49 +426,64 @@ class BucketWriter(Referenceable):
             # their children to know when they should do the rmdir. This
             # approach is simpler, but relies on os.rmdir refusing to delete
             # a non-empty directory. Do *not* use fileutil.rm_dir() here!
-            os.rmdir(os.path.dirname(self.incominghome))
+            parentdir = os.path.dirname(self.incominghome)
+            self._backend.rmdir(parentdir)
             # we also delete the grandparent (prefix) directory, .../ab ,
             # again to avoid leaving directories lying around. This might
             # fail if there is another bucket open that shares a prefix (like
             # ab/abfff).
-            os.rmdir(os.path.dirname(os.path.dirname(self.incominghome)))
+            self._backend.rmdir(os.path.dirname(parentdir))
             # we leave the great-grandparent (incoming/) directory in place.
         except EnvironmentError:
             # ignore the "can't rmdir because the directory is not empty"
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
+
+    def _closed(self, filelen, start):
         self._sharefile = None
         self.closed = True
         self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
 
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
         self.ss.bucket_writer_closed(self, filelen)
         self.ss.add_latency("close", time.time() - start)
         self.ss.count("close")
 
     def _disconnected(self):
-        if not self.closed:
+        if not self.closed and not self._closing:
             self._abort()
 
     def remote_abort(self):
         log.msg("storage: aborting sharefile %s" % self.incominghome,
                 facility="tahoe.storage", level=log.UNUSUAL)
-        if not self.closed:
+        if not self.closed and not self._closing:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
         self._abort()
         self.ss.count("abort")
 
     def _abort(self):
-        if self.closed:
+        if self.closed or self._closing:
+            # a close (or an earlier abort) is already under way, and will
+            # tell the server when it is done
+            return
+        if self._pending_writes:
+            # let the writes finish before the file goes away
+            self._closing = True
+            d = self._when_written()
+            d.addCallback(lambda ign: self._discard())
             return
+        self._discard()
 
-        os.remove(self.incominghome)
+    def _discard(self):
+        if self._write_buffer is not None:
+            self._write_buffer.discard()
+
+        self._backend.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
-        if not os.listdir(parentdir):
-            os.rmdir(parentdir)
+        if not self._backend.listdir(parentdir):
+            self._backend.rmdir(parentdir)
         self._sharefile = None
 
         # We are now considered closed for further writing. We must tell
@@ -295,10 +495,17 @@ class BucketWriter(Referenceable):
 
 class BucketReader(Referenceable):
     implements(RIBucketReader)
+    # who our reads are charged to (see StorageServer.schedule_call)
+    client = ANONYMOUS
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 filecache=None, share_file=None, backend=LOCAL_DISK):
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        if share_file is None:
+            share_file = ShareFile(sharefname, filecache=filecache,
+                                   backend=backend)
+        # anything with ShareFile's read methods, like a PackedShare
+        self._share_file = share_file
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -307,15 +514,46 @@ class BucketReader(Referenceable):
                                base32.b2a_l(self.storage_index[:8], 60),
                                self.shnum)
 
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self.ss.scheduler.call(self.client, self, methodname, args,
+                                      kwargs)
+
+    def _finished(self, result, category, start):
+        self.ss.add_latency(category, time.time() - start)
+        self.ss.count(category)
+        return result
+
     def remote_read(self, offset, length):
         start = time.time()
+        if self.ss.diskio:
+            d = self.ss.diskio.run(self._share_file.read_share_data,
+                                   offset, length)
+            d.addCallback(self._finished, "read", start)
+            return d
         data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
-        return data
+        return self._finished(data, "read", start)
+
+    def remote_readv(self, readv):
+        start = time.time()
+        if self.ss.diskio:
+            d = self.ss.diskio.run(self._share_file.readv, readv)
+            d.addCallback(self._finished, "read-vector", start)
+            return d
+        datav = self._share_file.readv(readv)
+        return self._finished(datav, "read-vector", start)
+
+    def remote_prefetch(self, readv):
+        self.ss.count("prefetch")
+        if self._share_file.prefetch(readv):
+            return
+        # without posix_fadvise, a disk I/O thread reads the data into the
+        # page cache instead. Without those, the hint is ignored: reading
+        # here would make the client wait for the disk after all.
+        if self.ss.diskio:
+            d = self.ss.diskio.run(self._share_file.readv, readv)
+            d.addErrback(lambda f: None)
 
     def remote_advise_corrupt_share(self, reason):
-        return self.ss.remote_advise_corrupt_share("immutable",
-                                                   self.storage_index,
-                                                   self.shnum,
-                                                   reason)
+        return self.ss.advise_corrupt_share(self.client, "immutable",
+                                            self.storage_index, self.shnum,
+                                            reason)
@@ -0,0 +1,486 @@
+import os, stat, struct
+
+from allmydata.util import base32
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError, UnknownLeaseDBVersionError
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.shares import get_share_file
+
+# The lease database lives in storage/leasedb.sqlite . Once a server has
+# one, it is the authoritative record of leases: the lease records inside
+# the share files are left alone (new immutable shares are still created
+# with their initial lease, since the container format requires it), but
+# nothing reads or updates them.
+
+SCHEMA_v1 = """
+CREATE TABLE version -- added in v1
+(
+ version INTEGER  -- contains one row, set to 2
+);
+
+CREATE TABLE leases -- added in v1
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ owner_num INTEGER,
+ renew_secret VARCHAR(52) NOT NULL,   -- base32(renew_secret)
+ cancel_secret VARCHAR(52) NOT NULL,  -- base32(cancel_secret)
+ expiration_time INTEGER NOT NULL,    -- seconds since epoch
+ nodeid VARCHAR(32),                  -- base32(nodeid), NULL for immutable
+ PRIMARY KEY (storage_index, shnum, renew_secret)
+);
+
+CREATE INDEX leases_by_expiration ON leases (expiration_time);
+"""
+
+TABLE_SHARES = """
+
+CREATE TABLE shares -- added in v2
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,       -- 'mutable' or 'immutable'
+ sharebytes INTEGER NOT NULL,         -- os.stat(fn).st_size
+ diskbytes INTEGER NOT NULL,          -- os.stat(fn).st_blocks*512
+ PRIMARY KEY (storage_index, shnum)
+);
+
+"""
+
+SCHEMA_v2 = SCHEMA_v1 + TABLE_SHARES
+
+UPDATE_v1_to_v2 = TABLE_SHARES + """
+UPDATE version SET version=2;
+"""
+
+def get_leasedb(dbfile):
+    """Open the lease database in 'dbfile', creating or upgrading it if
+    necessary. I return a LeaseDB. Its .must_import attribute is True if
+    the file did not exist before, or was upgraded from a version that did
+    not record everything that the current one does. In that case the
+    caller probably wants to import the leases and share sizes from the
+    existing share files with import_share_leases()."""
+    import sqlite3
+    must_create = not os.path.exists(dbfile)
+    db = sqlite3.connect(dbfile)
+    c = db.cursor()
+    if must_create:
+        c.executescript(SCHEMA_v2)
+        c.execute("INSERT INTO version (version) VALUES (?)", (2,))
+        db.commit()
+    try:
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+    except sqlite3.DatabaseError, e:
+        raise UnknownLeaseDBVersionError("lease database %s is unusable: %s"
+                                         % (dbfile, e))
+    must_import = must_create
+    if version == 1:
+        c.executescript(UPDATE_v1_to_v2)
+        db.commit()
+        version = 2
+        must_import = True # to fill in the shares table
+    if version != 2:
+        raise UnknownLeaseDBVersionError("unable to handle lease database "
+                                         "version %s in %s" % (version, dbfile))
+    ldb = LeaseDB(db)
+    ldb.created = must_create
+    ldb.must_import = must_import
+    return ldb
+
+def get_share_space(filename):
+    """Return (sharebytes, diskbytes) for a share file, the way the lease
+    checker measures them."""
+    s = os.stat(filename)
+    try:
+        diskbytes = s.st_blocks * 512
+    except AttributeError:
+        diskbytes = s.st_size # no stat().st_blocks on windows
+    return (s.st_size, diskbytes)
+
+def _prefix_range(prefix):
+    # the (low, high) bounds of the base32 storage indexes that start with
+    # 'prefix': every base32 character sorts before '~'
+    return (prefix, prefix + "~")
+
+def _nodeid_b2a(nodeid):
+    if nodeid is None:
+        return None
+    return base32.b2a(nodeid)
+
+def _nodeid_a2b(nodeid_s):
+    if nodeid_s is None:
+        return None
+    return base32.a2b(str(nodeid_s))
+
+class LeaseDB:
+    """I hold the leases for all of a storage server's shares in a SQLite
+    table, indexed by (storage_index, shnum, renew_secret) and by expiration
+    time. Renewing every lease on a bucket is a single UPDATE, instead of a
+    read-modify-write of every share file, and finding expired leases is a
+    range query on the expiration index. A second table records the type
+    and size of each share, so that the lease checker can account for
+    shares without looking at them.
+
+    Every mutating method except import_leases() and record_share() commits
+    before it returns.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.created = False
+        self.must_import = False
+
+    def close(self):
+        self.connection.close()
+
+    def _lease_from_row(self, row):
+        (owner_num, renew_secret_s, cancel_secret_s, expiration_time,
+         nodeid_s) = row
+        return LeaseInfo(owner_num,
+                         base32.a2b(str(renew_secret_s)),
+                         base32.a2b(str(cancel_secret_s)),
+                         expiration_time, _nodeid_a2b(nodeid_s))
+
+    def get_leases(self, storage_index, shnum):
+        """Return a list of LeaseInfo instances for one share, in the order
+        they were first added."""
+        self.cursor.execute("SELECT owner_num, renew_secret, cancel_secret,"
+                            " expiration_time, nodeid FROM leases"
+                            " WHERE storage_index=? AND shnum=?"
+                            " ORDER BY rowid",
+                            (si_b2a(storage_index), shnum))
+        return [self._lease_from_row(row) for row in self.cursor.fetchall()]
+
+    def _add_or_renew(self, si_s, shnum, lease_info):
+        # an existing lease keeps its cancel_secret, and is only extended
+        self.cursor.execute("INSERT OR IGNORE INTO leases"
+                            " (storage_index, shnum, owner_num, renew_secret,"
+                            "  cancel_secret, expiration_time, nodeid)"
+                            " VALUES (?,?,?,?,?,?,?)",
+                            (si_s, shnum, lease_info.owner_num,
+                             base32.b2a(lease_info.renew_secret),
+                             base32.b2a(lease_info.cancel_secret),
+                             int(lease_info.expiration_time),
+                             _nodeid_b2a(lease_info.nodeid)))
+        if not self.cursor.rowcount:
+            self.cursor.execute("UPDATE leases"
+                                " SET expiration_time=MAX(expiration_time, ?)"
+                                " WHERE storage_index=? AND shnum=?"
+                                " AND renew_secret=?",
+                                (int(lease_info.expiration_time), si_s, shnum,
+                                 base32.b2a(lease_info.renew_secret)))
+
+    def add_or_renew_leases(self, storage_index, shnums, lease_info):
+        si_s = si_b2a(storage_index)
+        for shnum in shnums:
+            self._add_or_renew(si_s, shnum, lease_info)
+        self.connection.commit()
+
+    def import_leases(self, storage_index, shnum, leases):
+        """Copy a share's existing lease records (an iterable of LeaseInfo
+        instances) into the database. For bulk imports, this does not
+        commit: call commit() afterwards."""
+        si_s = si_b2a(storage_index)
+        for lease_info in leases:
+            self._add_or_renew(si_s, shnum, lease_info)
+
+    def commit(self):
+        self.connection.commit()
+
+    def renew_leases(self, storage_index, renew_secret, new_expire_time,
+                     shnum=None):
+        """Extend every lease with this renew_secret on the given bucket (or
+        on just one share of it) to at least new_expire_time. Return the
+        number of leases that matched."""
+        query = ("UPDATE leases SET expiration_time=MAX(expiration_time, ?)"
+                 " WHERE storage_index=? AND renew_secret=?")
+        args = [int(new_expire_time), si_b2a(storage_index),
+                base32.b2a(renew_secret)]
+        if shnum is not None:
+            query += " AND shnum=?"
+            args.append(shnum)
+        self.cursor.execute(query, args)
+        matched = self.cursor.rowcount
+        self.connection.commit()
+        return matched
+
+    def cancel_leases(self, storage_index, shnum, cancel_secret):
+        """Remove the leases on one share that have the given cancel_secret.
+        Return the number of leases that were removed."""
+        self.cursor.execute("DELETE FROM leases"
+                            " WHERE storage_index=? AND shnum=?"
+                            " AND cancel_secret=?",
+                            (si_b2a(storage_index), shnum,
+                             base32.b2a(cancel_secret)))
+        removed = self.cursor.rowcount
+        self.connection.commit()
+        return removed
+
+    def record_share(self, storage_index, shnum, sharetype, filename):
+        """Remember the type and current size of a share. This does not
+        commit: the server always adds or renews a lease right afterwards,
+        which does."""
+        (sharebytes, diskbytes) = get_share_space(filename)
+        self.cursor.execute("INSERT OR REPLACE INTO shares"
+                            " (storage_index, shnum, sharetype, sharebytes,"
+                            "  diskbytes)"
+                            " VALUES (?,?,?,?,?)",
+                            (si_b2a(storage_index), shnum, sharetype,
+                             sharebytes, diskbytes))
+
+    def remove_share(self, storage_index, shnum):
+        args = (si_b2a(storage_index), shnum)
+        self.cursor.execute("DELETE FROM leases"
+                            " WHERE storage_index=? AND shnum=?", args)
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?", args)
+        self.connection.commit()
+
+    def get_prefix_buckets(self, prefix):
+        """Return a sorted list of the base32 storage indexes of the buckets
+        that start with 'prefix', which the crawlers use to name the
+        storage/shares/ subdirectories."""
+        self.cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?"
+                            " ORDER BY storage_index",
+                            _prefix_range(prefix))
+        return [str(si_s) for (si_s,) in self.cursor.fetchall()]
+
+    def get_bucket_shares(self, storage_index):
+        """Return a list of (shnum, sharetype, sharebytes, diskbytes) tuples
+        for the shares of one bucket, sorted by shnum."""
+        self.cursor.execute("SELECT shnum, sharetype, sharebytes, diskbytes"
+                            " FROM shares WHERE storage_index=?"
+                            " ORDER BY shnum",
+                            (si_b2a(storage_index),))
+        return [(shnum, str(sharetype), sharebytes, diskbytes)
+                for (shnum, sharetype, sharebytes, diskbytes)
+                in self.cursor.fetchall()]
+
+    def get_expired_shares(self, cutoff, prefix=None):
+        """Return a sorted list of (storage_index, shnum) for the shares that
+        have at least one lease, but whose leases all expire at or before
+        'cutoff'. If 'prefix' is given, only look at the buckets whose
+        base32 storage index starts with it. This is a range query on the
+        expiration index."""
+        query = ("SELECT DISTINCT storage_index, shnum FROM leases"
+                 " WHERE expiration_time <= ?"
+                 " AND NOT EXISTS (SELECT 1 FROM leases AS l2"
+                 "  WHERE l2.storage_index=leases.storage_index"
+                 "  AND l2.shnum=leases.shnum"
+                 "  AND l2.expiration_time > ?)")
+        args = [int(cutoff), int(cutoff)]
+        if prefix is not None:
+            query += " AND storage_index >= ? AND storage_index < ?"
+            args.extend(_prefix_range(prefix))
+        query += " ORDER BY storage_index, shnum"
+        self.cursor.execute(query, args)
+        return [(si_a2b(str(si_s)), shnum)
+                for (si_s, shnum) in self.cursor.fetchall()]
+
+    def get_expired_leases(self, cutoff, prefix):
+        """Return a sorted list of (storage_index, shnum, sharetype,
+        cancel_secret) for the leases that expire at or before 'cutoff', on
+        the shares of the buckets that start with 'prefix'. This is a range
+        query on the expiration index."""
+        self.cursor.execute("SELECT leases.storage_index, leases.shnum,"
+                            " shares.sharetype, leases.cancel_secret"
+                            " FROM leases JOIN shares"
+                            " ON leases.storage_index=shares.storage_index"
+                            " AND leases.shnum=shares.shnum"
+                            " WHERE leases.expiration_time <= ?"
+                            " AND leases.storage_index >= ?"
+                            " AND leases.storage_index < ?"
+                            " ORDER BY leases.storage_index, leases.shnum,"
+                            " leases.rowid",
+                            (int(cutoff),) + _prefix_range(prefix))
+        return [(si_a2b(str(si_s)), shnum, str(sharetype),
+                 base32.a2b(str(cancel_secret_s)))
+                for (si_s, shnum, sharetype, cancel_secret_s)
+                in self.cursor.fetchall()]
+
+    # The lease checker uses the following to account for a whole prefix of
+    # buckets at once, without a row per share, except for the shares that
+    # would be deleted.
+
+    def get_prefix_space(self, prefix):
+        """Return a list of (sharetype, shares, sharebytes, diskbytes) tuples
+        that add up the shares of the buckets that start with 'prefix', by
+        share type."""
+        self.cursor.execute("SELECT sharetype, COUNT(*), SUM(sharebytes),"
+                            " SUM(diskbytes) FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?"
+                            " GROUP BY sharetype",
+                            _prefix_range(prefix))
+        return [(str(sharetype), shares, sharebytes, diskbytes)
+                for (sharetype, shares, sharebytes, diskbytes)
+                in self.cursor.fetchall()]
+
+    def get_prefix_bucket_types(self, prefix):
+        """Return a dict that maps each share type to the number of buckets
+        that start with 'prefix' whose highest-numbered share has that
+        type."""
+        # SQLite takes the bare 'sharetype' column from the MAX(shnum) row
+        self.cursor.execute("SELECT sharetype, COUNT(*) FROM"
+                            " (SELECT MAX(shnum), sharetype FROM shares"
+                            "  WHERE storage_index >= ? AND storage_index < ?"
+                            "  GROUP BY storage_index)"
+                            " GROUP BY sharetype",
+                            _prefix_range(prefix))
+        return dict([(str(sharetype), buckets)
+                     for (sharetype, buckets) in self.cursor.fetchall()])
+
+    def get_prefix_leases_per_share(self, prefix):
+        """Return a dict that maps a number of leases to the number of
+        shares (in the buckets that start with 'prefix') that have that many
+        leases."""
+        self.cursor.execute("SELECT num_leases, COUNT(*) FROM"
+                            " (SELECT COUNT(leases.shnum) AS num_leases"
+                            "  FROM shares LEFT JOIN leases"
+                            "  ON leases.storage_index=shares.storage_index"
+                            "  AND leases.shnum=shares.shnum"
+                            "  WHERE shares.storage_index >= ?"
+                            "  AND shares.storage_index < ?"
+                            "  GROUP BY shares.storage_index, shares.shnum)"
+                            " GROUP BY num_leases",
+                            _prefix_range(prefix))
+        return dict(self.cursor.fetchall())
+
+    def get_prefix_lease_ages(self, prefix, now, interval):
+        """Return a dict that maps n to the number of leases on the shares
+        of the buckets that start with 'prefix' whose age (now minus their
+        expiration time, in seconds) is at least n*interval but less than
+        (n+1)*interval. n is rounded towards zero, like int()."""
+        self.cursor.execute("SELECT CAST((? - leases.expiration_time) / ?"
+                            "  AS INTEGER) AS n, COUNT(*)"
+                            " FROM leases JOIN shares"
+                            " ON leases.storage_index=shares.storage_index"
+                            " AND leases.shnum=shares.shnum"
+                            " WHERE leases.storage_index >= ?"
+                            " AND leases.storage_index < ?"
+                            " GROUP BY n",
+                            (float(now), float(interval))
+                            + _prefix_range(prefix))
+        return dict(self.cursor.fetchall())
+
+    def get_prefix_expired_space(self, prefix, cutoff):
+        """Return a sorted list of (storage_index, shnum, sharetype,
+        sharebytes, diskbytes, num_leases) for the shares of the buckets
+        that start with 'prefix' that have no lease which expires after
+        'cutoff'. Unlike get_expired_shares(), this includes the shares
+        which have no leases at all."""
+        self.cursor.execute("SELECT storage_index, shnum, sharetype,"
+                            " sharebytes, diskbytes,"
+                            " (SELECT COUNT(*) FROM leases"
+                            "  WHERE leases.storage_index=shares.storage_index"
+                            "  AND leases.shnum=shares.shnum)"
+                            " FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?"
+                            " AND NOT EXISTS (SELECT 1 FROM leases"
+                            "  WHERE leases.storage_index=shares.storage_index"
+                            "  AND leases.shnum=shares.shnum"
+                            "  AND leases.expiration_time > ?)"
+                            " ORDER BY storage_index, shnum",
+                            _prefix_range(prefix) + (int(cutoff),))
+        return [(si_a2b(str(si_s)), shnum, str(sharetype), sharebytes,
+                 diskbytes, num_leases)
+                for (si_s, shnum, sharetype, sharebytes, diskbytes, num_leases)
+                in self.cursor.fetchall()]
+
+    def count_leases(self):
+        self.cursor.execute("SELECT COUNT(*) FROM leases")
+        return self.cursor.fetchone()[0]
+
+
+class LeasedShare:
+    """I stand in for a ShareFile or MutableShareFile, and present the lease
+    methods that the storage server and the lease-checking crawler use, but
+    keep the leases in a LeaseDB instead of in the share file itself. I do
+    not open the share file. Cancelling the last lease deletes the share,
+    just like the in-share lease code does; the caller must then tell the
+    server, with share_removed()."""
+
+    def __init__(self, leasedb, storage_index, shnum, home, sharetype):
+        self._leasedb = leasedb
+        self._storage_index = storage_index
+        self._shnum = shnum
+        self.home = home
+        self.sharetype = sharetype
+
+    def get_leases(self):
+        return iter(self._leasedb.get_leases(self._storage_index,
+                                             self._shnum))
+
+    def add_or_renew_lease(self, lease_info):
+        self._leasedb.add_or_renew_leases(self._storage_index, [self._shnum],
+                                          lease_info)
+
+    def renew_lease(self, renew_secret, new_expire_time):
+        if not self._leasedb.renew_leases(self._storage_index, renew_secret,
+                                          new_expire_time, self._shnum):
+            raise IndexError("unable to renew non-existent lease")
+
+    def get_data_length(self):
+        return get_share_file(self.home).get_data_length()
+
+    def cancel_lease(self, cancel_secret):
+        """Remove the leases with the given cancel_secret. Return the number
+        of bytes freed, which is nonzero only if the last lease was removed
+        and the share was deleted. Raise IndexError if there was no lease
+        with the given cancel_secret."""
+        if not self._leasedb.cancel_leases(self._storage_index, self._shnum,
+                                           cancel_secret):
+            raise IndexError("unable to find matching lease to cancel")
+        if self._leasedb.get_leases(self._storage_index, self._shnum):
+            return 0
+        try:
+            space_freed = os.stat(self.home)[stat.ST_SIZE]
+            os.unlink(self.home)
+        except EnvironmentError:
+            space_freed = 0 # someone else deleted it already
+        self._leasedb.remove_share(self._storage_index, self._shnum)
+        return space_freed
+
+
+def import_share_leases(sharedir, leasedb):
+    """Walk every share in 'sharedir' (the storage server's storage/shares
+    directory), record its type and size in 'leasedb', and copy its in-share
+    lease records there. Shares that cannot be parsed are skipped. Return a
+    tuple of (number of shares imported, number of leases imported, number
+    of shares skipped)."""
+    num_shares = num_leases = num_skipped = 0
+    for prefix in sorted(os.listdir(sharedir)):
+        if prefix == "incoming":
+            continue
+        prefixdir = os.path.join(sharedir, prefix)
+        if not os.path.isdir(prefixdir):
+            continue
+        for si_s in sorted(os.listdir(prefixdir)):
+            try:
+                storage_index = si_a2b(str(si_s))
+            except (AssertionError, UnicodeError):
+                continue # not a storage index
+            bucketdir = os.path.join(prefixdir, si_s)
+            for fn in sorted(os.listdir(bucketdir)):
+                try:
+                    shnum = int(fn)
+                except ValueError:
+                    continue # non-numeric means not a sharefile
+                try:
+                    sf = get_share_file(os.path.join(bucketdir, fn))
+                    leases = list(sf.get_leases())
+                    leasedb.record_share(storage_index, shnum, sf.sharetype,
+                                         sf.home)
+                except (UnknownMutableContainerVersionError,
+                        UnknownImmutableContainerVersionError,
+                        struct.error, EnvironmentError):
+                    num_skipped += 1
+                    continue
+                leasedb.import_leases(storage_index, shnum, leases)
+                num_shares += 1
+                num_leases += len(leases)
+        leasedb.commit()
+    return (num_shares, num_leases, num_skipped)
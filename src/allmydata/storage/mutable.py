@@ -1,4 +1,4 @@
-import os, stat, struct
+import struct
 
 from allmydata.interfaces import BadWriteEnablerError
 from allmydata.util import idlib, log
@@ -7,6 +7,7 @@ from allmydata.util.hashutil import constant_time_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
      DataTooLargeError
+from allmydata.storage.backend import LOCAL_DISK
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 
 
@@ -28,6 +29,12 @@ from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 # 7   468       (a)     data
 # 8   ??        4       count of extra leases
 # 9   ??        n*92    extra leases
+#
+# Growing the data of a v1 container moves the extra leases (8,9) out of the
+# way, so every write that extends a share copies them. Version 2 containers
+# (MutableShareFileV2, below) keep all of the leases between the header and
+# the data instead, so that the data runs to the end of the file and can be
+# written, extended and truncated in place.
 
 
 # The struct module doc says that L's are 4 bytes in size., and that Q's are
@@ -38,6 +45,7 @@ assert struct.calcsize(">Q") == 8, struct.calcsize(">Q")
 class MutableShareFile:
 
     sharetype = "mutable"
+    CONTAINER_VERSION = 1
     DATA_LENGTH_OFFSET = struct.calcsize(">32s20s32s")
     EXTRA_LEASE_OFFSET = DATA_LENGTH_OFFSET + 8
     HEADER_SIZE = struct.calcsize(">32s20s32sQQ") # doesn't include leases
@@ -53,34 +61,64 @@ class MutableShareFile:
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, filecache=None,
+                 backend=LOCAL_DISK):
         self.home = filename
-        if os.path.exists(self.home):
-            # we don't cache anything, just check the magic
-            f = open(self.home, 'rb')
-            data = f.read(self.HEADER_SIZE)
-            (magic,
-             write_enabler_nodeid, write_enabler,
-             data_length, extra_least_offset) = \
-             struct.unpack(">32s20s32sQQ", data)
-            if magic != self.MAGIC:
-                msg = "sharefile %s had magic '%r' but we wanted '%r'" % \
-                      (filename, magic, self.MAGIC)
-                raise UnknownMutableContainerVersionError(msg)
+        self._filecache = filecache
+        self._backend = backend
+        if backend.exists(self.home):
+            # just check the magic (a FileHandleCache remembers that we
+            # have checked it)
+            f = self._open_for_read()
+            try:
+                if not (filecache and filecache.get_metadata(self.home)):
+                    self._check_magic(f)
+            finally:
+                self._done_reading(f)
         self.parent = parent # for logging
 
+    def _check_magic(self, f):
+        f.seek(0)
+        data = f.read(self.HEADER_SIZE)
+        (magic,
+         write_enabler_nodeid, write_enabler,
+         data_length, extra_least_offset) = \
+         struct.unpack(">32s20s32sQQ", data)
+        if magic != self.MAGIC:
+            msg = "sharefile %s had magic '%r' but we wanted '%r'" % \
+                  (self.home, magic, self.MAGIC)
+            raise UnknownMutableContainerVersionError(msg)
+        if self._filecache:
+            # remember which kind of container this is
+            self._filecache.set_metadata(self.home, self.__class__)
+
+    def _open_for_read(self):
+        if self._filecache:
+            return self._filecache.open(self.home)
+        return self._backend.open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._filecache:
+            self._filecache.release(f)
+        else:
+            f.close()
+
+    def _invalidate(self):
+        if self._filecache:
+            self._filecache.invalidate(self.home)
+
     def log(self, *args, **kwargs):
         return self.parent.log(*args, **kwargs)
 
     def create(self, my_nodeid, write_enabler):
-        assert not os.path.exists(self.home)
+        assert not self._backend.exists(self.home)
         data_length = 0
         extra_lease_offset = (self.HEADER_SIZE
                               + 4 * self.LEASE_SIZE
                               + data_length)
         assert extra_lease_offset == self.DATA_OFFSET # true at creation
         num_extra_leases = 0
-        f = open(self.home, 'wb')
+        f = self._backend.open(self.home, 'wb')
         header = struct.pack(">32s20s32sQQ",
                              self.MAGIC, my_nodeid, write_enabler,
                              data_length, extra_lease_offset,
@@ -93,17 +131,36 @@ class MutableShareFile:
         f.close()
 
     def unlink(self):
-        os.unlink(self.home)
+        self._invalidate()
+        self._backend.remove(self.home)
 
     def _read_data_length(self, f):
         f.seek(self.DATA_LENGTH_OFFSET)
         (data_length,) = struct.unpack(">Q", f.read(8))
         return data_length
 
+    def get_data_length(self):
+        f = self._open_for_read()
+        try:
+            return self._read_data_length(f)
+        finally:
+            self._done_reading(f)
+
     def _write_data_length(self, f, data_length):
         f.seek(self.DATA_LENGTH_OFFSET)
         f.write(struct.pack(">Q", data_length))
 
+    def _get_data_offset(self, f):
+        return self.DATA_OFFSET
+
+    def get_data_offset(self):
+        """Return where the share data starts in my file."""
+        f = self._open_for_read()
+        try:
+            return self._get_data_offset(f)
+        finally:
+            self._done_reading(f)
+
     def _read_share_data(self, f, offset, length):
         precondition(offset >= 0)
         data_length = self._read_data_length(f)
@@ -114,7 +171,7 @@ class MutableShareFile:
         if length == 0:
             return ""
         precondition(offset+length <= data_length)
-        f.seek(self.DATA_OFFSET+offset)
+        f.seek(self._get_data_offset(f)+offset)
         data = f.read(length)
         return data
 
@@ -261,7 +318,7 @@ class MutableShareFile:
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        f = open(self.home, 'rb')
+        f = self._backend.open(self.home, 'rb')
         for i, lease in self._enumerate_leases(f):
             yield lease
         f.close()
@@ -277,7 +334,8 @@ class MutableShareFile:
 
     def add_lease(self, lease_info):
         precondition(lease_info.owner_num != 0) # 0 means "no lease here"
-        f = open(self.home, 'rb+')
+        self._invalidate()
+        f = self._backend.open(self.home, 'rb+')
         num_lease_slots = self._get_num_lease_slots(f)
         empty_slot = self._get_first_empty_lease_slot(f)
         if empty_slot is not None:
@@ -288,7 +346,8 @@ class MutableShareFile:
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
-        f = open(self.home, 'rb+')
+        self._invalidate()
+        f = self._backend.open(self.home, 'rb+')
         for (leasenum,lease) in self._enumerate_leases(f):
             if constant_time_compare(lease.renew_secret, renew_secret):
                 # yup. See if we need to update the owner time.
@@ -333,7 +392,8 @@ class MutableShareFile:
                                 cancel_secret="\x00"*32,
                                 expiration_time=0,
                                 nodeid="\x00"*20)
-        f = open(self.home, 'rb+')
+        self._invalidate()
+        f = self._backend.open(self.home, 'rb+')
         for (leasenum,lease) in self._enumerate_leases(f):
             accepting_nodeids.add(lease.nodeid)
             if constant_time_compare(lease.cancel_secret, cancel_secret):
@@ -345,7 +405,7 @@ class MutableShareFile:
             freed_space = self._pack_leases(f)
             f.close()
             if not remaining:
-                freed_space += os.stat(self.home)[stat.ST_SIZE]
+                freed_space += self._backend.getsize(self.home)
                 self.unlink()
             return freed_space
 
@@ -372,10 +432,12 @@ class MutableShareFile:
 
     def readv(self, readv):
         datav = []
-        f = open(self.home, 'rb')
-        for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
-        f.close()
+        f = self._open_for_read()
+        try:
+            for (offset, length) in readv:
+                datav.append(self._read_share_data(f, offset, length))
+        finally:
+            self._done_reading(f)
         return datav
 
 #    def remote_get_length(self):
@@ -385,7 +447,7 @@ class MutableShareFile:
 #        return data_length
 
     def check_write_enabler(self, write_enabler, si_s):
-        f = open(self.home, 'rb+')
+        f = self._backend.open(self.home, 'rb+')
         (real_write_enabler, write_enabler_nodeid) = \
                              self._read_write_enabler_and_nodeid(f)
         f.close()
@@ -405,7 +467,7 @@ class MutableShareFile:
 
     def check_testv(self, testv):
         test_good = True
-        f = open(self.home, 'rb+')
+        f = self._backend.open(self.home, 'rb+')
         for (offset, length, operator, specimen) in testv:
             data = self._read_share_data(f, offset, length)
             if not testv_compare(data, operator, specimen):
@@ -415,7 +477,8 @@ class MutableShareFile:
         return test_good
 
     def writev(self, datav, new_length):
-        f = open(self.home, 'rb+')
+        self._invalidate()
+        f = self._backend.open(self.home, 'rb+')
         for (offset, data) in datav:
             self._write_share_data(f, offset, data)
         if new_length is not None:
@@ -427,6 +490,193 @@ class MutableShareFile:
                 # self._change_container_size() here.
         f.close()
 
+
+# A version 2 container has a header of the same shape, but its last field
+# holds the offset of the share data, and all of the space between the
+# header and the data is lease slots:
+#
+# #   offset    size    name
+# 1   0         32      magic verstr "tahoe mutable container v2" plus binary
+# 2   32        20      write enabler's nodeid
+# 3   52        32      write enabler
+# 4   84        8       data size (actual share data present) (a)
+# 5   92        8       offset of (7) the share data (b)
+# 6   100       b-100   lease slots, 92 bytes each (four at creation)
+# 7   b         (a)     data, up to the end of the file
+
+class MutableShareFileV2(MutableShareFile):
+    """I am a version 2 mutable container. Writes to the share data never
+    move anything else, and shrinking the share truncates the file. When
+    every lease slot is taken, adding a lease doubles the number of slots
+    and moves the data along, which happens once in a long while rather
+    than on every write."""
+
+    CONTAINER_VERSION = 2
+    MAGIC = "Tahoe mutable container v2\n" + "\x75\x09\x44\x03\x8e"
+    assert len(MAGIC) == 32
+    DATA_OFFSET = None # it varies: see get_data_offset()
+    DATA_OFFSET_OFFSET = MutableShareFile.EXTRA_LEASE_OFFSET
+    INITIAL_LEASE_SLOTS = 4
+    # the share data is moved in pieces of this size
+    COPY_CHUNK_SIZE = 1024*1024
+
+    def create(self, my_nodeid, write_enabler):
+        assert not self._backend.exists(self.home)
+        data_offset = (self.HEADER_SIZE
+                       + self.INITIAL_LEASE_SLOTS * self.LEASE_SIZE)
+        f = self._backend.open(self.home, 'wb')
+        header = struct.pack(">32s20s32sQQ",
+                             self.MAGIC, my_nodeid, write_enabler,
+                             0, data_offset)
+        f.write(header + "\x00" * (data_offset - self.HEADER_SIZE))
+        f.close()
+
+    def _get_data_offset(self, f):
+        f.seek(self.DATA_OFFSET_OFFSET)
+        (data_offset,) = struct.unpack(">Q", f.read(8))
+        return data_offset
+
+    def _write_data_offset(self, f, data_offset):
+        f.seek(self.DATA_OFFSET_OFFSET)
+        f.write(struct.pack(">Q", data_offset))
+
+    def _write_share_data(self, f, offset, data):
+        length = len(data)
+        precondition(offset >= 0)
+        if offset+length > self.MAX_SIZE:
+            raise DataTooLargeError()
+        data_offset = self._get_data_offset(f)
+        data_length = self._read_data_length(f)
+        if offset > data_length:
+            # Fill any newly exposed empty space with 0's, in case a
+            # truncated file left something behind.
+            f.seek(data_offset+data_length)
+            f.write('\x00'*(offset - data_length))
+        f.seek(data_offset+offset)
+        f.write(data)
+        if offset+length > data_length:
+            # an interrupt before this point leaves the old data length, and
+            # the new data is simply not part of the share yet
+            self._write_data_length(f, offset+length)
+
+    def _get_num_lease_slots(self, f):
+        return (self._get_data_offset(f) - self.HEADER_SIZE) // self.LEASE_SIZE
+
+    def _get_lease_offset(self, f, lease_number):
+        if lease_number >= self._get_num_lease_slots(f):
+            raise IndexError("No such lease number %d" % lease_number)
+        return self.HEADER_SIZE + lease_number * self.LEASE_SIZE
+
+    def _write_lease_record(self, f, lease_number, lease_info):
+        while lease_number >= self._get_num_lease_slots(f):
+            self._grow_lease_slots(f)
+        f.seek(self._get_lease_offset(f, lease_number))
+        f.write(lease_info.to_mutable_data())
+
+    def _read_lease_record(self, f, lease_number):
+        # returns a LeaseInfo instance, or None
+        f.seek(self._get_lease_offset(f, lease_number))
+        data = f.read(self.LEASE_SIZE)
+        lease_info = LeaseInfo().from_mutable_data(data)
+        if lease_info.owner_num == 0:
+            return None
+        return lease_info
+
+    def _grow_lease_slots(self, f):
+        old_data_offset = self._get_data_offset(f)
+        num_slots = self._get_num_lease_slots(f)
+        new_data_offset = old_data_offset + num_slots * self.LEASE_SIZE
+        data_length = self._read_data_length(f)
+        # Copy the data from the end backwards, since the old and new
+        # places overlap. An interrupt here will corrupt the share.
+        end = data_length
+        while end > 0:
+            start = max(0, end - self.COPY_CHUNK_SIZE)
+            f.seek(old_data_offset+start)
+            chunk = f.read(end - start)
+            f.seek(new_data_offset+start)
+            f.write(chunk)
+            end = start
+        self._write_data_offset(f, new_data_offset)
+        # the new slots are empty
+        f.seek(old_data_offset)
+        f.write("\x00" * (new_data_offset - old_data_offset))
+
+    def writev(self, datav, new_length):
+        self._invalidate()
+        f = self._backend.open(self.home, 'rb+')
+        for (offset, data) in datav:
+            self._write_share_data(f, offset, data)
+        if new_length is not None:
+            cur_length = self._read_data_length(f)
+            if new_length < cur_length:
+                self._write_data_length(f, new_length)
+                f.truncate(self._get_data_offset(f) + new_length)
+        f.close()
+
+# the container classes, by their magic
+MUTABLE_CONTAINERS = {MutableShareFile.MAGIC: MutableShareFile,
+                      MutableShareFileV2.MAGIC: MutableShareFileV2,
+                      }
+MUTABLE_CONTAINER_VERSIONS = {1: MutableShareFile,
+                              2: MutableShareFileV2,
+                              }
+
+def is_mutable_magic(prefix):
+    return prefix in MUTABLE_CONTAINERS
+
+def get_mutable_share_file(filename, parent=None, filecache=None,
+                           backend=LOCAL_DISK):
+    """Return a MutableShareFile or MutableShareFileV2 for an existing
+    share, whichever its magic calls for. A container with an unknown
+    magic gets a MutableShareFile, which raises
+    UnknownMutableContainerVersionError."""
+    if filecache:
+        f = filecache.open(filename)
+        try:
+            cls = filecache.get_metadata(filename)
+            if not cls:
+                f.seek(0)
+                cls = MUTABLE_CONTAINERS.get(f.read(32), MutableShareFile)
+        finally:
+            filecache.release(f)
+    else:
+        f = backend.open(filename, 'rb')
+        cls = MUTABLE_CONTAINERS.get(f.read(32), MutableShareFile)
+        f.close()
+    return cls(filename, parent, filecache=filecache, backend=backend)
+
+def convert_mutable_sharefile(filename, version, backend=LOCAL_DISK):
+    """Rewrite an existing mutable share in the given container version,
+    keeping its write enabler, leases and data. The new container is
+    written next to the old one and renamed over it. Returns False if the
+    share already had that version. Nothing else may use the share while
+    I work on it."""
+    old = get_mutable_share_file(filename, backend=backend)
+    new_cls = MUTABLE_CONTAINER_VERSIONS[version]
+    if old.__class__ is new_cls:
+        return False
+    f = backend.open(filename, 'rb')
+    (write_enabler, nodeid) = old._read_write_enabler_and_nodeid(f)
+    data_length = old._read_data_length(f)
+    leases = [lease for (i, lease) in old._enumerate_leases(f)]
+    tmpname = filename + ".convert"
+    if backend.exists(tmpname):
+        backend.remove(tmpname)
+    new = new_cls(tmpname, backend=backend)
+    new.create(nodeid, write_enabler)
+    for lease in leases:
+        new.add_lease(lease)
+    offset = 0
+    while offset < data_length:
+        chunk = old._read_share_data(f, offset,
+                                     MutableShareFileV2.COPY_CHUNK_SIZE)
+        new.writev([(offset, chunk)], None)
+        offset += len(chunk)
+    f.close()
+    backend.rename(tmpname, filename)
+    return True
+
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
     if op == "lt":
@@ -454,9 +704,14 @@ class EmptyShare:
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
-    ms = MutableShareFile(filename, parent)
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             filecache=None, backend=LOCAL_DISK, version=1):
+    cls = MUTABLE_CONTAINER_VERSIONS[version]
+    ms = cls(filename, parent, backend=backend)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    if filecache:
+        # forget any stale handle for a share that used to live there
+        filecache.invalidate(filename)
+    return cls(filename, parent, filecache=filecache, backend=backend)
 
@@ -0,0 +1,491 @@
+import os, re, struct, threading
+
+from allmydata.util import base32, fileutil, log
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownPackIndexVersionError
+from allmydata.storage.lease import LeaseInfo
+from allmydata.util.hashutil import constant_time_compare
+
+# Small immutable shares can be kept in storage/packs/ instead of getting a
+# file (and a bucket directory) of their own under storage/shares/ . Each
+# pack file is a sequence of records, appended one after another:
+#
+#  0x00: magic, 4 bytes, "TPK1"
+#  0x04: storage index, 16 bytes
+#  0x14: share number, four bytes big-endian
+#  0x18: share data length, eight bytes big-endian = A
+#  0x20: share data, A bytes
+#
+# The records make a pack file self-describing, but the authoritative
+# record of which share lives where (and of its leases) is the SQLite
+# index in storage/packs/index.sqlite . A record that is not in the index
+# (because its share expired, or was moved by compaction, or because the
+# server crashed between appending it and recording it) is dead space,
+# which compaction reclaims.
+
+RECORD_MAGIC = "TPK1"
+RECORD_HEADER = ">4s16sLQ"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+PACK_RE = re.compile("^pack-([0-9]+)$")
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ pack INTEGER NOT NULL,               -- storage/packs/pack-%08d
+ offset INTEGER NOT NULL,             -- where the share data starts
+ length INTEGER NOT NULL,             -- share data length
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_by_pack ON shares (pack);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ owner_num INTEGER,
+ renew_secret VARCHAR(52) NOT NULL,   -- base32(renew_secret)
+ cancel_secret VARCHAR(52) NOT NULL,  -- base32(cancel_secret)
+ expiration_time INTEGER NOT NULL,    -- seconds since epoch
+ PRIMARY KEY (storage_index, shnum, renew_secret)
+);
+"""
+
+def get_pack_index(dbfile):
+    import sqlite3
+    must_create = not os.path.exists(dbfile)
+    db = sqlite3.connect(dbfile)
+    c = db.cursor()
+    if must_create:
+        c.executescript(SCHEMA_v1)
+        c.execute("INSERT INTO version (version) VALUES (?)", (1,))
+        db.commit()
+    try:
+        c.execute("SELECT version FROM version")
+        version = c.fetchone()[0]
+    except sqlite3.DatabaseError, e:
+        raise UnknownPackIndexVersionError("pack index %s is unusable: %s"
+                                           % (dbfile, e))
+    if version != 1:
+        raise UnknownPackIndexVersionError("unable to handle pack index "
+                                           "version %s in %s"
+                                           % (version, dbfile))
+    return db
+
+
+class PackStore:
+    """I keep small immutable shares appended to a few large pack files, so
+    that each of them costs an index row instead of an inode, a directory
+    entry and a partly-used disk block.
+
+    Appending a share (append()) only touches the current pack file, under
+    a lock, so it may be done by the disk I/O pool. Everything that uses
+    the index (record(), lookups, lease changes, compaction) must be done
+    in the reactor thread.
+
+    I also keep the share numbers of each storage index that has packed
+    shares in memory, so that the common lookup, for a storage index that
+    has no shares in any pack, does not need to query the index at all.
+
+    Once the current pack reaches 'pack_size' bytes, a new one is started.
+    Shares that lose their last lease leave dead space behind. compact()
+    copies the live shares out of any pack that is less than
+    'compact_threshold' live, and deletes packs that were already empty the
+    last time it ran (so that a BucketReader handed out in between can
+    still read from it).
+    """
+
+    pack_size = 64*1024*1024
+    compact_threshold = 0.5
+
+    def __init__(self, packdir, fsync=False, filecache=None):
+        self.packdir = packdir
+        fileutil.make_dirs(packdir)
+        self.fsync = fsync
+        self.filecache = filecache
+        self._db = get_pack_index(os.path.join(packdir, "index.sqlite"))
+        self._cursor = self._db.cursor()
+        self._lock = threading.Lock()
+        self._packed = {} # storage_index -> set of packed shnums
+        self._cursor.execute("SELECT storage_index, shnum FROM shares")
+        for (si_s, shnum) in self._cursor.fetchall():
+            self._packed.setdefault(si_a2b(str(si_s)), set()).add(shnum)
+        packs = self._list_packs()
+        if packs:
+            self._current = packs[-1]
+        else:
+            self._current = 0
+        self._current_size = self._pack_size(self._current)
+        self._empty_packs = set() # found empty by the last compact()
+        self.compactions = 0
+        self.bytes_compacted = 0
+
+    def close(self):
+        self._db.close()
+
+    def _packfile(self, pack):
+        return os.path.join(self.packdir, "pack-%08d" % pack)
+
+    def _list_packs(self):
+        packs = []
+        for fn in os.listdir(self.packdir):
+            m = PACK_RE.match(fn)
+            if m:
+                packs.append(int(m.group(1)))
+        return sorted(packs)
+
+    def _pack_size(self, pack):
+        try:
+            return os.path.getsize(self._packfile(pack))
+        except EnvironmentError:
+            return 0
+
+    def append(self, storage_index, shnum, data):
+        """Write one share to the end of the current pack. Return the
+        (pack, offset) of its data, for record()."""
+        header = struct.pack(RECORD_HEADER, RECORD_MAGIC, storage_index,
+                             shnum, len(data))
+        self._lock.acquire()
+        try:
+            if self._current_size >= self.pack_size:
+                self._current += 1
+                self._current_size = 0
+            f = open(self._packfile(self._current), "ab")
+            try:
+                f.seek(0, 2)
+                offset = f.tell()
+                f.write(header)
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            if self.filecache:
+                # readers of the older shares can keep their handle
+                self.filecache.appended(self._packfile(self._current))
+            self._current_size = offset + len(header) + len(data)
+            return (self._current, offset + len(header))
+        finally:
+            self._lock.release()
+
+    def record(self, storage_index, shnum, location, length, lease_info):
+        """Add a share that append() has written to the index, with its
+        first lease."""
+        (pack, offset) = location
+        si_s = si_b2a(storage_index)
+        self._cursor.execute("INSERT OR REPLACE INTO shares"
+                             " (storage_index, shnum, pack, offset, length)"
+                             " VALUES (?,?,?,?,?)",
+                             (si_s, shnum, pack, offset, length))
+        self._add_or_renew(si_s, shnum, lease_info)
+        self._db.commit()
+        self._packed.setdefault(storage_index, set()).add(shnum)
+
+    def _share_from_row(self, storage_index, row):
+        (shnum, pack, offset, length) = row
+        return PackedShare(self, storage_index, shnum,
+                           self._packfile(pack), offset, length,
+                           self.filecache)
+
+    def get_shares(self, storage_index):
+        """Return a dict that maps shnum to a PackedShare, for the shares of
+        one storage index that live in packs."""
+        if storage_index not in self._packed:
+            return {}
+        self._cursor.execute("SELECT shnum, pack, offset, length FROM shares"
+                             " WHERE storage_index=?",
+                             (si_b2a(storage_index),))
+        return dict([(row[0], self._share_from_row(storage_index, row))
+                     for row in self._cursor.fetchall()])
+
+    def iter_shares(self):
+        """Yield a (storage_index, shnum, PackedShare) tuple for every share,
+        in storage index order."""
+        self._cursor.execute("SELECT storage_index, shnum, pack, offset,"
+                             " length FROM shares"
+                             " ORDER BY storage_index, shnum")
+        for row in self._cursor.fetchall():
+            storage_index = si_a2b(str(row[0]))
+            yield (storage_index, row[1],
+                   self._share_from_row(storage_index, row[1:]))
+
+    def count_prefix(self, prefix):
+        """Return a dict that maps the base32 storage index of each bucket
+        that starts with 'prefix' to a (shares, share bytes) tuple."""
+        # every base32 character sorts before '~'
+        self._cursor.execute("SELECT storage_index, COUNT(*), SUM(length)"
+                             " FROM shares"
+                             " WHERE storage_index >= ? AND storage_index < ?"
+                             " GROUP BY storage_index",
+                             (prefix, prefix + "~"))
+        return dict([(str(si_s), (shares, sharebytes))
+                     for (si_s, shares, sharebytes)
+                     in self._cursor.fetchall()])
+
+    def has_shares(self):
+        return bool(self._packed)
+
+    def remove_share(self, storage_index, shnum):
+        args = (si_b2a(storage_index), shnum)
+        self._cursor.execute("DELETE FROM leases"
+                             " WHERE storage_index=? AND shnum=?", args)
+        self._cursor.execute("DELETE FROM shares"
+                             " WHERE storage_index=? AND shnum=?", args)
+        self._db.commit()
+        shnums = self._packed.get(storage_index, set())
+        shnums.discard(shnum)
+        if not shnums:
+            self._packed.pop(storage_index, None)
+
+    # leases
+
+    def get_leases(self, storage_index, shnum):
+        self._cursor.execute("SELECT owner_num, renew_secret, cancel_secret,"
+                             " expiration_time FROM leases"
+                             " WHERE storage_index=? AND shnum=?"
+                             " ORDER BY rowid",
+                             (si_b2a(storage_index), shnum))
+        return [LeaseInfo(owner_num, base32.a2b(str(renew_secret_s)),
+                          base32.a2b(str(cancel_secret_s)), expiration_time)
+                for (owner_num, renew_secret_s, cancel_secret_s,
+                     expiration_time) in self._cursor.fetchall()]
+
+    def _add_or_renew(self, si_s, shnum, lease_info):
+        # an existing lease keeps its cancel_secret, and is only extended
+        self._cursor.execute("INSERT OR IGNORE INTO leases"
+                             " (storage_index, shnum, owner_num, renew_secret,"
+                             "  cancel_secret, expiration_time)"
+                             " VALUES (?,?,?,?,?,?)",
+                             (si_s, shnum, lease_info.owner_num,
+                              base32.b2a(lease_info.renew_secret),
+                              base32.b2a(lease_info.cancel_secret),
+                              int(lease_info.expiration_time)))
+        if not self._cursor.rowcount:
+            self._cursor.execute("UPDATE leases"
+                                 " SET expiration_time=MAX(expiration_time, ?)"
+                                 " WHERE storage_index=? AND shnum=?"
+                                 " AND renew_secret=?",
+                                 (int(lease_info.expiration_time), si_s, shnum,
+                                  base32.b2a(lease_info.renew_secret)))
+
+    def add_or_renew_lease(self, storage_index, shnum, lease_info):
+        self._add_or_renew(si_b2a(storage_index), shnum, lease_info)
+        self._db.commit()
+
+    def set_leases(self, storage_index, shnum, leases):
+        """Replace every lease on one share."""
+        si_s = si_b2a(storage_index)
+        self._cursor.execute("DELETE FROM leases"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_s, shnum))
+        for lease_info in leases:
+            self._add_or_renew(si_s, shnum, lease_info)
+        self._db.commit()
+
+    # compaction
+
+    def get_pack_usage(self):
+        """Return a dict that maps each pack number to a (size, live bytes)
+        tuple. Live bytes include the record headers."""
+        usage = dict([(pack, (self._pack_size(pack), 0))
+                      for pack in self._list_packs()])
+        self._cursor.execute("SELECT pack, COUNT(*), SUM(length) FROM shares"
+                             " GROUP BY pack")
+        for (pack, shares, sharebytes) in self._cursor.fetchall():
+            live = sharebytes + shares * RECORD_HEADER_SIZE
+            usage[pack] = (usage.get(pack, (0, 0))[0], live)
+        return usage
+
+    def compact(self):
+        """Reclaim the dead space in my packs. Return the number of packs
+        that were compacted."""
+        usage = self.get_pack_usage()
+        # packs that were already empty last time have had a whole lease
+        # checker cycle for their readers to go away
+        for pack in sorted(self._empty_packs):
+            if usage.get(pack, (0, 0))[1] == 0 and pack != self._current:
+                try:
+                    os.unlink(self._packfile(pack))
+                except EnvironmentError:
+                    pass
+                if self.filecache:
+                    self.filecache.invalidate(self._packfile(pack))
+                usage.pop(pack, None)
+        self._empty_packs = set()
+        compacted = 0
+        for (pack, (size, live)) in sorted(usage.items()):
+            if pack == self._current:
+                continue
+            if live and live < size * self.compact_threshold:
+                self._compact_pack(pack)
+                compacted += 1
+                self.bytes_compacted += live
+                live = 0
+            if not live:
+                self._empty_packs.add(pack)
+        if compacted:
+            self.compactions += compacted
+            log.msg(format="compacted %(packs)d pack files",
+                    packs=compacted, facility="tahoe.storage",
+                    level=log.OPERATIONAL, umid="hQ3Zbg")
+        return compacted
+
+    def _compact_pack(self, pack):
+        self._cursor.execute("SELECT storage_index, shnum, offset, length"
+                             " FROM shares WHERE pack=? ORDER BY offset",
+                             (pack,))
+        rows = self._cursor.fetchall()
+        f = open(self._packfile(pack), "rb")
+        try:
+            for (si_s, shnum, offset, length) in rows:
+                f.seek(offset)
+                data = f.read(length)
+                (new_pack, new_offset) = self.append(si_a2b(str(si_s)),
+                                                     shnum, data)
+                self._cursor.execute("UPDATE shares SET pack=?, offset=?"
+                                     " WHERE storage_index=? AND shnum=?",
+                                     (new_pack, new_offset, si_s, shnum))
+        finally:
+            f.close()
+        self._db.commit()
+
+    def get_stats(self):
+        self._cursor.execute("SELECT COUNT(*), SUM(length) FROM shares")
+        (shares, sharebytes) = self._cursor.fetchone()
+        packs = self._list_packs()
+        return {"packs": len(packs),
+                "shares": shares,
+                "share_bytes": sharebytes or 0,
+                "pack_bytes": sum([self._pack_size(pack) for pack in packs]),
+                "compactions": self.compactions,
+                "bytes_compacted": self.bytes_compacted,
+                }
+
+
+class PackedShare:
+    """I stand in for the ShareFile of an immutable share that lives in a
+    pack file. I offer the same read and lease methods, so BucketReader and
+    the lease checker can use me without knowing the difference. Reads only
+    use the pack file, so they may be done by the disk I/O pool; lease
+    methods use the PackStore index, and must be called from the reactor
+    thread. Cancelling the last lease removes the share from the index; the
+    caller must then tell the server, with share_removed()."""
+
+    sharetype = "immutable"
+
+    def __init__(self, store, storage_index, shnum, packfile, offset, length,
+                 filecache=None):
+        self._store = store
+        self._storage_index = storage_index
+        self._shnum = shnum
+        self.home = packfile
+        self._offset = offset
+        self._length = length
+        self._filecache = filecache
+
+    def get_data_length(self):
+        return self._length
+
+    def get_offset(self):
+        """Return where my data starts in my pack file."""
+        return self._offset
+
+    def _read_share_data(self, f, offset, length):
+        # like ShareFile, reads beyond the end of the data are truncated
+        actuallength = max(0, min(length, self._length-offset))
+        if actuallength == 0:
+            return ""
+        f.seek(self._offset+offset)
+        return f.read(actuallength)
+
+    def _open_for_read(self):
+        if self._filecache:
+            return self._filecache.open(self.home)
+        return open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._filecache:
+            self._filecache.release(f)
+        else:
+            f.close()
+
+    def read_share_data(self, offset, length):
+        f = self._open_for_read()
+        try:
+            return self._read_share_data(f, offset, length)
+        finally:
+            self._done_reading(f)
+
+    def readv(self, readv):
+        datav = []
+        f = self._open_for_read()
+        try:
+            for (offset, length) in readv:
+                datav.append(self._read_share_data(f, offset, length))
+        finally:
+            self._done_reading(f)
+        return datav
+
+    def prefetch(self, readv):
+        f = self._open_for_read()
+        try:
+            for (offset, length) in readv:
+                actuallength = max(0, min(length, self._length-offset))
+                if (actuallength and
+                    not fileutil.advise_willneed(f, self._offset+offset,
+                                                 actuallength)):
+                    return False
+        finally:
+            self._done_reading(f)
+        return True
+
+    def get_leases(self):
+        return iter(self._store.get_leases(self._storage_index, self._shnum))
+
+    def add_or_renew_lease(self, lease_info):
+        self._store.add_or_renew_lease(self._storage_index, self._shnum,
+                                       lease_info)
+
+    def renew_lease(self, renew_secret, new_expire_time):
+        leases = self._store.get_leases(self._storage_index, self._shnum)
+        for lease in leases:
+            if constant_time_compare(lease.renew_secret, renew_secret):
+                if new_expire_time > lease.expiration_time:
+                    lease.expiration_time = new_expire_time
+                    self._store.add_or_renew_lease(self._storage_index,
+                                                   self._shnum, lease)
+                return
+        raise IndexError("unable to renew non-existent lease")
+
+    def add_lease(self, lease_info):
+        self.add_or_renew_lease(lease_info)
+
+    def cancel_lease(self, cancel_secret):
+        """Remove the leases with the given cancel_secret. Return the number
+        of bytes freed, which is nonzero only if the last lease was removed
+        and the share was removed from its pack. Raise IndexError if there
+        was no lease with the given cancel_secret."""
+        leases = self._store.get_leases(self._storage_index, self._shnum)
+        remaining = [l for l in leases
+                     if not constant_time_compare(l.cancel_secret,
+                                                  cancel_secret)]
+        if len(remaining) == len(leases):
+            raise IndexError("unable to find matching lease to cancel")
+        if remaining:
+            self._store.set_leases(self._storage_index, self._shnum,
+                                   remaining)
+            return 0
+        self.unlink()
+        return self._length + RECORD_HEADER_SIZE
+
+    def unlink(self):
+        self._store.remove_share(self._storage_index, self._shnum)
@@ -0,0 +1,233 @@
+import heapq, time
+from twisted.internet import defer
+from allmydata.storage.common import ServerBusyError
+
+# the kinds of work that clients get a share of, and the size of each share
+DEFAULT_WEIGHTS = {"read": 4, "write": 2, "lease": 1}
+DEFAULT_MAX_QUEUED_PER_CLIENT = 1000
+# clients that have had nothing to do for this long are forgotten
+CLIENT_IDLE_TIMEOUT = 60*60
+
+# the category of each remote method of StorageServer, BucketWriter and
+# BucketReader. Methods that are not listed (get_version, abort, prefetch,
+# advise_corrupt_share, get_client_facet) are cheap, and always run at once.
+REQUEST_CATEGORIES = {"allocate_buckets": "write",
+                      "write": "write",
+                      "close": "write",
+                      "slot_testv_and_readv_and_writev": "write",
+                      "slot_testv_and_readv_and_writev_batch": "write",
+                      "get_buckets": "read",
+                      "get_buckets_batch": "read",
+                      "read": "read",
+                      "readv": "read",
+                      "slot_readv": "read",
+                      "add_lease": "lease",
+                      "renew_lease": "lease",
+                      }
+
+# requests that come straight to the StorageServer, rather than through a
+# client facet, are charged to this client
+ANONYMOUS = "anonymous"
+
+def parse_weights(s):
+    """Parse a [storage]scheduler.weights= value, like
+    'read=4,write=2,lease=1'. Categories that are left out keep their
+    default weight."""
+    weights = DEFAULT_WEIGHTS.copy()
+    for item in s.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" not in item:
+            raise ValueError("scheduler weight '%s' is not CATEGORY=WEIGHT"
+                             % item)
+        (category, weight) = [part.strip() for part in item.split("=", 1)]
+        if category not in DEFAULT_WEIGHTS:
+            raise ValueError("unknown scheduler category '%s' (must be one"
+                             " of %s)" % (category,
+                                          ", ".join(sorted(DEFAULT_WEIGHTS))))
+        weight = int(weight)
+        if weight < 1:
+            raise ValueError("scheduler weight for '%s' must be at least 1"
+                             % category)
+        weights[category] = weight
+    return weights
+
+
+class RequestScheduler:
+    """I decide when the requests that clients send to a StorageServer get
+    to run, so that one busy client (a deep-check, or a big repair) cannot
+    starve the interactive downloads of everyone else.
+
+    Every request is charged to a client (the Tub that sent it, for clients
+    that talk to a facet from StorageServer.remote_get_client_facet) and to
+    a category: 'read', 'write' or 'lease'. While fewer than
+    'max_outstanding' requests are running, a new one starts at once.
+    Beyond that, requests wait, and are started in start-time fair queuing
+    order: each (client, category) flow gets a share of the server that is
+    proportional to the weight of its category, no matter how many
+    requests it has waiting. Requests of one flow start in the order they
+    arrived, but a client's reads may overtake its own queued writes.
+
+    Admission control: a client that already has 'max_queued_per_client'
+    requests waiting gets ServerBusyError for any more.
+
+    A request runs until the Deferred that it returns fires, so only the
+    requests that wait for something (like the disk I/O threads) hold on to
+    their slot. With max_outstanding=0, nothing ever waits, but I still
+    keep the per-client counts.
+
+    For every request that had to wait, I record how long it waited as the
+    server's 'request-queue-wait' latency.
+    """
+
+    def __init__(self, server, max_outstanding=0,
+                 max_queued_per_client=DEFAULT_MAX_QUEUED_PER_CLIENT,
+                 weights=None):
+        assert max_outstanding >= 0, max_outstanding
+        assert max_queued_per_client >= 0, max_queued_per_client
+        self.server = server
+        self.max_outstanding = max_outstanding
+        self.max_queued_per_client = max_queued_per_client
+        self.weights = DEFAULT_WEIGHTS.copy()
+        if weights:
+            self.weights.update(weights)
+        self.outstanding = 0
+        self.queued = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self._queue = [] # heap of (start tag, seqnum, request)
+        self._seqnum = 0
+        # the start tag of the request that started last
+        self._virtual_time = 0.0
+        self._finish_tags = {} # (client, category) -> finish tag
+        self._clients = {} # client -> dict of counters
+        self._dispatching = False
+
+    def call(self, client, obj, methodname, args, kwargs):
+        """Run obj.remote_METHODNAME(*args, **kwargs) on behalf of client,
+        now or later. This is what the doRemoteCall() methods of the
+        server's Referenceables use."""
+        meth = getattr(obj, "remote_%s" % methodname)
+        category = REQUEST_CATEGORIES.get(methodname)
+        if category is None:
+            return meth(*args, **kwargs)
+        return self.run(client, category, meth, *args, **kwargs)
+
+    def run(self, client, category, f, *args, **kwargs):
+        """Run f(*args, **kwargs) as a request of the given client and
+        category. Returns its result if it could start at once, otherwise a
+        Deferred that fires with it."""
+        stats = self._get_client(client)
+        stats["last-active"] = time.time()
+        flow = (client, category)
+        start = max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+        if (not self.max_outstanding
+            or (self.outstanding < self.max_outstanding and not self._queue)):
+            self._finish_tags[flow] = start + 1.0 / self.weights[category]
+            self._virtual_time = start
+            return self._start(client, f, args, kwargs)
+        if stats["queued"] >= self.max_queued_per_client:
+            stats["rejected"] += 1
+            self.rejected += 1
+            raise ServerBusyError("client %s has %d requests waiting"
+                                  % (client, stats["queued"]))
+        self._finish_tags[flow] = start + 1.0 / self.weights[category]
+        d = defer.Deferred()
+        request = (client, f, args, kwargs, d, time.time())
+        heapq.heappush(self._queue, (start, self._seqnum, request))
+        self._seqnum += 1
+        stats["queued"] += 1
+        self.queued += 1
+        return d
+
+    def _get_client(self, client):
+        stats = self._clients.get(client)
+        if stats is None:
+            self._forget_idle_clients()
+            stats = self._clients[client] = {"outstanding": 0,
+                                             "queued": 0,
+                                             "completed": 0,
+                                             "rejected": 0,
+                                             "last-active": time.time(),
+                                             }
+        return stats
+
+    def _forget_idle_clients(self):
+        cutoff = time.time() - CLIENT_IDLE_TIMEOUT
+        for (client, stats) in self._clients.items():
+            if (not stats["outstanding"] and not stats["queued"]
+                and stats["last-active"] < cutoff):
+                del self._clients[client]
+                for category in self.weights:
+                    self._finish_tags.pop((client, category), None)
+
+    def _start(self, client, f, args, kwargs):
+        stats = self._clients[client]
+        stats["outstanding"] += 1
+        self.outstanding += 1
+        self.dispatched += 1
+        try:
+            result = f(*args, **kwargs)
+        except:
+            self._finished(client)
+            raise
+        if isinstance(result, defer.Deferred):
+            def _done(res):
+                self._finished(client)
+                return res
+            result.addBoth(_done)
+        else:
+            self._finished(client)
+        return result
+
+    def _finished(self, client):
+        stats = self._clients[client]
+        stats["outstanding"] -= 1
+        stats["completed"] += 1
+        stats["last-active"] = time.time()
+        self.outstanding -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._dispatching:
+            # a request that we just started finished at once: the loop
+            # below will look at the queue again
+            return
+        self._dispatching = True
+        try:
+            while self._queue and self.outstanding < self.max_outstanding:
+                (start, seqnum, request) = heapq.heappop(self._queue)
+                (client, f, args, kwargs, d, queued_at) = request
+                self._virtual_time = start
+                self._clients[client]["queued"] -= 1
+                self.queued -= 1
+                self.server.add_latency("request-queue-wait",
+                                        time.time() - queued_at)
+                d2 = defer.maybeDeferred(self._start, client, f, args, kwargs)
+                d2.chainDeferred(d)
+        finally:
+            self._dispatching = False
+
+    def get_client_stats(self):
+        """Return a dictionary that maps each client I know about to a
+        dictionary of its 'outstanding', 'queued', 'completed' and
+        'rejected' request counts."""
+        self._forget_idle_clients()
+        results = {}
+        for (client, stats) in self._clients.items():
+            results[client] = dict([(name, stats[name])
+                                    for name in ("outstanding", "queued",
+                                                 "completed", "rejected")])
+        return results
+
+    def get_stats(self):
+        active = [client for (client, stats) in self._clients.items()
+                  if stats["outstanding"] or stats["queued"]]
+        return {"max_outstanding": self.max_outstanding,
+                "outstanding": self.outstanding,
+                "queued": self.queued,
+                "dispatched": self.dispatched,
+                "rejected": self.rejected,
+                "active_clients": len(active),
+                }
@@ -1,29 +1,54 @@
-import os, re, weakref, struct, time
+import os, re, weakref, time
+from functools import partial
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.internet import defer
+from twisted.python import failure
 
 from zope.interface import implements
-from allmydata.interfaces import RIStorageServer, IStatsProducer
-from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.interfaces import RIStorageServer, IStatsProducer, \
+     MAX_BATCH_SIZE, MAX_READV_SIZE
+from allmydata.util import fileutil, idlib, log
+from allmydata.util.histogram import LatencyHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
 from allmydata.storage.lease import LeaseInfo
-from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
-     create_mutable_sharefile
+from allmydata.storage.mutable import EmptyShare, create_mutable_sharefile, \
+     get_mutable_share_file, MUTABLE_CONTAINER_VERSIONS
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseCheckingCrawler
+from allmydata.storage.shareindex import ShareIndex, ShareIndexCrawler, \
+     get_sharetype
+from allmydata.storage.filecache import FileHandleCache, \
+     DEFAULT_MAX_OPEN_FILES
+from allmydata.storage.leasedb import get_leasedb, import_share_leases, \
+     LeasedShare
+from allmydata.storage.sharecount import ShareCounter
+from allmydata.storage.space import SpaceAccountant
+from allmydata.storage.diskio import DiskIOPool, KeyedLock
+from allmydata.storage.writebuffer import WriteBufferPool, \
+     DEFAULT_WRITER_LIMIT, DEFAULT_TOTAL_LIMIT
+from allmydata.storage.packed import PackStore
+from allmydata.storage.backend import DiskBackend
+from allmydata.storage.scheduler import RequestScheduler, ANONYMOUS, \
+     DEFAULT_MAX_QUEUED_PER_CLIENT
+from allmydata.storage.advisories import CorruptionAdvisories, \
+     DEFAULT_MAX_REPORTS_PER_CLIENT
 
 # storage/
+# storage/shares/ lives in the server's backend (see backend.py)
 # storage/shares/incoming
 #   incoming/ holds temp dirs named $START/$STORAGEINDEX/$SHARENUM which will
 #   be moved to storage/shares/$START/$STORAGEINDEX/$SHARENUM upon success
 # storage/shares/$START/$STORAGEINDEX
 # storage/shares/$START/$STORAGEINDEX/$SHARENUM
+# storage/packs/ holds small immutable shares, if enabled (see packed.py)
 
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
@@ -32,11 +57,28 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 NUM_RE=re.compile("^[0-9]+$")
 
 
+class StorageClientFacet(Referenceable):
+    """I am what a client that called get_client_facet() talks to instead of
+    the StorageServer itself. I pass its requests on to the server, which
+    charges them (and the requests to the buckets that they return) to that
+    client in its RequestScheduler."""
+    implements(RIStorageServer)
+
+    def __init__(self, server, client):
+        self.server = server
+        self.client = client
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        return self.server.schedule_call(self.client, methodname, args, kwargs)
+
 
 class StorageServer(service.MultiService, Referenceable):
     implements(RIStorageServer, IStatsProducer)
     name = 'storage'
     LeaseCheckerClass = LeaseCheckingCrawler
+    IndexedLeaseCheckerClass = IndexedLeaseCheckingCrawler
+    # how many storage indexes _count_shares() remembers
+    share_count_cache_size = 10000
 
     def __init__(self, storedir, nodeid, reserved_space=0,
                  discard_storage=False, readonly_storage=False,
@@ -45,28 +87,75 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 expiration_incremental=False,
+                 share_index_enabled=False,
+                 open_file_cache_size=DEFAULT_MAX_OPEN_FILES,
+                 leasedb_enabled=False,
+                 crawler_prefetch_threads=0,
+                 crawler_io_percentage=50,
+                 disk_io_threads=0,
+                 write_buffer_size=DEFAULT_WRITER_LIMIT,
+                 write_buffer_total=DEFAULT_TOTAL_LIMIT,
+                 fsync_shares=False,
+                 packed_share_max_size=0,
+                 backend=None,
+                 mutable_container_version=1,
+                 max_outstanding_requests=0,
+                 max_queued_requests_per_client=DEFAULT_MAX_QUEUED_PER_CLIENT,
+                 request_weights=None,
+                 max_advisories_per_client=DEFAULT_MAX_REPORTS_PER_CLIENT):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
         self.my_nodeid = nodeid
         self.storedir = storedir
+        fileutil.make_dirs(storedir)
+        if backend is None:
+            backend = DiskBackend()
+        self.backend = backend
+        if not backend.local_files:
+            # these read share files behind the backend's back
+            if share_index_enabled or leasedb_enabled or packed_share_max_size:
+                raise ValueError("the share index, the lease database and"
+                                 " packed shares need a disk backend, not"
+                                 " the %s backend" % backend.name)
+            # and there is no disk to keep open or to wait for
+            open_file_cache_size = 0
+            disk_io_threads = 0
+            crawler_prefetch_threads = 0
+        if backend.pack_all_immutable_shares:
+            packed_share_max_size = 2**64
+        if mutable_container_version not in MUTABLE_CONTAINER_VERSIONS:
+            raise ValueError("unknown mutable container version %r"
+                             % (mutable_container_version,))
+        # new mutable shares get this container version
+        self.mutable_container_version = mutable_container_version
         sharedir = os.path.join(storedir, "shares")
-        fileutil.make_dirs(sharedir)
+        backend.make_dirs(sharedir)
         self.sharedir = sharedir
-        # we don't actually create the corruption-advisory dir until necessary
+        # where servers before the advisory database wrote their reports
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
+        self.corruption_advisories = CorruptionAdvisories(
+            os.path.join(storedir, "corruption-advisories.sqlite"),
+            max_advisories_per_client)
+        if self.corruption_advisories.created:
+            self.corruption_advisories.import_advisory_files(
+                self.corruption_advisory_dir)
         self.reserved_space = int(reserved_space)
         self.no_storage = discard_storage
         self.readonly_storage = readonly_storage
+        self.space = SpaceAccountant(sharedir, self.reserved_space,
+                                     readonly_storage, backend)
         self.stats_provider = stats_provider
         if self.stats_provider:
             self.stats_provider.register_producer(self)
         self.incomingdir = os.path.join(sharedir, 'incoming')
         self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
+        backend.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        self._share_counts = {} # storage_index -> number of shares
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -74,22 +163,67 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = {}
+        for category in ["allocate", "write", "close", "read", # immutable
+                         "read-vector", "get", "get-batch",
+                         "writev", "writev-batch", "readv", # mutable
+                         "add-lease", "renew", "cancel", # both
+                         "disk-queue-depth", "disk-queue-wait", # disk I/O
+                         "request-queue-wait", # request scheduler
+                         ]:
+            self.latencies[category] = LatencyHistogram()
+        self.filecache = None
+        if open_file_cache_size:
+            self.filecache = FileHandleCache(open_file_cache_size)
+
+        # immutable shares of up to this size go into pack files, if enabled
+        self.packed_share_max_size = packed_share_max_size
+        self.packs = None
+        if packed_share_max_size:
+            self.packs = PackStore(os.path.join(storedir, "packs"),
+                                   fsync=fsync_shares,
+                                   filecache=self.filecache)
+
+        countfile = os.path.join(self.storedir, "share_counts.pickle")
+        self.share_counter = ShareCounter(countfile,
+                                          empty=not self.have_shares())
         self.add_bucket_counter()
 
+        self.share_index = None
+        if share_index_enabled:
+            self.add_share_index()
+
+        # share reads and immutable writes go to a thread pool, if enabled.
+        # Mutable reads of a slot wait for its writes (and vice versa).
+        self.diskio = None
+        if disk_io_threads:
+            self.diskio = DiskIOPool(self, disk_io_threads)
+        self._slot_locks = KeyedLock()
+
+        # remote requests take turns, client by client
+        self.scheduler = RequestScheduler(self, max_outstanding_requests,
+                                          max_queued_requests_per_client,
+                                          request_weights)
+
+        # immutable share writes are coalesced in memory, if enabled
+        self.write_buffers = None
+        if write_buffer_size:
+            self.write_buffers = WriteBufferPool(write_buffer_size,
+                                                 write_buffer_total)
+        self.fsync_shares = fsync_shares
+
+        self.leasedb = None
+        if leasedb_enabled:
+            self.add_leasedb()
+
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
+        if expiration_incremental:
+            if not self.leasedb:
+                raise ValueError("incremental lease expiration requires the"
+                                 " lease database")
+            klass = self.IndexedLeaseCheckerClass
         self.lease_checker = klass(self, statefile, historyfile,
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
@@ -97,28 +231,80 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_sharetypes)
         self.lease_checker.setServiceParent(self)
 
+        if crawler_prefetch_threads:
+            crawlers = [self.bucket_counter, self.lease_checker]
+            if self.share_index:
+                crawlers.append(self.share_index_crawler)
+            for crawler in crawlers:
+                crawler.prefetch_threads = crawler_prefetch_threads
+                crawler.allowed_io_percentage = crawler_io_percentage / 100.0
+
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        if self.packs and self.packs.has_shares():
+            return True
+        return bool(set(self.backend.listdir(self.sharedir))
+                    - set(["incoming"]))
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
         self.bucket_counter.setServiceParent(self)
 
+    def add_share_index(self):
+        indexfile = os.path.join(self.storedir, "share_index.pickle")
+        self.share_index = ShareIndex(self.sharedir, indexfile)
+        statefile = os.path.join(self.storedir, "share_index.state")
+        self.share_index_crawler = ShareIndexCrawler(self, statefile,
+                                                     self.share_index)
+        self.share_index_crawler.setServiceParent(self)
+
+    def add_leasedb(self):
+        dbfile = os.path.join(self.storedir, "leasedb.sqlite")
+        self.leasedb = get_leasedb(dbfile)
+        if self.leasedb.must_import:
+            # first start with the lease database (or with a new version of
+            # it): copy the leases out of the existing share files before we
+            # accept any changes
+            (shares, leases, skipped) = import_share_leases(self.sharedir,
+                                                            self.leasedb)
+            log.msg(format="imported %(leases)d leases from %(shares)d shares"
+                    " into the lease database (%(skipped)d shares skipped)",
+                    leases=leases, shares=shares, skipped=skipped,
+                    facility="tahoe.storage", umid="Lq2dAw")
+
+    def _leased(self, storage_index, shnum, sf):
+        # the object to use for lease operations on a share
+        if self.leasedb:
+            return LeasedShare(self.leasedb, storage_index, shnum,
+                               sf.home, sf.sharetype)
+        return sf
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        if self.share_index:
+            # after the crawler has saved its own state
+            d.addCallback(lambda ign: self.share_index.save())
+        d.addCallback(lambda ign: self.share_counter.save(clean=True))
+        if self.diskio:
+            d.addCallback(lambda ign: self.diskio.stop())
+        if self.packs:
+            d.addCallback(lambda ign: self.packs.close())
+        if self.filecache:
+            d.addCallback(lambda ign: self.filecache.close_all())
+        d.addCallback(lambda ign: self.corruption_advisories.close())
+        return d
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
     def get_latencies(self):
         """Return a dict, indexed by category, that contains a dict of
@@ -130,34 +316,25 @@ class StorageServer(service.MultiService, Referenceable):
         samples for a given percentile to be interpreted unambiguously
         that percentile will be reported as None. If no samples have been
         collected for the given category, then that category name will
-        not be present in the return value. """
+        not be present in the return value. The numbers describe the
+        samples of the last five to ten minutes (see LatencyHistogram), and
+        percentiles are accurate to about 1%."""
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
         for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
-            else:
-                stats["mean"] = None
-
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
+            if self.latencies[category].get_count():
+                output[category] = self.latencies[category].get_stats()
+        return output
 
-            output[category] = stats
+    def get_latency_histograms(self):
+        """Return a dict that maps 'storage_server.CATEGORY' to the wire
+        form of the latency histogram of that category, for each category
+        with samples. The StatsGatherer merges these across servers."""
+        output = {}
+        for category in self.latencies:
+            if self.latencies[category].get_count():
+                output["storage_server." + category] = \
+                    self.latencies[category].to_wire()
         return output
 
     def log(self, *args, **kwargs):
@@ -166,7 +343,7 @@ class StorageServer(service.MultiService, Referenceable):
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        self.backend.rm_dir(self.incomingdir)
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
@@ -178,7 +355,8 @@ class StorageServer(service.MultiService, Referenceable):
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            disk = self.backend.get_disk_stats(self.sharedir,
+                                               self.reserved_space)
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -187,6 +365,7 @@ class StorageServer(service.MultiService, Referenceable):
             stats['storage_server.disk_free_for_root'] = disk['free_for_root']
             stats['storage_server.disk_free_for_nonroot'] = disk['free_for_nonroot']
             stats['storage_server.disk_avail'] = disk['avail']
+            self.space.set_available(disk['avail'])
         except AttributeError:
             writeable = True
         except EnvironmentError:
@@ -198,25 +377,48 @@ class StorageServer(service.MultiService, Referenceable):
             writeable = False
 
         stats['storage_server.accepting_immutable_shares'] = int(writeable)
-        s = self.bucket_counter.get_state()
-        bucket_count = s.get("last-complete-bucket-count")
-        if bucket_count:
-            stats['storage_server.total_bucket_count'] = bucket_count
+        headroom = self.space.get_remaining_space()
+        if headroom is not None:
+            stats['storage_server.allocation_headroom'] = headroom
+        counts = self.share_counter.get_counts()
+        if counts is not None:
+            stats['storage_server.total_bucket_count'] = counts["buckets"]
+            for sharetype in ("immutable", "mutable"):
+                stats['storage_server.total_share_count.' + sharetype] = \
+                    counts["shares-" + sharetype]
+                stats['storage_server.total_share_bytes.' + sharetype] = \
+                    counts["bytes-" + sharetype]
+            stats['storage_server.share_counts_exact'] = \
+                int(self.share_counter.exact)
+        else:
+            # until the live counts are known, use the crawler's
+            s = self.bucket_counter.get_state()
+            bucket_count = s.get("last-complete-bucket-count")
+            if bucket_count:
+                stats['storage_server.total_bucket_count'] = bucket_count
+        if self.filecache:
+            for name,v in self.filecache.get_stats().items():
+                stats['storage_server.open_file_cache.%s' % name] = v
+        if self.write_buffers:
+            for name,v in self.write_buffers.get_stats().items():
+                stats['storage_server.write_buffer.%s' % name] = v
+        if self.packs:
+            for name,v in self.packs.get_stats().items():
+                stats['storage_server.packs.%s' % name] = v
+        for name,v in self.scheduler.get_stats().items():
+            stats['storage_server.scheduler.%s' % name] = v
+        for name,v in self.corruption_advisories.get_stats().items():
+            stats['storage_server.corruption_advisories.%s' % name] = v
         return stats
 
     def get_available_space(self):
         """Returns available space for share storage in bytes, or None if no
         API to get this information is available."""
 
-        if self.readonly_storage:
-            return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        return self.space.get_available_space()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self.space.allocated
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
@@ -231,11 +433,59 @@ class StorageServer(service.MultiService, Referenceable):
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "get-buckets-batch": True,
+                      "maximum-get-buckets-batch-size": MAX_BATCH_SIZE,
+                      "slot-writev-batch": True,
+                      "maximum-slot-writev-batch-size": MAX_BATCH_SIZE,
+                      "immutable-readv": True,
+                      "client-facets": True,
+                      "maximum-immutable-readv-size": MAX_READV_SIZE,
+                      "immutable-prefetch": True,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
         return version
 
+    def doRemoteCall(self, methodname, args, kwargs):
+        # clients that do not use a facet are all charged as one
+        return self.schedule_call(ANONYMOUS, methodname, args, kwargs)
+
+    def schedule_call(self, client, methodname, args, kwargs):
+        if methodname == "advise_corrupt_share":
+            # reports are limited per client
+            return self.advise_corrupt_share(client, *args, **kwargs)
+        res = self.scheduler.call(client, self, methodname, args, kwargs)
+        if client != ANONYMOUS and methodname in ("allocate_buckets",
+                                                  "get_buckets",
+                                                  "get_buckets_batch"):
+            # the reads and writes of the buckets are the client's, too
+            if isinstance(res, defer.Deferred):
+                res.addCallback(self._charge_buckets, methodname, client)
+            else:
+                res = self._charge_buckets(res, methodname, client)
+        return res
+
+    def _charge_buckets(self, res, methodname, client):
+        if methodname == "allocate_buckets":
+            buckets = res[1].values()
+        elif methodname == "get_buckets":
+            buckets = res.values()
+        else:
+            buckets = [b for bucketreaders in res.values()
+                       for b in bucketreaders.values()]
+        for b in buckets:
+            b.client = client
+        return res
+
+    def remote_get_client_facet(self, canary):
+        # we know the client by the Tub of its canary
+        try:
+            client = canary.getRemoteTubID()
+        except AttributeError:
+            client = ANONYMOUS
+        log.msg("storage: get_client_facet for %s" % client)
+        return StorageClientFacet(self, client)
+
     def remote_allocate_buckets(self, storage_index,
                                 renew_secret, cancel_secret,
                                 sharenums, allocated_size,
@@ -253,8 +503,8 @@ class StorageServer(service.MultiService, Referenceable):
         log.msg("storage: allocate_buckets %s" % si_s)
 
         # in this implementation, the lease information (including secrets)
-        # goes into the share files themselves. It could also be put into a
-        # separate database. Note that the lease should not be added until
+        # goes into the share files themselves, or into the lease database
+        # if that is enabled. Note that the lease should not be added until
         # the BucketWriter has been closed.
         expire_time = time.time() + 31*24*60*60
         lease_info = LeaseInfo(owner_num,
@@ -263,13 +513,8 @@ class StorageServer(service.MultiService, Referenceable):
 
         max_space_per_bucket = allocated_size
 
-        remaining_space = self.get_available_space()
+        remaining_space = self.space.get_remaining_space()
         limited = remaining_space is not None
-        if limited:
-            # this is a bit conservative, since some of this allocated_size()
-            # has already been written to disk, where it will show up in
-            # get_available_space.
-            remaining_space -= self.allocated_size()
         # self.readonly_storage causes remaining_space <= 0
 
         # fill alreadygot with all shares that we have, not just the ones
@@ -278,16 +523,25 @@ class StorageServer(service.MultiService, Referenceable):
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
+            if not self.leasedb:
+                sf = ShareFile(fn, filecache=self.filecache,
+                               backend=self.backend)
+                sf.add_or_renew_lease(lease_info)
+        if self.leasedb and alreadygot:
+            self.leasedb.add_or_renew_leases(storage_index, sorted(alreadygot),
+                                             lease_info)
+        # packed shares keep their leases in the pack index
+        for (shnum, sf) in self._get_packed_shares(storage_index).items():
+            alreadygot.add(shnum)
             sf.add_or_renew_lease(lease_info)
 
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
             finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            if shnum in alreadygot:
                 # great! we already have it. easy.
                 pass
-            elif os.path.exists(incominghome):
+            elif self.backend.exists(incominghome):
                 # Note that we don't create BucketWriters for shnums that
                 # have a partial share (in incoming/), so if a second upload
                 # occurs while the first is still in progress, the second
@@ -295,39 +549,60 @@ class StorageServer(service.MultiService, Referenceable):
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
+                write_buffer = None
+                if self.write_buffers:
+                    write_buffer = self.write_buffers.new_buffer()
+                packer = None
+                if self.packs and \
+                       max_space_per_bucket <= self.packed_share_max_size:
+                    packer = partial(self.packs.append, storage_index, shnum)
                 bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                                  max_space_per_bucket, lease_info, canary,
+                                  write_buffer=write_buffer,
+                                  fsync=self.fsync_shares, packer=packer,
+                                  backend=self.backend)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self._active_writers[bw] = (storage_index, shnum)
+                self.space.reserve(bw, max_space_per_bucket)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
+        if [w for w in bucketwriters.values() if not w.packed]:
+            self.backend.make_dirs(os.path.join(self.sharedir, si_dir))
 
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
     def _iter_share_files(self, storage_index):
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
-            header = f.read(32)
-            f.close()
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+        for shnum, filename, sharetype in self._get_bucket_sharetypes(storage_index):
+            if sharetype == "mutable":
+                sf = get_mutable_share_file(filename, self,
+                                            filecache=self.filecache,
+                                            backend=self.backend)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+            elif sharetype == "immutable":
+                sf = ShareFile(filename, filecache=self.filecache,
+                               backend=self.backend)
             else:
                 continue # non-sharefile
             yield sf
+        packed = self._get_packed_shares(storage_index)
+        for shnum in sorted(packed):
+            yield packed[shnum]
+
+    def _get_packed_shares(self, storage_index):
+        """Return a dict that maps shnum to a PackedShare, for the shares of
+        this storage_index that live in pack files."""
+        if not self.packs:
+            return {}
+        return self.packs.get_shares(storage_index)
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
@@ -337,8 +612,16 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
-            sf.add_or_renew_lease(lease_info)
+        if self.leasedb:
+            shnums = [shnum for (shnum, filename, sharetype)
+                      in self._get_bucket_sharetypes(storage_index)
+                      if sharetype]
+            self.leasedb.add_or_renew_leases(storage_index, shnums, lease_info)
+            for sf in self._get_packed_shares(storage_index).values():
+                sf.add_or_renew_lease(lease_info)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                sf.add_or_renew_lease(lease_info)
         self.add_latency("add-lease", time.time() - start)
         return None
 
@@ -347,9 +630,24 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
-            found_buckets = True
-            sf.renew_lease(renew_secret, new_expire_time)
+        if self.leasedb:
+            # one UPDATE covers every share in the bucket
+            found_buckets = bool([shnum for (shnum, filename, sharetype)
+                                  in self._get_bucket_sharetypes(storage_index)
+                                  if sharetype])
+            if found_buckets:
+                renewed = self.leasedb.renew_leases(storage_index,
+                                                    renew_secret,
+                                                    new_expire_time)
+                if not renewed:
+                    raise IndexError("unable to renew non-existent lease")
+            for sf in self._get_packed_shares(storage_index).values():
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
+        else:
+            for sf in self._iter_share_files(storage_index):
+                found_buckets = True
+                sf.renew_lease(renew_secret, new_expire_time)
         self.add_latency("renew", time.time() - start)
         if not found_buckets:
             raise IndexError("no such lease to renew")
@@ -357,15 +655,99 @@ class StorageServer(service.MultiService, Referenceable):
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum) = self._active_writers.pop(bw)
+        self.space.release(bw)
+        self.space.consumed(consumed_size)
+        if bw.pack_location is not None:
+            # the share index and the lease database only know about share
+            # files: a packed share's leases live in the pack index
+            self.packs.record(storage_index, shnum, bw.pack_location,
+                              consumed_size, bw.lease_info)
+        elif consumed_size:
+            if self.filecache:
+                # forget any stale handle for a share that used to live there
+                self.filecache.invalidate(bw.finalhome)
+            if self.share_index:
+                self.share_index.add_share(storage_index, shnum, "immutable",
+                                           consumed_size, bw.finalhome)
+            if self.leasedb:
+                self.leasedb.record_share(storage_index, shnum, "immutable",
+                                          bw.finalhome)
+                self.leasedb.add_or_renew_leases(storage_index, [shnum],
+                                                 bw.lease_info)
+        if consumed_size:
+            self._adjust_share_count(storage_index, 1)
+            self.share_counter.add_share(storage_index, "immutable",
+                                         bw.allocated_size(),
+                                         self._count_shares(storage_index) == 1)
+
+    def _count_shares(self, storage_index):
+        """Return how many shares I hold for this storage index. Only the
+        first call for each one looks at the bucket: after that,
+        _adjust_share_count() keeps the count up to date, so closing each
+        share of an upload does not list the bucket again."""
+        count = self._share_counts.get(storage_index)
+        if count is None:
+            if len(self._share_counts) >= self.share_count_cache_size:
+                self._share_counts.clear()
+            count = (len(list(self._get_bucket_shares(storage_index)))
+                     + len(self._get_packed_shares(storage_index)))
+            self._share_counts[storage_index] = count
+        return count
+
+    def _adjust_share_count(self, storage_index, delta):
+        # a count that is not cached yet will include the change when
+        # _count_shares() reads it from disk
+        if storage_index in self._share_counts:
+            self._share_counts[storage_index] += delta
+
+
+    def share_removed(self, storage_index, shnum, sharetype=None,
+                      data_length=None):
+        """Notify me that a share was deleted by someone other than me (for
+        example, the lease-expiration crawler). If the caller knows the
+        share's type and data length, the live share counts are updated;
+        otherwise they are corrected by the next bucket-counting cycle."""
+        if self.filecache:
+            filename = os.path.join(self.sharedir,
+                                    storage_index_to_dir(storage_index),
+                                    "%d" % shnum)
+            self.filecache.invalidate(filename)
+        if self.share_index:
+            self.share_index.remove_share(storage_index, shnum)
+        if self.leasedb:
+            self.leasedb.remove_share(storage_index, shnum)
+        self._adjust_share_count(storage_index, -1)
+        if sharetype in ("immutable", "mutable") and data_length is not None:
+            self.share_counter.remove_share(storage_index, sharetype,
+                                            data_length,
+                                            not self._count_shares(storage_index))
+
+    def _get_bucket_sharetypes(self, storage_index):
+        """Return a list of (shnum, pathname, sharetype) tuples for files
+        that hold shares for this storage_index. 'sharetype' is 'mutable',
+        'immutable', or None for files that do not look like shares."""
+        if self.share_index:
+            shares = self.share_index.get_shares(storage_index)
+            return [(shnum, filename, sharetype)
+                    for (shnum, (sharetype, size, filename))
+                    in sorted(shares.items())]
+        return [(shnum, filename, get_sharetype(filename, self.backend))
+                for (shnum, filename)
+                in self._get_bucket_shares(storage_index)]
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
+        if self.share_index:
+            shares = self.share_index.get_shares(storage_index)
+            for (shnum, (sharetype, size, filename)) in sorted(shares.items()):
+                yield (shnum, filename)
+            return
         storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
         try:
-            for f in os.listdir(storagedir):
+            for f in self.backend.listdir(storagedir):
                 if NUM_RE.match(f):
                     filename = os.path.join(storagedir, f)
                     yield (int(f), filename)
@@ -378,13 +760,100 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
+        if self.diskio:
+            shares = self._list_shares_for_io(storage_index)
+            if shares != []:
+                d = self.diskio.run(self._get_bucket_readers, storage_index,
+                                    shares)
+                d.addCallback(self._add_packed_readers, storage_index)
+                d.addCallback(self._finished, "get", start)
+                return d
+            # a miss in the share index opens no share files, so it is
+            # answered here rather than queued behind the I/O that does
+            bucketreaders = {}
+        else:
+            bucketreaders = self._get_bucket_readers(storage_index)
+        bucketreaders = self._add_packed_readers(bucketreaders, storage_index)
+        return self._finished(bucketreaders, "get", start)
+
+    def _finished(self, result, category, start):
+        self.add_latency(category, time.time() - start)
+        return result
+
+    def _list_shares_for_io(self, storage_index):
+        # the share index may only be used from the reactor thread, so the
+        # I/O pool is given its answer. Without an index, the pool lists
+        # the bucket directory itself.
+        if self.share_index:
+            return list(self._get_bucket_shares(storage_index))
+        return None
+
+    def _get_bucket_readers(self, storage_index, shares=None):
+        if shares is None:
+            shares = self._get_bucket_shares(storage_index)
         bucketreaders = {} # k: sharenum, v: BucketReader
-        for shnum, filename in self._get_bucket_shares(storage_index):
+        for shnum, filename in shares:
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
-        self.add_latency("get", time.time() - start)
+                                                storage_index, shnum,
+                                                filecache=self.filecache,
+                                                backend=self.backend)
+        return bucketreaders
+
+    def _add_packed_readers(self, bucketreaders, storage_index):
+        # the pack index may only be used from the reactor thread, but
+        # reading a packed share only needs its pack file
+        for (shnum, sf) in self._get_packed_shares(storage_index).items():
+            bucketreaders[shnum] = BucketReader(self, sf.home,
+                                                storage_index, shnum,
+                                                share_file=sf)
         return bucketreaders
 
+    def remote_get_buckets_batch(self, storage_indexes):
+        start = time.time()
+        self.count("get-batch")
+        log.msg("storage: get_buckets_batch (%d storage indexes)"
+                % len(storage_indexes))
+        if self.diskio:
+            # only the storage indexes which the share index has not
+            # already answered as misses go to the I/O pool
+            io_storage_indexes = []
+            io_shares = []
+            for storage_index in storage_indexes:
+                shares = self._list_shares_for_io(storage_index)
+                if shares != []:
+                    io_storage_indexes.append(storage_index)
+                    io_shares.append(shares)
+            if io_storage_indexes:
+                d = self.diskio.run(self._get_buckets_batch,
+                                    io_storage_indexes, io_shares)
+                d.addCallback(self._add_packed_batch, storage_indexes)
+                d.addCallback(self._finished, "get-batch", start)
+                return d
+            results = {}
+        else:
+            results = self._get_buckets_batch(storage_indexes)
+        results = self._add_packed_batch(results, storage_indexes)
+        return self._finished(results, "get-batch", start)
+
+    def _get_buckets_batch(self, storage_indexes, shares=None):
+        if shares is None:
+            shares = [None] * len(storage_indexes)
+        results = {} # k: storage_index, v: dict of BucketReaders
+        for (storage_index, bucket) in zip(storage_indexes, shares):
+            bucketreaders = self._get_bucket_readers(storage_index, bucket)
+            if bucketreaders:
+                results[storage_index] = bucketreaders
+        return results
+
+    def _add_packed_batch(self, results, storage_indexes):
+        if self.packs:
+            for storage_index in storage_indexes:
+                bucketreaders = results.get(storage_index, {})
+                self._add_packed_readers(bucketreaders, storage_index)
+                if bucketreaders:
+                    results[storage_index] = bucketreaders
+        return results
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -396,9 +865,15 @@ class StorageServer(service.MultiService, Referenceable):
         # from the first share
         try:
             shnum, filename = self._get_bucket_shares(storage_index).next()
-            sf = ShareFile(filename)
+            if self.leasedb:
+                return iter(self.leasedb.get_leases(storage_index, shnum))
+            sf = ShareFile(filename, filecache=self.filecache,
+                           backend=self.backend)
             return sf.get_leases()
         except StopIteration:
+            packed = self._get_packed_shares(storage_index)
+            if packed:
+                return packed[min(packed)].get_leases()
             return iter([])
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
@@ -407,6 +882,63 @@ class StorageServer(service.MultiService, Referenceable):
                                                read_vector):
         start = time.time()
         self.count("writev")
+        if self.diskio:
+            # wait for any reads of this slot that are in the I/O pool
+            d = self._slot_locks.run(storage_index, self._slot_writev,
+                                     storage_index, secrets,
+                                     test_and_write_vectors, read_vector)
+            d.addCallback(self._finished, "writev", start)
+            return d
+        result = self._slot_writev(storage_index, secrets,
+                                   test_and_write_vectors, read_vector)
+        return self._finished(result, "writev", start)
+
+    def remote_slot_testv_and_readv_and_writev_batch(self, requests):
+        start = time.time()
+        self.count("writev-batch")
+        log.msg("storage: slot_writev_batch (%d slots)" % len(requests))
+        if self.diskio:
+            # the slots are independent, but writes to the same slot are
+            # applied in the order they were sent, by the slot's lock
+            dl = []
+            for (storage_index, secrets, tw_vectors, read_vector) in requests:
+                d = self._slot_locks.run(storage_index, self._slot_writev,
+                                         storage_index, secrets, tw_vectors,
+                                         read_vector)
+                d.addCallbacks(self._slot_writev_done,
+                               self._slot_writev_failed,
+                               errbackArgs=(storage_index,))
+                dl.append(d)
+            d = defer.gatherResults(dl)
+            d.addCallback(self._finished, "writev-batch", start)
+            return d
+        results = []
+        for (storage_index, secrets, tw_vectors, read_vector) in requests:
+            try:
+                result = self._slot_writev(storage_index, secrets, tw_vectors,
+                                           read_vector)
+                result = self._slot_writev_done(result)
+            except Exception:
+                result = self._slot_writev_failed(failure.Failure(),
+                                                  storage_index)
+            results.append(result)
+        return self._finished(results, "writev-batch", start)
+
+    def _slot_writev_done(self, result):
+        (testv_is_good, read_data) = result
+        return (testv_is_good, read_data, None)
+
+    def _slot_writev_failed(self, f, storage_index):
+        # one slot of a batch failed: tell the client why, and carry on
+        # with the others
+        self.log("slot_writev_batch %s failed: %s"
+                 % (si_b2a(storage_index), f.getErrorMessage()),
+                 level=log.UNUSUAL)
+        error = "%s: %s" % (f.value.__class__.__name__, f.getErrorMessage())
+        return (False, {}, error)
+
+    def _slot_writev(self, storage_index, secrets, test_and_write_vectors,
+                     read_vector):
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
         si_dir = storage_index_to_dir(storage_index)
@@ -414,16 +946,12 @@ class StorageServer(service.MultiService, Referenceable):
         # shares exist if there is a file for them
         bucketdir = os.path.join(self.sharedir, si_dir)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for (sharenum, filename) in self._get_bucket_shares(storage_index):
+            msf = get_mutable_share_file(filename, self,
+                                         filecache=self.filecache,
+                                         backend=self.backend)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
         # Now evaluate test vectors.
@@ -461,7 +989,11 @@ class StorageServer(service.MultiService, Referenceable):
                 (testv, datav, new_length) = test_and_write_vectors[sharenum]
                 if new_length == 0:
                     if sharenum in shares:
-                        shares[sharenum].unlink()
+                        share = shares.pop(sharenum)
+                        data_length = share.get_data_length()
+                        share.unlink()
+                        self.share_removed(storage_index, sharenum,
+                                           "mutable", data_length)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
@@ -470,29 +1002,49 @@ class StorageServer(service.MultiService, Referenceable):
                                                           sharenum,
                                                           allocated_size,
                                                           owner_num=0)
+                        self._adjust_share_count(storage_index, 1)
+                        self.share_counter.add_share(
+                            storage_index, "mutable", 0, not shares)
                         shares[sharenum] = share
+                    old_length = shares[sharenum].get_data_length()
                     shares[sharenum].writev(datav, new_length)
+                    growth = shares[sharenum].get_data_length() - old_length
+                    self.share_counter.resize_share(storage_index, "mutable",
+                                                    growth)
+                    self.space.consumed(max(growth, 0))
+                    if self.leasedb:
+                        self.leasedb.record_share(storage_index, sharenum,
+                                                  "mutable",
+                                                  shares[sharenum].home)
                     # and update the lease
-                    shares[sharenum].add_or_renew_lease(lease_info)
+                    self._leased(storage_index, sharenum,
+                                 shares[sharenum]).add_or_renew_lease(lease_info)
+                    if self.share_index:
+                        filename = shares[sharenum].home
+                        self.share_index.add_share(storage_index, sharenum,
+                                                   "mutable",
+                                                   os.path.getsize(filename),
+                                                   filename)
 
             if new_length == 0:
                 # delete empty bucket directories
-                if not os.listdir(bucketdir):
-                    os.rmdir(bucketdir)
+                if not self.backend.listdir(bucketdir):
+                    self.backend.rmdir(bucketdir)
 
 
         # all done
-        self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
                              allocated_size, owner_num=0):
         (write_enabler, renew_secret, cancel_secret) = secrets
         my_nodeid = self.my_nodeid
-        fileutil.make_dirs(bucketdir)
+        self.backend.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         self, filecache=self.filecache,
+                                         backend=self.backend,
+                                         version=self.mutable_container_version)
         return share
 
     def remote_slot_readv(self, storage_index, shares, readv):
@@ -501,46 +1053,53 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
+        def _done(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
+            return self._finished(datavs, "readv", start)
+        if self.diskio:
+            def _read():
+                bucket = self._list_shares_for_io(storage_index)
+                return self.diskio.run(self._read_slot, storage_index,
+                                       shares, readv, bucket)
+            d = self._slot_locks.run(storage_index, _read)
+            d.addCallback(_done)
+            return d
+        return _done(self._read_slot(storage_index, shares, readv))
+
+    def _read_slot(self, storage_index, shares, readv, bucket=None):
+        if bucket is None:
+            bucket = self._get_bucket_shares(storage_index)
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
-            self.add_latency("readv", time.time() - start)
-            return {}
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for (sharenum, filename) in bucket:
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = get_mutable_share_file(filename, self,
+                                             filecache=self.filecache,
+                                             backend=self.backend)
                 datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
                                     reason):
-        fileutil.make_dirs(self.corruption_advisory_dir)
-        now = time_format.iso_utc(sep="T")
+        return self.advise_corrupt_share(ANONYMOUS, share_type, storage_index,
+                                         shnum, reason)
+
+    def advise_corrupt_share(self, client, share_type, storage_index, shnum,
+                             reason):
+        self.count("corruption-advisory")
+        result = self.corruption_advisories.add(client, share_type,
+                                                storage_index, shnum, reason)
         si_s = si_b2a(storage_index)
-        # windows can't handle colons in the filename
-        fn = os.path.join(self.corruption_advisory_dir,
-                          "%s--%s-%d" % (now, si_s, shnum)).replace(":","")
-        f = open(fn, "w")
-        f.write("report: Share Corruption\n")
-        f.write("type: %s\n" % share_type)
-        f.write("storage_index: %s\n" % si_s)
-        f.write("share_number: %d\n" % shnum)
-        f.write("\n")
-        f.write(reason)
-        f.write("\n")
-        f.close()
+        if result is None:
+            # the client has sent too many: don't flood the log either
+            return None
+        if result == "new":
+            level = log.SCARY
+        else:
+            level = log.NOISY
         log.msg(format=("client claims corruption in (%(share_type)s) " +
                         "%(si)s-%(shnum)d: %(reason)s"),
                 share_type=share_type, si=si_s, shnum=shnum, reason=reason,
-                level=log.SCARY, umid="SGx2fA")
+                level=level, umid="SGx2fA")
         return None
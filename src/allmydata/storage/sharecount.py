@@ -0,0 +1,191 @@
+import os, time, struct
+import cPickle as pickle
+from allmydata.storage.common import si_b2a, UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.backend import LOCAL_DISK
+from allmydata.util import fileutil, log
+
+# the per-prefix counters, in order
+FIELDS = ("buckets",
+          "shares-immutable", "shares-mutable",
+          "bytes-immutable", "bytes-mutable")
+BUCKETS, SHARES, BYTES = 0, {"immutable": 1, "mutable": 2}, \
+                         {"immutable": 3, "mutable": 4}
+
+def count_prefixdir(prefixdir, packed=None, backend=LOCAL_DISK):
+    """Examine every bucket in a prefixdir, and return a list of counters
+    (in the order of FIELDS) for the shares in it. Files that do not look
+    like shares are not counted. 'bytes' is the size of the share data,
+    which (unlike the size of the share file) does not change when leases
+    are added or removed.
+
+    'packed' is what PackStore.count_prefix() reports for the same prefix,
+    if the server keeps some immutable shares in pack files."""
+    counts = [0] * len(FIELDS)
+    found_buckets = set()
+    try:
+        buckets = backend.listdir(prefixdir)
+    except EnvironmentError:
+        buckets = []
+    for bucket in buckets:
+        bucketdir = os.path.join(prefixdir, bucket)
+        try:
+            names = backend.listdir(bucketdir)
+        except EnvironmentError:
+            continue
+        found = False
+        for fn in names:
+            if not fn.isdigit():
+                continue
+            try:
+                sf = get_share_file(os.path.join(bucketdir, fn),
+                                    backend=backend)
+                data_length = sf.get_data_length()
+            except (EnvironmentError, UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError, struct.error):
+                continue
+            found = True
+            counts[SHARES[sf.sharetype]] += 1
+            counts[BYTES[sf.sharetype]] += data_length
+        if found:
+            counts[BUCKETS] += 1
+            found_buckets.add(bucket)
+    for (bucket, (shares, sharebytes)) in (packed or {}).items():
+        if bucket not in found_buckets:
+            counts[BUCKETS] += 1
+        counts[SHARES["immutable"]] += shares
+        counts[BYTES["immutable"]] += sharebytes
+    return counts
+
+class ShareCounter:
+    """I keep live counts of the buckets and shares that this server holds,
+    and of the bytes of share data in them, by share type. The storage
+    server tells me about every share it adds or removes, so my counts do
+    not wait for a crawler to visit the whole disk.
+
+    The counts are kept per prefixdir, which lets the BucketCountingCrawler
+    verify them one prefix at a time: each time it visits a prefixdir, the
+    counts it finds on disk replace mine, and any difference is logged.
+
+    My counts are 'exact' once they started from an empty server, were
+    loaded from a file that was saved at shutdown, or were verified by a
+    complete crawler cycle. They are saved to 'countfile' every
+    'save_interval' seconds (as long as something changes), so a server
+    which crashes comes back with counts that are nearly right, but not
+    exact until the crawler has verified them again.
+    """
+
+    save_interval = 5*60
+
+    def __init__(self, countfile, empty=False):
+        self.countfile = countfile
+        self._prefixes = {} # prefix -> list of counters, in FIELDS order
+        self.known = False
+        self.exact = False
+        self._reconciled = set()
+        self._last_save = time.time()
+        self.load()
+        if not self.known and empty:
+            self.known = self.exact = True
+
+    def load(self):
+        try:
+            f = open(self.countfile, "rb")
+            state = pickle.load(f)
+            f.close()
+        except Exception:
+            return
+        if state.get("version") != 1:
+            return
+        self._prefixes = state["prefixes"]
+        self.known = True
+        self.exact = state["exact"]
+        if self.exact:
+            # from here on, a crash would lose changes
+            self.save(clean=False)
+
+    def save(self, clean=False):
+        """Write my counts to disk. Only a clean save (at shutdown) marks
+        them as exact for the next process."""
+        state = {"version": 1,
+                 "exact": bool(clean and self.exact),
+                 "prefixes": self._prefixes,
+                 }
+        tmpfile = self.countfile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        fileutil.move_into_place(tmpfile, self.countfile)
+        self._last_save = time.time()
+
+    def _get_counts(self, storage_index):
+        prefix = si_b2a(storage_index)[:2]
+        counts = self._prefixes.get(prefix)
+        if counts is None:
+            counts = self._prefixes[prefix] = [0] * len(FIELDS)
+        return counts
+
+    def _changed(self):
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def add_share(self, storage_index, sharetype, data_length, new_bucket):
+        counts = self._get_counts(storage_index)
+        if new_bucket:
+            counts[BUCKETS] += 1
+        counts[SHARES[sharetype]] += 1
+        counts[BYTES[sharetype]] += data_length
+        self._changed()
+
+    def resize_share(self, storage_index, sharetype, delta):
+        if delta:
+            self._get_counts(storage_index)[BYTES[sharetype]] += delta
+            self._changed()
+
+    def remove_share(self, storage_index, sharetype, data_length,
+                     bucket_gone):
+        counts = self._get_counts(storage_index)
+        if bucket_gone:
+            counts[BUCKETS] -= 1
+        counts[SHARES[sharetype]] -= 1
+        counts[BYTES[sharetype]] -= data_length
+        self._changed()
+
+    def get_counts(self):
+        """Return a dictionary that maps each name in FIELDS to its total
+        over all prefixes, or None if I do not know the counts yet."""
+        if not self.known:
+            return None
+        totals = [0] * len(FIELDS)
+        for counts in self._prefixes.values():
+            for i in range(len(FIELDS)):
+                totals[i] += counts[i]
+        return dict(zip(FIELDS, totals))
+
+    def started_reconciliation(self):
+        self._reconciled = set()
+
+    def reconcile_prefix(self, prefix, counts):
+        """Replace my counts for one prefixdir with the ones just found on
+        disk (by count_prefixdir)."""
+        old = self._prefixes.get(prefix, [0] * len(FIELDS))
+        if self.known and old != counts:
+            drift = ", ".join(["%s %+d" % (name, new-was)
+                               for (name, was, new) in zip(FIELDS, old, counts)
+                               if was != new])
+            log.msg(format="share counts for prefix %(prefix)s were off:"
+                    " %(drift)s", prefix=prefix, drift=drift,
+                    exact=self.exact, level=log.UNUSUAL,
+                    facility="tahoe.storage", umid="e8ZqPw")
+        self._prefixes[prefix] = list(counts)
+        self._reconciled.add(prefix)
+
+    def finished_reconciliation(self, prefixes):
+        """The crawler finished a cycle. If it visited every prefix since I
+        was created (or since the cycle began), my counts are now exact."""
+        if self._reconciled.issuperset(prefixes):
+            self.known = self.exact = True
+            for prefix in set(self._prefixes) - set(prefixes):
+                del self._prefixes[prefix]
+            self.save()
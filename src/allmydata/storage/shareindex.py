@@ -0,0 +1,229 @@
+
+import os, struct
+import cPickle as pickle
+from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.mutable import is_mutable_magic
+from allmydata.storage.backend import LOCAL_DISK
+from allmydata.util import fileutil, log
+
+def get_sharetype(filename, backend=LOCAL_DISK):
+    """Sniff the container header of a share file. Returns 'mutable' or
+    'immutable', or None if the file does not look like a share."""
+    f = backend.open(filename, 'rb')
+    header = f.read(32)
+    f.close()
+    if is_mutable_magic(header[:32]):
+        return "mutable"
+    if header[:4] == struct.pack(">L", 1):
+        return "immutable"
+    return None
+
+class ShareIndex:
+    """I remember where the shares for each storage index live, so that the
+    StorageServer can answer DYHB queries, lease operations and slot reads
+    without listing the bucket directory and sniffing the share headers on
+    every request.
+
+    For each known storage index I hold a dictionary that maps shnum to a
+    (sharetype, size, filename) tuple. Buckets are grouped by their
+    two-character prefix, which lets the ShareIndexCrawler reconcile a whole
+    prefixdir at a time.
+
+    I am 'complete' once every prefixdir has been examined (either by the
+    crawler, or by loading an index that was saved at shutdown). Until then,
+    lookups for unknown storage indexes fall through to the disk, and the
+    result is remembered. Once I am complete, a miss means that the server
+    has no shares for that storage index, and the disk is not touched.
+
+    The index is saved to 'indexfile' when the server shuts down. The file
+    is removed as soon as it has been loaded, so that a server which crashes
+    (and therefore might have lost track of some changes) will rebuild the
+    index from scratch the next time it starts.
+    """
+
+    def __init__(self, sharedir, indexfile):
+        self.sharedir = sharedir
+        self.indexfile = indexfile
+        self.complete = False
+        self.loaded = False
+        self._prefixes = {} # prefix -> {si: {shnum: (sharetype,size,fn)}}
+        self.load()
+
+    def load(self):
+        try:
+            f = open(self.indexfile, "rb")
+            state = pickle.load(f)
+            f.close()
+        except Exception:
+            return
+        try:
+            os.unlink(self.indexfile)
+        except EnvironmentError:
+            # if we can't remove it, we can't tell a crash from a clean
+            # shutdown next time, so don't trust it
+            log.msg("unable to remove share index %s, rebuilding"
+                    % self.indexfile, level=log.UNUSUAL,
+                    facility="tahoe.storage")
+            return
+        if state.get("version") != 1:
+            return
+        self._prefixes = state["prefixes"]
+        self.complete = state["complete"]
+        self.loaded = True
+
+    def save(self):
+        state = {"version": 1,
+                 "complete": self.complete,
+                 "prefixes": self._prefixes,
+                 }
+        tmpfile = self.indexfile + ".tmp"
+        f = open(tmpfile, "wb")
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        fileutil.move_into_place(tmpfile, self.indexfile)
+
+    def _get_bucket(self, storage_index, create=False):
+        prefix = si_b2a(storage_index)[:2]
+        buckets = self._prefixes.get(prefix)
+        if buckets is None:
+            if not create:
+                return None
+            buckets = self._prefixes[prefix] = {}
+        bucket = buckets.get(storage_index)
+        if bucket is None and create:
+            bucket = buckets[storage_index] = {}
+        return bucket
+
+    def get_shares(self, storage_index):
+        """Return a dictionary mapping shnum to (sharetype, size, filename)
+        for all shares of the given storage index. If the index is not yet
+        complete and the storage index is unknown, the bucket directory is
+        examined (and remembered). Callers must not modify the result."""
+        bucket = self._get_bucket(storage_index)
+        if bucket is None:
+            if self.complete:
+                return {}
+            bucket = self.scan_bucket(storage_index)
+        return bucket
+
+    def scan_bucket(self, storage_index):
+        """Examine the bucket directory for this storage index on disk,
+        replacing anything I previously knew about it."""
+        bucketdir = os.path.join(self.sharedir,
+                                 storage_index_to_dir(storage_index))
+        bucket = {}
+        try:
+            names = os.listdir(bucketdir)
+        except EnvironmentError:
+            # Commonly caused by there being no buckets at all.
+            names = []
+        for f in names:
+            try:
+                shnum = int(f)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            filename = os.path.join(bucketdir, f)
+            try:
+                sharetype = get_sharetype(filename)
+                size = os.path.getsize(filename)
+            except EnvironmentError:
+                continue
+            bucket[shnum] = (sharetype, size, filename)
+        self._set_bucket(storage_index, bucket)
+        return bucket
+
+    def _set_bucket(self, storage_index, bucket):
+        prefix = si_b2a(storage_index)[:2]
+        buckets = self._prefixes.setdefault(prefix, {})
+        if bucket:
+            buckets[storage_index] = bucket
+        else:
+            # remember empty buckets (so misses stay cheap) only while we
+            # are incomplete: afterwards, absence means the same thing
+            if self.complete:
+                buckets.pop(storage_index, None)
+            else:
+                buckets[storage_index] = bucket
+
+    def add_share(self, storage_index, shnum, sharetype, size, filename):
+        bucket = self._get_bucket(storage_index, create=True)
+        bucket[shnum] = (sharetype, size, filename)
+
+    def update_share_size(self, storage_index, shnum, size):
+        bucket = self._get_bucket(storage_index)
+        if bucket and shnum in bucket:
+            (sharetype, oldsize, filename) = bucket[shnum]
+            bucket[shnum] = (sharetype, size, filename)
+
+    def remove_share(self, storage_index, shnum):
+        bucket = self._get_bucket(storage_index)
+        if bucket is None:
+            return
+        bucket.pop(shnum, None)
+        if not bucket:
+            self._set_bucket(storage_index, bucket)
+
+    def get_known_storage_indexes(self, prefix):
+        return set(self._prefixes.get(prefix, {}).keys())
+
+    def forget_bucket(self, storage_index):
+        prefix = si_b2a(storage_index)[:2]
+        self._prefixes.get(prefix, {}).pop(storage_index, None)
+
+    def set_complete(self):
+        self.complete = True
+        # the empty buckets we remembered to keep misses cheap are no longer
+        # needed
+        for buckets in self._prefixes.values():
+            for si in [si for si in buckets if not buckets[si]]:
+                del buckets[si]
+
+
+class ShareIndexCrawler(ShareCrawler):
+    """I build and maintain the StorageServer's ShareIndex. On each prefixdir
+    I compare the bucket directories that are present on disk with the ones
+    the index knows about: new buckets are scanned, and vanished buckets are
+    forgotten. Buckets that the index already knows are not re-examined, so
+    once the index is complete, a cycle costs one listdir per prefixdir.
+
+    When the first full cycle finishes, the index is marked complete.
+    """
+
+    slow_start = 0 # the index is useless until it is built
+    minimum_cycle_time = 24*60*60 # reconcile once a day
+
+    def __init__(self, server, statefile, index):
+        self.index = index
+        ShareCrawler.__init__(self, server, statefile)
+        if not index.loaded and self.state["current-cycle"] is not None:
+            # the index is being rebuilt from nothing, but the cycle in
+            # progress skipped the prefixes finished by an earlier process
+            self.state["index-cycle-complete"] = False
+
+    def add_initial_state(self):
+        # ["index-cycle-complete"]: bool, True if this cycle started from the
+        #                           beginning (and can thus complete the index)
+        self.state.setdefault("index-cycle-complete", False)
+
+    def started_cycle(self, cycle):
+        self.state["index-cycle-complete"] = True
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        on_disk = set()
+        for bucket in buckets:
+            try:
+                on_disk.add(si_a2b(bucket))
+            except AssertionError:
+                continue # not a storage index
+        known = self.index.get_known_storage_indexes(prefix)
+        for si in known - on_disk:
+            self.index.forget_bucket(si)
+        for si in on_disk - known:
+            self.index.scan_bucket(si)
+
+    def finished_cycle(self, cycle):
+        if self.state["index-cycle-complete"] and not self.index.complete:
+            self.index.set_complete()
+            self.server.log("share index is complete",
+                            level=log.OPERATIONAL)
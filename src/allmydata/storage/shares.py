@@ -1,14 +1,16 @@
 #! /usr/bin/python
 
-from allmydata.storage.mutable import MutableShareFile
+from allmydata.storage.mutable import is_mutable_magic, get_mutable_share_file
 from allmydata.storage.immutable import ShareFile
+from allmydata.storage.backend import LOCAL_DISK
 
-def get_share_file(filename):
-    f = open(filename, "rb")
+def get_share_file(filename, filecache=None, backend=LOCAL_DISK):
+    f = backend.open(filename, "rb")
     prefix = f.read(32)
     f.close()
-    if prefix == MutableShareFile.MAGIC:
-        return MutableShareFile(filename)
+    if is_mutable_magic(prefix):
+        return get_mutable_share_file(filename, filecache=filecache,
+                                      backend=backend)
     # otherwise assume it's immutable
-    return ShareFile(filename)
+    return ShareFile(filename, filecache=filecache, backend=backend)
 
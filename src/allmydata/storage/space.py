@@ -0,0 +1,87 @@
+import time, weakref
+from allmydata.storage.backend import LOCAL_DISK
+
+class SpaceAccountant:
+    """I decide how much space the storage server can still promise to new
+    immutable shares, without a statvfs() call and a walk over every active
+    BucketWriter for each allocate_buckets request.
+
+    Each BucketWriter reserves its maximum size when it is created, and
+    releases it when it is closed or aborted (or garbage-collected without
+    either). I keep the total of the outstanding reservations as a running
+    sum.
+
+    The amount of free disk space is measured at most once every
+    'refresh_interval' seconds. Between measurements I subtract the bytes
+    that closed shares and mutable writes have added to the disk, and
+    measure again as soon as more than 'refresh_bytes' have been added.
+    Space that is still reserved by an open BucketWriter is counted once,
+    as a reservation, even after some of it has been written.
+    """
+
+    refresh_interval = 10
+    refresh_bytes = 64*1024*1024
+
+    def __init__(self, sharedir, reserved_space=0, readonly=False,
+                 backend=LOCAL_DISK):
+        self.sharedir = sharedir
+        self.backend = backend
+        self.reserved_space = reserved_space
+        self.readonly = readonly
+        self.allocated = 0
+        self._reservations = {} # weakref to BucketWriter -> size
+        self._avail = None
+        self._consumed = 0 # bytes added to the disk since the last refresh
+        self._last_refresh = None
+        self.refreshes = 0
+
+    def reserve(self, bw, size):
+        ref = weakref.ref(bw, self._forget)
+        self._reservations[ref] = size
+        self.allocated += size
+
+    def release(self, bw):
+        self._forget(weakref.ref(bw))
+
+    def _forget(self, ref):
+        size = self._reservations.pop(ref, None)
+        if size is not None:
+            self.allocated -= size
+
+    def consumed(self, size):
+        """Tell me that 'size' bytes were just added to the disk."""
+        self._consumed += size
+
+    def set_available(self, avail):
+        """Accept a fresh measurement of the available space, made by
+        somebody else."""
+        self._avail = avail
+        self._consumed = 0
+        self._last_refresh = time.time()
+
+    def refresh(self):
+        self.refreshes += 1
+        self.set_available(self.backend.get_available_space(
+            self.sharedir, self.reserved_space))
+
+    def get_available_space(self):
+        """Returns available space for share storage in bytes, or None if no
+        API to get this information is available."""
+        if self.readonly:
+            return 0
+        if (self._last_refresh is None
+            or time.time() - self._last_refresh >= self.refresh_interval
+            or self._consumed >= self.refresh_bytes):
+            self.refresh()
+        if self._avail is None:
+            return None
+        return max(self._avail - self._consumed, 0)
+
+    def get_remaining_space(self):
+        """Return the space that new reservations may use, or None if it is
+        unlimited (because this platform cannot tell us how much space is
+        available)."""
+        avail = self.get_available_space()
+        if avail is None:
+            return None
+        return avail - self.allocated
@@ -0,0 +1,77 @@
+DEFAULT_WRITER_LIMIT = 1024*1024
+DEFAULT_TOTAL_LIMIT = 64*1024*1024
+
+class WriteBuffer:
+    """I hold the blocks that a client has sent to one BucketWriter but
+    that have not been written to its share file yet. Writes that continue
+    where the previous one ended are merged into a single run, so an upload
+    of many small segments turns into a few large sequential writes.
+
+    The runs are kept in the order they arrived: a client that writes the
+    same offset twice still gets the last write.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._runs = [] # (offset, [data]), in arrival order
+        self._end = None # where the last run ends
+        self.buffered = 0
+
+    def add(self, offset, data):
+        """Buffer one write. Returns True if it is time to flush, because
+        either I or the server's buffers as a whole are over their limit."""
+        if not data:
+            return False
+        if self._runs and offset == self._end:
+            self._runs[-1][1].append(data)
+            self.pool.coalesced_writes += 1
+        else:
+            self._runs.append((offset, [data]))
+        self._end = offset + len(data)
+        self.buffered += len(data)
+        self.pool.buffered += len(data)
+        self.pool.buffered_writes += 1
+        return (self.buffered >= self.pool.writer_limit
+                or self.pool.buffered >= self.pool.total_limit)
+
+    def take(self):
+        """Empty me, and return what I held as a list of (offset, data)
+        pairs, ready for ShareFile.writev_share_data()."""
+        datav = [(offset, "".join(chunks)) for (offset, chunks) in self._runs]
+        if datav:
+            self.pool.flushes += 1
+        self.discard()
+        return datav
+
+    def discard(self):
+        self.pool.buffered -= self.buffered
+        self._runs = []
+        self._end = None
+        self.buffered = 0
+
+
+class WriteBufferPool:
+    """I hand out a WriteBuffer to each BucketWriter, and keep the total
+    amount of buffered share data under 'total_limit' bytes: once it is
+    reached, every write flushes its own writer's buffer, as does any
+    writer that holds more than 'writer_limit' bytes."""
+
+    def __init__(self, writer_limit=DEFAULT_WRITER_LIMIT,
+                 total_limit=DEFAULT_TOTAL_LIMIT):
+        assert writer_limit > 0, writer_limit
+        self.writer_limit = writer_limit
+        self.total_limit = max(total_limit, writer_limit)
+        self.buffered = 0
+        self.buffered_writes = 0
+        self.coalesced_writes = 0
+        self.flushes = 0
+
+    def new_buffer(self):
+        return WriteBuffer(self)
+
+    def get_stats(self):
+        return {"buffered": self.buffered,
+                "buffered_writes": self.buffered_writes,
+                "coalesced_writes": self.coalesced_writes,
+                "flushes": self.flushes,
+                }
@@ -29,9 +29,10 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 # 6: implement other sorts of IStorageClient classes: S3, etc
 
 
-import re, time
+import re, time, heapq, math
 from zope.interface import implements
-from foolscap.api import eventually
+from twisted.internet import defer
+from foolscap.api import eventually, Referenceable
 from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
@@ -54,6 +55,130 @@ from allmydata.util.hashutil import sha1
 # look like?
 #  don't pass signatures: only pass validated blessed-objects
 
+# the permuted server lists of this many recently used peer selection
+# indexes are remembered
+PERMUTATION_CACHE_SIZE = 100
+
+# each new sample moves a ServerPerformance average this far towards it
+PERFORMANCE_WEIGHT = 0.2
+# responses smaller than this measure round-trip time, larger ones
+# throughput
+THROUGHPUT_MIN_SIZE = 16*1024
+
+# expected delays below this are all alike when choosing between servers
+FAST_ENOUGH = 0.01
+
+STORAGE_V1 = "http://allmydata.org/tahoe/protocols/storage/v1"
+
+def get_storage_v1_version(version):
+    """Return the storage-protocol part of a server's version dict (as
+    found in server.get_version() or rref.version), or an empty dict if the
+    server did not send one."""
+    return (version or {}).get(STORAGE_V1) or {}
+
+def get_max_immutable_readv_size(server):
+    """Return how many spans the given IServer accepts in one immutable
+    readv() call, or 0 if it does not offer readv()."""
+    v1 = get_storage_v1_version(server.get_version())
+    if not v1.get("immutable-readv"):
+        return 0
+    return v1.get("maximum-immutable-readv-size", 0)
+
+def delay_class(delay):
+    """Return 0 for expected delays below FAST_ENOUGH, and one more for
+    each doubling above it, so that callers can prefer faster servers
+    without being swayed by small differences."""
+    if delay < FAST_ENOUGH:
+        return 0
+    return 1 + int(math.log(delay / FAST_ENOUGH, 2))
+
+def _result_size(result):
+    if isinstance(result, str):
+        return len(result)
+    if isinstance(result, (list, tuple)):
+        return sum([_result_size(r) for r in result])
+    return 0
+
+class ServerPerformance:
+    """I keep rolling averages of how well one storage server has been
+    answering this client: the round-trip time of small requests, the
+    throughput of large reads, and the fraction of requests that failed,
+    along with the number of requests that are waiting for an answer right
+    now. All downloads (immutable and mutable) feed me through track(), so
+    that each one can prefer the servers that have been fast and are not
+    busy with the others."""
+
+    def __init__(self):
+        self.rtt = None # seconds
+        self.throughput = None # bytes per second
+        self.error_rate = 0.0
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_response_time = None
+
+    def _average(self, old, sample):
+        if old is None:
+            return sample
+        return old + PERFORMANCE_WEIGHT * (sample - old)
+
+    def track(self, d, sent=None):
+        """Record the request whose answer 'd' will fire with. Returns d,
+        which fires with the same result."""
+        if sent is None:
+            sent = time.time()
+        self.outstanding += 1
+        def _done(res):
+            self.response_received(time.time() - sent, _result_size(res))
+            return res
+        def _failed(f):
+            self.request_failed()
+            return f
+        d.addCallbacks(_done, _failed)
+        return d
+
+    def response_received(self, elapsed, size=0):
+        self.outstanding = max(self.outstanding - 1, 0)
+        self.requests += 1
+        self.last_response_time = time.time()
+        self.error_rate = self._average(self.error_rate, 0.0)
+        if size < THROUGHPUT_MIN_SIZE:
+            self.rtt = self._average(self.rtt, elapsed)
+            return
+        transfer_time = elapsed - (self.rtt or 0.0)
+        if transfer_time <= 0:
+            transfer_time = elapsed
+        if transfer_time > 0:
+            self.throughput = self._average(self.throughput,
+                                            size / transfer_time)
+
+    def request_failed(self):
+        self.outstanding = max(self.outstanding - 1, 0)
+        self.requests += 1
+        self.errors += 1
+        self.error_rate = self._average(self.error_rate, 1.0)
+
+    def expected_delay(self, size=0, rtt=None):
+        """Guess how long a request for 'size' bytes would take if it were
+        sent now, behind the requests that are already waiting, and
+        allowing for the chance that it fails. 'rtt' is used until I have
+        measured the round-trip time myself."""
+        if self.rtt is not None:
+            rtt = self.rtt
+        delay = (rtt or 0.0) * (1 + self.outstanding)
+        if size and self.throughput:
+            delay += float(size) / self.throughput
+        return delay / max(1.0 - self.error_rate, 0.1)
+
+    def get_stats(self):
+        return {"rtt": self.rtt,
+                "throughput": self.throughput,
+                "error_rate": self.error_rate,
+                "outstanding": self.outstanding,
+                "requests": self.requests,
+                "errors": self.errors,
+                }
+
 class StorageFarmBroker:
     implements(IStorageBroker)
     """I live on the client, and know about storage servers. For each server
@@ -61,6 +186,18 @@ class StorageFarmBroker:
     remember enough information to establish a connection to it on demand.
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
+
+    The set of connected servers, and the permuted lists of them for the
+    most recently used peer selection indexes, are computed once and then
+    remembered until a server connects, disconnects, or is added or
+    replaced (see servers_changed()). Several operations on the same file
+    (a servermap update followed by a publish, or a check followed by a
+    repair) share a single permutation. iter_servers_for_psi() is the lazy
+    form of get_servers_for_psi(), for callers that may only want the
+    first few servers: it skips sorting the rest.
+
+    I also keep a ServerPerformance for every server that this client has
+    downloaded from (see get_server_performance()).
     """
     def __init__(self, tub, permute_peers):
         self.tub = tub
@@ -72,6 +209,14 @@ class StorageFarmBroker:
         # them for it.
         self.servers = {}
         self.introducer_client = None
+        self._connected_servers = None
+        self._ring = None # list of (permutation seed, server), when connected
+        self._permutations = {} # peer_selection_index -> (last used, list)
+        self._permutation_uses = 0
+        # bumped by servers_changed(), so that a half-finished
+        # iter_servers_for_psi() does not cache a stale permutation
+        self._generation = 0
+        self._performance = {} # serverid -> ServerPerformance
 
     # these two are used in unit tests
     def test_add_rref(self, serverid, rref, ann):
@@ -79,9 +224,20 @@ class StorageFarmBroker:
         s.rref = rref
         s._is_connected = True
         self.servers[serverid] = s
+        self.servers_changed()
 
     def test_add_server(self, serverid, s):
         self.servers[serverid] = s
+        self.servers_changed()
+
+    def servers_changed(self):
+        """Forget the connected servers and their permutations. This must
+        be called whenever a server connects or disconnects, and whenever
+        self.servers is modified."""
+        self._connected_servers = None
+        self._ring = None
+        self._permutations.clear()
+        self._generation += 1
 
     def use_introducer(self, introducer_client):
         self.introducer_client = ic = introducer_client
@@ -103,7 +259,9 @@ class StorageFarmBroker:
             old.stop_connecting()
             # now we forget about them and start using the new one
         self.servers[serverid] = s
-        s.start_connecting(self.tub, self._trigger_connections)
+        self.servers_changed()
+        s.start_connecting(self.tub, self._trigger_connections,
+                           self.servers_changed)
         # the descriptor will manage their own Reconnector, and each time we
         # need servers, we'll ask them if they're connected or not.
 
@@ -121,16 +279,71 @@ class StorageFarmBroker:
     def get_servers_for_psi(self, peer_selection_index):
         # return a list of server objects (IServers)
         assert self.permute_peers == True
-        def _permuted(server):
-            seed = server.get_permutation_seed()
-            return sha1(peer_selection_index + seed).digest()
-        return sorted(self.get_connected_servers(), key=_permuted)
+        servers = self._get_cached_permutation(peer_selection_index)
+        if servers is None:
+            keyed = self._get_permutation_keys(peer_selection_index)
+            keyed.sort()
+            servers = [s for (key, s) in keyed]
+            self._cache_permutation(peer_selection_index, servers)
+        return list(servers)
+
+    def iter_servers_for_psi(self, peer_selection_index):
+        """Yield the same servers as get_servers_for_psi(), in the same
+        order, but only do the work of finding each one when it is asked
+        for."""
+        assert self.permute_peers == True
+        servers = self._get_cached_permutation(peer_selection_index)
+        if servers is not None:
+            for server in servers:
+                yield server
+            return
+        generation = self._generation
+        heap = self._get_permutation_keys(peer_selection_index)
+        heapq.heapify(heap)
+        servers = []
+        while heap:
+            server = heapq.heappop(heap)[1]
+            servers.append(server)
+            yield server
+        if generation == self._generation:
+            self._cache_permutation(peer_selection_index, servers)
+
+    def _get_permutation_keys(self, peer_selection_index):
+        # this is the expensive part: one hash per connected server
+        if self._ring is None:
+            self._ring = [(s.get_permutation_seed(), s)
+                          for s in self.get_connected_servers()]
+        return [(sha1(peer_selection_index + seed).digest(), s)
+                for (seed, s) in self._ring]
+
+    def _get_cached_permutation(self, peer_selection_index):
+        cached = self._permutations.get(peer_selection_index)
+        if cached is None:
+            return None
+        self._permutation_uses += 1
+        self._permutations[peer_selection_index] = (self._permutation_uses,
+                                                    cached[1])
+        return cached[1]
+
+    def _cache_permutation(self, peer_selection_index, servers):
+        if len(self._permutations) >= PERMUTATION_CACHE_SIZE:
+            # forget the least recently used half
+            by_use = sorted(self._permutations.items(),
+                            key=lambda i: i[1][0])
+            for (psi, cached) in by_use[:len(by_use)//2 + 1]:
+                del self._permutations[psi]
+        self._permutation_uses += 1
+        self._permutations[peer_selection_index] = (self._permutation_uses,
+                                                    tuple(servers))
 
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
 
     def get_connected_servers(self):
-        return frozenset([s for s in self.servers.values() if s.is_connected()])
+        if self._connected_servers is None:
+            self._connected_servers = frozenset([s for s in self.servers.values()
+                                                 if s.is_connected()])
+        return self._connected_servers
 
     def get_known_servers(self):
         return frozenset(self.servers.values())
@@ -140,6 +353,13 @@ class StorageFarmBroker:
             return self.servers[serverid].get_nickname()
         return None
 
+    def get_server_performance(self, server):
+        serverid = server.get_serverid()
+        perf = self._performance.get(serverid)
+        if perf is None:
+            perf = self._performance[serverid] = ServerPerformance()
+        return perf
+
     def get_stub_server(self, serverid):
         if serverid in self.servers:
             return self.servers[serverid]
@@ -177,7 +397,7 @@ class NativeStorageServer:
     implements(IServer)
 
     VERSION_DEFAULTS = {
-        "http://allmydata.org/tahoe/protocols/storage/v1" :
+        STORAGE_V1 :
         { "maximum-immutable-share-size": 2**32 - 1,
           "maximum-mutable-share-size": 2*1000*1000*1000, # maximum prior to v1.9.2
           "tolerates-immutable-read-overrun": False,
@@ -220,6 +440,9 @@ class NativeStorageServer:
         self._is_connected = False
         self._reconnector = None
         self._trigger_cb = None
+        self._changed_cb = None
+        # servers that have client facets know us by the Tub of this object
+        self._canary = Referenceable()
 
     # Special methods used by copy.copy() and copy.deepcopy(). When those are
     # used in allmydata.immutable.filenode to copy CheckResults during
@@ -266,9 +489,11 @@ class NativeStorageServer:
     def get_announcement_time(self):
         return self.announcement_time
 
-    def start_connecting(self, tub, trigger_cb):
+    def start_connecting(self, tub, trigger_cb, changed_cb=None):
+        # changed_cb is called whenever we connect or disconnect
         furl = str(self.announcement["anonymous-storage-FURL"])
         self._trigger_cb = trigger_cb
+        self._changed_cb = changed_cb
         self._reconnector = tub.connectTo(furl, self._got_connection)
 
     def _got_connection(self, rref):
@@ -279,10 +504,30 @@ class NativeStorageServer:
             eventually(self._trigger_cb)
         default = self.VERSION_DEFAULTS
         d = add_version_to_remote_reference(rref, default)
+        d.addCallback(self._get_client_facet, lp)
         d.addCallback(self._got_versioned_service, lp)
         d.addErrback(log.err, format="storageclient._got_connection",
                      name=self.get_name(), umid="Sdq3pg")
 
+    def _get_client_facet(self, rref, lp):
+        # a server that shares its time out fairly between its clients needs
+        # to know which client each request comes from
+        v1 = get_storage_v1_version(rref.version)
+        if not v1.get("client-facets"):
+            return rref
+        d = rref.callRemote("get_client_facet", self._canary)
+        def _got_facet(facet):
+            facet.version = rref.version
+            return facet
+        def _no_facet(f):
+            log.msg(format="%(name)s did not give us a client facet",
+                    name=self.get_name(), failure=f,
+                    facility="tahoe.storage_broker", umid="g8YxUw",
+                    level=log.UNUSUAL, parent=lp)
+            return rref
+        d.addCallbacks(_got_facet, _no_facet)
+        return d
+
     def _got_versioned_service(self, rref, lp):
         log.msg(format="%(name)s provided version info %(version)s",
                 name=self.get_name(), version=rref.version,
@@ -294,6 +539,8 @@ class NativeStorageServer:
         self.rref = rref
         self._is_connected = True
         rref.notifyOnDisconnect(self._lost)
+        if self._changed_cb:
+            self._changed_cb()
 
     def get_rref(self):
         return self.rref
@@ -309,6 +556,8 @@ class NativeStorageServer:
         # use s.get_rref().callRemote() and not worry about it being None.
         self._is_connected = False
         self.remote_host = None
+        if self._changed_cb:
+            self._changed_cb()
 
     def stop_connecting(self):
         # used when this descriptor has been superceded by another
@@ -320,3 +569,169 @@ class NativeStorageServer:
 
 class UnknownServerTypeError(Exception):
     pass
+
+
+class BucketQueryBatcher:
+    """I coalesce the get_buckets() queries that are sent to a single storage
+    server into get_buckets_batch() calls.
+
+    A query that arrives while no batch is in flight is sent immediately, so
+    an idle server adds no latency. Queries that arrive while a batch is in
+    flight are held until it retires, and then sent together. Callers that
+    issue many queries at once (a deep-check, or several downloads)
+    therefore use one round trip per batch instead of one per storage
+    index.
+    """
+
+    def __init__(self, rref, max_batch_size):
+        self._rref = rref
+        self._max_batch_size = max_batch_size
+        self._pending = [] # list of (storage_index, Deferred)
+        self._in_flight = False
+
+    def get_buckets(self, storage_index):
+        d = defer.Deferred()
+        self._pending.append((storage_index, d))
+        self._flush()
+        return d
+
+    def _flush(self):
+        if self._in_flight or not self._pending:
+            return
+        batch = self._pending[:self._max_batch_size]
+        self._pending = self._pending[self._max_batch_size:]
+        storage_indexes = []
+        for (storage_index, d) in batch:
+            if storage_index not in storage_indexes:
+                storage_indexes.append(storage_index)
+        self._in_flight = True
+        d = self._rref.callRemote("get_buckets_batch", storage_indexes)
+        def _got(results):
+            for (storage_index, waiter) in batch:
+                waiter.callback(results.get(storage_index, {}))
+        def _failed(f):
+            for (storage_index, waiter) in batch:
+                waiter.errback(f)
+        d.addCallbacks(_got, _failed)
+        def _retired(ign):
+            self._in_flight = False
+            self._flush()
+        d.addBoth(_retired)
+        d.addErrback(log.err, format="error in BucketQueryBatcher",
+                     level=log.WEIRD, umid="r2Gk3w")
+
+def get_buckets(server, storage_index):
+    """Ask the given IServer which shares it holds for storage_index, like
+    server.get_rref().callRemote('get_buckets', storage_index). If the server
+    supports get_buckets_batch(), the query is coalesced with any others
+    that are outstanding for the same server."""
+    rref = server.get_rref()
+    v1 = get_storage_v1_version(getattr(rref, "version", None))
+    if not v1.get("get-buckets-batch"):
+        return rref.callRemote("get_buckets", storage_index)
+    # like .version, the batcher lives on the RemoteReference, so it is
+    # shared by everyone who talks to this server, and goes away with the
+    # connection
+    batcher = getattr(rref, "bucket_query_batcher", None)
+    if batcher is None:
+        max_batch_size = v1.get("maximum-get-buckets-batch-size", 1)
+        batcher = BucketQueryBatcher(rref, max_batch_size)
+        rref.bucket_query_batcher = batcher
+    return batcher.get_buckets(storage_index)
+
+
+# a batch of slot writes stops growing once it carries this much share data,
+# so that one large publish does not hold up the writes queued behind it
+MAX_SLOT_WRITE_BATCH_BYTES = 1*1024*1024
+
+class SlotWriteError(Exception):
+    """A storage server refused one of the slot writes of a
+    slot_testv_and_readv_and_writev_batch() call. The message is the one
+    the server sent back, and starts with the name of the exception that
+    the write raised there."""
+
+class SlotWriteBatcher:
+    """I coalesce the slot_testv_and_readv_and_writev() calls that are sent
+    to a single storage server into slot_testv_and_readv_and_writev_batch()
+    calls.
+
+    Writes that are issued in the same reactor turn (like the ones that a
+    Publish sends to each of its servers when it pushes its shares, or the
+    ones of several concurrent publishes) travel together, as do the writes
+    that arrive while a batch is in flight. The server applies each write
+    atomically, and in the order it was issued.
+    """
+
+    def __init__(self, rref, max_batch_size,
+                 max_batch_bytes=MAX_SLOT_WRITE_BATCH_BYTES):
+        self._rref = rref
+        self._max_batch_size = max_batch_size
+        self._max_batch_bytes = max_batch_bytes
+        self._pending = [] # list of (request, size, Deferred)
+        self._in_flight = False
+        self._flush_scheduled = False
+
+    def slot_testv_and_readv_and_writev(self, storage_index, secrets,
+                                        tw_vectors, read_vector):
+        d = defer.Deferred()
+        size = 0
+        for (testv, datav, new_length) in tw_vectors.values():
+            size += sum([len(data) for (offset, data) in datav])
+        self._pending.append(((storage_index, secrets, tw_vectors,
+                               read_vector), size, d))
+        if not self._flush_scheduled:
+            # wait for the rest of this reactor turn's writes
+            self._flush_scheduled = True
+            eventually(self._flush)
+        return d
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._in_flight or not self._pending:
+            return
+        batch = [self._pending.pop(0)]
+        batch_bytes = batch[0][1]
+        while (self._pending and len(batch) < self._max_batch_size
+               and batch_bytes + self._pending[0][1] <= self._max_batch_bytes):
+            batch.append(self._pending.pop(0))
+            batch_bytes += batch[-1][1]
+        self._in_flight = True
+        d = self._rref.callRemote("slot_testv_and_readv_and_writev_batch",
+                                  [request for (request, size, waiter)
+                                   in batch])
+        def _got(results):
+            for ((request, size, waiter), (testv_is_good, read_data, error)) \
+                    in zip(batch, results):
+                if error is not None:
+                    waiter.errback(SlotWriteError(error))
+                else:
+                    waiter.callback((testv_is_good, read_data))
+        def _failed(f):
+            for (request, size, waiter) in batch:
+                waiter.errback(f)
+        d.addCallbacks(_got, _failed)
+        def _retired(ign):
+            self._in_flight = False
+            self._flush()
+        d.addBoth(_retired)
+        d.addErrback(log.err, format="error in SlotWriteBatcher",
+                     level=log.WEIRD, umid="J3t6bQ")
+
+def slot_testv_and_readv_and_writev(rref, storage_index, secrets, tw_vectors,
+                                    read_vector):
+    """Send a test-and-set write for one mutable slot to the storage server
+    behind rref, like rref.callRemote('slot_testv_and_readv_and_writev',
+    ...). If the server supports slot_testv_and_readv_and_writev_batch(),
+    the write is coalesced with any others for the same server."""
+    v1 = get_storage_v1_version(getattr(rref, "version", None))
+    if not v1.get("slot-writev-batch"):
+        return rref.callRemote("slot_testv_and_readv_and_writev",
+                               storage_index, secrets, tw_vectors,
+                               read_vector)
+    batcher = getattr(rref, "slot_write_batcher", None)
+    if batcher is None:
+        max_batch_size = v1.get("maximum-slot-writev-batch-size", 1)
+        batcher = SlotWriteBatcher(rref, max_batch_size)
+        rref.slot_write_batcher = batcher
+    return batcher.slot_testv_and_readv_and_writev(storage_index, secrets,
+                                                   tw_vectors, read_vector)
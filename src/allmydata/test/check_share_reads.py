@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+
+"""Measure how much CPU time the storage server spends serving large
+immutable share reads.
+
+This builds a throwaway StorageServer in a temporary directory, stores one
+large immutable share in it, and then reads the whole share back through
+BucketReader.remote_read() several times, using each of the server's read
+paths:
+
+ open-per-read:  no open-file cache, the share is opened for every read
+ cached-handle:  the share stays open, and is read with seek()+read()
+ cached-mmap:    the share stays open, and large reads slice an mmap of it
+
+It reports the CPU time (user+system) spent per GB served, for a few read
+sizes. Run it with 'make check-share-reads', or directly:
+
+ python check_share_reads.py [SHARE_SIZE_MB [REPEATS]]
+
+The share is read from the page cache after the first pass, so this measures
+the cost of moving bytes into Python strings, not disk speed.
+"""
+
+import os, sys, shutil, tempfile
+from allmydata.storage.server import StorageServer
+from allmydata.storage.immutable import ShareFile
+
+MiB = 1024*1024
+GB = 1000*1000*1000
+
+READ_SIZES = [128*1024, 1*MiB, 4*MiB]
+
+class FakeCanary:
+    def notifyOnDisconnect(self, *args, **kwargs):
+        return None
+    def dontNotifyOnDisconnect(self, marker):
+        pass
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+class ShareReadSpeedTest:
+    def __init__(self, share_size, repeats):
+        self.share_size = share_size
+        self.repeats = repeats
+        self.basedir = tempfile.mkdtemp(prefix="check_share_reads-")
+        self.results = {} # (mode, readsize) -> CPU seconds per GB
+
+    def make_server(self, open_file_cache_size):
+        ss = StorageServer(self.basedir, "\x00" * 20,
+                           open_file_cache_size=open_file_cache_size)
+        # the crawlers are never started, since the service is never started
+        return ss
+
+    def store_share(self):
+        ss = self.make_server(0)
+        already, writers = ss.remote_allocate_buckets("si1", "r"*32, "c"*32,
+                                                      [0], self.share_size,
+                                                      FakeCanary())
+        bw = writers[0]
+        chunk = os.urandom(MiB)
+        for offset in range(0, self.share_size, MiB):
+            bw.remote_write(offset, chunk[:self.share_size-offset])
+        bw.remote_close()
+
+    def read_all(self, reader, readsize):
+        for i in range(self.repeats):
+            for offset in range(0, self.share_size, readsize):
+                reader.remote_read(offset, readsize)
+
+    def one_test(self, mode, readsize):
+        if mode == "open-per-read":
+            ss = self.make_server(0)
+        else:
+            ss = self.make_server(1)
+        old_threshold = ShareFile.MMAP_READ_THRESHOLD
+        if mode == "cached-handle":
+            ShareFile.MMAP_READ_THRESHOLD = self.share_size + 1
+        try:
+            reader = ss.remote_get_buckets("si1")[0]
+            self.read_all(reader, readsize) # warm the page cache
+            start = cpu_time()
+            self.read_all(reader, readsize)
+            elapsed = cpu_time() - start
+        finally:
+            ShareFile.MMAP_READ_THRESHOLD = old_threshold
+            if ss.filecache:
+                ss.filecache.close_all()
+        served = self.share_size * self.repeats
+        per_gb = elapsed * GB / served
+        self.results[(mode, readsize)] = per_gb
+        print "%-14s %5dKiB reads: %.3f CPU-s/GB" % (mode, readsize/1024,
+                                                     per_gb)
+
+    def run(self):
+        print "share size: %dMiB, read %d times per test" % \
+              (self.share_size/MiB, self.repeats)
+        try:
+            self.store_share()
+            for readsize in READ_SIZES:
+                for mode in ("open-per-read", "cached-handle", "cached-mmap"):
+                    self.one_test(mode, readsize)
+        finally:
+            shutil.rmtree(self.basedir)
+        for readsize in READ_SIZES:
+            base = self.results[("open-per-read", readsize)]
+            mmap = self.results[("cached-mmap", readsize)]
+            if mmap:
+                print "%5dKiB reads: mmap path uses %.2fx less CPU" % \
+                      (readsize/1024, base/mmap)
+
+if __name__ == '__main__':
+    share_size = 64*MiB
+    repeats = 10
+    if len(sys.argv) > 1:
+        share_size = int(sys.argv[1])*MiB
+    if len(sys.argv) > 2:
+        repeats = int(sys.argv[2])
+    ShareReadSpeedTest(share_size, repeats).run()
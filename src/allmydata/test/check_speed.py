@@ -21,6 +21,7 @@ class SpeedTest:
         self.failed = None
         self.upload_times = {}
         self.download_times = {}
+        self.encoding_rates = {}
 
     def run(self):
         print "STARTING"
@@ -61,9 +62,13 @@ class SpeedTest:
         reactor.callLater(delay, d.callback, result)
         return d
 
-    def record_times(self, times, key):
-        print "TIME (%s): %s up, %s down" % (key, times[0], times[1])
-        self.upload_times[key], self.download_times[key] = times
+    def record_times(self, rates, key):
+        print "TIME (%s): %s up, %s down" % (key, rates["upload_time"],
+                                             rates["download_time"])
+        self.upload_times[key] = rates["upload_time"]
+        self.download_times[key] = rates["download_time"]
+        if "encoding_rate" in rates:
+            self.encoding_rates[key] = rates["encoding_rate"]
 
     def one_test(self, res, name, count, size, mutable):
         # values for 'mutable':
@@ -71,7 +76,8 @@ class SpeedTest:
         #   "create" (upload different contents into a new SSK file)
         #   "upload" (upload different contents into the same SSK file. The
         #             time consumed does not include the creation of the file)
-        d = self.client_rref.callRemote("speed_test", count, size, mutable)
+        d = self.client_rref.callRemote("speed_test_rates",
+                                        count, size, mutable)
         d.addCallback(self.record_times, name)
         return d
 
@@ -156,6 +162,11 @@ class SpeedTest:
             if "100MB" in self.upload_times:
                 A3 = 100*MB / (self.upload_times["100MB"] - B)
                 print "upload speed (100MB):", self.number(A3, "Bps")
+            # erasure-coding and block hashing alone
+            for key in ["1MB", "10MB", "100MB"]:
+                if key in self.encoding_rates:
+                    print "encoding speed (%s):" % key, \
+                          self.number(self.encoding_rates[key], "Bps")
 
             # download
             if "100x 200B" in self.download_times:
@@ -23,10 +23,12 @@ from base64 import b32encode
 from allmydata import uri as tahoe_uri
 from allmydata.client import Client
 from allmydata.storage.server import StorageServer, storage_index_to_dir
+from allmydata.storage.backend import get_backend
 from allmydata.util import fileutil, idlib, hashutil
 from allmydata.util.hashutil import sha1
 from allmydata.test.common_web import HTTPClientGETFactory
 from allmydata.interfaces import IStorageBroker, IServer
+from allmydata.storage_client import ServerPerformance
 from allmydata.test.common import TEST_RSA_KEY_SIZE
 
 
@@ -105,6 +107,10 @@ class LocalWrapper:
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = LocalWrapper(res[shnum])
+            if methname == "get_buckets_batch":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        buckets[shnum] = LocalWrapper(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -159,15 +165,26 @@ class NoNetworkServer:
     def get_rref(self):
         return self.rref
     def get_version(self):
-        return self.rref.version
+        if self.rref:
+            return self.rref.version
+        return None
 
 class NoNetworkStorageBroker:
     implements(IStorageBroker)
+    def __init__(self):
+        self._performance = {}
     def get_servers_for_psi(self, peer_selection_index):
         def _permuted(server):
             seed = server.get_permutation_seed()
             return sha1(peer_selection_index + seed).digest()
         return sorted(self.get_connected_servers(), key=_permuted)
+    def iter_servers_for_psi(self, peer_selection_index):
+        return iter(self.get_servers_for_psi(peer_selection_index))
+    def get_server_performance(self, server):
+        serverid = server.get_serverid()
+        if serverid not in self._performance:
+            self._performance[serverid] = ServerPerformance()
+        return self._performance[serverid]
     def get_connected_servers(self):
         return self.client._servers
     def get_nickname_for_serverid(self, serverid):
@@ -222,9 +239,11 @@ class SimpleStats:
 
 class NoNetworkGrid(service.MultiService):
     def __init__(self, basedir, num_clients=1, num_servers=10,
-                 client_config_hooks={}):
+                 client_config_hooks={}, backend="memory"):
         service.MultiService.__init__(self)
         self.basedir = basedir
+        # the kind of storage backend that each server gets
+        self.backend = backend
         fileutil.make_dirs(basedir)
 
         self.servers_by_number = {} # maps to StorageServer instance
@@ -270,7 +289,8 @@ class NoNetworkGrid(service.MultiService):
                                  idlib.shortnodeid_b2a(serverid), "storage")
         fileutil.make_dirs(serverdir)
         ss = StorageServer(serverdir, serverid, stats_provider=SimpleStats(),
-                           readonly_storage=readonly)
+                           readonly_storage=readonly,
+                           backend=get_backend(self.backend))
         ss._no_network_server_number = i
         return ss
 
@@ -329,9 +349,10 @@ class NoNetworkGrid(service.MultiService):
     def nuke_from_orbit(self):
         """ Empty all share directories in this grid. It's the only way to be sure ;-) """
         for server in self.servers_by_number.values():
-            for prefixdir in os.listdir(server.sharedir):
+            for prefixdir in server.backend.listdir(server.sharedir):
                 if prefixdir != 'incoming':
-                    fileutil.rm_dir(os.path.join(server.sharedir, prefixdir))
+                    server.backend.rm_dir(os.path.join(server.sharedir,
+                                                       prefixdir))
 
 
 class GridTestMixin:
@@ -342,13 +363,18 @@ class GridTestMixin:
     def tearDown(self):
         return self.s.stopService()
 
+    # the storage servers keep their shares in memory, unless a test needs
+    # to find them on the disk
+    storage_backend = "memory"
+
     def set_up_grid(self, num_clients=1, num_servers=10,
                     client_config_hooks={}):
         # self.basedir must be set
         self.g = NoNetworkGrid(self.basedir,
                                num_clients=num_clients,
                                num_servers=num_servers,
-                               client_config_hooks=client_config_hooks)
+                               client_config_hooks=client_config_hooks,
+                               backend=self.storage_backend)
         self.g.setServiceParent(self.s)
         self.client_webports = [c.getServiceNamed("webish").getPortnum()
                                 for c in self.g.clients]
@@ -373,9 +399,9 @@ class GridTestMixin:
         for i,ss in self.g.servers_by_number.items():
             serverid = ss.my_nodeid
             basedir = os.path.join(ss.sharedir, prefixdir)
-            if not os.path.exists(basedir):
+            if not ss.backend.exists(basedir):
                 continue
-            for f in os.listdir(basedir):
+            for f in ss.backend.listdir(basedir):
                 try:
                     shnum = int(f)
                     shares.append((shnum, serverid, os.path.join(basedir, f)))
@@ -383,41 +409,60 @@ class GridTestMixin:
                     pass
         return sorted(shares)
 
+    def get_share_backend(self, sharefile):
+        """Return the backend of the server that holds a share file that
+        find_uri_shares() reported."""
+        for ss in self.g.servers_by_number.values():
+            if sharefile.startswith(ss.sharedir + os.sep):
+                return ss.backend
+        raise KeyError(sharefile)
+
+    def read_share(self, sharefile):
+        f = self.get_share_backend(sharefile).open(sharefile, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def write_share(self, sharefile, data):
+        f = self.get_share_backend(sharefile).open(sharefile, "wb")
+        f.write(data)
+        f.close()
+
     def copy_shares(self, uri):
         shares = {}
         for (shnum, serverid, sharefile) in self.find_uri_shares(uri):
-            shares[sharefile] = open(sharefile, "rb").read()
+            shares[sharefile] = self.read_share(sharefile)
         return shares
 
     def restore_all_shares(self, shares):
         for sharefile, data in shares.items():
-            open(sharefile, "wb").write(data)
+            self.write_share(sharefile, data)
 
     def delete_share(self, (shnum, serverid, sharefile)):
-        os.unlink(sharefile)
+        self.get_share_backend(sharefile).remove(sharefile)
 
     def delete_shares_numbered(self, uri, shnums):
         for (i_shnum, i_serverid, i_sharefile) in self.find_uri_shares(uri):
             if i_shnum in shnums:
-                os.unlink(i_sharefile)
+                self.get_share_backend(i_sharefile).remove(i_sharefile)
 
     def corrupt_share(self, (shnum, serverid, sharefile), corruptor_function):
-        sharedata = open(sharefile, "rb").read()
+        sharedata = self.read_share(sharefile)
         corruptdata = corruptor_function(sharedata)
-        open(sharefile, "wb").write(corruptdata)
+        self.write_share(sharefile, corruptdata)
 
     def corrupt_shares_numbered(self, uri, shnums, corruptor, debug=False):
         for (i_shnum, i_serverid, i_sharefile) in self.find_uri_shares(uri):
             if i_shnum in shnums:
-                sharedata = open(i_sharefile, "rb").read()
+                sharedata = self.read_share(i_sharefile)
                 corruptdata = corruptor(sharedata, debug=debug)
-                open(i_sharefile, "wb").write(corruptdata)
+                self.write_share(i_sharefile, corruptdata)
 
     def corrupt_all_shares(self, uri, corruptor, debug=False):
         for (i_shnum, i_serverid, i_sharefile) in self.find_uri_shares(uri):
-            sharedata = open(i_sharefile, "rb").read()
+            sharedata = self.read_share(i_sharefile)
             corruptdata = corruptor(sharedata, debug=debug)
-            open(i_sharefile, "wb").write(corruptdata)
+            self.write_share(i_sharefile, corruptdata)
 
     def GET(self, urlpath, followRedirect=False, return_response=False,
             method="GET", clientnum=0, **kwargs):
@@ -437,3 +482,10 @@ class GridTestMixin:
 
     def PUT(self, urlpath, **kwargs):
         return self.GET(urlpath, method="PUT", **kwargs)
+
+
+class DiskBackedGridTestMixin(GridTestMixin):
+    """I am a GridTestMixin whose storage servers keep their shares on the
+    disk, for tests that find, corrupt or replace the share files directly
+    instead of going through read_share() and write_share()."""
+    storage_backend = "disk"
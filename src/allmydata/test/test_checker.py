@@ -10,7 +10,8 @@ from allmydata.web import check_results as web_check_results
 from allmydata.storage_client import StorageFarmBroker, NativeStorageServer
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.monitor import Monitor
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import GridTestMixin, \
+     DiskBackedGridTestMixin
 from allmydata.immutable.upload import Data
 from allmydata.test.common_web import WebRenderingMixin
 from allmydata.mutable.publish import MutableData
@@ -312,7 +313,7 @@ class WebResultsRendering(unittest.TestCase, WebRenderingMixin):
         d.addCallback(_got_lit_results)
         return d
 
-class BalancingAct(GridTestMixin, unittest.TestCase):
+class BalancingAct(DiskBackedGridTestMixin, unittest.TestCase):
     # test for #1115 regarding the 'count-good-share-hosts' metric
 
 
@@ -31,7 +31,9 @@ from allmydata.scripts.common import DEFAULT_ALIAS, get_aliases, get_alias, \
 
 from allmydata.scripts import cli, debug, runner, backupdb
 from allmydata.test.common_util import StallMixin, ReallyEqualMixin
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import GridTestMixin, \
+     DiskBackedGridTestMixin
+from allmydata.test.test_storage import FakeCanary
 from twisted.internet import threads # CLI tests use deferToThread
 from twisted.internet import defer # List uses a DeferredList in one place.
 from twisted.python import usage
@@ -396,6 +398,128 @@ class CLI(CLITestMixin, unittest.TestCase):
         self.failUnless("mqfblse6m5a6dh45isu2cg7oji" in err,
                         "didn't see 'mqfblse6m5a6dh45isu2cg7oji' in '%s'" % err)
 
+    def test_find_shares_packed(self):
+        from allmydata.storage.server import StorageServer
+        from allmydata.storage.backend import LogBackend
+        from allmydata.storage.common import si_b2a
+        nodedir = "cli/test_find_shares_packed/node1"
+        storedir = os.path.join(nodedir, "storage")
+        fileutil.make_dirs(storedir)
+        ss = StorageServer(storedir, "\x00" * 20, backend=LogBackend())
+        rs = hashutil.tagged_hash("renew", "si1")
+        cs = hashutil.tagged_hash("cancel", "si1")
+        already, writers = ss.remote_allocate_buckets("si1", rs, cs, [0, 3],
+                                                      10, FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, "a"*10)
+            wb.remote_close()
+        ss.packs.close()
+
+        o = debug.FindSharesOptions()
+        o.stdout = StringIO()
+        o.parseOptions([si_b2a("si1"), nodedir])
+        debug.find_shares(o)
+        lines = o.stdout.getvalue().splitlines()
+        self.failUnlessEqual(len(lines), 2, lines)
+        packfile = os.path.join(os.path.abspath(storedir), "packs",
+                                "pack-00000000")
+        self.failUnless(lines[0].startswith(packfile + "@"), lines)
+
+    def test_corruption_advisories(self):
+        from allmydata.storage.server import StorageServer
+        from allmydata.storage.common import si_b2a
+        nodedir = "cli/test_corruption_advisories/node1"
+        storedir = os.path.join(nodedir, "storage")
+        fileutil.make_dirs(storedir)
+        ss = StorageServer(storedir, "\x00" * 20)
+        rs = hashutil.tagged_hash("renew", "si1")
+        cs = hashutil.tagged_hash("cancel", "si1")
+        already, writers = ss.remote_allocate_buckets("si1", rs, cs, [0],
+                                                      10, FakeCanary())
+        writers[0].remote_write(0, "a"*10)
+        writers[0].remote_close()
+        ss.remote_advise_corrupt_share("immutable", "si1", 0, "bad hash\n")
+        ss.remote_advise_corrupt_share("immutable", "si1", 0, "bad hash\n")
+        ss.remote_advise_corrupt_share("immutable", "si1", 5, "gone\n")
+        ss.corruption_advisories.close()
+
+        def _run(*args):
+            o = debug.CorruptionAdvisoriesOptions()
+            o.stdout, o.stderr = StringIO(), StringIO()
+            o.parseOptions(list(args) + [nodedir])
+            rc = debug.corruption_advisories(o)
+            self.failUnlessEqual(rc, 0)
+            return o.stdout.getvalue().splitlines()
+
+        lines = _run("--verbose")
+        self.failUnlessEqual(len(lines), 4, lines)
+        byshare = dict([(l.split()[2], l.split()) for l in lines
+                        if not l.startswith(" ")])
+        self.failUnlessEqual(byshare["0"][:4],
+                             ["immutable", si_b2a("si1"), "0", "2"])
+        self.failUnless(byshare["0"][6].strip("'").endswith("0"), lines)
+        self.failUnlessEqual(byshare["5"][3:], ["1"] + byshare["5"][4:6]
+                             + ["missing"])
+        self.failUnlessIn("  bad hash", lines)
+
+        lines = _run("--remove", si_b2a("si1") + ":5")
+        self.failUnlessIn("removed the reports about 1 shares", lines[0])
+        lines = _run()
+        self.failUnlessEqual(len(lines), 1, lines)
+
+        self.failUnlessRaises(usage.UsageError, _run, "--remove", "si1:x")
+
+    def test_convert_mutable_shares(self):
+        from allmydata.storage.server import StorageServer
+        from allmydata.storage.common import storage_index_to_dir
+        from allmydata.storage.mutable import get_mutable_share_file
+        nodedir = "cli/test_convert_mutable_shares/node1"
+        storedir = os.path.join(nodedir, "storage")
+        fileutil.make_dirs(storedir)
+        ss = StorageServer(storedir, "\x00" * 20)
+        secrets = (hashutil.tagged_hash("we", "si1"),
+                   hashutil.tagged_hash("renew", "si1"),
+                   hashutil.tagged_hash("cancel", "si1"))
+        ss.remote_slot_testv_and_readv_and_writev("si1", secrets,
+                                                  {0: ([], [(0, "a"*100)],
+                                                       None),
+                                                   1: ([], [(0, "b"*100)],
+                                                       None)}, [])
+        fn = os.path.join(os.path.abspath(ss.sharedir),
+                          storage_index_to_dir("si1"), "0")
+
+        def _convert(*args):
+            o = debug.ConvertMutableSharesOptions()
+            o.stdout, o.stderr = StringIO(), StringIO()
+            o.parseOptions(list(args) + [nodedir])
+            rc = debug.convert_mutable_shares(o)
+            return (rc, o.stdout.getvalue(), o.stderr.getvalue())
+
+        (rc, out, err) = _convert()
+        self.failUnlessEqual((rc, err), (0, ""))
+        self.failUnlessIn("converted 2 mutable shares to version 2, 0 already",
+                          out)
+        self.failUnlessEqual(get_mutable_share_file(fn).CONTAINER_VERSION, 2)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 100)]),
+                             {0: ["a"*100]})
+
+        o = debug.DumpOptions()
+        o.stdout, o.stderr = StringIO(), StringIO()
+        o.parseOptions([fn])
+        debug.dump_share(o)
+        self.failUnlessIn(" container_version: 2", o.stdout.getvalue())
+        self.failUnlessIn(" data_length: 100", o.stdout.getvalue())
+
+        (rc, out, err) = _convert("--to-version=1")
+        self.failUnlessIn("converted 2 mutable shares to version 1", out)
+        self.failUnlessEqual(get_mutable_share_file(fn).CONTAINER_VERSION, 1)
+        self.failUnlessRaises(usage.UsageError, _convert, "--to-version=3")
+
+        fileutil.write(os.path.join(nodedir, "twistd.pid"), "1234")
+        (rc, out, err) = _convert()
+        self.failUnlessEqual(rc, 1)
+        self.failUnlessIn("stop it before converting its shares", err)
+
     def test_alias(self):
         def s128(c): return base32.b2a(c*(128/8))
         def s256(c): return base32.b2a(c*(256/8))
@@ -1425,6 +1549,39 @@ class Admin(unittest.TestCase):
         d.addCallback(_done)
         return d
 
+    def test_import_leases(self):
+        from allmydata.storage.server import StorageServer
+        from allmydata.storage.leasedb import get_leasedb
+        basedir = "cli/Admin/import_leases"
+        storedir = os.path.join(basedir, "storage")
+        fileutil.make_dirs(storedir)
+        ss = StorageServer(storedir, "\x00" * 20)
+        rs = hashutil.tagged_hash("renew", "si1")
+        cs = hashutil.tagged_hash("cancel", "si1")
+        already, writers = ss.remote_allocate_buckets("si1", rs, cs, [0, 1],
+                                                      10, FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, "a"*10)
+            wb.remote_close()
+
+        d = self.do_cli("admin", "import-leases", basedir)
+        def _done( (stdout, stderr) ):
+            self.failUnlessEqual(stderr, "")
+            self.failUnlessIn("imported 2 leases from 2 shares", stdout)
+            ldb = get_leasedb(os.path.join(storedir, "leasedb.sqlite"))
+            leases = ldb.get_leases("si1", 1)
+            self.failUnlessEqual([(l.renew_secret, l.cancel_secret)
+                                  for l in leases], [(rs, cs)])
+            ldb.close()
+            # a running node is left alone
+            fileutil.write(os.path.join(basedir, "twistd.pid"), "1234")
+            return self.do_cli("admin", "import-leases", basedir)
+        d.addCallback(_done)
+        def _running( (stdout, stderr) ):
+            self.failUnlessEqual(stdout, "")
+            self.failUnlessIn("stop it before importing leases", stderr)
+        d.addCallback(_running)
+        return d
 
 class List(GridTestMixin, CLITestMixin, unittest.TestCase):
     def test_list(self):
@@ -2929,7 +3086,7 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
         return d
 
 
-class Check(GridTestMixin, CLITestMixin, unittest.TestCase):
+class Check(DiskBackedGridTestMixin, CLITestMixin, unittest.TestCase):
 
     def test_check(self):
         self.basedir = "cli/Check/check"
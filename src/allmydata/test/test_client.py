@@ -1,10 +1,11 @@
-import os
+import os, time
 from twisted.trial import unittest
+from twisted.internet import defer
 from twisted.application import service
 
 import allmydata
 from allmydata.node import OldConfigError, OldConfigOptionError, MissingConfigEntry
-from allmydata import client
+from allmydata import client, storage_client
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.util import base32, fileutil
 from allmydata.interfaces import IFilesystemNode, IFileNode, \
@@ -150,6 +151,110 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
                            "reserved_space = bogus\n")
         self.failUnlessRaises(ValueError, client.Client, basedir)
 
+    def test_write_buffer(self):
+        basedir = "client.Basic.test_write_buffer"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "write_buffer.size = 256KiB\n" + \
+                           "write_buffer.total = 8MiB\n" + \
+                           "fsync_shares = true\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.write_buffers.writer_limit, 256*1024)
+        self.failUnlessEqual(ss.write_buffers.total_limit, 8*1024*1024)
+        self.failUnless(ss.fsync_shares)
+
+    def test_packed_shares(self):
+        basedir = "client.Basic.test_packed_shares"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "packed_shares.max_size = 16kB\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.packed_share_max_size, 16*1000)
+        self.failUnless(ss.packs)
+
+    def test_backend(self):
+        basedir = "client.Basic.test_backend"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "backend = memory\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.backend.name, "memory")
+        self.failIf(os.path.exists(os.path.join(basedir, "storage", "shares")))
+
+    def test_backend_unknown(self):
+        basedir = "client.Basic.test_backend_unknown"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "backend = tape\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
+    def test_mutable_container_version(self):
+        basedir = "client.Basic.test_mutable_container_version"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "mutable_container.version = 2\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.mutable_container_version, 2)
+
+    def test_scheduler(self):
+        basedir = "client.Basic.test_scheduler"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "scheduler.max_outstanding = 8\n" + \
+                           "scheduler.max_queued_per_client = 50\n" + \
+                           "scheduler.weights = read=10, lease=2\n")
+        c = client.Client(basedir)
+        scheduler = c.getServiceNamed("storage").scheduler
+        self.failUnlessEqual(scheduler.max_outstanding, 8)
+        self.failUnlessEqual(scheduler.max_queued_per_client, 50)
+        self.failUnlessEqual(scheduler.weights,
+                             {"read": 10, "write": 2, "lease": 2})
+
+    def test_crawler_io_percentage_bad(self):
+        basedir = "client.Basic.test_crawler_io_percentage_bad"
+        os.mkdir(basedir)
+        for value in ["0", "101", "-5"]:
+            fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                               BASECONFIG + \
+                               "[storage]\n" + \
+                               "enabled = true\n" + \
+                               "crawler.io_percentage = %s\n" % value)
+            e = self.failUnlessRaises(ValueError, client.Client, basedir)
+            self.failUnlessIn("crawler.io_percentage", str(e))
+
+    def test_scheduler_bad_weights(self):
+        basedir = "client.Basic.test_scheduler_bad_weights"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "scheduler.weights = delete=3\n")
+        e = self.failUnlessRaises(ValueError, client.Client, basedir)
+        self.failUnlessIn("unknown scheduler category 'delete'", str(e))
+
     def _permute(self, sb, key):
         return [ s.get_longname() for s in sb.get_servers_for_psi(key) ]
 
@@ -163,8 +268,101 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
         self.failUnlessReallyEqual(self._permute(sb, "two"), ['0','4','2','1','3'])
         sb.servers.clear()
+        sb.servers_changed()
         self.failUnlessReallyEqual(self._permute(sb, "one"), [])
 
+    def test_permute_cached(self):
+        sb = StorageFarmBroker(None, True)
+        for k in ["%d" % i for i in range(5)]:
+            ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+
+        # the lazy form gives the same order, and can stop early
+        it = sb.iter_servers_for_psi("one")
+        self.failUnlessReallyEqual(it.next().get_longname(), '3')
+        self.failUnlessReallyEqual([s.get_longname()
+                                    for s in sb.iter_servers_for_psi("one")],
+                                   ['3','1','0','4','2'])
+
+        # repeated calls reuse the permutation, but callers get their own
+        # copy of the list
+        servers = sb.get_servers_for_psi("two")
+        servers.pop()
+        self.failUnlessReallyEqual(self._permute(sb, "two"), ['0','4','2','1','3'])
+        self.failUnlessIdentical(sb.get_connected_servers(),
+                                 sb.get_connected_servers())
+
+        # a disconnection invalidates them
+        s3 = sb.servers["3"]
+        s3._is_connected = False
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
+        sb.servers_changed()
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['1','0','4','2'])
+        self.failUnlessReallyEqual([s.get_longname()
+                                    for s in sb.iter_servers_for_psi("one")],
+                                   ['1','0','4','2'])
+        self.failIfIn(s3, sb.get_connected_servers())
+
+        # only the most recently used permutations are kept
+        for i in range(storage_client.PERMUTATION_CACHE_SIZE + 10):
+            sb.get_servers_for_psi("si%d" % i)
+        self.failUnless(len(sb._permutations)
+                        <= storage_client.PERMUTATION_CACHE_SIZE)
+        self.failIfIn("si0", sb._permutations)
+        self.failUnlessIn("si%d" % (storage_client.PERMUTATION_CACHE_SIZE + 9),
+                          sb._permutations)
+
+    def test_server_performance(self):
+        perf = storage_client.ServerPerformance()
+        self.failUnlessEqual(perf.expected_delay(), 0.0)
+        self.failUnlessEqual(perf.expected_delay(rtt=0.5), 0.5)
+
+        d = defer.Deferred()
+        self.failUnlessIdentical(perf.track(d, time.time() - 0.1), d)
+        self.failUnlessEqual(perf.outstanding, 1)
+        d.callback({})
+        self.failUnlessEqual(perf.outstanding, 0)
+        self.failUnless(perf.rtt >= 0.1, perf.rtt)
+        self.failUnlessEqual(perf.throughput, None)
+
+        perf.rtt = 0.1
+        perf.response_received(1.1, 1000000)
+        self.failUnlessAlmostEqual(perf.throughput, 1000000.0)
+        perf.response_received(0.3)
+        self.failUnlessAlmostEqual(perf.rtt, 0.14)
+        self.failUnlessAlmostEqual(perf.expected_delay(500000), 0.64)
+
+        # requests that are waiting make the next one look slower
+        perf.outstanding = 2
+        self.failUnlessAlmostEqual(perf.expected_delay(), 0.42)
+        perf.outstanding = 0
+
+        d = defer.Deferred()
+        perf.track(d)
+        d.errback(ValueError("oops"))
+        self.failUnlessEqual(perf.errors, 1)
+        self.failUnlessAlmostEqual(perf.error_rate, 0.2)
+        self.failUnlessAlmostEqual(perf.expected_delay(), 0.14 / 0.8)
+        d.addErrback(lambda f: f.trap(ValueError))
+        s = perf.get_stats()
+        self.failUnlessEqual(s["requests"], 4)
+        self.failUnlessEqual(s["errors"], 1)
+
+        self.failUnlessEqual(storage_client.delay_class(0.001), 0)
+        self.failUnlessEqual(storage_client.delay_class(0.015), 1)
+        self.failUnlessEqual(storage_client.delay_class(0.03), 2)
+        self.failUnlessEqual(storage_client.delay_class(0.039), 2)
+
+        # the broker keeps one per server, shared by every download
+        sb = StorageFarmBroker(None, True)
+        ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+               "permutation-seed-base32": base32.b2a("0") }
+        sb.test_add_rref("0", "rref", ann)
+        server = sb.get_connected_servers().__iter__().next()
+        self.failUnlessIdentical(sb.get_server_performance(server),
+                                 sb.get_server_performance(sb.servers["0"]))
+
     def test_versions(self):
         basedir = "test_client.Basic.test_versions"
         os.mkdir(basedir)
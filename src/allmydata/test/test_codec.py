@@ -2,9 +2,10 @@
 import os
 from twisted.trial import unittest
 from twisted.python import log
-from allmydata.codec import CRSEncoder, CRSDecoder
+from allmydata.codec import CRSEncoder, CRSDecoder, PooledCRSEncoder, \
+     EncodingPool
 import random
-from allmydata.util import mathutil
+from allmydata.util import mathutil, hashutil
 
 class T(unittest.TestCase):
     def do_test(self, size, required_shares, max_shares, fewer_shares=None):
@@ -92,3 +93,38 @@ class T(unittest.TestCase):
 
     def test_encode2(self):
         return self.do_test(125, 25, 100, 90)
+
+class Pooled(unittest.TestCase):
+    def test_encode_and_hash(self):
+        size, required_shares, max_shares = 1000, 25, 100
+        data0s = [os.urandom(mathutil.div_ceil(size, required_shares))
+                  for i in range(required_shares)]
+        pool = EncodingPool(2)
+        self.addCleanup(pool.stop)
+        self.failUnlessEqual(pool.segments_in_flight, 3)
+        enc = PooledCRSEncoder(pool)
+        enc.set_params(size, required_shares, max_shares)
+        plain = CRSEncoder()
+        plain.set_params(size, required_shares, max_shares)
+        d = enc.encode_and_hash(data0s)
+        def _check((shares, shareids, block_hashes, elapsed)):
+            self.failUnless(pool.started)
+            self.failUnless(elapsed >= 0, elapsed)
+            self.failUnlessEqual(len(shares), max_shares)
+            self.failUnlessEqual(list(shareids), range(max_shares))
+            self.failUnlessEqual(block_hashes,
+                                 [hashutil.block_hash(b) for b in shares])
+            d1 = plain.encode(data0s)
+            d1.addCallback(lambda (plain_shares, plain_shareids):
+                           self.failUnlessEqual(plain_shares, shares))
+            return d1
+        d.addCallback(_check)
+        d.addCallback(lambda res: enc.encode(data0s, [0, 99]))
+        def _check_some((shares, shareids)):
+            self.failUnlessEqual(tuple(shareids), (0, 99))
+            self.failUnlessEqual(len(shares), 2)
+        d.addCallback(_check_some)
+        # the work is done by other processes, not just other threads
+        d.addCallback(lambda res: pool.run(os.getpid))
+        d.addCallback(lambda pid: self.failIfEqual(pid, os.getpid()))
+        return d
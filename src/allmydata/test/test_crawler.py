@@ -1,5 +1,5 @@
 
-import time
+import time, threading
 import os.path
 from twisted.trial import unittest
 from twisted.application import service
@@ -82,6 +82,23 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class PrefetchingCrawler(BucketEnumeratingCrawler):
+    prefetch_threads = 2
+    allowed_io_percentage = 1.0
+    def __init__(self, *args, **kwargs):
+        BucketEnumeratingCrawler.__init__(self, *args, **kwargs)
+        self.prefetched = []
+        self.prefetch_threads_used = set()
+        self.device_progress = None
+    def get_device(self, prefixdir):
+        # pretend the prefixdirs are spread over three disks
+        return ord(os.path.basename(prefixdir)[1]) % 3
+    def prefetch_bucket(self, prefixdir, storage_index_b32):
+        self.prefetched.append(storage_index_b32)
+        self.prefetch_threads_used.add(threading.currentThread())
+    def finished_prefix(self, cycle, prefix):
+        self.device_progress = self.get_progress()["devices"]
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -165,6 +182,54 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+    def test_prefetch(self):
+        self.basedir = "crawler/Basic/prefetch"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(30)]
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = PrefetchingCrawler(ss, statefile)
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            # the buckets are still processed in order, each one once
+            self.failUnlessEqual(sorted(sis), c.all_buckets)
+            # and each one was read ahead of time, in another thread
+            self.failUnlessEqual(sorted(sis), sorted(c.prefetched))
+            self.failIfIn(threading.currentThread(), c.prefetch_threads_used)
+            self.failUnless(len(c.prefetch_threads_used) <= 2,
+                            c.prefetch_threads_used)
+            # the progress view covered every device
+            p = c.device_progress
+            self.failUnlessEqual(sorted(p.keys()), ["0", "1", "2"])
+            self.failUnlessEqual(sum([dp["prefixes"] for dp in p.values()]),
+                                 len(c.prefixes))
+            for dp in p.values():
+                self.failUnlessEqual(dp["prefetched-prefixes"], dp["prefixes"])
+                self.failUnlessEqual(dp["prefetch-complete-percentage"], 100.0)
+            # the prefetcher is gone between cycles
+            self.failUnlessEqual(c.prefetcher, None)
+            self.failIfIn("devices", c.get_progress())
+        d.addCallback(_check)
+        return d
+
+    def test_prefetch_config(self):
+        self.basedir = "crawler/Basic/prefetch_config"
+        fileutil.make_dirs(self.basedir)
+        ss = StorageServer(self.basedir, "\x00" * 20,
+                           crawler_prefetch_threads=3,
+                           crawler_io_percentage=20)
+        for c in (ss.bucket_counter, ss.lease_checker):
+            self.failUnlessEqual(c.prefetch_threads, 3)
+            self.failUnlessEqual(c.allowed_io_percentage, 0.2)
+        ss = StorageServer(self.basedir, "\x00" * 20)
+        self.failUnlessEqual(ss.lease_checker.prefetch_threads, 0)
+
     def test_paced(self):
         self.basedir = "crawler/Basic/paced"
         fileutil.make_dirs(self.basedir)
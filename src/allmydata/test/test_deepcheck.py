@@ -19,7 +19,8 @@ from twisted.web.client import getPage
 from allmydata.test.common import ErrorMixin, _corrupt_mutable_share_data, \
      ShouldFailMixin
 from allmydata.test.common_util import StallMixin
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import GridTestMixin, \
+     DiskBackedGridTestMixin
 
 timeout = 2400 # One of these took 1046.091s on Zandr's ARM box.
 
@@ -885,7 +886,7 @@ class DeepCheckWebGood(DeepCheckBase, unittest.TestCase):
         return d
 
 
-class DeepCheckWebBad(DeepCheckBase, unittest.TestCase):
+class DeepCheckWebBad(DiskBackedGridTestMixin, DeepCheckBase, unittest.TestCase):
     def test_bad(self):
         self.basedir = "deepcheck/DeepCheckWebBad/bad"
         self.set_up_grid()
@@ -1253,3 +1254,37 @@ class Large(DeepCheckBase, unittest.TestCase):
         d.addCallback(_check)
 
         return d
+
+
+class BatchedQueries(GridTestMixin, unittest.TestCase):
+    def test_deepcheck_batches_get_buckets(self):
+        self.basedir = "deepcheck/BatchedQueries/deepcheck_batches_get_buckets"
+        self.set_up_grid()
+        COUNT = 12
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode()
+        def _created_root(n):
+            self.root = n
+            dl = []
+            for i in range(COUNT):
+                up = upload.Data("file %d large enough for CHK" % i * 10, "")
+                dl.append(n.add_file(u"%02d" % i, up))
+            return defer.DeferredList(dl, fireOnOneErrback=True)
+        d.addCallback(_created_root)
+        def _start_deepcheck(ignored):
+            for wrapper in self.g.wrappers_by_id.values():
+                wrapper._clear_counters()
+            return self.root.start_deep_check().when_done()
+        d.addCallback(_start_deepcheck)
+        def _check(results):
+            c = results.get_counters()
+            self.failUnlessEqual(c["count-objects-checked"], COUNT+1)
+            self.failUnlessEqual(c["count-objects-healthy"], COUNT+1)
+            for wrapper in self.g.wrappers_by_id.values():
+                counters = wrapper.counter_by_methname
+                self.failIfIn("get_buckets", counters)
+                # every server is asked about every file, but in batches
+                self.failUnless(0 < counters["get_buckets_batch"] < COUNT,
+                                counters)
+        d.addCallback(_check)
+        return d
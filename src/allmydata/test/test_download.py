@@ -8,10 +8,12 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
+from allmydata.storage.immutable import BucketReader
 from allmydata.util import base32, fileutil, spans, log, hashutil
 from allmydata.util.consumer import download_to_data, MemoryConsumer
 from allmydata.immutable import upload, layout
-from allmydata.test.no_network import GridTestMixin, NoNetworkServer
+from allmydata.test.no_network import GridTestMixin, NoNetworkServer, \
+     DiskBackedGridTestMixin
 from allmydata.test.common import ShouldFailMixin
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError, \
      DownloadStopped
@@ -188,7 +190,7 @@ class _Base(GridTestMixin, ShouldFailMixin):
         d.addCallback(_got_data)
         return d
 
-class DownloadTest(_Base, unittest.TestCase):
+class DownloadTest(DiskBackedGridTestMixin, _Base, unittest.TestCase):
     timeout = 2400 # It takes longer than 240 seconds on Zandr's ARM box.
     def test_download(self):
         self.basedir = self.mktemp()
@@ -609,6 +611,136 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_data)
         return d
 
+    def _count_readv(self):
+        return sum([ss.latencies["read-vector"].get_count()
+                    for ss in self.g.servers_by_number.values()])
+
+    def test_download_uses_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+
+        # with several segments, each segment needs its block and some
+        # non-adjacent hash-tree nodes
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            for ss in self.g.servers_by_number.values():
+                ss.latencies["read-vector"].clear()
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnless(self._count_readv() > 0)
+        d.addCallback(_got_data)
+        return d
+
+    def _record_prefetches(self):
+        self.prefetches = []
+        original = BucketReader.remote_prefetch
+        def remote_prefetch(br, readv):
+            # remember where each share's blocks start, so hints can be
+            # mapped back to segment numbers
+            bp = layout.ReadBucketProxy(None, None, '')
+            header = br._share_file.read_share_data(0, 0x44)
+            datastart = bp._parse_offsets(header)["data"]
+            self.prefetches.append( (br.shnum, readv, datastart) )
+            return original(br, readv)
+        self.patch(BucketReader, "remote_prefetch", remote_prefetch)
+
+    def test_download_prefetches(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self._record_prefetches()
+
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.failUnlessEqual(self.prefetches, [])
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            self.n = n
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnless(self.prefetches)
+            node = self.n._cnode._node
+            # each hint is for the blocks of (at most) the next two
+            # segments. The segment size is only known once segment 0 has
+            # arrived, and segment 1 is fetched right away, so every later
+            # segment is hinted for each share that is used (which may be
+            # more than k, if a slow share made the downloader add another).
+            k = node._verifycap.needed_shares
+            hinted = {} # segnum -> set of shnums
+            hints = []
+            for (shnum, readv, datastart) in self.prefetches:
+                self.failUnless(1 <= len(readv) <= 2, readv)
+                for (offset, length) in readv:
+                    self.failUnless(length in (node.block_size,
+                                               node.tail_block_size))
+                    segnum, rem = divmod(offset - datastart, node.block_size)
+                    self.failUnlessEqual(rem, 0, (shnum, offset))
+                    self.failUnless(0 <= segnum < node.num_segments, segnum)
+                    hinted.setdefault(segnum, set()).add(shnum)
+                    hints.append( (shnum, offset) )
+            self.failUnlessEqual(len(hints), len(set(hints)), hints)
+            for segnum in range(2, node.num_segments):
+                self.failUnless(len(hinted.get(segnum, ())) >= k,
+                                "segment %d hinted for shares %s"
+                                % (segnum, sorted(hinted.get(segnum, ()))))
+        d.addCallback(_got_data)
+        return d
+
+    def test_download_without_prefetch(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self._record_prefetches()
+
+        u = upload.Data(plaintext, None)
+        u.max_segment_size = 70
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            # servers that do not advertise prefetch() get no hints
+            for s in self.c0.storage_broker.get_connected_servers():
+                rref = s.get_rref()
+                v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+                v1["immutable-prefetch"] = False
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(self.prefetches, [])
+        d.addCallback(_got_data)
+        return d
+
+    def test_download_without_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+
+        self.load_shares()
+
+        # make the client believe that the servers are too old to offer
+        # readv(), so it must send one read() per span
+        for s in self.c0.storage_broker.get_connected_servers():
+            rref = s.get_rref()
+            v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1["immutable-readv"] = False
+
+        n = self.c0.create_node_from_uri(immutable_uri)
+        d = download_to_data(n)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            self.failUnlessEqual(self._count_readv(), 0)
+        d.addCallback(_got_data)
+        return d
+
     def test_download_segment(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -1290,6 +1422,8 @@ class MyShare:
         self._dyhb_rtt = rtt
     def __repr__(self):
         return "sh%d-on-%s" % (self._shnum, self._server.get_name())
+    def get_expected_delay(self):
+        return self._dyhb_rtt
 
 class MySegmentFetcher(SegmentFetcher):
     def __init__(self, *args, **kwargs):
@@ -1375,6 +1509,23 @@ class Selection(unittest.TestCase):
         d.addCallback(_check2)
         return d
 
+    def test_prefer_fast_servers(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None)
+        shares = [MyShare(i, make_server("peer-%d" % i), 0.1*i)
+                  for i in range(5)]
+        # other downloads have learned that peer-1 is now slow, and that
+        # peer-4 is fast
+        shares[1]._dyhb_rtt = 1.0
+        shares[4]._dyhb_rtt = 0.0
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[4], shares[2]])
+        d.addCallback(_check1)
+        return d
+
     def test_good_diversity_late(self):
         node = FakeNode()
         sf = MySegmentFetcher(node, 0, 3, None)
@@ -4,6 +4,7 @@ from twisted.internet import defer
 from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
+from allmydata.codec import EncodingPool
 from allmydata.immutable import encode, upload, checker
 from allmydata.util import hashutil
 from allmydata.util.assertutil import _assert
@@ -263,10 +264,11 @@ class Encode(unittest.TestCase):
     timeout = 2400 # It takes longer than 240 seconds on Zandr's ARM box.
 
     def do_encode(self, max_segment_size, datalen, NUM_SHARES, NUM_SEGMENTS,
-                  expected_block_hashes, expected_share_hashes):
+                  expected_block_hashes, expected_share_hashes,
+                  encoding_pool=None):
         data = make_data(datalen)
         # force use of multiple segments
-        e = encode.Encoder()
+        e = encode.Encoder(encoding_pool=encoding_pool)
         u = upload.Data(data, convergence="some convergence string")
         u.set_default_encoding_parameters({'max_segment_size': max_segment_size,
                                            'k': 25, 'happy': 75, 'n': 100})
@@ -315,6 +317,7 @@ class Encode(unittest.TestCase):
                 for (hashnum, h) in peer.share_hashes:
                     self.failUnless(isinstance(hashnum, int))
                     self.failUnlessEqual(len(h), 32)
+            return verifycap
         d.addCallback(_check)
 
         return d
@@ -349,6 +352,22 @@ class Encode(unittest.TestCase):
         # 5 segments: 25, 25, 25, 25, 1
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
+    def test_send_pooled(self):
+        # encoding segments ahead in a pool must give the same file
+        pool = EncodingPool(2)
+        self.addCleanup(pool.stop)
+        d = self.do_encode(25, 101, 100, 5, 15, 8)
+        def _encoded(verifycap):
+            self.verifycap = verifycap
+            return self.do_encode(25, 101, 100, 5, 15, 8,
+                                  encoding_pool=pool)
+        d.addCallback(_encoded)
+        def _check(verifycap):
+            self.failUnlessEqual(verifycap.uri_extension_hash,
+                                 self.verifycap.uri_extension_hash)
+        d.addCallback(_check)
+        return d
+
 
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
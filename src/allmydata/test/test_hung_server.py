@@ -9,7 +9,7 @@ from allmydata.immutable import upload
 from allmydata.mutable.common import UnrecoverableFileError
 from allmydata.mutable.publish import MutableData
 from allmydata.storage.common import storage_index_to_dir
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import DiskBackedGridTestMixin
 from allmydata.test.common import ShouldFailMixin
 from allmydata.util.pollmixin import PollMixin
 from allmydata.interfaces import NotEnoughSharesError
@@ -17,8 +17,8 @@ from allmydata.interfaces import NotEnoughSharesError
 immutable_plaintext = "data" * 10000
 mutable_plaintext = "muta" * 10000
 
-class HungServerDownloadTest(GridTestMixin, ShouldFailMixin, PollMixin,
-                             unittest.TestCase):
+class HungServerDownloadTest(DiskBackedGridTestMixin, ShouldFailMixin,
+                             PollMixin, unittest.TestCase):
     # Many of these tests take around 60 seconds on François's ARM buildslave:
     # http://tahoe-lafs.org/buildbot/builders/FranXois%20lenny-armv5tel
     # allmydata.test.test_hung_server.HungServerDownloadTest.test_2_good_8_broken_duplicate_share_fail
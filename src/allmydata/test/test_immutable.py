@@ -15,6 +15,7 @@ from allmydata.util.consumer import download_to_data
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable.upload import Data
 from allmydata.immutable.downloader import finder
+from allmydata.storage_client import ServerPerformance
 
 class MockNode(object):
     def __init__(self, check_reneging, check_fetch_failed):
@@ -119,6 +120,8 @@ class TestShareFinder(unittest.TestCase):
                     MockIServer("ms2", mockserver2),
                     MockIServer("ms3", mockserver3), ]
         mockstoragebroker.get_servers_for_psi.return_value = servers
+        mockstoragebroker.iter_servers_for_psi.return_value = iter(servers)
+        mockstoragebroker.get_server_performance.return_value = ServerPerformance()
         mockdownloadstatus = mock.Mock()
         mocknode = MockNode(check_reneging=True, check_fetch_failed=True)
 
@@ -8,7 +8,8 @@ from allmydata.util.consumer import download_to_data
 from twisted.internet import defer
 from twisted.trial import unittest
 import random
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import GridTestMixin, \
+     DiskBackedGridTestMixin
 
 # We'll allow you to pass this test even if you trigger eighteen times as
 # many disk reads and block fetches as would be optimal.
@@ -360,7 +361,7 @@ WRITE_LEEWAY = 35
 # Optimally, you could repair one of these (small) files in a single write.
 DELTA_WRITES_PER_SHARE = 1 * WRITE_LEEWAY
 
-class Repairer(GridTestMixin, unittest.TestCase, RepairTestMixin,
+class Repairer(DiskBackedGridTestMixin, unittest.TestCase, RepairTestMixin,
                common.ShouldFailMixin):
 
     def test_harness(self):
@@ -1,8 +1,12 @@
 
 from twisted.trial import unittest
 from twisted.application import service
-from allmydata.stats import CPUUsageMonitor
+from twisted.internet import defer
+from zope.interface import implements
+from allmydata.interfaces import IStatsProducer
+from allmydata.stats import CPUUsageMonitor, StatsProvider, StatsGatherer
 from allmydata.util import pollmixin
+from allmydata.util.histogram import LatencyHistogram
 import allmydata.test.common_util as testutil
 
 class FasterMonitor(CPUUsageMonitor):
@@ -37,3 +41,57 @@ class CPUUsage(unittest.TestCase, pollmixin.PollMixin, testutil.StallMixin):
         d.addCallback(_check)
         return d
 
+
+
+class FakeProducer:
+    implements(IStatsProducer)
+    def __init__(self, values):
+        self.histogram = LatencyHistogram()
+        for value in values:
+            self.histogram.add(value)
+    def get_stats(self):
+        return {}
+    def get_latency_histograms(self):
+        return {"storage_server.read": self.histogram.to_wire()}
+
+class FakeProviderReference:
+    def __init__(self, provider, tubid):
+        self.provider = provider
+        self.tubid = tubid
+    def getRemoteTubID(self):
+        return self.tubid
+    def callRemote(self, methname, *args, **kwargs):
+        meth = getattr(self.provider, "remote_" + methname)
+        return defer.maybeDeferred(meth, *args, **kwargs)
+
+class OldProviderReference(FakeProviderReference):
+    def callRemote(self, methname, *args, **kwargs):
+        if methname == "get_latency_histograms":
+            return defer.fail(AttributeError(methname))
+        return FakeProviderReference.callRemote(self, methname,
+                                                *args, **kwargs)
+
+class MyStatsGatherer(StatsGatherer):
+    def got_stats(self, stats, tubid, nickname):
+        pass
+
+class Latencies(unittest.TestCase):
+    def test_merge(self):
+        g = MyStatsGatherer("stats/Latencies/merge")
+        for (tubid, values) in [("tub1", [0.01] * 10), ("tub2", [1.0] * 30)]:
+            sp = StatsProvider(None, None)
+            sp.register_producer(FakeProducer(values))
+            g.remote_provide(FakeProviderReference(sp, tubid), tubid)
+        g.remote_provide(OldProviderReference(StatsProvider(None, None),
+                                              "tub3"), "tub3")
+        g.poll()
+        self.failUnlessEqual(sorted(g.latency_histograms.keys()),
+                             ["tub1", "tub2"])
+        merged = g.get_merged_latencies()
+        self.failUnlessEqual(merged.keys(), ["storage_server.read"])
+        h = merged["storage_server.read"]
+        self.failUnlessEqual(h.get_count(), 40)
+        self.failUnlessEqual(h.get_min(), 0.01)
+        self.failUnlessEqual(h.get_max(), 1.0)
+        # the real median of all 40 values, not an average of medians
+        self.failUnless(abs(h.get_percentile(0.5) - 1.0) < 0.01)
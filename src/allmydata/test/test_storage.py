@@ -1,4 +1,4 @@
-import time, os.path, platform, stat, re, simplejson, struct, shutil
+import time, os.path, platform, stat, re, simplejson, struct, shutil, threading
 
 import mock
 
@@ -6,18 +6,28 @@ from twisted.trial import unittest
 
 from twisted.internet import defer
 from twisted.application import service
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, Tub, Referenceable
 import itertools
 from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
 from allmydata.storage.server import StorageServer
-from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.mutable import MutableShareFile, MutableShareFileV2, \
+     get_mutable_share_file, convert_mutable_sharefile
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_b2a, ServerBusyError
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.filecache import FileHandleCache
+from allmydata.storage import expirer, leasedb, packed
+from allmydata.storage.backend import MemoryBackend, LogBackend, get_backend
+from allmydata.storage.scheduler import RequestScheduler, parse_weights, \
+     ANONYMOUS
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseCheckingCrawler
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.advisories import parse_share_spec
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -31,12 +41,15 @@ from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
 from allmydata.interfaces import BadWriteEnablerError
 from allmydata.test.common import LoggingServiceParent, ShouldFailMixin
 from allmydata.test.common_web import WebRenderingMixin
-from allmydata.test.no_network import NoNetworkServer
+from allmydata.test.no_network import NoNetworkServer, wrap_storage_server
+from allmydata.storage_client import get_buckets, SlotWriteError, \
+     slot_testv_and_readv_and_writev
 from allmydata.web.storage import StorageStatus, remove_prefix
 
 class Marker:
     pass
 class FakeCanary:
+    tubid = None
     def __init__(self, ignore_disconnectors=False):
         self.ignore = ignore_disconnectors
         self.disconnectors = {}
@@ -50,6 +63,10 @@ class FakeCanary:
         if self.ignore:
             return
         del self.disconnectors[marker]
+    def getRemoteTubID(self):
+        if self.tubid is None:
+            raise AttributeError("no tubid")
+        return self.tubid
 
 class FakeStatsProvider:
     def count(self, name, delta=1):
@@ -57,6 +74,13 @@ class FakeStatsProvider:
     def register_producer(self, producer):
         pass
 
+class FakeDiskIO:
+    def __init__(self):
+        self.calls = []
+    def run(self, f, *args):
+        self.calls.append(args)
+        return defer.maybeDeferred(f, *args)
+
 class Bucket(unittest.TestCase):
     def make_workdir(self, name):
         basedir = os.path.join("storage", "Bucket", name)
@@ -66,6 +90,7 @@ class Bucket(unittest.TestCase):
         fileutil.make_dirs(os.path.join(basedir, "tmp"))
         return incoming, final
 
+    diskio = None
     def bucket_writer_closed(self, bw, consumed):
         pass
     def add_latency(self, category, latency):
@@ -106,6 +131,43 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_readv(self):
+        incoming, final = self.make_workdir("test_readv")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        bw.remote_write(50, "c"*7)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        datav = br.remote_readv([(25, 25), (0, 10), (50, 7), (190, 20),
+                                 (200, 10)])
+        # reads past the end are truncated, just like read()
+        self.failUnlessEqual(datav, ["b"*25, "a"*10, "c"*7, "\x00"*10, ""])
+        self.failUnlessEqual(br.remote_readv([]), [])
+
+    def test_prefetch(self):
+        incoming, final = self.make_workdir("test_prefetch")
+        bw = BucketWriter(self, incoming, final, 200, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*200)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        sf = ShareFile(bw.finalhome)
+        self.failUnlessEqual(sf.prefetch([(0, 100), (150, 100), (300, 10)]),
+                             fileutil.have_posix_fadvise)
+        self.failUnlessEqual(br.remote_prefetch([(0, 100)]), None)
+
+        # without posix_fadvise, the disk I/O threads read the data instead
+        self.patch(fileutil, "have_posix_fadvise", False)
+        self.failIf(sf.prefetch([(0, 100)]))
+        self.failUnlessEqual(br.remote_prefetch([(0, 100)]), None)
+        self.diskio = FakeDiskIO()
+        self.failUnlessEqual(br.remote_prefetch([(0, 100), (150, 10)]), None)
+        self.failUnlessEqual(self.diskio.calls, [([(0, 100), (150, 10)],)])
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -139,6 +201,7 @@ class Bucket(unittest.TestCase):
         fileutil.write(final, share_file_data)
 
         mockstorageserver = mock.Mock()
+        mockstorageserver.diskio = None
 
         # Now read from it.
         br = BucketReader(mockstorageserver, final)
@@ -159,6 +222,7 @@ class RemoteBucket:
     def __init__(self):
         self.read_count = 0
         self.write_count = 0
+        self.readv_count = 0
 
     def callRemote(self, methname, *args, **kwargs):
         def _call():
@@ -167,12 +231,17 @@ class RemoteBucket:
 
         if methname == "slot_readv":
             self.read_count += 1
+        if methname == "readv":
+            self.readv_count += 1
         if "writev" in methname:
             self.write_count += 1
 
         return defer.maybeDeferred(_call)
 
 
+class FakeStorageServerRref:
+    version = None
+
 class BucketProxy(unittest.TestCase):
     def make_bucket(self, name, size):
         basedir = os.path.join("storage", "BucketProxy", name)
@@ -194,6 +263,7 @@ class BucketProxy(unittest.TestCase):
         return LeaseInfo(owner_num, renew_secret, cancel_secret,
                          expiration_time, "\x00" * 20)
 
+    diskio = None
     def bucket_writer_closed(self, bw, consumed):
         pass
     def add_latency(self, category, latency):
@@ -211,7 +281,8 @@ class BucketProxy(unittest.TestCase):
                               uri_extension_size_max=500)
         self.failUnless(interfaces.IStorageBucketWriter.providedBy(bp), bp)
 
-    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class):
+    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class,
+                           server_version=None):
         # Let's pretend each share has 100 bytes of data, and that there are
         # 4 segments (25 bytes each), and 8 shares total. So the two
         # per-segment merkle trees (crypttext_hash_tree,
@@ -258,6 +329,9 @@ class BucketProxy(unittest.TestCase):
             rb = RemoteBucket()
             rb.target = br
             server = NoNetworkServer("abc", None)
+            if server_version:
+                server = NoNetworkServer("abc", FakeStorageServerRref())
+                server.rref.version = server_version
             rbp = rbp_class(rb, server, storage_index="")
             self.failUnlessIn("to peer", repr(rbp))
             self.failUnless(interfaces.IStorageBucketReader.providedBy(rbp), rbp)
@@ -282,6 +356,21 @@ class BucketProxy(unittest.TestCase):
             d1.addCallback(lambda res:
                            self.failUnlessEqual(res, uri_extension))
 
+            def _read_in_parallel(res):
+                rb.readv_count = 0
+                dl = [rbp.get_block_data(0, 25, 25),
+                      rbp.get_block_data(3, 25, 20),
+                      rbp.get_crypttext_hashes()]
+                return defer.gatherResults(dl)
+            d1.addCallback(_read_in_parallel)
+            def _check_parallel(res):
+                self.failUnlessEqual(res, ["a"*25, "d"*20, crypttext_hashes])
+                if server_version:
+                    self.failUnlessEqual(rb.readv_count, 1)
+                else:
+                    self.failUnlessEqual(rb.readv_count, 0)
+            d1.addCallback(_check_parallel)
+
             return d1
 
         d.addCallback(_start_reading)
@@ -296,6 +385,14 @@ class BucketProxy(unittest.TestCase):
         return self._do_test_readwrite("test_readwrite_v2",
                                        0x44, WriteBucketProxy_v2, ReadBucketProxy)
 
+    def test_readwrite_readv(self):
+        version = {"http://allmydata.org/tahoe/protocols/storage/v1":
+                   {"immutable-readv": True,
+                    "maximum-immutable-readv-size": 100}}
+        return self._do_test_readwrite("test_readwrite_readv",
+                                       0x44, WriteBucketProxy_v2, ReadBucketProxy,
+                                       server_version=version)
+
 class Server(unittest.TestCase):
 
     def setUp(self):
@@ -472,6 +569,53 @@ class Server(unittest.TestCase):
         for i,wb in writers.items():
             wb.remote_abort()
 
+    def test_get_buckets_batch(self):
+        ss = self.create("test_get_buckets_batch")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get("get-buckets-batch"), sv1)
+        self.failUnless(sv1.get("maximum-get-buckets-batch-size") > 1, sv1)
+
+        for si, shnums in [("si1", [0,1]), ("si2", [3])]:
+            already, writers = self.allocate(ss, si, shnums, 10)
+            for i,wb in writers.items():
+                wb.remote_write(0, "%10d" % i)
+                wb.remote_close()
+        res = ss.remote_get_buckets_batch(["si1", "si2", "si3"])
+        self.failUnlessEqual(sorted(res.keys()), ["si1", "si2"])
+        self.failUnlessEqual(sorted(res["si1"].keys()), [0,1])
+        self.failUnlessEqual(res["si2"][3].remote_read(0, 10), "%10d" % 3)
+
+    def test_batched_bucket_queries(self):
+        ss = self.create("test_batched_bucket_queries")
+        for si in ["si1", "si2"]:
+            already, writers = self.allocate(ss, si, [0], 10)
+            writers[0].remote_write(0, "%10d" % 0)
+            writers[0].remote_close()
+        wrapper = wrap_storage_server(ss)
+        server = NoNetworkServer("\x00" * 20, wrapper)
+        # the first query goes out at once, the rest wait for it and then
+        # travel together
+        dl = [get_buckets(server, si) for si in ["si1", "si2", "si3", "si1"]]
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.failUnlessEqual([sorted(b.keys()) for b in res],
+                                 [[0], [0], [], [0]])
+            self.failUnlessEqual(wrapper.counter_by_methname,
+                                 {"get_buckets_batch": 2})
+            # older servers get one query per storage index
+            wrapper._clear_counters()
+            wrapper.version = {"http://allmydata.org/tahoe/protocols/storage/v1": {}}
+            dl = [get_buckets(server, si) for si in ["si1", "si2"]]
+            return defer.gatherResults(dl)
+        d.addCallback(_check)
+        def _check_old(res):
+            self.failUnlessEqual([sorted(b.keys()) for b in res], [[0], [0]])
+            self.failUnlessEqual(wrapper.counter_by_methname,
+                                 {"get_buckets": 2})
+        d.addCallback(_check_old)
+        return d
+
     def test_bad_container_version(self):
         ss = self.create("test_bad_container_version")
         a,w = self.allocate(ss, "si1", [0], 10)
@@ -573,6 +717,55 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    @mock.patch('allmydata.util.fileutil.get_disk_stats')
+    def test_space_accountant(self, mock_get_disk_stats):
+        mock_get_disk_stats.return_value = {'avail': 5000}
+        ss = self.create("test_space_accountant")
+        canary = FakeCanary(True)
+
+        # the free space is measured once, not for every allocation
+        already,writers = self.allocate(ss, "vid1", [0,1], 1000, canary)
+        already2,writers2 = self.allocate(ss, "vid2", [0,1], 1000, canary)
+        self.failUnlessEqual(len(writers2), 2)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, 1)
+        self.failUnlessEqual(ss.allocated_size(), 4000)
+        self.failUnlessEqual(ss.space.get_remaining_space(), 1000)
+
+        # closing a share turns its reservation into used space, aborting
+        # one just releases it
+        writers[0].remote_write(0, "a"*1000)
+        writers[0].remote_close()
+        writers[1].remote_abort()
+        self.failUnlessEqual(ss.allocated_size(), 2000)
+        used = os.path.getsize(writers[0].finalhome)
+        self.failUnlessEqual(ss.get_available_space(), 5000 - used)
+        self.failUnlessEqual(ss.space.get_remaining_space(),
+                             5000 - used - 2000)
+
+        # abandoned writers release their reservation too
+        del already2, writers2
+        self.failUnlessEqual(ss.allocated_size(), 0)
+
+        # get_stats() measures the disk anyway, and reports the headroom
+        mock_get_disk_stats.return_value = {'avail': 4000,
+                                            'total': 10000,
+                                            'used': 6000,
+                                            'free_for_root': 4000,
+                                            'free_for_nonroot': 4000}
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.allocation_headroom"],
+                             4000)
+        self.failUnlessEqual(stats["storage_server.allocated"], 0)
+
+        # the measurement is repeated once enough data has been written
+        ss.space.refresh_bytes = 500
+        mock_get_disk_stats.return_value = {'avail': 3000}
+        already,writers = self.allocate(ss, "vid3", [0], 600, canary)
+        self.failUnlessEqual(ss.space.get_remaining_space(), 4000 - 600)
+        writers[0].remote_write(0, "a"*600)
+        writers[0].remote_close()
+        self.failUnlessEqual(ss.get_available_space(), 3000)
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -726,25 +919,27 @@ class Server(unittest.TestCase):
         workdir = self.workdir("test_advise_corruption")
         ss = StorageServer(workdir, "\x00" * 20, discard_storage=True)
         ss.setServiceParent(self.sparent)
+        advisories = ss.corruption_advisories
 
-        si0_s = base32.b2a("si0")
         ss.remote_advise_corrupt_share("immutable", "si0", 0,
                                        "This share smells funny.\n")
-        reportdir = os.path.join(workdir, "corruption-advisories")
-        reports = os.listdir(reportdir)
-        self.failUnlessEqual(len(reports), 1)
-        report_si0 = reports[0]
-        self.failUnlessIn(si0_s, report_si0)
-        f = open(os.path.join(reportdir, report_si0), "r")
-        report = f.read()
-        f.close()
-        self.failUnlessIn("type: immutable", report)
-        self.failUnlessIn("storage_index: %s" % si0_s, report)
-        self.failUnlessIn("share_number: 0", report)
-        self.failUnlessIn("This share smells funny.", report)
+        self.failUnlessEqual(advisories.count_shares(), 1)
+        a = advisories.get_advisory("si0", 0)
+        self.failUnlessEqual(a["share_type"], "immutable")
+        self.failUnlessEqual(a["count"], 1)
+        self.failUnlessEqual(a["client"], "anonymous")
+        self.failUnlessEqual(a["first_seen"], a["last_seen"])
+        self.failUnlessIn("This share smells funny.", a["reason"])
+
+        # a second report about the same share updates its record
+        ss.remote_advise_corrupt_share("immutable", "si0", 0,
+                                       "Still smells. \xff\n")
+        self.failUnlessEqual(advisories.count_shares(), 1)
+        a = advisories.get_advisory("si0", 0)
+        self.failUnlessEqual(a["count"], 2)
+        self.failUnlessIn("Still smells.", a["reason"])
 
         # test the RIBucketWriter version too
-        si1_s = base32.b2a("si1")
         already,writers = self.allocate(ss, "si1", [1], 75)
         self.failUnlessEqual(already, set())
         self.failUnlessEqual(set(writers.keys()), set([1]))
@@ -755,17 +950,153 @@ class Server(unittest.TestCase):
         self.failUnlessEqual(set(b.keys()), set([1]))
         b[1].remote_advise_corrupt_share("This share tastes like dust.\n")
 
-        reports = os.listdir(reportdir)
-        self.failUnlessEqual(len(reports), 2)
-        report_si1 = [r for r in reports if si1_s in r][0]
-        f = open(os.path.join(reportdir, report_si1), "r")
-        report = f.read()
+        self.failUnlessEqual(advisories.count_shares(), 2)
+        a = advisories.get_advisory("si1", 1)
+        self.failUnlessEqual(a["share_type"], "immutable")
+        self.failUnlessIn("This share tastes like dust.", a["reason"])
+        self.failUnlessEqual(sorted([(adv["storage_index"], adv["shnum"])
+                                     for adv in advisories.get_advisories()]),
+                             [("si0", 0), ("si1", 1)])
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.corruption_advisories.shares"], 2)
+        self.failUnlessEqual(stats["storage_server.corruption_advisories.reports"], 3)
+
+        self.failUnlessEqual(advisories.remove("si0"), 1)
+        self.failUnlessEqual(advisories.get_advisory("si0", 0), None)
+        self.failUnlessEqual(advisories.remove("si1", 0), 0)
+        self.failUnlessEqual(advisories.count_shares(), 1)
+
+    def test_advise_corruption_rate_limit(self):
+        workdir = self.workdir("test_advise_corruption_rate_limit")
+        ss = StorageServer(workdir, "\x00" * 20, discard_storage=True,
+                           max_advisories_per_client=3)
+        ss.setServiceParent(self.sparent)
+        advisories = ss.corruption_advisories
+        now = [1000.0]
+        advisories._clock = lambda: now[0]
+
+        for i in range(5):
+            ss.schedule_call("client-a", "advise_corrupt_share",
+                             ("immutable", "si0", i, "bad"), {})
+        # other clients have their own allowance
+        ss.schedule_call("client-b", "advise_corrupt_share",
+                         ("immutable", "si0", 9, "bad"), {})
+        self.failUnlessEqual(advisories.count_shares(), 4)
+        self.failUnlessEqual(advisories.get_advisory("si0", 9)["client"],
+                             "client-b")
+        stats = advisories.get_stats()
+        self.failUnlessEqual(stats["reports"], 4)
+        self.failUnlessEqual(stats["dropped"], 2)
+
+        # the allowance refills over time
+        now[0] += 60*60/3
+        ss.schedule_call("client-a", "advise_corrupt_share",
+                         ("immutable", "si0", 3, "bad"), {})
+        self.failUnlessEqual(advisories.count_shares(), 5)
+        ss.schedule_call("client-a", "advise_corrupt_share",
+                         ("immutable", "si0", 4, "bad"), {})
+        self.failUnlessEqual(advisories.count_shares(), 5)
+
+    def test_advise_corruption_rate_limit_by_facet(self):
+        workdir = self.workdir("test_advise_corruption_rate_limit_by_facet")
+        ss = StorageServer(workdir, "\x00" * 20, discard_storage=True,
+                           max_advisories_per_client=2)
+        ss.setServiceParent(self.sparent)
+        advisories = ss.corruption_advisories
+        tub = Tub()
+        tub.setServiceParent(self.sparent)
+        l = tub.listenOn("tcp:0:interface=127.0.0.1")
+        tub.setLocation("127.0.0.1:%d" % l.getPortnum())
+        furl = tub.registerReference(ss)
+        client_tubs = []
+        for i in range(2):
+            t = Tub()
+            t.setServiceParent(self.sparent)
+            client_tubs.append(t)
+        si = "s" * 16
+        def advise(rref, shnums):
+            return defer.gatherResults([rref.callRemote("advise_corrupt_share",
+                                                        "immutable", si,
+                                                        shnum, "bad")
+                                        for shnum in shnums])
+        d = defer.gatherResults([t.getReference(furl) for t in client_tubs])
+        def _connected(rrefs):
+            self.rrefs = rrefs
+            return defer.gatherResults([rref.callRemote("get_client_facet",
+                                                        Referenceable())
+                                        for rref in rrefs])
+        d.addCallback(_connected)
+        def _got_facets(facets):
+            return defer.gatherResults([advise(facet, [10*i, 10*i+1, 10*i+2])
+                                        for (i, facet) in enumerate(facets)])
+        d.addCallback(_got_facets)
+        def _check_facets(ign):
+            # each client that uses a facet is known by its Tub, and has
+            # an allowance of its own
+            self.failUnlessEqual(advisories.count_shares(), 4)
+            self.failUnlessEqual(advisories.get_stats()["dropped"], 2)
+            for (i, t) in enumerate(client_tubs):
+                for shnum in (10*i, 10*i+1):
+                    self.failUnlessEqual(
+                        advisories.get_advisory(si, shnum)["client"],
+                        t.getTubID())
+                self.failUnlessEqual(advisories.get_advisory(si, 10*i+2),
+                                     None)
+            # calls on the server itself all share the anonymous allowance
+            return defer.gatherResults([advise(rref, [20+i, 30+i])
+                                        for (i, rref)
+                                        in enumerate(self.rrefs)])
+        d.addCallback(_check_facets)
+        def _check_anonymous(ign):
+            self.failUnlessEqual(advisories.count_shares(), 6)
+            self.failUnlessEqual(advisories.get_stats()["dropped"], 4)
+            anonymous = [shnum for shnum in (20, 21, 30, 31)
+                         if advisories.get_advisory(si, shnum)]
+            self.failUnlessEqual(len(anonymous), 2)
+            for shnum in anonymous:
+                self.failUnlessEqual(advisories.get_advisory(si, shnum)["client"],
+                                     ANONYMOUS)
+        d.addCallback(_check_anonymous)
+        return d
+
+    def test_import_old_advisories(self):
+        workdir = self.workdir("test_import_old_advisories")
+        reportdir = os.path.join(workdir, "corruption-advisories")
+        fileutil.make_dirs(reportdir)
+        si0_s = base32.b2a("si0")
+        f = open(os.path.join(reportdir, "2010-01-01T00:00:00.000000Z--%s-0"
+                              % si0_s), "w")
+        f.write("report: Share Corruption\n"
+                "type: mutable\n"
+                "storage_index: %s\n"
+                "share_number: 0\n"
+                "\n"
+                "It was bad.\n"
+                "\n" % si0_s)
+        f.close()
+        f = open(os.path.join(reportdir, "junk"), "w")
+        f.write("not a report\n")
         f.close()
-        self.failUnlessIn("type: immutable", report)
-        self.failUnlessIn("storage_index: %s" % si1_s, report)
-        self.failUnlessIn("share_number: 1", report)
-        self.failUnlessIn("This share tastes like dust.", report)
 
+        ss = StorageServer(workdir, "\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        advisories = ss.corruption_advisories
+        self.failUnlessEqual(advisories.count_shares(), 1)
+        a = advisories.get_advisory("si0", 0)
+        self.failUnlessEqual(a["share_type"], "mutable")
+        self.failUnlessEqual(a["reason"], "It was bad.")
+        # the old files are left alone
+        self.failUnlessEqual(len(os.listdir(reportdir)), 2)
+
+    def test_parse_share_spec(self):
+        si = "\x01" * 16
+        si_s = base32.b2a(si)
+        self.failUnlessEqual(parse_share_spec(si_s), (si, None))
+        self.failUnlessEqual(parse_share_spec(si_s + ":3"), (si, 3))
+        self.failUnlessRaises(ValueError, parse_share_spec, "")
+        self.failUnlessRaises(ValueError, parse_share_spec, si_s + ":x")
+        self.failUnlessRaises(ValueError, parse_share_spec, "BOGUS")
 
 
 class MutableServer(unittest.TestCase):
@@ -815,6 +1146,94 @@ class MutableServer(unittest.TestCase):
         self.failUnless(isinstance(readv_data, dict))
         self.failUnlessEqual(len(readv_data), 0)
 
+    def test_writev_batch(self):
+        ss = self.create("test_writev_batch")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get("slot-writev-batch"), sv1)
+        self.failUnless(sv1.get("maximum-slot-writev-batch-size") > 1, sv1)
+
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(), set([0]), 10)
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        bad_secrets = ("bad write enabler", secrets[1], secrets[2])
+        batch = ss.remote_slot_testv_and_readv_and_writev_batch
+        results = batch([("si1", secrets, {0: ([], [(0, "a"*10)], None)}, []),
+                         ("si2", secrets, {1: ([], [(0, "b"*10)], None)}, []),
+                         # a bad write enabler only fails its own slot
+                         ("si1", bad_secrets, {0: ([], [(0, "c"*10)], None)},
+                          []),
+                         # the writes are applied in order
+                         ("si1", secrets,
+                          {0: ([(0, 10, "eq", "a"*10)], [(5, "d"*5)], None)},
+                          [(0, 10)]),
+                         ("si2", secrets,
+                          {1: ([(0, 10, "eq", "x"*10)], [(0, "e"*10)], None)},
+                          [(0, 10)]),
+                         ])
+        self.failUnlessEqual(len(results), 5)
+        self.failUnlessEqual(results[0], (True, {0: []}, None))
+        self.failUnlessEqual(results[1], (True, {}, None))
+        (did_write, read_data, error) = results[2]
+        self.failIf(did_write)
+        self.failUnlessEqual(read_data, {})
+        self.failUnless(error.startswith("BadWriteEnablerError: "), error)
+        self.failUnlessEqual(results[3], (True, {0: ["a"*10]}, None))
+        self.failUnlessEqual(results[4], (False, {1: ["b"*10]}, None))
+        read = ss.remote_slot_readv
+        self.failUnlessEqual(read("si1", [0], [(0, 10)]), {0: ["a"*5+"d"*5]})
+        self.failUnlessEqual(read("si2", [1], [(0, 10)]), {1: ["b"*10]})
+        self.failUnlessEqual(ss.latencies["writev-batch"].get_count(), 1)
+
+    def test_batched_slot_writes(self):
+        ss = self.create("test_batched_slot_writes")
+        wrapper = wrap_storage_server(ss)
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        def write(si, data, secrets=secrets):
+            return slot_testv_and_readv_and_writev(
+                wrapper, si, secrets, {0: ([], [(0, data)], None)}, [])
+        # the writes that are issued in one turn travel together
+        dl = [write(si, si*5) for si in ["si1", "si2", "si3"]]
+        d = defer.gatherResults(dl)
+        def _check(res):
+            self.failUnlessEqual(res, [(True, {})] * 3)
+            self.failUnlessEqual(wrapper.counter_by_methname,
+                                 {"slot_testv_and_readv_and_writev_batch": 1})
+            self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 15)]),
+                                 {0: ["si2"*5]})
+            wrapper._clear_counters()
+            bad_secrets = ("bad write enabler", secrets[1], secrets[2])
+            d1 = write("si1", "x", bad_secrets)
+            d2 = write("si4", "si4")
+            def _failed(f):
+                f.trap(SlotWriteError)
+                self.failUnless(str(f.value).startswith("BadWriteEnablerError"),
+                                str(f.value))
+            d1.addCallbacks(lambda res: self.fail("should have failed: %r"
+                                                  % (res,)),
+                            _failed)
+            d1.addCallback(lambda ign: d2)
+            return d1
+        d.addCallback(_check)
+        def _check_bad(res):
+            self.failUnlessEqual(res, (True, {}))
+            self.failUnlessEqual(wrapper.counter_by_methname,
+                                 {"slot_testv_and_readv_and_writev_batch": 1})
+            # older servers get one call per slot
+            wrapper._clear_counters()
+            wrapper.version = {"http://allmydata.org/tahoe/protocols/storage/v1": {}}
+            return defer.gatherResults([write("si1", "y"), write("si2", "y")])
+        d.addCallback(_check_bad)
+        def _check_old(res):
+            self.failUnlessEqual(res, [(True, {0: []})] * 2)
+            self.failUnlessEqual(wrapper.counter_by_methname,
+                                 {"slot_testv_and_readv_and_writev": 2})
+        d.addCallback(_check_old)
+        return d
+
     def test_bad_magic(self):
         ss = self.create("test_bad_magic")
         self.allocate(ss, "si1", "we1", self._lease_secret.next(), set([0]), 10)
@@ -1239,7 +1658,7 @@ class MutableServer(unittest.TestCase):
         f.write("you ought to be ignoring me\n")
         f.close()
 
-        s0 = MutableShareFile(os.path.join(bucket_dir, "0"))
+        s0 = get_mutable_share_file(os.path.join(bucket_dir, "0"))
         self.failUnlessEqual(len(list(s0.get_leases())), 1)
 
         # add-lease on a missing storage index is silently ignored
@@ -1359,6 +1778,115 @@ class MutableServer(unittest.TestCase):
         self.failIf(os.path.exists(bucketdir), bucketdir)
 
 
+class MutableServerV2(MutableServer):
+    # all of the MutableServer tests, with version 2 containers
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "MutableServerV2", name)
+        return basedir
+
+    def create(self, name):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20, mutable_container_version=2)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self, n):
+        return (self.write_enabler("we1"),
+                self.renew_secret("we1-%d" % n),
+                self.cancel_secret("we1-%d" % n))
+
+    def test_in_place(self):
+        ss = self.create("test_in_place")
+        write = ss.remote_slot_testv_and_readv_and_writev
+        read = ss.remote_slot_readv
+        write("si1", self.secrets(0), {0: ([], [(0, "a"*100)], None)}, [])
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        msf = get_mutable_share_file(fn)
+        self.failUnless(isinstance(msf, MutableShareFileV2))
+        data_offset = msf.get_data_offset()
+        self.failUnlessEqual(data_offset, MutableShareFile.DATA_OFFSET)
+        self.failUnlessEqual(os.path.getsize(fn), data_offset + 100)
+
+        # growing the share writes past the end, and moves nothing
+        write("si1", self.secrets(0), {0: ([], [(100, "b"*1000)], None)}, [])
+        self.failUnlessEqual(msf.get_data_offset(), data_offset)
+        self.failUnlessEqual(os.path.getsize(fn), data_offset + 1100)
+        # shrinking it gives the space back
+        write("si1", self.secrets(0), {0: ([], [], 50)}, [])
+        self.failUnlessEqual(os.path.getsize(fn), data_offset + 50)
+        self.failUnlessEqual(read("si1", [0], [(0, 100)]), {0: ["a"*50]})
+
+        # the fifth lease makes room for four more, by moving the data
+        for i in range(1, 5):
+            write("si1", self.secrets(i), {0: ([], [(0, "c"*10)], None)}, [])
+        self.failUnlessEqual(len(list(msf.get_leases())), 5)
+        self.failUnlessEqual(msf.get_data_offset(),
+                             data_offset + 4 * MutableShareFile.LEASE_SIZE)
+        self.failUnlessEqual(read("si1", [0], [(0, 100)]),
+                             {0: ["c"*10 + "a"*40]})
+        for i in range(5, 8):
+            write("si1", self.secrets(i), {0: ([], [], None)}, [])
+        self.failUnlessEqual(len(list(msf.get_leases())), 8)
+        self.failUnlessEqual(msf.get_data_offset(),
+                             data_offset + 4 * MutableShareFile.LEASE_SIZE)
+
+        # cancelling every lease deletes the share
+        for i in range(8):
+            msf.cancel_lease(self.secrets(i)[2])
+        self.failIf(os.path.exists(fn))
+
+    def test_grow_lease_slots_in_pieces(self):
+        ss = self.create("test_grow_lease_slots_in_pieces")
+        write = ss.remote_slot_testv_and_readv_and_writev
+        data = "".join([chr(i % 256) for i in range(5000)])
+        write("si1", self.secrets(0), {0: ([], [(0, data)], None)}, [])
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        msf = get_mutable_share_file(fn)
+        msf.COPY_CHUNK_SIZE = 1000
+        for i in range(1, 5):
+            msf.add_lease(LeaseInfo(1, self.renew_secret(i),
+                                    self.cancel_secret(i), 0, "\x00"*20))
+        self.failUnlessEqual(msf.readv([(0, 5000)]), [data])
+
+    def test_convert(self):
+        basedir = self.workdir("test_convert")
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        write = ss.remote_slot_testv_and_readv_and_writev
+        data = "".join([("%d" % i) * 10 for i in range(10)])
+        for i in range(6):
+            write("si1", self.secrets(i), {0: ([], [(0, data)], None)}, [])
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        leases = list(get_mutable_share_file(fn).get_leases())
+
+        self.failUnless(convert_mutable_sharefile(fn, 2))
+        self.failIf(convert_mutable_sharefile(fn, 2))
+        msf = get_mutable_share_file(fn)
+        self.failUnlessEqual(msf.CONTAINER_VERSION, 2)
+        self.compare_leases(leases, list(msf.get_leases()))
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 200)]),
+                             {0: [data]})
+        # the old write enabler still works
+        rc = write("si1", self.secrets(0), {0: ([], [(100, "x")], None)}, [])
+        self.failUnlessEqual(rc, (True, {0: []}))
+
+        self.failUnless(convert_mutable_sharefile(fn, 1))
+        msf = get_mutable_share_file(fn)
+        self.failUnlessEqual(msf.CONTAINER_VERSION, 1)
+        self.compare_leases(leases, list(msf.get_leases()))
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 200)]),
+                             {0: [data + "x"]})
+        self.failIf(os.path.exists(fn + ".convert"))
+
+    def test_bad_version(self):
+        basedir = self.workdir("test_bad_version")
+        fileutil.make_dirs(basedir)
+        self.failUnlessRaises(ValueError, StorageServer, basedir, "\x00" * 20,
+                              mutable_container_version=3)
+
+
 class MDMFProxies(unittest.TestCase, ShouldFailMixin):
     def setUp(self):
         self.sparent = LoggingServiceParent()
@@ -2796,6 +3324,10 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # the latency histograms are accurate to about 1%
+        self.failUnless(abs(value - expected) <= 0.02 * expected, output)
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2812,47 +3344,48 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+        self.failUnlessEqual(ss.latencies["allocate"].get_count(), 10000)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(ss.latencies["renew"].get_count(), 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(ss.latencies["write"].get_count(), 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(ss.latencies["cancel"].get_count(), 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(ss.latencies["get"].get_count(), 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2862,6 +3395,17 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+        histograms = ss.get_latency_histograms()
+        self.failUnlessEqual(sorted(histograms.keys()),
+                             ["storage_server.allocate",
+                              "storage_server.cancel", "storage_server.get",
+                              "storage_server.renew", "storage_server.write"])
+        (layout, count, total, minimum, maximum, buckets) = \
+                 histograms["storage_server.get"]
+        self.failUnlessEqual((count, total, minimum, maximum),
+                             (1, 5.0, 5.0, 5.0))
+        self.failUnlessEqual(buckets.values(), [1])
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -2908,7 +3452,8 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         s = remove_tags(html)
         self.failUnlessIn("Accepting new shares: Yes", s)
         self.failUnlessIn("Reserved space: - 0 B (0)", s)
-        self.failUnlessIn("Total buckets: Not computed yet", s)
+        # an empty server knows its bucket count without crawling
+        self.failUnlessIn("Total buckets: 0 (the number of", s)
         self.failUnlessIn("Next crawl in", s)
 
         # give the bucket-counting-crawler one tick to get started. The
@@ -2941,7 +3486,7 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
             html = w.renderSynchronously()
             s = remove_tags(html)
             self.failUnlessIn("Total buckets: 0 (the number of", s)
-            self.failUnless("Next crawl in 59 minutes" in s or "Next crawl in 60 minutes" in s, s)
+            self.failUnless("Next crawl in 23 hours" in s or "Next crawl in 24 hours" in s, s)
         d.addCallback(_check2)
         return d
 
@@ -3025,6 +3570,1751 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         ss.setServiceParent(self.s)
         return d
 
+    def allocate(self, ss, storage_index, sharenums, size):
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      "r"*32, "c"*32,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for i,wb in writers.items():
+            wb.remote_write(0, "%*d" % (size, i))
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, sharenums, data, new_length=None):
+        secrets = ("w"*32, "r"*32, "c"*32)
+        tw = dict([(shnum, ([], [(0, data)], new_length))
+                   for shnum in sharenums])
+        rc = ss.remote_slot_testv_and_readv_and_writev(storage_index, secrets,
+                                                       tw, [])
+        self.failUnless(rc[0])
+
+    def get_counts(self, ss):
+        stats = ss.get_stats()
+        return dict([(remove_prefix(k, "storage_server."), v)
+                     for (k,v) in stats.items()
+                     if k.startswith("storage_server.total_")])
+
+    def test_live_counts(self):
+        basedir = "storage/BucketCounter/live_counts"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.bucket_counter.slow_start = 1000 # don't let it reconcile yet
+        ss.setServiceParent(self.s)
+
+        zero = {"total_bucket_count": 0,
+                "total_share_count.immutable": 0,
+                "total_share_count.mutable": 0,
+                "total_share_bytes.immutable": 0,
+                "total_share_bytes.mutable": 0}
+        self.failUnlessEqual(self.get_counts(ss), zero)
+        self.failUnlessEqual(ss.get_stats()["storage_server.share_counts_exact"],
+                             1)
+
+        self.allocate(ss, "si1", [0,1], 10)
+        self.allocate(ss, "si1", [2], 10) # same bucket
+        self.allocate(ss, "si2", [0], 20)
+        # aborted uploads are not counted
+        already, writers = ss.remote_allocate_buckets("si3", "r"*32, "c"*32,
+                                                      [0], 10, FakeCanary())
+        writers[0].remote_abort()
+        self.write_mutable(ss, "si4", [0,1], "a"*100)
+        self.write_mutable(ss, "si4", [0], "b"*150) # grows share 0
+        self.write_mutable(ss, "si5", [0], "c"*30)
+        expected = {"total_bucket_count": 4,
+                    "total_share_count.immutable": 4,
+                    "total_share_count.mutable": 3,
+                    "total_share_bytes.immutable": 50,
+                    "total_share_bytes.mutable": 280}
+        self.failUnlessEqual(self.get_counts(ss), expected)
+
+        # deleting a mutable share, and then the last one in its bucket
+        self.write_mutable(ss, "si4", [1], "", new_length=0)
+        self.write_mutable(ss, "si5", [0], "", new_length=0)
+        expected.update({"total_bucket_count": 3,
+                         "total_share_count.mutable": 1,
+                         "total_share_bytes.mutable": 150})
+        self.failUnlessEqual(self.get_counts(ss), expected)
+
+        # the lease-expiration crawler tells the server about the shares it
+        # deletes
+        sharefile = os.path.join(ss.sharedir, storage_index_to_dir("si2"), "0")
+        data_length = get_share_file(sharefile).get_data_length()
+        os.unlink(sharefile)
+        ss.share_removed("si2", 0, "immutable", data_length)
+        expected.update({"total_bucket_count": 2,
+                         "total_share_count.immutable": 3,
+                         "total_share_bytes.immutable": 30})
+        self.failUnlessEqual(self.get_counts(ss), expected)
+
+        # the counts survive a restart, and are still exact afterwards
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss2 = StorageServer(basedir, "\x00" * 20)
+            self.failUnless(ss2.share_counter.exact)
+            self.failUnlessEqual(self.get_counts(ss2), expected)
+        d.addCallback(_restart)
+        return d
+
+    def test_live_counts_list_bucket_once(self):
+        basedir = "storage/BucketCounter/live_counts_list_bucket_once"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.bucket_counter.slow_start = 1000 # don't let it reconcile yet
+        ss.setServiceParent(self.s)
+        listed = []
+        original = ss._get_bucket_shares
+        def _get_bucket_shares(storage_index):
+            listed.append(storage_index)
+            return original(storage_index)
+        ss._get_bucket_shares = _get_bucket_shares
+
+        already, writers = ss.remote_allocate_buckets("si1", "r"*32, "c"*32,
+                                                      range(5), 10,
+                                                      FakeCanary())
+        del listed[:]
+        for i,wb in writers.items():
+            wb.remote_write(0, "%10d" % i)
+            wb.remote_close()
+        # only the first share that closed made the server list the bucket
+        self.failUnlessEqual(listed, ["si1"])
+        counts = self.get_counts(ss)
+        self.failUnlessEqual(counts["total_bucket_count"], 1)
+        self.failUnlessEqual(counts["total_share_count.immutable"], 5)
+
+        # removing every share empties the bucket, without listing it again
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir("si1"))
+        for shnum in range(5):
+            os.unlink(os.path.join(bucketdir, "%d" % shnum))
+            ss.share_removed("si1", shnum, "immutable", 10)
+        self.failUnlessEqual(listed, ["si1"])
+        self.failUnlessEqual(self.get_counts(ss)["total_bucket_count"], 0)
+
+        self.allocate(ss, "si1", [0], 10)
+        counts = self.get_counts(ss)
+        self.failUnlessEqual(counts["total_bucket_count"], 1)
+        self.failUnlessEqual(counts["total_share_count.immutable"], 1)
+
+    def test_reconcile(self):
+        basedir = "storage/BucketCounter/reconcile"
+        fileutil.make_dirs(basedir)
+        ss1 = StorageServer(basedir, "\x00" * 20)
+        self.allocate(ss1, "si1", [0,1], 10)
+        self.write_mutable(ss1, "si2", [0], "a"*100)
+        expected = self.get_counts(ss1)
+        # a share which is removed behind the server's back is not counted
+        # until the crawler finds out
+        os.unlink(os.path.join(ss1.sharedir, storage_index_to_dir("si1"), "1"))
+        self.failUnlessEqual(self.get_counts(ss1), expected)
+
+        # a server which was never stopped cleanly, and has shares on disk,
+        # does not know its counts until the crawler has run
+        self.failIf(os.path.exists(os.path.join(basedir,
+                                                "share_counts.pickle")))
+        ss = StorageServer(basedir, "\x00" * 20)
+        self.failUnlessEqual(ss.share_counter.get_counts(), None)
+        self.failIf("storage_server.total_bucket_count" in ss.get_stats())
+        w = StorageStatus(ss)
+        self.failUnlessIn("Total buckets: Not computed yet",
+                          remove_tags(w.renderSynchronously()))
+
+        ss.bucket_counter.slow_start = 0
+        ss.setServiceParent(self.s)
+        d = self.poll(lambda: ss.share_counter.exact)
+        def _check(ign):
+            expected.update({"total_share_count.immutable": 1,
+                             "total_share_bytes.immutable": 10})
+            self.failUnlessEqual(self.get_counts(ss), expected)
+            self.failUnlessEqual(
+                ss.get_stats()["storage_server.share_counts_exact"], 1)
+        d.addCallback(_check)
+        return d
+
+class ShareIndex(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, share_index_enabled=True):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           share_index_enabled=share_index_enabled)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        renew_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        cancel_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      renew_secret,
+                                                      cancel_secret,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for i,wb in writers.items():
+            wb.remote_write(0, "%*d" % (size, i))
+            wb.remote_close()
+        return already, writers
+
+    def write_mutable(self, ss, storage_index, sharenums, data):
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "1"),
+                   hashutil.tagged_hash("cancel_blah", "1"))
+        if data:
+            datav = [(0, data)]
+            new_length = None
+        else:
+            datav = []
+            new_length = 0
+        tw = dict([(shnum, ([], datav, new_length)) for shnum in sharenums])
+        rc = ss.remote_slot_testv_and_readv_and_writev(storage_index, secrets,
+                                                       tw, [])
+        self.failUnless(rc[0])
+
+    def _wait_for_index(self, ss):
+        return self.poll(lambda: ss.share_index.complete)
+
+    def test_disabled(self):
+        ss = self.create("storage/ShareIndex/disabled",
+                         share_index_enabled=False)
+        self.failUnlessEqual(ss.share_index, None)
+        self.allocate(ss, "si1", [0,1], 10)
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                             set([0,1]))
+
+    def test_immutable(self):
+        ss = self.create("storage/ShareIndex/immutable")
+        d = self._wait_for_index(ss)
+        def _indexed(ign):
+            self.failUnlessEqual(ss.share_index.get_shares("si1"), {})
+            self.allocate(ss, "si1", [0,1,2], 25)
+            shares = ss.share_index.get_shares("si1")
+            self.failUnlessEqual(sorted(shares.keys()), [0,1,2])
+            (sharetype, size, filename) = shares[1]
+            self.failUnlessEqual(sharetype, "immutable")
+            self.failUnlessEqual(size, os.path.getsize(filename))
+
+            # aborted writes are not indexed
+            already, writers = ss.remote_allocate_buckets("si2", "r"*32,
+                                                          "c"*32, [0], 10,
+                                                          FakeCanary())
+            writers[0].remote_abort()
+            self.failUnlessEqual(ss.share_index.get_shares("si2"), {})
+
+            # lookups and lease operations use the index, not the disk
+            def _no_listdir(*args):
+                raise AssertionError("should not list the bucket directory")
+            self.patch(os, "listdir", _no_listdir)
+            b = ss.remote_get_buckets("si1")
+            self.failUnlessEqual(set(b.keys()), set([0,1,2]))
+            self.failUnlessEqual(b[2].remote_read(0, 25), "%25d" % 2)
+            self.failUnlessEqual(ss.remote_get_buckets("unknown"), {})
+            ss.remote_add_lease("si1", "r2"*16, "c2"*16)
+            self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+            already, writers = self.allocate(ss, "si1", [2,3], 25)
+            self.failUnlessEqual(already, set([0,1,2]))
+            self.failUnlessEqual(set(writers.keys()), set([3]))
+        d.addCallback(_indexed)
+        return d
+
+    def test_mutable(self):
+        ss = self.create("storage/ShareIndex/mutable")
+        d = self._wait_for_index(ss)
+        def _indexed(ign):
+            self.write_mutable(ss, "si1", [0,1], "data"*10)
+            shares = ss.share_index.get_shares("si1")
+            self.failUnlessEqual(sorted(shares.keys()), [0,1])
+            (sharetype, size, filename) = shares[0]
+            self.failUnlessEqual(sharetype, "mutable")
+            self.failUnlessEqual(size, os.path.getsize(filename))
+
+            self.write_mutable(ss, "si1", [0], "data"*1000)
+            (sharetype, size, filename) = ss.share_index.get_shares("si1")[0]
+            self.failUnlessEqual(size, os.path.getsize(filename))
+
+            self.failUnlessEqual(ss.remote_slot_readv("si1", [], [(0,4)]),
+                                 {0: ["data"], 1: ["data"]})
+            self.write_mutable(ss, "si1", [0], None)
+            self.failUnlessEqual(ss.share_index.get_shares("si1").keys(), [1])
+            self.failUnlessEqual(ss.remote_slot_readv("si1", [], [(0,4)]),
+                                 {1: ["data"]})
+        d.addCallback(_indexed)
+        return d
+
+    def test_crawler_builds_index(self):
+        basedir = "storage/ShareIndex/crawler_builds_index"
+        ss = self.create(basedir, share_index_enabled=False)
+        self.allocate(ss, "si1", [0,1], 10)
+        self.allocate(ss, "si2", [5], 10)
+        self.write_mutable(ss, "si3", [2], "data")
+        d = defer.succeed(None)
+        d.addCallback(lambda ign: ss.disownServiceParent())
+        def _restart(ign):
+            self.ss = ss = self.create(basedir)
+            # before the crawler has finished, unknown buckets are examined
+            # on demand
+            self.failIf(ss.share_index.complete)
+            self.failUnlessEqual(sorted(ss.share_index.get_shares("si1")),
+                                 [0,1])
+            return self._wait_for_index(ss)
+        d.addCallback(_restart)
+        def _check(ign):
+            index = self.ss.share_index
+            self.failUnlessEqual(sorted(index.get_shares("si1")), [0,1])
+            self.failUnlessEqual(sorted(index.get_shares("si2")), [5])
+            self.failUnlessEqual(index.get_shares("si3")[2][0], "mutable")
+            self.failUnlessEqual(index.get_shares("si4"), {})
+            # the crawler forgets buckets which vanish from the disk
+            fileutil.rm_dir(os.path.join(self.ss.sharedir,
+                                         storage_index_to_dir("si2")))
+            crawler = self.ss.share_index_crawler
+            prefix = si_b2a("si2")[:2]
+            crawler.process_prefixdir(0, prefix,
+                                      os.path.join(self.ss.sharedir, prefix),
+                                      [], time.time())
+            self.failUnlessEqual(index.get_shares("si2"), {})
+        d.addCallback(_check)
+        return d
+
+    def test_persistence(self):
+        basedir = "storage/ShareIndex/persistence"
+        ss = self.create(basedir)
+        indexfile = os.path.join(basedir, "share_index.pickle")
+        d = self._wait_for_index(ss)
+        def _indexed(ign):
+            self.allocate(ss, "si1", [0], 10)
+            return ss.disownServiceParent()
+        d.addCallback(_indexed)
+        def _restart(ign):
+            self.failUnless(os.path.exists(indexfile))
+            ss = self.create(basedir)
+            # a loaded index is authoritative immediately, and the saved
+            # copy is removed so a crash will force a rebuild
+            self.failIf(os.path.exists(indexfile))
+            self.failUnless(ss.share_index.complete)
+            self.failUnlessEqual(sorted(ss.share_index.get_shares("si1")), [0])
+        d.addCallback(_restart)
+        return d
+
+class FileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, open_file_cache_size=10):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           open_file_cache_size=open_file_cache_size)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        renew_secret = hashutil.tagged_hash("blah", "%s-renew" % storage_index)
+        cancel_secret = hashutil.tagged_hash("blah", "%s-cancel" % storage_index)
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      renew_secret,
+                                                      cancel_secret,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for i,wb in writers.items():
+            wb.remote_write(0, "%*d" % (size, i))
+            wb.remote_close()
+
+    def test_lru(self):
+        basedir = "storage/FileCache/lru"
+        fileutil.make_dirs(basedir)
+        fns = []
+        for name in "abc":
+            fn = os.path.join(basedir, name)
+            fileutil.write(fn, name*10)
+            fns.append(fn)
+        (a, b, c) = fns
+        fc = FileHandleCache(2)
+        fa = fc.open(a)
+        self.failUnlessIdentical(fc.open(a), fa)
+        fc.open(b)
+        fc.open(a)
+        fc.open(c) # b is the least recently used
+        fc.set_metadata(a, "meta")
+        self.failUnlessEqual(fc.get_metadata(a), "meta")
+        self.failUnlessEqual(fc.get_metadata(b), None)
+        stats = fc.get_stats()
+        self.failUnlessEqual((stats["hits"], stats["misses"],
+                              stats["evictions"], stats["open_files"]),
+                             (2, 3, 1, 2))
+        self.failUnlessEqual(stats["hit_rate"], 2.0/5)
+
+        fc.invalidate(a)
+        self.failUnlessEqual(fc.get_stats()["invalidations"], 1)
+        self.failUnlessEqual(fc.get_metadata(a), None)
+        fc.close_all()
+        self.failUnlessEqual(fc.get_stats()["open_files"], 0)
+
+    def test_notices_outside_changes(self):
+        basedir = "storage/FileCache/outside_changes"
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "share")
+        fileutil.write(fn, "old data")
+        fc = FileHandleCache(10)
+        f = fc.open(fn)
+        fc.set_metadata(fn, "meta")
+
+        # a file that is replaced is reopened, and its metadata forgotten
+        fileutil.write(fn + ".tmp", "new data, longer")
+        fileutil.move_into_place(fn + ".tmp", fn)
+        f2 = fc.open(fn)
+        self.failIfIdentical(f2, f)
+        f2.seek(0)
+        self.failUnlessEqual(f2.read(), "new data, longer")
+        self.failUnlessEqual(fc.get_metadata(fn), None)
+
+        # a file that is deleted is not readable any more
+        os.unlink(fn)
+        self.failUnlessRaises(IOError, fc.open, fn)
+        self.failUnlessEqual(fc.get_stats()["open_files"], 0)
+
+    def test_appended(self):
+        basedir = "storage/FileCache/appended"
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "pack")
+        fileutil.write(fn, "old data")
+        fc = FileHandleCache(10)
+        f = fc.open(fn)
+        self.failUnlessEqual(fc.get_mmap(fn)[:], "old data")
+        fc.release(f)
+
+        # an append keeps the handle, which can read the new data too, but
+        # the mapping of the old length is dropped
+        fileutil.write(fn, ", new data", mode="ab")
+        fc.appended(fn)
+        f2 = fc.open(fn)
+        self.failUnlessIdentical(f2, f)
+        f2.seek(0)
+        self.failUnlessEqual(f2.read(), "old data, new data")
+        self.failUnlessEqual(fc.get_mmap(fn)[:], "old data, new data")
+        stats = fc.get_stats()
+        self.failUnlessEqual((stats["misses"], stats["invalidations"]), (1, 0))
+
+        # a mapping that is in use while the file grows is not closed under
+        # its reader: the handle is forgotten instead
+        fileutil.write(fn, "!", mode="ab")
+        fc.appended(fn)
+        self.failUnlessEqual(fc.get_stats()["invalidations"], 1)
+        self.failIf(f2.closed)
+        fc.release(f2)
+        self.failUnless(f2.closed)
+        fc.appended(fn) # not cached: nothing to do
+
+    def test_threads(self):
+        basedir = "storage/FileCache/threads"
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "share")
+        fileutil.write(fn, "data")
+        fc = FileHandleCache(10)
+        f = fc.open(fn)
+        fc.set_metadata(fn, "meta")
+        results = []
+        def _other_thread():
+            f2 = fc.open(fn)
+            f2.seek(0)
+            results.append((f2 is f, f2.read(), fc.get_metadata(fn)))
+            fc.release(f2)
+            results.append(f2.closed)
+        t = threading.Thread(target=_other_thread)
+        t.start()
+        t.join()
+        # another thread gets its own handle, and none of our metadata
+        self.failUnlessEqual(results, [(False, "data", None), True])
+        self.failUnlessEqual(fc.get_stats()["private_opens"], 1)
+        self.failUnlessEqual(fc.get_metadata(fn), "meta")
+
+        # a handle that is invalidated while in use stays open until the
+        # last user releases it
+        self.failUnlessIdentical(fc.open(fn), f)
+        fc.invalidate(fn)
+        f.seek(0)
+        self.failUnlessEqual(f.read(), "data")
+        fc.release(f)
+        self.failIf(f.closed)
+        fc.release(f)
+        self.failUnless(f.closed)
+        self.failUnlessEqual(fc.get_stats()["open_files"], 0)
+
+    def test_immutable(self):
+        ss = self.create("storage/FileCache/immutable")
+        self.allocate(ss, "si1", [0], 25)
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(readers[0].remote_read(0, 25), "%25d" % 0)
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(readers[0].remote_read(0, 25), "%25d" % 0)
+        self.failUnlessEqual(readers[0].remote_readv([(0, 5), (20, 5)]),
+                             [" "*5, "    0"])
+        stats = ss.filecache.get_stats()
+        # only the first BucketReader had to open the file
+        self.failUnlessEqual(stats["misses"], 1)
+        self.failUnlessEqual(stats["hits"], 4)
+
+        # lease changes close the file
+        ss.remote_add_lease("si1", hashutil.tagged_hash("blah", "r2"),
+                            hashutil.tagged_hash("blah", "c2"))
+        self.failUnlessEqual(ss.filecache.get_stats()["invalidations"], 1)
+        self.failUnlessEqual(readers[0].remote_read(0, 25), "%25d" % 0)
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.open_file_cache.misses"], 2)
+        self.failUnlessIn("storage_server.open_file_cache.hit_rate", stats)
+
+    def test_mmap_reads(self):
+        ss = self.create("storage/FileCache/mmap_reads")
+        size = ShareFile.MMAP_READ_THRESHOLD * 2
+        self.allocate(ss, "si1", [0], size)
+        reader = ss.remote_get_buckets("si1")[0]
+        self.failUnlessEqual(reader.remote_read(0, size), "%*d" % (size, 0))
+        self.failUnlessEqual(ss.filecache.get_stats()["mmap_reads"], 1)
+        # reads past the end are truncated, just like read()
+        self.failUnlessEqual(reader.remote_read(size-10, size), "%10d" % 0)
+        # small reads do not use the mapping
+        self.failUnlessEqual(reader.remote_read(size-1, 1), "0")
+        self.failUnlessEqual(ss.filecache.get_stats()["mmap_reads"], 1)
+
+        # the mapping is discarded along with the handle
+        ss.remote_add_lease("si1", hashutil.tagged_hash("blah", "r2"),
+                            hashutil.tagged_hash("blah", "c2"))
+        self.failUnlessEqual(reader.remote_read(0, size), "%*d" % (size, 0))
+        self.failUnlessEqual(ss.filecache.get_stats()["mmap_reads"], 2)
+
+    def test_mutable(self):
+        ss = self.create("storage/FileCache/mutable")
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "1"),
+                   hashutil.tagged_hash("cancel_blah", "1"))
+        def write(data):
+            tw = {0: ([], [(0, data)], None)}
+            rc = ss.remote_slot_testv_and_readv_and_writev("si1", secrets,
+                                                           tw, [])
+            self.failUnless(rc[0])
+        write("a"*20)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 5)]),
+                             {0: ["a"*5]})
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 5)]),
+                             {0: ["a"*5]})
+        self.failUnless(ss.filecache.get_stats()["hits"] > 0)
+        write("b"*20)
+        self.failUnless(ss.filecache.get_stats()["invalidations"] > 0)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 5)]),
+                             {0: ["b"*5]})
+
+    def test_disabled(self):
+        ss = self.create("storage/FileCache/disabled", open_file_cache_size=0)
+        self.failUnlessEqual(ss.filecache, None)
+        self.allocate(ss, "si1", [0], 25)
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(readers[0].remote_read(0, 25), "%25d" % 0)
+        stats = ss.get_stats()
+        self.failIfIn("storage_server.open_file_cache.hits", stats)
+
+class DiskIO(unittest.TestCase):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, disk_io_threads=2, share_index_enabled=False):
+        fileutil.make_dirs(basedir)
+        # without write buffers, so that every write goes to the pool
+        ss = StorageServer(basedir, "\x00" * 20,
+                           disk_io_threads=disk_io_threads,
+                           write_buffer_size=0,
+                           share_index_enabled=share_index_enabled)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def test_immutable(self):
+        ss = self.create("storage/DiskIO/immutable")
+        already, writers = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "r1"),
+            hashutil.tagged_hash("blah", "c1"), [0, 1], 25, FakeCanary())
+        # the client closes without waiting for its writes
+        dl = []
+        for i,wb in writers.items():
+            d1 = wb.remote_write(0, "%10d" % i)
+            d2 = wb.remote_write(10, "%15d" % i)
+            d3 = wb.remote_close()
+            dl.extend([d1, d2, d3])
+            self.failIf(wb.closed)
+        d = defer.DeferredList(dl, fireOnOneErrback=True)
+        def _closed(ign):
+            for wb in writers.values():
+                self.failUnless(wb.closed)
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            self.failUnlessEqual(ss.latencies["close"].get_count(), 2)
+            return ss.remote_get_buckets("si1")
+        d.addCallback(_closed)
+        def _got_readers(readers):
+            self.failUnlessEqual(sorted(readers), [0, 1])
+            self.readers = readers
+            return readers[1].remote_read(0, 25)
+        d.addCallback(_got_readers)
+        d.addCallback(lambda data:
+                      self.failUnlessEqual(data, "%10d%15d" % (1, 1)))
+        d.addCallback(lambda ign:
+                      self.readers[0].remote_readv([(0, 5), (20, 5)]))
+        d.addCallback(lambda datav:
+                      self.failUnlessEqual(datav, [" "*5, "    0"]))
+        d.addCallback(lambda ign: ss.remote_get_buckets_batch(["si1", "si2"]))
+        def _got_batch(results):
+            self.failUnlessEqual(results.keys(), ["si1"])
+            self.failUnlessEqual(sorted(results["si1"]), [0, 1])
+            # every job recorded how long it waited, and how deep the
+            # queue was when it was submitted
+            jobs = ss.latencies["disk-queue-wait"].get_count()
+            # 4 writes, 2 closes, a get, 2 reads and a batch get
+            self.failUnlessEqual(jobs, 10)
+            self.failUnlessEqual(ss.latencies["disk-queue-depth"].get_count(), jobs)
+            self.failUnless(ss.latencies["disk-queue-depth"].get_max() > 0)
+            self.failUnlessEqual(ss.diskio.outstanding, 0)
+        d.addCallback(_got_batch)
+        return d
+
+    def test_share_index_miss(self):
+        ss = self.create("storage/DiskIO/share_index_miss",
+                         share_index_enabled=True)
+        already, writers = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "r1"),
+            hashutil.tagged_hash("blah", "c1"), [0], 25, FakeCanary())
+        d = writers[0].remote_write(0, "a"*25)
+        d.addCallback(lambda ign: writers[0].remote_close())
+        def _closed(ign):
+            jobs = ss.latencies["disk-queue-wait"].get_count()
+            submitted = []
+            run = ss.diskio.run
+            def _run(f, *args, **kwargs):
+                submitted.append(args)
+                return run(f, *args, **kwargs)
+            ss.diskio.run = _run
+            # a storage index the server has no shares for is answered
+            # without waiting for the pool
+            self.failUnlessEqual(ss.remote_get_buckets("si2"), {})
+            self.failUnlessEqual(ss.remote_get_buckets_batch(["si2", "si3"]),
+                                 {})
+            self.failUnlessEqual(submitted, [])
+            self.failUnlessEqual(ss.latencies["disk-queue-wait"].get_count(),
+                                 jobs)
+            # only the storage index with shares goes to the pool
+            d2 = ss.remote_get_buckets_batch(["si2", "si1", "si3"])
+            def _got_batch(results):
+                self.failUnlessEqual(results.keys(), ["si1"])
+                self.failUnlessEqual(sorted(results["si1"]), [0])
+                self.failUnlessEqual(len(submitted), 1)
+                self.failUnlessEqual(submitted[0][0], ["si1"])
+            d2.addCallback(_got_batch)
+            return d2
+        d.addCallback(_closed)
+        return d
+
+    def test_abort(self):
+        ss = self.create("storage/DiskIO/abort")
+        canary = FakeCanary()
+        already, writers = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "r1"),
+            hashutil.tagged_hash("blah", "c1"), [0], 25, canary)
+        wb = writers[0]
+        d = wb.remote_write(0, "a"*25)
+        # the abort waits for the write to land, then removes the share
+        wb.remote_abort()
+        self.failIf(wb.closed)
+        def _check(ign):
+            self.failUnless(wb.closed)
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            bucketdir = os.path.dirname(wb.incominghome)
+            self.failIf(os.path.exists(bucketdir), bucketdir)
+        d.addCallback(fireEventually)
+        d.addCallback(_check)
+        return d
+
+    def test_abort_during_close(self):
+        ss = self.create("storage/DiskIO/abort_during_close")
+        canary = FakeCanary()
+        already, writers = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "r1"),
+            hashutil.tagged_hash("blah", "c1"), [0], 25, canary)
+        wb = writers[0]
+        wb.remote_write(0, "a"*25)
+        d = wb.remote_close()
+        # the close is already under way in the pool, so the abort (or a
+        # disconnect) is ignored, and the share is kept
+        wb.remote_abort()
+        wb._disconnected()
+        self.failUnlessRaises(AssertionError, wb.remote_close)
+        closed = []
+        orig_closed = ss.bucket_writer_closed
+        def _bucket_writer_closed(bw, consumed_size):
+            closed.append(consumed_size)
+            return orig_closed(bw, consumed_size)
+        ss.bucket_writer_closed = _bucket_writer_closed
+        def _check(ign):
+            self.failUnless(wb.closed)
+            self.failUnlessEqual(closed, [os.path.getsize(wb.finalhome)])
+            self.failUnlessEqual(ss._active_writers, {})
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            self.failUnless(os.path.exists(wb.finalhome))
+            return ss.remote_get_buckets("si1")
+        d.addCallback(fireEventually)
+        d.addCallback(_check)
+        d.addCallback(lambda readers: readers[0].remote_read(0, 25))
+        d.addCallback(lambda data: self.failUnlessEqual(data, "a"*25))
+        return d
+
+    def test_mutable(self):
+        ss = self.create("storage/DiskIO/mutable")
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "1"),
+                   hashutil.tagged_hash("cancel_blah", "1"))
+        def write(data):
+            tw = {0: ([], [(0, data)], None)}
+            return ss.remote_slot_testv_and_readv_and_writev("si1", secrets,
+                                                             tw, [])
+        def read():
+            return ss.remote_slot_readv("si1", [0], [(0, 5)])
+        # reads and writes of a slot are done in the order they arrive
+        dl = [write("a"*20), read(), write("b"*20), read(), read()]
+        d = defer.gatherResults(dl)
+        def _check(res):
+            (w1, r1, w2, r2, r3) = res
+            self.failUnless(w1[0])
+            self.failUnless(w2[0])
+            self.failUnlessEqual(r1, {0: ["a"*5]})
+            self.failUnlessEqual(r2, {0: ["b"*5]})
+            self.failUnlessEqual(r3, {0: ["b"*5]})
+            # the locks go away when they are no longer used
+            self.failUnlessEqual(ss._slot_locks._locks, {})
+        d.addCallback(_check)
+        return d
+
+    def test_mutable_batch(self):
+        ss = self.create("storage/DiskIO/mutable_batch")
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "1"),
+                   hashutil.tagged_hash("cancel_blah", "1"))
+        bad_secrets = ("bad write enabler", secrets[1], secrets[2])
+        def request(si, data, secrets=secrets):
+            return (si, secrets, {0: ([], [(0, data)], None)}, [(0, 5)])
+        d1 = ss.remote_slot_readv("si1", [0], [(0, 5)])
+        d2 = ss.remote_slot_testv_and_readv_and_writev_batch(
+            [request("si1", "a"*20), request("si2", "b"*20),
+             request("si1", "c"*20, bad_secrets), request("si1", "d"*20)])
+        d3 = ss.remote_slot_readv("si1", [0], [(0, 5)])
+        d = defer.gatherResults([d1, d2, d3])
+        def _check(res):
+            (r1, results, r2) = res
+            self.failUnlessEqual(r1, {})
+            self.failUnlessEqual(results[0], (True, {}, None))
+            self.failUnlessEqual(results[1], (True, {}, None))
+            self.failUnless(results[2][2].startswith("BadWriteEnablerError"),
+                            results[2])
+            self.failUnlessEqual(results[3], (True, {0: ["a"*5]}, None))
+            self.failUnlessEqual(r2, {0: ["d"*5]})
+            self.failUnlessEqual(ss._slot_locks._locks, {})
+        d.addCallback(_check)
+        return d
+
+    def test_disabled(self):
+        ss = self.create("storage/DiskIO/disabled", disk_io_threads=0)
+        self.failUnlessEqual(ss.diskio, None)
+        already, writers = ss.remote_allocate_buckets(
+            "si1", hashutil.tagged_hash("blah", "r1"),
+            hashutil.tagged_hash("blah", "c1"), [0], 25, FakeCanary())
+        self.failUnlessEqual(writers[0].remote_write(0, "a"*25), None)
+        writers[0].remote_close()
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(readers[0].remote_read(0, 25), "a"*25)
+        self.failIfIn("disk-queue-wait",
+                      [k for k in ss.latencies if ss.latencies[k].get_count()])
+
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = {}
+    def add_latency(self, category, latency):
+        self.latencies.setdefault(category, []).append(latency)
+
+class RequestScheduling(unittest.TestCase):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def fill(self, scheduler):
+        # a request that holds the only slot until we fire 'blocker'
+        self.blocker = defer.Deferred()
+        self.order = []
+        res = scheduler.run("busy", "write", lambda: self.blocker)
+        self.failUnlessIdentical(res, self.blocker)
+        self.failUnlessEqual(scheduler.outstanding, 1)
+
+    def request(self, scheduler, client, category, name):
+        def _run():
+            self.order.append(name)
+            return name
+        return scheduler.run(client, category, _run)
+
+    def test_immediate(self):
+        scheduler = RequestScheduler(LatencyRecorder(), max_outstanding=0)
+        self.order = []
+        # without a limit, requests run at once, and return their results
+        self.failUnlessEqual(self.request(scheduler, "a", "read", "r1"), "r1")
+        d = defer.Deferred()
+        self.failUnlessIdentical(scheduler.run("a", "write", lambda: d), d)
+        self.failUnlessEqual(self.request(scheduler, "b", "read", "r2"), "r2")
+        self.failUnlessEqual(scheduler.get_stats()["outstanding"], 1)
+        self.failUnlessEqual(scheduler.get_client_stats(),
+                             {"a": {"outstanding": 1, "queued": 0,
+                                    "completed": 1, "rejected": 0},
+                              "b": {"outstanding": 0, "queued": 0,
+                                    "completed": 1, "rejected": 0}})
+        d.callback(None)
+        self.failUnlessEqual(scheduler.get_stats()["outstanding"], 0)
+        # exceptions reach the caller, too
+        def _fail():
+            raise ValueError("oops")
+        self.failUnlessRaises(ValueError, scheduler.run, "a", "read", _fail)
+        self.failUnlessEqual(scheduler.get_client_stats()["a"]["completed"], 3)
+
+    def test_fair_between_clients(self):
+        recorder = LatencyRecorder()
+        scheduler = RequestScheduler(recorder, max_outstanding=1)
+        self.fill(scheduler)
+        # the greedy client asked first, but the other one still gets
+        # every other turn
+        dl = [self.request(scheduler, "greedy", "read", "g%d" % i)
+              for i in range(5)]
+        dl += [self.request(scheduler, "modest", "read", "m%d" % i)
+               for i in range(2)]
+        s = scheduler.get_stats()
+        self.failUnlessEqual((s["outstanding"], s["queued"],
+                              s["active_clients"]), (1, 7, 3))
+        self.failUnlessEqual(self.order, [])
+        self.blocker.callback(None)
+        self.failUnlessEqual(self.order,
+                             ["g0", "m0", "g1", "m1", "g2", "g3", "g4"])
+        self.failUnlessEqual(len(recorder.latencies["request-queue-wait"]), 7)
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda res: self.failUnlessEqual(res[-1], "m1"))
+        return d
+
+    def test_weights(self):
+        scheduler = RequestScheduler(LatencyRecorder(), max_outstanding=1,
+                                     weights={"lease": 1, "read": 4})
+        self.fill(scheduler)
+        for i in range(4):
+            self.request(scheduler, "a", "lease", "l%d" % i)
+            self.request(scheduler, "a", "read", "r%d" % i)
+        self.blocker.callback(None)
+        # leases get a quarter of the turns that reads get, and each kind
+        # runs in the order it arrived
+        self.failUnlessEqual(self.order,
+                             ["l0", "r0", "r1", "r2", "r3", "l1", "l2", "l3"])
+
+    def test_deferred_results(self):
+        scheduler = RequestScheduler(LatencyRecorder(), max_outstanding=1)
+        self.fill(scheduler)
+        later = defer.Deferred()
+        d1 = scheduler.run("a", "read", lambda: later)
+        d2 = self.request(scheduler, "a", "read", "r1")
+        self.blocker.callback(None)
+        # the second request waits for the first one's Deferred
+        self.failUnlessEqual(self.order, [])
+        self.failUnlessEqual(scheduler.queued, 1)
+        later.callback("done")
+        self.failUnlessEqual(self.order, ["r1"])
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(lambda res: self.failUnlessEqual(res, ["done", "r1"]))
+        return d
+
+    def test_admission_control(self):
+        scheduler = RequestScheduler(LatencyRecorder(), max_outstanding=1,
+                                     max_queued_per_client=2)
+        self.fill(scheduler)
+        self.request(scheduler, "a", "read", "r0")
+        self.request(scheduler, "a", "write", "w0")
+        e = self.failUnlessRaises(ServerBusyError,
+                                  self.request, scheduler, "a", "read", "r1")
+        self.failUnlessIn("has 2 requests waiting", str(e))
+        # other clients are still welcome
+        self.request(scheduler, "b", "read", "r2")
+        self.failUnlessEqual(scheduler.get_stats()["rejected"], 1)
+        self.failUnlessEqual(scheduler.get_client_stats()["a"]["rejected"], 1)
+        self.blocker.callback(None)
+        self.failUnlessEqual(sorted(self.order), ["r0", "r2", "w0"])
+
+    def test_parse_weights(self):
+        self.failUnlessEqual(parse_weights(""),
+                             {"read": 4, "write": 2, "lease": 1})
+        self.failUnlessEqual(parse_weights("write=5, read = 1"),
+                             {"read": 1, "write": 5, "lease": 1})
+        self.failUnlessRaises(ValueError, parse_weights, "read")
+        self.failUnlessRaises(ValueError, parse_weights, "read=0")
+        self.failUnlessRaises(ValueError, parse_weights, "renew=2")
+
+    def test_server(self):
+        basedir = "storage/RequestScheduling/server"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, max_outstanding_requests=4)
+        ss.setServiceParent(self.s)
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get("client-facets"), sv1)
+
+        canary = FakeCanary()
+        canary.tubid = "clienttubid"
+        facet = ss.remote_get_client_facet(canary)
+        already, writers = facet.doRemoteCall(
+            "allocate_buckets",
+            ("si1", hashutil.tagged_hash("blah", "r1"),
+             hashutil.tagged_hash("blah", "c1"), [0], 10, canary), {})
+        # the requests to the buckets are charged to the same client
+        self.failUnlessEqual(writers[0].client, "clienttubid")
+        writers[0].doRemoteCall("write", (0, "a"*10), {})
+        writers[0].doRemoteCall("close", (), {})
+        readers = facet.doRemoteCall("get_buckets", ("si1",), {})
+        self.failUnlessEqual(readers[0].client, "clienttubid")
+        self.failUnlessEqual(readers[0].doRemoteCall("read", (0, 10), {}),
+                             "a"*10)
+        batch = facet.doRemoteCall("get_buckets_batch", (["si1"],), {})
+        self.failUnlessEqual(batch["si1"][0].client, "clienttubid")
+        # requests to the server itself are anonymous
+        readers = ss.doRemoteCall("get_buckets", ("si1",), {})
+        self.failUnlessEqual(readers[0].client, ANONYMOUS)
+        # and so is everything from a client that we cannot identify
+        facet2 = ss.remote_get_client_facet(FakeCanary())
+        facet2.doRemoteCall("get_version", (), {})
+        facet2.doRemoteCall("get_buckets", ("si2",), {})
+
+        clients = ss.scheduler.get_client_stats()
+        self.failUnlessEqual(sorted(clients), [ANONYMOUS, "clienttubid"])
+        # allocate, write, close, get, read, get-batch
+        self.failUnlessEqual(clients["clienttubid"]["completed"], 6)
+        self.failUnlessEqual(clients[ANONYMOUS]["completed"], 2)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.scheduler.max_outstanding"],
+                             4)
+        self.failUnlessEqual(stats["storage_server.scheduler.dispatched"], 8)
+        self.failUnlessEqual(stats["storage_server.scheduler.rejected"], 0)
+
+        w = StorageStatus(ss)
+        html = w.renderSynchronously()
+        s = remove_tags(html)
+        self.failUnlessIn("Request Scheduler", s)
+        self.failUnlessIn("Requests: 0 running, 0 waiting, 8 started,"
+                          " 0 refused (at most 4 requests run at once", s)
+        self.failUnlessIn("clienttubid", s)
+
+
+class WriteBuffers(unittest.TestCase):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, **kwargs):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, hashutil.tagged_hash("blah", "r-"+storage_index),
+            hashutil.tagged_hash("blah", "c-"+storage_index),
+            sharenums, size, FakeCanary())
+        return writers
+
+    def read_incoming(self, wb, offset, length):
+        return ShareFile(wb.incominghome).read_share_data(offset, length)
+
+    def test_coalesce(self):
+        ss = self.create("storage/WriteBuffers/coalesce",
+                         write_buffer_size=100)
+        wb = self.allocate(ss, "si1", [0], 250)[0]
+        for i in range(4):
+            wb.remote_write(i*25, "%25d" % i)
+        # the fourth block filled the buffer, so all four went out at once
+        self.failUnlessEqual(self.read_incoming(wb, 75, 25), "%25d" % 3)
+        stats = ss.write_buffers.get_stats()
+        self.failUnlessEqual((stats["buffered_writes"], stats["coalesced_writes"],
+                              stats["flushes"], stats["buffered"]),
+                             (4, 3, 1, 0))
+        wb.remote_write(100, "%25d" % 4)
+        self.failUnlessEqual(self.read_incoming(wb, 100, 25), "\x00"*25)
+        # blocks that do not follow each other are kept apart, and written
+        # in the order they arrived
+        wb.remote_write(200, "%50d" % 8)
+        wb.remote_write(200, "%25d" % 9)
+        self.failUnlessEqual(ss.write_buffers.flushes, 2)
+        wb.remote_write(125, "%75d" % 5)
+        self.failUnlessEqual(ss.write_buffers.buffered, 75)
+        wb.remote_close()
+        self.failUnlessEqual(ss.write_buffers.buffered, 0)
+        self.failUnlessEqual(ss.write_buffers.flushes, 3)
+
+        reader = ss.remote_get_buckets("si1")[0]
+        self.failUnlessEqual(reader.remote_read(0, 250),
+                             "".join(["%25d" % i for i in range(5)])
+                             + "%75d" % 5 + "%25d" % 9 + ("%50d" % 8)[25:])
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.write_buffer.flushes"], 3)
+
+    def test_total_limit(self):
+        ss = self.create("storage/WriteBuffers/total_limit",
+                         write_buffer_size=40, write_buffer_total=60)
+        writers = self.allocate(ss, "si1", [0, 1], 100)
+        writers[0].remote_write(0, "a"*30)
+        self.failUnlessEqual(ss.write_buffers.flushes, 0)
+        # the second writer takes the total over the limit
+        writers[1].remote_write(0, "b"*30)
+        self.failUnlessEqual(ss.write_buffers.flushes, 1)
+        self.failUnlessEqual(ss.write_buffers.buffered, 30)
+        self.failUnlessEqual(self.read_incoming(writers[1], 0, 30), "b"*30)
+        self.failUnlessEqual(self.read_incoming(writers[0], 0, 30),
+                             "\x00"*30)
+
+        # an aborted upload gives its buffer back
+        writers[0].remote_abort()
+        self.failUnlessEqual(ss.write_buffers.buffered, 0)
+        self.failUnlessEqual(ss.allocated_size(), 100)
+
+    def test_too_large(self):
+        ss = self.create("storage/WriteBuffers/too_large")
+        wb = self.allocate(ss, "si1", [0], 100)[0]
+        # the error is reported to the write that caused it, not later
+        self.failUnlessRaises(DataTooLargeError,
+                              wb.remote_write, 90, "a"*20)
+        self.failUnlessEqual(ss.write_buffers.buffered, 0)
+
+    def test_fsync(self):
+        ss = self.create("storage/WriteBuffers/fsync", fsync_shares=True)
+        writers = self.allocate(ss, "si1", [0, 1], 100)
+        fsync = mock.Mock()
+        self.patch(os, "fsync", fsync)
+        for wb in writers.values():
+            for i in range(4):
+                wb.remote_write(i*25, "%25d" % i)
+        self.failIf(fsync.called)
+        for wb in writers.values():
+            wb.remote_close()
+        # once per share, no matter how many writes it took
+        self.failUnlessEqual(fsync.call_count, 2)
+        self.failUnlessEqual(ss.remote_get_buckets("si1")[1].remote_read(0, 25),
+                             "%25d" % 0)
+
+    def test_disk_io_threads(self):
+        ss = self.create("storage/WriteBuffers/disk_io_threads",
+                         write_buffer_size=50, disk_io_threads=2)
+        wb = self.allocate(ss, "si1", [0], 100)[0]
+        self.failUnlessEqual(wb.remote_write(0, "a"*25), None)
+        d1 = wb.remote_write(25, "b"*25)
+        wb.remote_write(50, "c"*25)
+        d2 = wb.remote_close()
+        d = defer.gatherResults([d1, d2])
+        def _check(ign):
+            self.failUnless(wb.closed)
+            # one flush while writing, one when closing
+            self.failUnlessEqual(ss.latencies["disk-queue-wait"].get_count(), 2)
+            return ss.remote_get_buckets("si1")
+        d.addCallback(_check)
+        d.addCallback(lambda readers: readers[0].remote_read(0, 75))
+        d.addCallback(lambda data:
+                      self.failUnlessEqual(data, "a"*25+"b"*25+"c"*25))
+        return d
+
+    def test_disabled(self):
+        ss = self.create("storage/WriteBuffers/disabled", write_buffer_size=0)
+        self.failUnlessEqual(ss.write_buffers, None)
+        wb = self.allocate(ss, "si1", [0], 100)[0]
+        wb.remote_write(0, "a"*25)
+        self.failUnlessEqual(self.read_incoming(wb, 0, 25), "a"*25)
+        self.failIfIn("storage_server.write_buffer.flushes", ss.get_stats())
+
+class PackedShares(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, **kwargs):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, packed_share_max_size=1000,
+                           **kwargs)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def secrets(self, name):
+        return (hashutil.tagged_hash("renew", name),
+                hashutil.tagged_hash("cancel", name))
+
+    def allocate(self, ss, storage_index, lease_name, sharenums, size=100):
+        rs, cs = self.secrets(lease_name)
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for (shnum, wb) in writers.items():
+            wb.remote_write(0, ("%d" % shnum) * size)
+            wb.remote_close()
+        return already, writers
+
+    def test_append_keeps_file_handle(self):
+        basedir = "storage/PackedShares/append_keeps_file_handle"
+        ss = self.create(basedir)
+        self.allocate(ss, "si1", "a", [0])
+        reader = ss.remote_get_buckets("si1")[0]
+        self.failUnlessEqual(reader.remote_read(0, 100), "0"*100)
+        # writing more shares to the same pack does not make the next read
+        # of an older share open the pack again
+        for si in ("si2", "si3"):
+            self.allocate(ss, si, "a", [1])
+            self.failUnlessEqual(reader.remote_read(0, 100), "0"*100)
+        self.failUnlessEqual(ss.remote_get_buckets("si3")[1].remote_read(0, 100),
+                             "1"*100)
+        stats = ss.filecache.get_stats()
+        self.failUnlessEqual((stats["misses"], stats["invalidations"]), (1, 0))
+
+    def test_packed(self):
+        basedir = "storage/PackedShares/packed"
+        ss = self.create(basedir)
+        self.allocate(ss, "si1", "a", [0, 1, 2])
+        self.allocate(ss, "si2", "a", [0], size=2000)
+        si1_dir = os.path.join(basedir, "shares", storage_index_to_dir("si1"))
+        si2_dir = os.path.join(basedir, "shares", storage_index_to_dir("si2"))
+        self.failIf(os.path.exists(si1_dir))
+        self.failUnless(os.path.exists(os.path.join(si2_dir, "0")))
+        self.failIf(os.listdir(os.path.join(basedir, "shares", "incoming")))
+
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(readers), [0, 1, 2])
+        self.failUnlessEqual(readers[1].remote_read(0, 100), "1"*100)
+        self.failUnlessEqual(readers[2].remote_read(90, 20), "2"*10)
+        self.failUnlessEqual(readers[1]._share_file.prefetch([(0, 200)]),
+                             fileutil.have_posix_fadvise)
+        results = ss.remote_get_buckets_batch(["si1", "si2", "si3"])
+        self.failUnlessEqual(sorted(results), ["si1", "si2"])
+        self.failUnlessEqual(results["si1"][0].remote_read(0, 100), "0"*100)
+        self.failUnlessEqual(results["si2"][0].remote_read(0, 10), "0"*10)
+
+        # storage indexes without packed shares do not query the pack index
+        cursor = ss.packs._cursor
+        ss.packs._cursor = None
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si2")), [0])
+        self.failUnlessEqual(ss.remote_get_buckets("si3"), {})
+        self.failUnlessEqual(sorted(ss.remote_get_buckets_batch(["si2",
+                                                                 "si3"])),
+                             ["si2"])
+        ss.packs._cursor = cursor
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packs.packs"], 1)
+        self.failUnlessEqual(stats["storage_server.packs.shares"], 3)
+        self.failUnlessEqual(stats["storage_server.packs.share_bytes"], 300)
+        self.failUnlessEqual(stats["storage_server.packs.pack_bytes"],
+                             3 * (100 + packed.RECORD_HEADER_SIZE))
+        counts = ss.share_counter.get_counts()
+        self.failUnlessEqual((counts["buckets"], counts["shares-immutable"]),
+                             (2, 4))
+
+        # a second upload finds the packed shares, and adds its lease
+        already, writers = self.allocate(ss, "si1", "b", [0, 1, 3])
+        self.failUnlessEqual(already, set([0, 1, 2]))
+        self.failUnlessEqual(sorted(writers), [3])
+        leases = ss.packs.get_leases("si1", 0)
+        self.failUnlessEqual([(l.renew_secret, l.cancel_secret)
+                              for l in leases],
+                             [self.secrets("a"), self.secrets("b")])
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+
+        rs, cs = self.secrets("c")
+        ss.remote_add_lease("si1", rs, cs)
+        self.failUnlessEqual(len(ss.packs.get_leases("si1", 2)), 3)
+        ss.remote_renew_lease("si1", rs)
+        self.failUnlessRaises(IndexError,
+                              ss.remote_renew_lease, "si1", self.secrets("d")[0])
+
+    def test_restart(self):
+        basedir = "storage/PackedShares/restart"
+        ss = self.create(basedir)
+        self.allocate(ss, "si1", "a", [0, 1])
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss2 = self.create(basedir)
+            self.failUnless(ss2.have_shares())
+            self.allocate(ss2, "si2", "a", [0])
+            readers = ss2.remote_get_buckets("si1")
+            self.failUnlessEqual(readers[1].remote_read(0, 100), "1"*100)
+            readers = ss2.remote_get_buckets("si2")
+            self.failUnlessEqual(readers[0].remote_read(0, 100), "0"*100)
+            # new shares go on in the same pack
+            self.failUnlessEqual(ss2.packs.get_stats()["packs"], 1)
+        d.addCallback(_restart)
+        return d
+
+    def test_compact(self):
+        basedir = "storage/PackedShares/compact"
+        ss = self.create(basedir)
+        ss.packs.pack_size = 300
+        for si in ["si1", "si2", "si3", "si4"]:
+            self.allocate(ss, si, "a", [0])
+        # si1, si2 and si3 went into the first pack, si4 into the second
+        self.failUnlessEqual(sorted(ss.packs.get_pack_usage()), [0, 1])
+
+        for si in ["si1", "si3", "si4"]:
+            sf = ss.packs.get_shares(si)[0]
+            freed = sf.cancel_lease(self.secrets("a")[1])
+            self.failUnlessEqual(freed, 100 + packed.RECORD_HEADER_SIZE)
+            ss.share_removed(si, 0, "immutable", 100)
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        reader = ss.remote_get_buckets("si2")[0]
+
+        # the first pack is mostly empty, so si2 is copied out of it. The
+        # second one is the current pack, which is left alone.
+        self.failUnlessEqual(ss.packs.compact(), 1)
+        self.failUnlessEqual(sorted(ss.packs.get_pack_usage()), [0, 1])
+        self.failUnlessEqual(ss.packs.get_shares("si2")[0].home,
+                             os.path.join(basedir, "packs", "pack-00000001"))
+        # a reader from before the compaction can still read
+        self.failUnlessEqual(reader.remote_read(0, 100), "0"*100)
+        self.failUnlessEqual(ss.remote_get_buckets("si2")[0].remote_read(0, 100),
+                             "0"*100)
+        # the empty pack is deleted by the next compaction
+        self.failUnlessEqual(ss.packs.compact(), 0)
+        self.failUnlessEqual(sorted(ss.packs.get_pack_usage()), [1])
+        stats = ss.packs.get_stats()
+        self.failUnlessEqual((stats["shares"], stats["compactions"],
+                              stats["bytes_compacted"]),
+                             (1, 1, 100 + packed.RECORD_HEADER_SIZE))
+
+    def test_cancel_lease(self):
+        ss = self.create("storage/PackedShares/cancel_lease")
+        self.allocate(ss, "si1", "a", [0])
+        self.allocate(ss, "si1", "b", [0])
+        sf = ss.packs.get_shares("si1")[0]
+        self.failUnlessRaises(IndexError,
+                              sf.cancel_lease, self.secrets("c")[1])
+        self.failUnlessEqual(sf.cancel_lease(self.secrets("a")[1]), 0)
+        self.failUnlessEqual(len(list(sf.get_leases())), 1)
+        self.failUnless(sf.cancel_lease(self.secrets("b")[1]))
+        self.failIf(ss.packs.has_shares())
+
+    def test_lease_checker(self):
+        return self.do_test_lease_checker("storage/PackedShares/lease_checker")
+
+    def test_incremental_lease_checker(self):
+        # si2 has one packed share, with its leases in the pack index, and
+        # one share file, with its leases in the lease database
+        return self.do_test_lease_checker(
+            "storage/PackedShares/incremental_lease_checker",
+            leasedb_enabled=True, expiration_incremental=True)
+
+    def do_test_lease_checker(self, basedir, **kwargs):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, packed_share_max_size=1000,
+                           expiration_enabled=True, expiration_mode="age",
+                           expiration_override_lease_duration=2000, **kwargs)
+        self.allocate(ss, "si1", "a", [0, 1])
+        self.allocate(ss, "si2", "a", [0])
+        self.allocate(ss, "si2", "b", [1], size=2000)
+        # back-date the leases on si1
+        for shnum in [0, 1]:
+            ss.packs.set_leases("si1", shnum,
+                                [LeaseInfo(0, rs, cs, time.time() - 1000,
+                                           None)
+                                 for (rs, cs) in [self.secrets("a")]])
+        ss.lease_checker.slow_start = 0
+        ss.setServiceParent(self.s)
+        lc = ss.lease_checker
+        def _cycle_done():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_cycle_done)
+        def _check(ign):
+            self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+            self.failUnlessEqual(sorted(ss.remote_get_buckets("si2")), [0, 1])
+            history = lc.get_state()["history"][0]
+            rec = history["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["examined-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            counts = ss.share_counter.get_counts()
+            self.failUnlessEqual((counts["buckets"],
+                                  counts["shares-immutable"]), (1, 2))
+        d.addCallback(_check)
+        return d
+
+    def test_disabled(self):
+        basedir = "storage/PackedShares/disabled"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.s)
+        self.failUnlessEqual(ss.packs, None)
+        self.allocate(ss, "si1", "a", [0])
+        self.failIf(os.path.exists(os.path.join(basedir, "packs")))
+        self.failUnless(os.path.exists(os.path.join(basedir, "shares",
+                                                    storage_index_to_dir("si1"),
+                                                    "0")))
+
+class Backends(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, **kwargs):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def secrets(self, name):
+        return (hashutil.tagged_hash("renew", name),
+                hashutil.tagged_hash("cancel", name))
+
+    def allocate(self, ss, storage_index, sharenums, size=100):
+        rs, cs = self.secrets("a")
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for (shnum, wb) in writers.items():
+            wb.remote_write(0, ("%d" % shnum) * size)
+            wb.remote_close()
+        return already, writers
+
+    def write_mutable(self, ss, storage_index, sharenums, data):
+        rs, cs = self.secrets("a")
+        we = hashutil.tagged_hash("write-enabler", storage_index)
+        tws = dict([(shnum, ([], [(0, data)], None)) for shnum in sharenums])
+        return ss.remote_slot_testv_and_readv_and_writev(storage_index,
+                                                         (we, rs, cs),
+                                                         tws, [])
+
+    def test_get_backend(self):
+        self.failUnless(isinstance(get_backend("memory"), MemoryBackend))
+        self.failUnless(isinstance(get_backend("log"), LogBackend))
+        self.failUnlessEqual(get_backend("disk").name, "disk")
+        self.failUnlessRaises(ValueError, get_backend, "tape")
+
+    def test_memory(self):
+        basedir = "storage/Backends/memory"
+        backend = MemoryBackend()
+        ss = self.create(basedir, backend=backend)
+        self.failIf(ss.have_shares())
+        self.failUnlessEqual(ss.diskio, None)
+        self.failUnlessEqual(ss.filecache, None)
+        self.allocate(ss, "si1", [0, 1])
+        self.failUnlessEqual(self.write_mutable(ss, "si2", [0], "m"*50),
+                             (True, {}))
+        self.failUnless(ss.have_shares())
+        # nothing but the server's own state went to the disk
+        self.failIf(os.path.exists(os.path.join(basedir, "shares")))
+        self.failUnless(backend.exists(os.path.join(basedir, "shares",
+                                                    storage_index_to_dir("si1"),
+                                                    "1")))
+
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(readers), [0, 1])
+        self.failUnlessEqual(readers[1].remote_read(0, 100), "1"*100)
+        # the memory backend has nothing to read ahead
+        self.failUnless(readers[1]._share_file.prefetch([(0, 100)]))
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 10)]),
+                             {0: ["m"*10]})
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 1)
+        counts = ss.share_counter.get_counts()
+        self.failUnlessEqual((counts["buckets"], counts["shares-immutable"],
+                              counts["shares-mutable"]), (2, 2, 1))
+
+        # deleting the mutable share removes its bucket
+        ss.remote_slot_testv_and_readv_and_writev(
+            "si2", (hashutil.tagged_hash("write-enabler", "si2"),
+                    self.secrets("a")[0], self.secrets("a")[1]),
+            {0: ([], [], 0)}, [])
+        self.failIf(backend.exists(os.path.join(basedir, "shares",
+                                                storage_index_to_dir("si2"))))
+        # without a capacity, the server takes shares of any size
+        self.failUnlessEqual(ss.get_available_space(), None)
+
+    def test_memory_capacity(self):
+        backend = MemoryBackend(capacity=1000)
+        ss = self.create("storage/Backends/memory_capacity", backend=backend,
+                         reserved_space=200)
+        self.allocate(ss, "si1", [0], size=300)
+        self.failUnless(backend.used > 300)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.disk_total"], 1000)
+        self.failUnlessEqual(stats["storage_server.disk_used"], backend.used)
+        self.failUnlessEqual(stats["storage_server.disk_avail"],
+                             1000 - backend.used - 200)
+        # there is only room left for one more share of this size
+        already, writers = self.allocate(ss, "si2", [0, 1], size=300)
+        self.failUnlessEqual(sorted(writers), [0])
+
+    def test_memory_crawlers(self):
+        basedir = "storage/Backends/memory_crawlers"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, backend=MemoryBackend(),
+                           expiration_enabled=True,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(time.time()) + 1000)
+        self.allocate(ss, "si1", [0, 1])
+        self.write_mutable(ss, "si2", [0], "m"*50)
+        ss.lease_checker.slow_start = 0
+        ss.setServiceParent(self.s)
+        lc = ss.lease_checker
+        def _cycle_done():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_cycle_done)
+        def _check(ign):
+            rec = lc.get_state()["history"][0]["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 3)
+            self.failUnlessEqual(rec["actual-shares"], 3)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+            counts = ss.share_counter.get_counts()
+            self.failUnlessEqual((counts["buckets"],
+                                  counts["shares-immutable"],
+                                  counts["shares-mutable"]), (0, 0, 0))
+        d.addCallback(_check)
+        return d
+
+    def test_memory_refuses_disk_features(self):
+        basedir = "storage/Backends/refuses"
+        fileutil.make_dirs(basedir)
+        for kwargs in [dict(leasedb_enabled=True),
+                       dict(share_index_enabled=True),
+                       dict(packed_share_max_size=1000)]:
+            self.failUnlessRaises(ValueError, StorageServer, basedir,
+                                  "\x00" * 20, backend=MemoryBackend(),
+                                  **kwargs)
+
+    def test_log(self):
+        basedir = "storage/Backends/log"
+        ss = self.create(basedir, backend=LogBackend())
+        self.failIfEqual(ss.packs, None)
+        self.allocate(ss, "si1", [0, 1], size=5000)
+        self.write_mutable(ss, "si2", [0], "m"*50)
+        # every immutable share went into the packs, however large
+        self.failIf(os.path.exists(os.path.join(basedir, "shares",
+                                                storage_index_to_dir("si1"))))
+        self.failUnless(os.path.exists(os.path.join(basedir, "shares",
+                                                    storage_index_to_dir("si2"),
+                                                    "0")))
+        self.failUnlessEqual(ss.packs.get_stats()["shares"], 2)
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(readers[1].remote_read(4990, 100), "1"*10)
+
+class LeaseDB(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def create(self, basedir, **kwargs):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, **kwargs)
+        ss.setServiceParent(self.s)
+        return ss
+
+    def secrets(self, name):
+        return (hashutil.tagged_hash("renew", name),
+                hashutil.tagged_hash("cancel", name))
+
+    def allocate(self, ss, storage_index, lease_name, sharenums, size=100):
+        rs, cs = self.secrets(lease_name)
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, size,
+                                                      FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, "a"*size)
+            wb.remote_close()
+        return already, writers
+
+    def write_mutable(self, ss, storage_index, lease_name, sharenums,
+                      new_length=100):
+        rs, cs = self.secrets(lease_name)
+        we = hashutil.tagged_hash("write-enabler", storage_index)
+        tws = dict([(shnum, ([], [(0, "b"*new_length)], new_length))
+                    for shnum in sharenums])
+        ss.remote_slot_testv_and_readv_and_writev(storage_index, (we, rs, cs),
+                                                  tws, [])
+
+    def leases_on(self, ss, storage_index, shnum):
+        return [(l.renew_secret, l.cancel_secret)
+                for l in ss.leasedb.get_leases(storage_index, shnum)]
+
+    def test_disabled(self):
+        ss = self.create("storage/LeaseDB/disabled")
+        self.failUnlessEqual(ss.leasedb, None)
+        self.failIf(os.path.exists("storage/LeaseDB/disabled/leasedb.sqlite"))
+
+    def test_immutable(self):
+        ss = self.create("storage/LeaseDB/immutable", leasedb_enabled=True)
+        self.failUnless(ss.leasedb.created)
+        self.allocate(ss, "si1", "a", [0, 1, 2])
+        self.failUnlessEqual(self.leases_on(ss, "si1", 1), [self.secrets("a")])
+
+        # a second uploader gets a second lease on the existing shares
+        already, writers = self.allocate(ss, "si1", "b", [0, 1, 2])
+        self.failUnlessEqual(already, set([0, 1, 2]))
+        self.failUnlessEqual(self.leases_on(ss, "si1", 2),
+                             [self.secrets("a"), self.secrets("b")])
+        # and add-lease a third
+        rs, cs = self.secrets("c")
+        ss.remote_add_lease("si1", rs, cs)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 3)
+        # adding the same lease again just renews it
+        ss.remote_add_lease("si1", rs, cs)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 3)
+
+        # the leases live in the database, not in the share file
+        sf = ShareFile(os.path.join(ss.sharedir, storage_index_to_dir("si1"),
+                                    "0"))
+        self.failUnlessEqual(len(list(sf.get_leases())), 1)
+
+        # renewal updates every share in one go
+        old = [l.expiration_time for l in ss.leasedb.get_leases("si1", 0)]
+        ss.leasedb.renew_leases("si1", self.secrets("a")[0], 1000)
+        self.failUnlessEqual([l.expiration_time
+                              for l in ss.leasedb.get_leases("si1", 0)], old)
+        later = old[0] + 1000
+        self.failUnlessEqual(ss.leasedb.renew_leases("si1",
+                                                     self.secrets("a")[0],
+                                                     later), 3)
+        for shnum in (0, 1, 2):
+            leases = ss.leasedb.get_leases("si1", shnum)
+            self.failUnlessEqual(leases[0].expiration_time, later)
+        ss.remote_renew_lease("si1", self.secrets("b")[0])
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si1",
+                              self.secrets("d")[0])
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si2",
+                              self.secrets("a")[0])
+
+        # add-lease on a missing storage index is silently ignored
+        self.failUnlessEqual(ss.remote_add_lease("si2", rs, cs), None)
+        self.failUnlessEqual(ss.leasedb.count_leases(), 9)
+
+    def test_mutable(self):
+        ss = self.create("storage/LeaseDB/mutable", leasedb_enabled=True)
+        self.write_mutable(ss, "si1", "a", [0, 1])
+        self.write_mutable(ss, "si1", "b", [0, 1])
+        self.failUnlessEqual(self.leases_on(ss, "si1", 0),
+                             [self.secrets("a"), self.secrets("b")])
+        leases = ss.leasedb.get_leases("si1", 1)
+        self.failUnlessEqual(leases[0].nodeid, "\x00" * 20)
+        msf = MutableShareFile(os.path.join(ss.sharedir,
+                                            storage_index_to_dir("si1"), "0"))
+        self.failUnlessEqual(list(msf.get_leases()), [])
+        ss.remote_renew_lease("si1", self.secrets("a")[0])
+
+        # deleting a share removes its leases
+        self.write_mutable(ss, "si1", "a", [1], new_length=0)
+        self.failUnlessEqual(self.leases_on(ss, "si1", 1), [])
+        self.failUnlessEqual(ss.leasedb.count_leases(), 2)
+
+    def test_import(self):
+        basedir = "storage/LeaseDB/import"
+        ss = self.create(basedir)
+        self.allocate(ss, "si1", "a", [0, 1])
+        self.allocate(ss, "si1", "b", [0, 1])
+        self.write_mutable(ss, "si2", "a", [3])
+        self.write_mutable(ss, "si2", "c", [3])
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir("si3"))
+        fileutil.make_dirs(bucketdir)
+        fileutil.write(os.path.join(bucketdir, "0"), "not a share")
+
+        ss2 = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True)
+        self.failUnless(ss2.leasedb.created)
+        self.failUnlessEqual(self.leases_on(ss2, "si1", 1),
+                             [self.secrets("a"), self.secrets("b")])
+        self.failUnlessEqual(self.leases_on(ss2, "si2", 3),
+                             [self.secrets("a"), self.secrets("c")])
+        self.failUnlessEqual(ss2.leasedb.count_leases(), 6)
+        ss2.leasedb.close()
+
+        # the import only happens when the database is created
+        ss3 = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True)
+        self.failIf(ss3.leasedb.created)
+        self.failUnlessEqual(ss3.leasedb.count_leases(), 6)
+        ss3.leasedb.close()
+
+    def test_expired_shares(self):
+        ss = self.create("storage/LeaseDB/expired_shares",
+                         leasedb_enabled=True)
+        ldb = ss.leasedb
+        def lease(name, expiration_time):
+            rs, cs = self.secrets(name)
+            return LeaseInfo(0, rs, cs, expiration_time, None)
+        ldb.add_or_renew_leases("si1", [0, 1], lease("a", 100))
+        ldb.add_or_renew_leases("si1", [1], lease("b", 300))
+        ldb.add_or_renew_leases("si2", [0], lease("a", 200))
+        self.failUnlessEqual(ldb.get_expired_shares(50), [])
+        self.failUnlessEqual(ldb.get_expired_shares(100), [("si1", 0)])
+        self.failUnlessEqual(ldb.get_expired_shares(250),
+                             [("si1", 0), ("si2", 0)])
+        self.failUnlessEqual(ldb.get_expired_shares(300),
+                             [("si1", 0), ("si1", 1), ("si2", 0)])
+        # cancelling a lease, or removing a share, removes the rows
+        self.failUnlessEqual(ldb.cancel_leases("si1", 1,
+                                               self.secrets("b")[1]), 1)
+        self.failUnlessEqual(ldb.cancel_leases("si1", 1,
+                                               self.secrets("b")[1]), 0)
+        ldb.remove_share("si2", 0)
+        self.failUnlessEqual(ldb.get_expired_shares(250),
+                             [("si1", 0), ("si1", 1)])
+        # the lease checker asks about one prefix at a time
+        self.failUnlessEqual(ldb.get_expired_shares(250, si_b2a("si1")[:2]),
+                             [("si1", 0), ("si1", 1)])
+        self.failUnlessEqual(ldb.get_expired_shares(250, "aa"), [])
+
+    def make_expiring_server(self, basedir, now, **kwargs):
+        fileutil.make_dirs(basedir)
+        kwargs.setdefault("expiration_mode", "age")
+        if kwargs["expiration_mode"] == "age":
+            kwargs.setdefault("expiration_override_lease_duration", 2000)
+        ss = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True,
+                           expiration_enabled=True,
+                           **kwargs)
+        self.allocate(ss, "si1", "a", [0])
+        self.allocate(ss, "si2", "a", [0])
+        self.allocate(ss, "si2", "b", [0])
+        self.write_mutable(ss, "si3", "a", [0])
+        # back-date the "a" leases. The in-share leases are all still fresh,
+        # so only a checker that reads the database will expire anything.
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                  " WHERE renew_secret=?",
+                                  (int(now) - 1000,
+                                   base32.b2a(self.secrets("a")[0])))
+        ss.leasedb.commit()
+        ss.lease_checker.slow_start = 0
+        return ss
+
+    def run_lease_checker(self, ss):
+        lc = ss.lease_checker
+        ss.setServiceParent(self.s)
+        def _cycle_done():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_cycle_done)
+        d.addCallback(lambda ign: lc.get_state()["history"][0])
+        return d
+
+    def check_expired(self, ss, history):
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        self.failUnlessEqual(ss.remote_slot_readv("si3", [], [(0, 10)]), {})
+        self.failUnlessEqual(len(ss.remote_get_buckets("si2")), 1)
+        self.failUnlessEqual(self.leases_on(ss, "si2", 0), [self.secrets("b")])
+        self.failUnlessEqual(ss.leasedb.count_leases(), 1)
+        rec = history["space-recovered"]
+        self.failUnlessEqual(rec["examined-shares"], 3)
+        self.failUnlessEqual(rec["actual-shares"], 2)
+        self.failUnlessEqual(rec["actual-buckets"], 2)
+        self.failUnlessEqual(history["leases-per-share-histogram"],
+                             {1: 2, 2: 1})
+
+    def test_lease_checker(self):
+        ss = self.make_expiring_server("storage/LeaseDB/lease_checker",
+                                       time.time())
+        d = self.run_lease_checker(ss)
+        d.addCallback(lambda h: self.check_expired(ss, h))
+        return d
+
+    def test_incremental_lease_checker(self):
+        return self.do_test_incremental_lease_checker("incremental")
+
+    def test_incremental_lease_checker_cutoff_date(self):
+        # leases last 31 days, so the "a" leases were last renewed more
+        # than 31 days before now, and the "b" leases less than that
+        now = time.time()
+        return self.do_test_incremental_lease_checker(
+            "incremental_cutoff_date", now,
+            expiration_mode="cutoff-date",
+            expiration_cutoff_date=int(now - 31*24*60*60 - 500))
+
+    def do_test_incremental_lease_checker(self, name, now=None, **kwargs):
+        if now is None:
+            now = time.time()
+        ss = self.make_expiring_server("storage/LeaseDB/" + name, now,
+                                       expiration_incremental=True, **kwargs)
+        self.failUnless(isinstance(ss.lease_checker,
+                                   IndexedLeaseCheckingCrawler))
+        # the same shares, checked by a full crawl, for comparison
+        ss_full = self.make_expiring_server("storage/LeaseDB/%s_full" % name,
+                                            now, **kwargs)
+        # the incremental checker must not open any share files, except to
+        # measure the ones it deletes (which LeasedShare does), nor look at
+        # the leases of every share
+        def _no_share_files(*args):
+            self.fail("the incremental lease checker opened a share file")
+        self.patch(expirer, "get_share_file", _no_share_files)
+        def _no_process_leases(*args):
+            self.fail("the incremental lease checker examined every share")
+        self.patch(IndexedLeaseCheckingCrawler, "process_leases",
+                   _no_process_leases)
+        d = self.run_lease_checker(ss)
+        def _check(h):
+            self.check_expired(ss, h)
+            # the full crawl uses get_share_file
+            self.patch(expirer, "get_share_file", get_share_file)
+            d2 = defer.maybeDeferred(ss.disownServiceParent)
+            d2.addCallback(lambda ign: self.run_lease_checker(ss_full))
+            def _compare(h_full):
+                for k in ("space-recovered", "leases-per-share-histogram",
+                          "lease-age-histogram", "corrupt-shares"):
+                    self.failUnlessEqual(h[k], h_full[k], k)
+            d2.addCallback(_compare)
+            return d2
+        d.addCallback(_check)
+        return d
+
+    def test_incremental_requires_leasedb(self):
+        basedir = "storage/LeaseDB/incremental_requires_leasedb"
+        fileutil.make_dirs(basedir)
+        self.failUnlessRaises(ValueError, StorageServer, basedir, "\x00" * 20,
+                              expiration_incremental=True)
+
+    def test_upgrade(self):
+        import sqlite3
+        basedir = "storage/LeaseDB/upgrade"
+        ss = self.create(basedir)
+        self.allocate(ss, "si1", "a", [0])
+        db = sqlite3.connect(os.path.join(basedir, "leasedb.sqlite"))
+        db.executescript(leasedb.SCHEMA_v1)
+        db.execute("INSERT INTO version (version) VALUES (1)")
+        db.commit()
+        db.close()
+        # a version-1 database has no shares table, so the server fills it
+        # (and re-imports the leases) when it upgrades
+        ss2 = StorageServer(basedir, "\x00" * 20, leasedb_enabled=True)
+        self.failIf(ss2.leasedb.created)
+        self.failUnless(ss2.leasedb.must_import)
+        self.failUnlessEqual(ss2.leasedb.get_prefix_buckets(si_b2a("si1")[:2]),
+                             [si_b2a("si1")])
+        shares = ss2.leasedb.get_bucket_shares("si1")
+        self.failUnlessEqual([(shnum, sharetype)
+                              for (shnum, sharetype, sharebytes, diskbytes)
+                              in shares], [(0, "immutable")])
+        self.failUnlessEqual(self.leases_on(ss2, "si1", 0), [self.secrets("a")])
+        ss2.leasedb.close()
+
 class InstrumentedLeaseCheckingCrawler(LeaseCheckingCrawler):
     stop_after_first_bucket = False
     def process_bucket(self, *args, **kwargs):
@@ -3418,6 +5708,12 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
                             rec["original-diskbytes"])
             self.failUnless(rec["configured-diskbytes"] >= 0,
                             rec["configured-diskbytes"])
+
+            # the live share counts followed the deletions
+            counts = ss.share_counter.get_counts()
+            self.failUnlessEqual(counts["buckets"], 2)
+            self.failUnlessEqual(counts["shares-immutable"], 1)
+            self.failUnlessEqual(counts["shares-mutable"], 1)
         d.addCallback(_after_first_cycle)
         d.addCallback(lambda ign: self.render1(webstatus))
         def _check_html(html):
@@ -3848,6 +6144,42 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check)
         return d
 
+    def test_prefetch(self):
+        basedir = "storage/LeaseCrawler/prefetch"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=-1000,
+                           crawler_prefetch_threads=2,
+                           crawler_io_percentage=100)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        prefetched = []
+        def _prefetch_bucket(prefixdir, storage_index_b32):
+            prefetched.append(storage_index_b32)
+            return LeaseCheckingCrawler.prefetch_bucket(lc, prefixdir,
+                                                        storage_index_b32)
+        lc.prefetch_bucket = _prefetch_bucket
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _check(ignored):
+            self.failUnlessEqual(sorted(prefetched),
+                                 sorted([si_b2a(si) for si in self.sis]))
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["corrupt-shares"], [])
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-shares"], 4)
+            for si in self.sis:
+                self.failUnlessEqual(list(ss._iter_share_files(si)), [])
+        d.addCallback(_check)
+        return d
+
     def test_share_corruption(self):
         self._poll_should_ignore_these_errors = [
             UnknownMutableContainerVersionError,
@@ -3976,6 +6308,7 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         nodeid = "\x00" * 20
         ss = StorageServer(basedir, nodeid)
         ss.setServiceParent(self.s)
+        ss.remote_advise_corrupt_share("mutable", "si0", 3, "It was bad.\n")
         w = StorageStatus(ss, "nickname")
         d = self.render1(w)
         def _check_html(html):
@@ -3985,6 +6318,9 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             self.failUnlessIn("Server Nodeid: %s"  % base32.b2a(nodeid), s)
             self.failUnlessIn("Accepting new shares: Yes", s)
             self.failUnlessIn("Reserved space: - 0 B (0)", s)
+            self.failUnlessIn("1 shares reported corrupt (1 reports received,"
+                              " 0 dropped", s)
+            self.failUnlessIn("It was bad.", s)
         d.addCallback(_check_html)
         d.addCallback(lambda ign: self.render_json(w))
         def _check_json(json):
@@ -3994,6 +6330,12 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             self.failUnlessEqual(s["storage_server.reserved_space"], 0)
             self.failUnlessIn("bucket-counter", data)
             self.failUnlessIn("lease-checker", data)
+            self.failUnlessEqual(data["request-scheduler"], {})
+            advisories = data["corruption-advisories"]
+            self.failUnlessEqual(len(advisories), 1)
+            self.failUnlessEqual(advisories[0]["storage_index"],
+                                 base32.b2a("si0"))
+            self.failUnlessEqual(advisories[0]["shnum"], 3)
         d.addCallback(_check_json)
         return d
 
@@ -383,7 +383,10 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
             sp = self.clients[0].stats_provider
             sp_furl = self.clients[0].tub.registerReference(sp)
             d = self.clients[1].tub.getReference(sp_furl)
-            d.addCallback(lambda sp_rref: sp_rref.callRemote("get_stats"))
+            def _got_reference(rref):
+                self.sp_rref = rref
+                return rref.callRemote("get_stats")
+            d.addCallback(_got_reference)
             def _got_stats(stats):
                 #print "STATS"
                 #from pprint import pprint
@@ -392,7 +395,14 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
                 self.failUnlessEqual(s["storage_server.accepting_immutable_shares"], 1)
                 c = stats["counters"]
                 self.failUnless("storage_server.allocate" in c)
+                return self.sp_rref.callRemote("get_latency_histograms")
             d.addCallback(_got_stats)
+            def _got_histograms(histograms):
+                (layout, count, total, minimum, maximum, buckets) = \
+                         histograms["storage_server.allocate"]
+                self.failUnless(count > 0, count)
+                self.failUnlessEqual(sum(buckets.values()), count)
+            d.addCallback(_got_histograms)
             return d
         d.addCallback(_grab_stats)
 
@@ -1412,6 +1422,13 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
             self.failUnlessEqual(data, expected_data)
         d.addCallback(_check)
         d.addCallback(lambda res: rref.callRemote("speed_test", 1, 200, False))
+        d.addCallback(lambda res:
+                      rref.callRemote("speed_test_rates", 1, 200, False))
+        def _check_rates(rates):
+            for name in ["upload", "download", "encoding"]:
+                self.failUnlessIn("%s_time" % name, rates)
+            self.failUnlessIn("upload_rate", rates)
+        d.addCallback(_check_rates)
         if sys.platform in ("linux2", "linux3"):
             d.addCallback(lambda res: rref.callRemote("get_memory_usage"))
         d.addCallback(lambda res: rref.callRemote("measure_peer_response_time"))
@@ -1906,7 +1923,14 @@ class Connections(SystemTestMixin, unittest.TestCase):
             self.s1_rref = self.s1.get_rref()
             self.failIfEqual(self.s1_rref, None)
             self.failUnless(self.s1.is_connected())
+            return self.s1_rref.callRemote("get_buckets", "\x00"*16)
         d.addCallback(_start)
+        def _charged(ign):
+            # the server knows which client that request came from
+            ss = self.clients[1].getServiceNamed("storage")
+            clients = ss.scheduler.get_client_stats()
+            self.failUnlessEqual(clients.keys(), [self.c0.tub.getTubID()])
+        d.addCallback(_charged)
 
         # now shut down the server
         d.addCallback(lambda ign: self.clients[1].disownServiceParent())
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import os, shutil
+import os, shutil, random
 from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
@@ -14,10 +14,11 @@ from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
 from allmydata.util.deferredutil import DeferredListShouldSucceed
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import DiskBackedGridTestMixin
 from allmydata.test.common_util import ShouldFailMixin
 from allmydata.util.happinessutil import servers_of_happiness, \
-                                         shares_by_server, merge_servers
+                                         shares_by_server, merge_servers, \
+                                         HappinessMatcher
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.client import Client
@@ -104,6 +105,7 @@ class FakeStorageServer:
     def __init__(self, mode):
         self.mode = mode
         self.allocated = []
+        self.writers = []
         self.queries = 0
         self.version = { "http://allmydata.org/tahoe/protocols/storage/v1" :
                          { "maximum-immutable-share-size": 2**32 - 1 },
@@ -139,18 +141,19 @@ class FakeStorageServer:
         elif self.mode == "already got them":
             return (set(sharenums), {},)
         else:
+            buckets = {}
             for shnum in sharenums:
                 self.allocated.append( (storage_index, shnum) )
-            return (set(),
-                    dict([( shnum, FakeBucketWriter(share_size) )
-                          for shnum in sharenums]),
-                    )
+                buckets[shnum] = FakeBucketWriter(share_size)
+                self.writers.append(buckets[shnum])
+            return (set(), buckets)
 
 class FakeBucketWriter:
     # a diagnostic version of storageserver.BucketWriter
     def __init__(self, size):
         self.data = StringIO()
         self.closed = False
+        self.aborted = False
         self._size = size
 
     def callRemote(self, methname, *args, **kwargs):
@@ -182,7 +185,7 @@ class FakeBucketWriter:
         self.closed = True
 
     def remote_abort(self):
-        pass
+        self.aborted = True
 
 class FakeClient:
     DEFAULT_ENCODING_PARAMETERS = {"k":25,
@@ -332,6 +335,24 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_data_large_encoding_processes(self):
+        self.u = upload.Uploader(encoding_processes=2)
+        self.u.running = True
+        self.u.parent = self.node
+        self.addCleanup(self.u.stopService)
+        data = self.get_data(SIZE_LARGE)
+        segsize = int(SIZE_LARGE / 2.5)
+        self.set_encoding_parameters(25, 25, 100, segsize)
+        d = upload_data(self.u, data)
+        def _done(results):
+            self.failUnless(self.u._encoding_pool.started)
+            self.failUnless(results.get_timings()["cumulative_encoding"] > 0)
+            return results
+        d.addCallback(_done)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        return d
+
     def test_filehandle_zero(self):
         data = self.get_data(SIZE_ZERO)
         d = upload_filehandle(self.u, StringIO(data))
@@ -473,9 +494,9 @@ class FullServer(unittest.TestCase):
 
 class ServerSelection(unittest.TestCase):
 
-    def make_client(self, num_servers=50):
-        self.node = FakeClient(mode="good", num_servers=num_servers)
-        self.u = upload.Uploader()
+    def make_client(self, num_servers=50, mode="good", max_parallel_queries=0):
+        self.node = FakeClient(mode=mode, num_servers=num_servers)
+        self.u = upload.Uploader(max_parallel_queries=max_parallel_queries)
         self.u.running = True
         self.u.parent = self.node
 
@@ -536,6 +557,52 @@ class ServerSelection(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_parallel_one_each(self):
+        # asking all 50 servers at once should still give one share to each
+        self.make_client(max_parallel_queries=50)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(25, 30, 50)
+        d = upload_data(self.u, data)
+        def _check_results(ur):
+            timings = ur.get_timings()
+            self.failUnless(timings["cumulative_peer_selection"] > 0.0,
+                            timings)
+            return ur
+        d.addCallback(_check_results)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check(res):
+            for s in self.node.last_servers:
+                self.failUnlessEqual(len(s.allocated), 1)
+                self.failUnlessEqual(s.queries, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_parallel_with_full_servers(self):
+        # half of the servers are full, so the first round will almost
+        # certainly leave some shares homeless, and the next round will ask
+        # more servers than there are shares. Any share that two servers
+        # accepted must be aborted on one of them.
+        mode = dict([(i, ["good", "full"][i%2]) for i in range(50)])
+        self.make_client(mode=mode, max_parallel_queries=20)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(3, 7, 10)
+        d = upload_data(self.u, data)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check(res):
+            kept = []
+            for s in self.node.last_servers:
+                if s.mode == "full":
+                    self.failUnlessEqual(s.writers, [])
+                for (w, (si, shnum)) in zip(s.writers, s.allocated):
+                    if not w.aborted:
+                        self.failUnless(w.closed)
+                        kept.append(shnum)
+            self.failUnlessEqual(sorted(kept), range(10))
+        d.addCallback(_check)
+        return d
+
     def test_one_each_plus_one_extra(self):
         # if we have 51 shares, and there are 50 servers, then one server
         # gets two shares and the rest get just one
@@ -745,8 +812,8 @@ class FakeServerTracker:
     def get_serverid(self):
         return self._serverid
 
-class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
-    ShouldFailMixin):
+class EncodingParameters(DiskBackedGridTestMixin, unittest.TestCase,
+    SetDEPMixin, ShouldFailMixin):
     def find_all_shares(self, unused=None):
         """Locate shares on disk. Returns a dict that maps
         server to set of sharenums.
@@ -1512,6 +1579,55 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         self.failUnlessEqual(2, servers_of_happiness(test))
 
 
+    def test_happiness_matcher(self):
+        # Zooko's first puzzle again, built up one placement at a time
+        m = HappinessMatcher()
+        self.failUnlessEqual(0, m.get_happiness())
+        m.add(0, "server1")
+        m.add(1, "server1")
+        self.failUnlessEqual(1, m.get_happiness())
+        m.add(1, "server2")
+        self.failUnlessEqual(2, m.get_happiness())
+        m.add(2, "server2")
+        self.failUnlessEqual(2, m.get_happiness())
+        m.add(2, "server3")
+        self.failUnlessEqual(3, m.get_happiness())
+        # taking away a matched placement finds another way round
+        m.remove(1, "server1")
+        self.failUnlessEqual(3, m.get_happiness())
+        m.remove(2, "server3")
+        self.failUnlessEqual(2, m.get_happiness())
+        # a placement that was added twice must be removed twice
+        m.add(2, "server3")
+        m.add(2, "server3")
+        self.failUnlessEqual(3, m.get_happiness())
+        m.remove(2, "server3")
+        self.failUnlessEqual(3, m.get_happiness())
+        m.remove(2, "server3")
+        self.failUnlessEqual(2, m.get_happiness())
+
+        # random changes must always agree with starting from scratch
+        r = random.Random(778)
+        m = HappinessMatcher()
+        placements = []
+        for i in xrange(500):
+            if placements and r.random() < 0.4:
+                (shnum, server) = placements.pop(r.randrange(len(placements)))
+                m.remove(shnum, server)
+            else:
+                shnum, server = r.randrange(20), "server%d" % r.randrange(15)
+                placements.append((shnum, server))
+                m.add(shnum, server)
+            sharemap = {}
+            for (shnum, server) in placements:
+                sharemap.setdefault(shnum, set()).add(server)
+            self.failUnlessEqual(servers_of_happiness(sharemap),
+                                 m.get_happiness())
+        self.failUnlessEqual(15, servers_of_happiness(
+            dict([(i, set(["server%d" % j for j in xrange(15)]))
+                  for i in xrange(20)])))
+
+
     def test_shares_by_server(self):
         test = dict([(i, set(["server%d" % i])) for i in xrange(1, 5)])
         sbs = shares_by_server(test)
@@ -12,7 +12,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, histogram
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 
@@ -311,6 +311,94 @@ class Statistics(unittest.TestCase):
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
 
 
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+class Histogram(unittest.TestCase):
+    def failUnlessClose(self, value, expected):
+        self.failUnless(abs(value - expected) <= 0.01 * expected,
+                        (value, expected))
+
+    def test_buckets(self):
+        self.failUnlessEqual(histogram.bucket_for(0), 0)
+        self.failUnlessEqual(histogram.bucket_for(1e-7), 0)
+        self.failUnlessEqual(histogram.bucket_for(1e9),
+                             histogram.MAXIMUM_BUCKET)
+        for value in [1e-6, 0.0004, 0.25, 1.0, 3.5, 1234.5]:
+            bucket = histogram.bucket_for(value)
+            self.failUnlessClose(histogram.bucket_value(bucket), value)
+            self.failUnless(bucket < histogram.bucket_for(value * 1.03))
+
+    def test_percentiles(self):
+        h = histogram.LatencyHistogram()
+        self.failUnlessEqual(h.get_count(), 0)
+        self.failUnlessEqual(h.get_mean(), None)
+        self.failUnlessEqual(h.get_percentile(0.5), None)
+        for i in range(1, 1001):
+            h.add(0.001 * i)
+        self.failUnlessEqual(h.get_count(), 1000)
+        self.failUnlessClose(h.get_mean(), 0.5005)
+        self.failUnlessEqual(h.get_min(), 0.001)
+        self.failUnlessEqual(h.get_max(), 1.0)
+        self.failUnlessClose(h.get_percentile(0.5), 0.501)
+        self.failUnlessClose(h.get_percentile(0.999), 1.0)
+        # values are clamped to the real extremes
+        self.failUnlessEqual(h.get_percentile(0), 0.001)
+        self.failUnless(h.get_percentile(1.0) <= 1.0)
+        stats = h.get_stats()
+        self.failUnlessEqual(stats["samplesize"], 1000)
+        self.failUnlessClose(stats["90_0_percentile"], 0.901)
+        self.failUnlessClose(stats["99_9_percentile"], 1.0)
+        h.clear()
+        self.failUnlessEqual(h.get_count(), 0)
+
+    def test_windows(self):
+        clock = FakeClock()
+        h = histogram.LatencyHistogram(window=60, clock=clock)
+        h.add(1.0)
+        clock.now += 59
+        h.add(2.0)
+        self.failUnlessEqual(h.get_count(), 2)
+        # the first window becomes the previous one, and is still reported
+        clock.now += 2
+        h.add(3.0)
+        self.failUnlessEqual(h.get_count(), 3)
+        self.failUnlessEqual(h.get_max(), 3.0)
+        # and then it is forgotten
+        clock.now += 60
+        self.failUnlessEqual(h.get_count(), 1)
+        self.failUnlessEqual(h.get_min(), 3.0)
+        # after two idle windows, nothing is left
+        clock.now += 120
+        self.failUnlessEqual(h.get_count(), 0)
+        self.failUnlessEqual(h.get_max(), None)
+
+    def test_merge(self):
+        h1 = histogram.LatencyHistogram()
+        h2 = histogram.LatencyHistogram()
+        for i in range(100):
+            h1.add(0.01)
+            h2.add(1.0)
+        wire = h2.to_wire()
+        self.failUnlessEqual(wire[:5], (histogram.LAYOUT_VERSION, 100, 100.0,
+                                        1.0, 1.0))
+        merged = histogram.from_wire(h1.to_wire())
+        merged.add_wire(wire)
+        self.failUnlessEqual(merged.get_count(), 200)
+        self.failUnlessEqual(merged.get_min(), 0.01)
+        self.failUnlessEqual(merged.get_max(), 1.0)
+        self.failUnlessClose(merged.get_mean(), 0.505)
+        self.failUnlessClose(merged.get_percentile(0.25), 0.01)
+        self.failUnlessClose(merged.get_percentile(0.75), 1.0)
+        h1.merge(h2)
+        self.failUnlessEqual(h1.to_wire(), merged.to_wire())
+        self.failUnlessRaises(ValueError, merged.add_wire,
+                              (histogram.LAYOUT_VERSION+1,) + wire[1:])
+
+
 class Asserts(unittest.TestCase):
     def should_assert(self, func, *args, **kwargs):
         try:
@@ -530,6 +618,23 @@ class FileUtil(unittest.TestCase):
         disk = fileutil.get_disk_stats('.', 2**128)
         self.failUnlessEqual(disk['avail'], 0)
 
+    def test_advise_willneed(self):
+        basedir = "util/FileUtil/test_advise_willneed"
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "file")
+        fileutil.write(fn, "a"*10000)
+        f = open(fn, "rb")
+        try:
+            self.failUnlessEqual(fileutil.advise_willneed(f, 100, 5000),
+                                 fileutil.have_posix_fadvise)
+            # ranges past the end of the file are fine
+            self.failUnlessEqual(fileutil.advise_willneed(f, 9000, 5000),
+                                 fileutil.have_posix_fadvise)
+        finally:
+            f.close()
+        if sys.platform.startswith("linux"):
+            self.failUnless(fileutil.have_posix_fadvise)
+
 class PollMixinTests(unittest.TestCase):
     def setUp(self):
         self.pm = pollmixin.PollMixin()
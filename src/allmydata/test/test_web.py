@@ -16,6 +16,8 @@ from nevow import rend
 
 from allmydata import interfaces, uri, webish, dirnode
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.scheduler import RequestScheduler
+from allmydata.storage.advisories import CorruptionAdvisories
 from allmydata.storage_client import StorageFarmBroker, StubServer
 from allmydata.immutable import upload
 from allmydata.immutable.downloader.status import DownloadStatus
@@ -34,7 +36,7 @@ from allmydata.test.common import FakeCHKFileNode, FakeMutableFileNode, \
 from allmydata.interfaces import IMutableFileNode, SDMF_VERSION, MDMF_VERSION
 from allmydata.mutable import servermap, publish, retrieve
 import allmydata.test.common_util as testutil
-from allmydata.test.no_network import GridTestMixin
+from allmydata.test.no_network import DiskBackedGridTestMixin
 from allmydata.test.common_web import HTTPClientGETFactory, \
      HTTPClientHEADFactory
 from allmydata.client import Client, SecretHolder
@@ -221,6 +223,8 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.scheduler = RequestScheduler(self)
+        self.corruption_advisories = CorruptionAdvisories(":memory:")
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
 
@@ -615,6 +619,7 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
             res_u = res.decode('utf-8')
             self.failUnlessIn(u'<td>fake_nickname \u263A</td>', res_u)
             self.failUnlessIn(u'<div class="nickname">other_nickname \u263B</div>', res_u)
+            self.failUnlessIn('<td class="service-performance">no requests yet</td>', res)
             self.failUnlessIn(u'\u00A9 <a href="https://tahoe-lafs.org/">Tahoe-LAFS Software Foundation', res_u)
 
             self.s.basedir = 'web/test_welcome'
@@ -624,6 +629,20 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check)
         return d
 
+    def test_welcome_server_performance(self):
+        sb = self.s.get_storage_broker()
+        perf = sb.get_server_performance(sb.servers["other_nodeid"])
+        perf.response_received(0.25)
+        perf.rtt = 0.25
+        perf.response_received(1.25, 2000000)
+        perf.request_failed()
+        d = self.GET("/")
+        def _check(res):
+            self.failUnlessIn('<td class="service-performance">RTT 250ms,'
+                              ' 2.00MBps, 20% errors, 0 waiting</td>', res)
+        d.addCallback(_check)
+        return d
+
     def test_introducer_status(self):
         class MockIntroducerClient(object):
             def __init__(self, connected):
@@ -4503,7 +4522,7 @@ class Util(ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessReallyEqual(convert2(["1","2"]), "has shares: 1,2")
 
 
-class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
+class Grid(DiskBackedGridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMixin, unittest.TestCase):
 
     def CHECK(self, ign, which, args, clientnum=0):
         fileurl = self.fileurls[which]
@@ -335,6 +335,31 @@ if sys.platform == "win32":
         import traceback
         traceback.print_exc()
 
+# posix_fadvise(2), which the os module only offers from Python 3.3 on
+have_posix_fadvise = False
+POSIX_FADV_WILLNEED = 3
+if sys.platform.startswith("linux") or sys.platform.startswith("freebsd"):
+    try:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _posix_fadvise = getattr(_libc, "posix_fadvise64", None)
+        if _posix_fadvise is None:
+            _posix_fadvise = _libc.posix_fadvise
+        _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                   ctypes.c_longlong, ctypes.c_int]
+        _posix_fadvise.restype = ctypes.c_int
+        have_posix_fadvise = True
+    except Exception:
+        pass
+
+def advise_willneed(f, offset, length):
+    """Tell the OS that f[offset:offset+length] (f is an open file) will be
+    read soon, so that it can start reading it into the page cache now.
+    Return False if this platform cannot take such hints."""
+    if not have_posix_fadvise:
+        return False
+    return _posix_fadvise(f.fileno(), offset, length, POSIX_FADV_WILLNEED) == 0
+
 def get_disk_stats(whichdir, reserved_space=0):
     """Return disk statistics for the storage disk, in the form of a dict
     with the following fields.
@@ -3,8 +3,6 @@ I contain utilities useful for calculating servers_of_happiness, and for
 reporting it in messages
 """
 
-from copy import deepcopy
-
 def failure_message(peer_count, k, happy, effective_happy):
     # If peer_count < needed_shares, this error message makes more
     # sense than any of the others, so use it.
@@ -64,8 +62,10 @@ def merge_servers(servermap, upload_trackers=None):
     """
     # Since we mutate servermap, and are called outside of a
     # context where it is okay to do that, make a copy of servermap and
-    # work with it.
-    servermap = deepcopy(servermap)
+    # work with it. Its values are sets of serverids, which are strings, so
+    # copying each set is enough.
+    servermap = dict([(shnum, set(serverids))
+                      for (shnum, serverids) in servermap.iteritems()])
     if not upload_trackers:
         return servermap
 
@@ -123,180 +123,165 @@ def servers_of_happiness(sharemap):
     that |M'| > |M|. Then M is a maximum matching in G. Intuitively, and
     as long as k <= 5, we can see that the layout above has
     servers_of_happiness = 5, which matches the results here.
+
+    Callers that change a layout a little at a time and want the new value
+    after each change should keep a HappinessMatcher instead of calling me
+    again.
     """
-    if sharemap == {}:
-        return 0
-    sharemap = shares_by_server(sharemap)
-    graph = flow_network_for(sharemap)
-    # This is an implementation of the Ford-Fulkerson method for finding
-    # a maximum flow in a flow network applied to a bipartite graph.
-    # Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    # BFS to find the shortest augmenting path at each iteration, if one
-    # exists.
-    #
-    # The implementation here is an adapation of an algorithm described in
-    # "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
-    dim = len(graph)
-    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(map(lambda (u, v), rf=residual_function: rf[u][v],
-                        path))
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-        residual_graph, residual_function = residual_network(graph,
-                                                             flow_function)
-    num_servers = len(sharemap)
-    # The value of a flow is the total flow out of the source vertex
-    # (vertex 0, in our graph). We could just as well sum across all of
-    # f[0], but we know that vertex 0 only has edges to the servers in
-    # our graph, so we can stop after summing flow across those. The
-    # value of a flow computed in this way is the size of a maximum
-    # matching on the bipartite graph described above.
-    return sum([flow_function[0][v] for v in xrange(1, num_servers+1)])
+    return HappinessMatcher(sharemap).get_happiness()
 
-def flow_network_for(sharemap):
+class HappinessMatcher:
     """
-    I take my argument, a dict of peerid -> set(shareid) mappings, and
-    turn it into a flow network suitable for use with Edmonds-Karp. I
-    then return the adjacency list representation of that network.
+    I keep a maximum matching between servers and shares (see
+    servers_of_happiness) for a layout that changes over time: add() and
+    remove() change one share placement and bring the matching up to date
+    with at most one search for an augmenting path, since one placement
+    can change the size of a maximum matching by at most one.
 
-    Specifically, I build G = (V, E), where:
-      V = { peerid in sharemap } U { shareid in sharemap } U {s, t}
-      E = {(s, peerid) for each peerid}
-          U {(peerid, shareid) if peerid is to store shareid }
-          U {(shareid, t) for each shareid}
+    Servers and shares are numbered as they are first seen, and the graph
+    and matching are kept in lists indexed by those numbers. When the whole
+    layout is known up front, I find the matching with the Hopcroft-Karp
+    algorithm: each phase finds a maximal set of shortest augmenting paths
+    with one breadth-first and one depth-first search, and it takes at most
+    about sqrt(number of shares) phases.
 
-    s and t will be source and sink nodes when my caller starts treating
-    the graph I return like a flow network. Without s and t, the
-    returned graph is bipartite.
+    A placement may be added more than once (a share can be both already
+    present on a server and allocated there by an upload's bookkeeping); it
+    stays in the layout until it has been removed as many times.
     """
-    # Servers don't have integral identifiers, and we can't make any
-    # assumptions about the way shares are indexed -- it's possible that
-    # there are missing shares, for example. So before making a graph,
-    # we re-index so that all of our vertices have integral indices, and
-    # that there aren't any holes. We start indexing at 1, so that we
-    # can add a source node at index 0.
-    sharemap, num_shares = reindex(sharemap, base_index=1)
-    num_servers = len(sharemap)
-    graph = [] # index -> [index], an adjacency list
-    # Add an entry at the top (index 0) that has an edge to every server
-    # in sharemap
-    graph.append(sharemap.keys())
-    # For each server, add an entry that has an edge to every share that it
-    # contains (or will contain).
-    for k in sharemap:
-        graph.append(sharemap[k])
-    # For each share, add an entry that has an edge to the sink.
-    sink_num = num_servers + num_shares + 1
-    for i in xrange(num_shares):
-        graph.append([sink_num])
-    # Add an empty entry for the sink, which has no outbound edges.
-    graph.append([])
-    return graph
+    FREE = -1
+    UNREACHED = -1
 
-def reindex(sharemap, base_index):
-    """
-    Given sharemap, I map peerids and shareids to integers that don't
-    conflict with each other, so they're useful as indices in a graph. I
-    return a sharemap that is reindexed appropriately, and also the
-    number of distinct shares in the resulting sharemap as a convenience
-    for my caller. base_index tells me where to start indexing.
-    """
-    shares  = {} # shareid  -> vertex index
-    num = base_index
-    ret = {} # peerid -> [shareid], a reindexed sharemap.
-    # Number the servers first
-    for k in sharemap:
-        ret[num] = sharemap[k]
-        num += 1
-    # Number the shares
-    for k in ret:
-        for shnum in ret[k]:
-            if not shares.has_key(shnum):
-                shares[shnum] = num
-                num += 1
-        ret[k] = map(lambda x: shares[x], ret[k])
-    return (ret, len(shares))
+    def __init__(self, sharemap=None):
+        self._servers = {} # serverid -> server number
+        self._shares = {} # shareid -> share number
+        self._edges = [] # server number -> [share number]
+        self._counts = {} # (server number, share number) -> times added
+        self._share_of = [] # server number -> matched share number, or FREE
+        self._server_of = [] # share number -> matched server number, or FREE
+        self._happiness = 0
+        if sharemap:
+            for shareid, serverids in sharemap.iteritems():
+                for serverid in serverids:
+                    self._add_edge(shareid, serverid)
+            while True:
+                found = self._augment()
+                if not found:
+                    break
+                self._happiness += found
 
-def residual_network(graph, f):
-    """
-    I return the residual network and residual capacity function of the
-    flow network represented by my graph and f arguments. graph is a
-    flow network in adjacency-list form, and f is a flow in graph.
-    """
-    new_graph = [[] for i in xrange(len(graph))]
-    cf = [[0 for s in xrange(len(graph))] for sh in xrange(len(graph))]
-    for i in xrange(len(graph)):
-        for v in graph[i]:
-            if f[i][v] == 1:
-                # We add an edge (v, i) with cf[v,i] = 1. This means
-                # that we can remove 1 unit of flow from the edge (i, v)
-                new_graph[v].append(i)
-                cf[v][i] = 1
-                cf[i][v] = -1
-            else:
-                # We add the edge (i, v), since we're not using it right
-                # now.
-                new_graph[i].append(v)
-                cf[i][v] = 1
-                cf[v][i] = -1
-    return (new_graph, cf)
+    def get_happiness(self):
+        """
+        Return the size of a maximum matching, which is the
+        servers_of_happiness value of the current layout.
+        """
+        return self._happiness
 
-def augmenting_path_for(graph):
-    """
-    I return an augmenting path, if there is one, from the source node
-    to the sink node in the flow network represented by my graph argument.
-    If there is no augmenting path, I return False. I assume that the
-    source node is at index 0 of graph, and the sink node is at the last
-    index. I also assume that graph is a flow network in adjacency list
-    form.
-    """
-    bfs_tree = bfs(graph, 0)
-    if bfs_tree[len(graph) - 1]:
-        n = len(graph) - 1
-        path = [] # [(u, v)], where u and v are vertices in the graph
-        while n != 0:
-            path.insert(0, (bfs_tree[n], n))
-            n = bfs_tree[n]
-        return path
-    return False
+    def add(self, shareid, serverid):
+        """
+        Record that serverid holds (or will hold) shareid.
+        """
+        (server, share, new) = self._add_edge(shareid, serverid)
+        if not new:
+            return
+        if (self._share_of[server] == self.FREE
+            and self._server_of[share] == self.FREE):
+            self._match(server, share)
+            self._happiness += 1
+        else:
+            self._happiness += self._augment()
 
-def bfs(graph, s):
-    """
-    Perform a BFS on graph starting at s, where graph is a graph in
-    adjacency list form, and s is a node in graph. I return the
-    predecessor table that the BFS generates.
-    """
-    # This is an adaptation of the BFS described in "Introduction to
-    # Algorithms", Cormen et al, 2nd ed., p. 532.
-    # WHITE vertices are those that we haven't seen or explored yet.
-    WHITE = 0
-    # GRAY vertices are those we have seen, but haven't explored yet
-    GRAY  = 1
-    # BLACK vertices are those we have seen and explored
-    BLACK = 2
-    color        = [WHITE for i in xrange(len(graph))]
-    predecessor  = [None for i in xrange(len(graph))]
-    distance     = [-1 for i in xrange(len(graph))]
-    queue = [s] # vertices that we haven't explored yet.
-    color[s] = GRAY
-    distance[s] = 0
-    while queue:
-        n = queue.pop(0)
-        for v in graph[n]:
-            if color[v] == WHITE:
-                color[v] = GRAY
-                distance[v] = distance[n] + 1
-                predecessor[v] = n
-                queue.append(v)
-        color[n] = BLACK
-    return predecessor
+    def remove(self, shareid, serverid):
+        """
+        Forget one placement of shareid on serverid that was added before.
+        """
+        server = self._servers[serverid]
+        share = self._shares[shareid]
+        edge = (server, share)
+        self._counts[edge] -= 1
+        if self._counts[edge]:
+            return
+        del self._counts[edge]
+        self._edges[server].remove(share)
+        if self._share_of[server] == share:
+            # a matching without this edge is at most one smaller, and may
+            # not be smaller at all if another path can take its place
+            self._share_of[server] = self.FREE
+            self._server_of[share] = self.FREE
+            self._happiness -= 1
+            self._happiness += self._augment()
+
+    def _add_edge(self, shareid, serverid):
+        server = self._servers.get(serverid)
+        if server is None:
+            server = self._servers[serverid] = len(self._edges)
+            self._edges.append([])
+            self._share_of.append(self.FREE)
+        share = self._shares.get(shareid)
+        if share is None:
+            share = self._shares[shareid] = len(self._server_of)
+            self._server_of.append(self.FREE)
+        edge = (server, share)
+        count = self._counts.get(edge, 0)
+        self._counts[edge] = count + 1
+        if count:
+            return (server, share, False)
+        self._edges[server].append(share)
+        return (server, share, True)
+
+    def _match(self, server, share):
+        self._share_of[server] = share
+        self._server_of[share] = server
+
+    def _augment(self):
+        """
+        Run one phase of Hopcroft-Karp, and return the number of augmenting
+        paths that it applied to the matching.
+        """
+        edges = self._edges
+        share_of = self._share_of
+        server_of = self._server_of
+        FREE = self.FREE
+        UNREACHED = self.UNREACHED
+        # Breadth-first search from every free server, alternating between
+        # unmatched and matched edges, to number the servers by their
+        # distance from a free server.
+        distance = [UNREACHED] * len(edges)
+        queue = [server for server in xrange(len(edges))
+                 if share_of[server] == FREE and edges[server]]
+        for server in queue:
+            distance[server] = 0
+        free_servers = len(queue)
+        reached_free_share = False
+        i = 0
+        while i < len(queue):
+            server = queue[i]
+            i += 1
+            for share in edges[server]:
+                other = server_of[share]
+                if other == FREE:
+                    reached_free_share = True
+                elif distance[other] == UNREACHED:
+                    distance[other] = distance[server] + 1
+                    queue.append(other)
+        if not reached_free_share:
+            return 0
+
+        # Depth-first search along those layers from each free server, so
+        # that the augmenting paths we apply do not share any vertex.
+        def _extend(server):
+            for share in edges[server]:
+                other = server_of[share]
+                if other == FREE or (distance[other] == distance[server] + 1
+                                     and _extend(other)):
+                    share_of[server] = share
+                    server_of[share] = server
+                    return True
+            # no augmenting path goes through here in this phase
+            distance[server] = UNREACHED
+            return False
+        found = 0
+        for server in queue[:free_servers]:
+            if _extend(server):
+                found += 1
+        return found
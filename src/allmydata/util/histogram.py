@@ -0,0 +1,202 @@
+import math, time
+
+# The bucket layout of every LatencyHistogram. Histograms can only be merged
+# with ones that use the same layout, so the number in their wire format
+# must change whenever one of these does.
+LAYOUT_VERSION = 1
+MINIMUM_VALUE = 1e-6 # values below this all go into bucket 0
+BUCKET_RATIO = 1.02 # each bucket is 2% wider than the one before it
+MAXIMUM_BUCKET = 1200 # about 1e-6*1.02**1200 = 2e4: values above share it
+_LOG_RATIO = math.log(BUCKET_RATIO)
+
+DEFAULT_WINDOW = 5*60
+
+# (fraction, name, fewest samples for which it is reported), as used in
+# the storage_server.latencies.* stats
+PERCENTILES = [(0.01, "01_0_percentile", 100),
+               (0.1, "10_0_percentile", 10),
+               (0.50, "50_0_percentile", 10),
+               (0.90, "90_0_percentile", 10),
+               (0.95, "95_0_percentile", 20),
+               (0.99, "99_0_percentile", 100),
+               (0.999, "99_9_percentile", 1000),
+               ]
+
+def bucket_for(value):
+    if value < MINIMUM_VALUE:
+        return 0
+    bucket = 1 + int(math.log(value / MINIMUM_VALUE) / _LOG_RATIO)
+    return min(bucket, MAXIMUM_BUCKET)
+
+def bucket_value(bucket):
+    """Return the value that stands for everything in the given bucket:
+    the geometric middle of its range."""
+    if bucket == 0:
+        return 0.0
+    return MINIMUM_VALUE * BUCKET_RATIO ** (bucket - 0.5)
+
+
+class _Window:
+    def __init__(self):
+        self.buckets = {} # bucket number -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, bucket):
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add_window(self, count, total, minimum, maximum, buckets):
+        if not count:
+            return
+        for (bucket, n) in buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+        self.count += count
+        self.total += total
+        if self.min is None or minimum < self.min:
+            self.min = minimum
+        if self.max is None or maximum > self.max:
+            self.max = maximum
+
+
+class LatencyHistogram:
+    """I record a distribution of values (usually latencies, in seconds) in
+    a fixed number of logarithmic buckets, each 2% wider than the one
+    before it, so that add() takes constant time and I use constant memory
+    no matter how many values I am given. The percentiles I report are
+    within about 1% of the exact ones, and I keep the exact count, mean,
+    minimum and maximum.
+
+    I only describe recent values: I keep two windows of 'window' seconds,
+    and at the end of each window, the older one is thrown away. So my
+    numbers cover between one and two windows' worth of values.
+
+    Histograms can be sent over the wire with to_wire(), and the ones from
+    several servers merged with add_wire(), which is how the StatsGatherer
+    computes grid-wide percentiles.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, clock=time.time):
+        self.window = window
+        self._clock = clock
+        self._current = _Window()
+        self._previous = _Window()
+        self._window_started = clock()
+
+    def _rotate(self):
+        now = self._clock()
+        elapsed = now - self._window_started
+        if elapsed < self.window:
+            return
+        if elapsed < 2*self.window:
+            self._previous = self._current
+        else:
+            self._previous = _Window()
+        self._current = _Window()
+        self._window_started = now - (elapsed % self.window)
+
+    def add(self, value):
+        self._rotate()
+        self._current.add(value, bucket_for(value))
+
+    def clear(self):
+        self._current = _Window()
+        self._previous = _Window()
+        self._window_started = self._clock()
+
+    def _combined(self):
+        self._rotate()
+        w = _Window()
+        for old in (self._previous, self._current):
+            w.add_window(old.count, old.total, old.min, old.max, old.buckets)
+        return w
+
+    def get_count(self):
+        self._rotate()
+        return self._previous.count + self._current.count
+
+    def get_mean(self):
+        w = self._combined()
+        if not w.count:
+            return None
+        return w.total / float(w.count)
+
+    def get_max(self):
+        return self._combined().max
+
+    def get_min(self):
+        return self._combined().min
+
+    def get_percentile(self, fraction):
+        """Return the value that 'fraction' (between 0 and 1) of my values
+        fall below, or None if I have none."""
+        return self._get_percentiles(self._combined(), [fraction])[0]
+
+    def _get_percentiles(self, w, fractions):
+        if not w.count:
+            return [None] * len(fractions)
+        # the same rank as sorted(samples)[int(fraction*count)]
+        ranks = [min(int(fraction * w.count), w.count - 1)
+                 for fraction in fractions]
+        results = {}
+        wanted = sorted(set(ranks))
+        seen = 0
+        for bucket in sorted(w.buckets):
+            seen += w.buckets[bucket]
+            while wanted and wanted[0] < seen:
+                value = bucket_value(bucket)
+                results[wanted.pop(0)] = min(max(value, w.min), w.max)
+            if not wanted:
+                break
+        return [results[rank] for rank in ranks]
+
+    def get_stats(self):
+        """Return a dict with 'samplesize', 'mean' and the PERCENTILES. A
+        percentile is None unless there are enough values to tell it apart
+        from its neighbours, and the mean is None for a single value."""
+        w = self._combined()
+        stats = {"samplesize": w.count}
+        if w.count > 1:
+            stats["mean"] = w.total / float(w.count)
+        else:
+            stats["mean"] = None
+        values = self._get_percentiles(w, [p[0] for p in PERCENTILES])
+        for ((fraction, name, minnumtoobserve), value) in zip(PERCENTILES,
+                                                              values):
+            if w.count >= minnumtoobserve:
+                stats[name] = value
+            else:
+                stats[name] = None
+        return stats
+
+    def to_wire(self):
+        """Return my values as (layout, count, total, min, max, buckets),
+        where buckets is a dict that maps bucket number to count."""
+        w = self._combined()
+        return (LAYOUT_VERSION, w.count, w.total, w.min, w.max, w.buckets)
+
+    def add_wire(self, wire):
+        """Add the values of another histogram, as returned by its
+        to_wire(), to my current window."""
+        (layout, count, total, minimum, maximum, buckets) = wire
+        if layout != LAYOUT_VERSION:
+            raise ValueError("cannot merge a histogram with bucket layout %r"
+                             " into one with layout %d"
+                             % (layout, LAYOUT_VERSION))
+        self._rotate()
+        self._current.add_window(count, total, minimum, maximum, buckets)
+
+    def merge(self, other):
+        self.add_wire(other.to_wire())
+
+def from_wire(wire, window=DEFAULT_WINDOW, clock=time.time):
+    h = LatencyHistogram(window, clock)
+    h.add_wire(wire)
+    return h
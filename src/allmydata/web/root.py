@@ -14,7 +14,8 @@ from allmydata.interfaces import IFileNode
 from allmydata.web import filenode, directory, unlinked, status, operations
 from allmydata.web import storage
 from allmydata.web.common import abbreviate_size, getxmlfile, WebError, \
-     get_arg, RenderMixin, get_format, get_mutable_type
+     get_arg, RenderMixin, get_format, get_mutable_type, abbreviate_time, \
+     abbreviate_rate
 
 
 class URIHandler(RenderMixin, rend.Page):
@@ -297,9 +298,25 @@ class Root(rend.Page):
                                                  time.localtime(announced)))
         ctx.fillSlots("version", version)
         ctx.fillSlots("service_name", service_name)
+        sb = self.client.get_storage_broker()
+        ctx.fillSlots("performance",
+                      self._describe_performance(sb.get_server_performance(server)))
 
         return ctx.tag
 
+    def _describe_performance(self, perf):
+        s = perf.get_stats()
+        if not s["requests"] and not s["outstanding"]:
+            return "no requests yet"
+        parts = []
+        if s["rtt"] is not None:
+            parts.append("RTT %s" % abbreviate_time(s["rtt"]))
+        if s["throughput"] is not None:
+            parts.append(abbreviate_rate(s["throughput"]))
+        parts.append("%d%% errors" % round(100 * s["error_rate"]))
+        parts.append("%d waiting" % s["outstanding"])
+        return ", ".join(parts)
+
     def render_download_form(self, ctx, data):
         # this is a form where users can download files by URI
         form = T.form(action="uri", method="get",
@@ -87,6 +87,9 @@ class UploadResultsRendererMixin(RateAndTimeMixin):
     def data_time_peer_selection(self, ctx, data):
         return self._get_time("peer_selection")
 
+    def data_time_cumulative_peer_selection(self, ctx, data):
+        return self._get_time("cumulative_peer_selection")
+
     def data_time_total_encode_and_push(self, ctx, data):
         return self._get_time("total_encode_and_push")
 
@@ -3,7 +3,7 @@ import time, simplejson
 from nevow import rend, tags as T, inevow
 from allmydata.web.common import getxmlfile, abbreviate_time, get_arg
 from allmydata.util.abbreviate import abbreviate_space
-from allmydata.util import time_format, idlib
+from allmydata.util import time_format, idlib, base32
 
 def remove_prefix(s, prefix):
     if not s.startswith(prefix):
@@ -32,6 +32,8 @@ class StorageStatus(rend.Page):
              "bucket-counter": self.storage.bucket_counter.get_state(),
              "lease-checker": self.storage.lease_checker.get_state(),
              "lease-checker-progress": self.storage.lease_checker.get_progress(),
+             "request-scheduler": self.storage.scheduler.get_client_stats(),
+             "corruption-advisories": self._get_advisories(),
              }
         return simplejson.dumps(d, indent=1) + "\n"
 
@@ -93,6 +95,10 @@ class StorageStatus(rend.Page):
         return d
 
     def data_last_complete_bucket_count(self, ctx, data):
+        # the live count, if the server knows it yet
+        count = self.storage.get_stats().get("storage_server.total_bucket_count")
+        if count is not None:
+            return count
         s = self.storage.bucket_counter.get_state()
         count = s.get("last-complete-bucket-count")
         if count is None:
@@ -128,6 +134,61 @@ class StorageStatus(rend.Page):
             return ["Next crawl in %s" % abbreviate_time(soon),
                     cycletime_s]
 
+    def render_scheduler_status(self, ctx, data):
+        s = self.storage.scheduler.get_stats()
+        if s["max_outstanding"]:
+            limit = ("at most %d requests run at once, and clients take turns"
+                     " when more are waiting" % s["max_outstanding"])
+        else:
+            limit = "every request starts as soon as it arrives"
+        return ctx.tag["Requests: %d running, %d waiting, %d started, "
+                       "%d refused (%s)" % (s["outstanding"], s["queued"],
+                                            s["dispatched"], s["rejected"],
+                                            limit)]
+
+    def render_scheduler_clients(self, ctx, data):
+        clients = self.storage.scheduler.get_client_stats()
+        if not clients:
+            return ""
+        t = T.table(border="1")
+        t[T.tr[T.th["Client"], T.th["Running"], T.th["Waiting"],
+               T.th["Completed"], T.th["Refused"]]]
+        for client in sorted(clients):
+            c = clients[client]
+            t[T.tr[T.td[client], T.td["%d" % c["outstanding"]],
+                   T.td["%d" % c["queued"]], T.td["%d" % c["completed"]],
+                   T.td["%d" % c["rejected"]]]]
+        return ctx.tag[t]
+
+    def _get_advisories(self, limit=None):
+        advisories = []
+        for a in self.storage.corruption_advisories.get_advisories(limit):
+            a = a.copy()
+            a["storage_index"] = base32.b2a(a["storage_index"])
+            advisories.append(a)
+        return advisories
+
+    def render_corruption_advisories_status(self, ctx, data):
+        s = self.storage.corruption_advisories.get_stats()
+        return ctx.tag["%d shares reported corrupt (%d reports received, %d"
+                       " dropped because their client sent too many)"
+                       % (s["shares"], s["reports"], s["dropped"])]
+
+    def render_corruption_advisories(self, ctx, data):
+        advisories = self._get_advisories(limit=20)
+        if not advisories:
+            return ""
+        t = T.table(border="1")
+        t[T.tr[T.th["Type"], T.th["Storage Index"], T.th["Share"],
+               T.th["Reports"], T.th["Latest Report"], T.th["Reason"]]]
+        for a in advisories:
+            reason = a["reason"].split("\n")[0]
+            t[T.tr[T.td[a["share_type"]], T.td[T.tt[a["storage_index"]]],
+                   T.td["%d" % a["shnum"]], T.td["%d" % a["count"]],
+                   T.td[time_format.iso_utc(a["last_seen"], sep=" ")],
+                   T.td[reason]]]
+        return ctx.tag[t]
+
     def render_lease_expiration_enabled(self, ctx, data):
         lc = self.storage.lease_checker
         if lc.expiration_enabled: